@@ -573,3 +573,11 @@ exclude_fields_on_paste = []
 # Useful if for some reason your operating systems network checking
 # facilities are not reliable (for example NetworkManager on Linux).
 skip_network_check = False
+
+#: Use compact storage for the in-memory copy of the library
+# calibre keeps a copy of all book metadata in memory. For very large
+# libraries (hundreds of thousands of books) this can use a lot of RAM. Set
+# this to True to store the data in compact arrays instead, which uses much
+# less memory at the cost of somewhat slower access. Needs a restart to take
+# effect.
+columnar_library_tables = False
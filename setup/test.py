@@ -44,6 +44,8 @@ def find_tests(which_tests=None):
         a(test(return_tests=True))
         from css_selectors.tests import find_tests
         a(find_tests())
+        from calibre.ebooks.oeb.transforms.parallel import find_tests
+        a(find_tests())
     if ok('docx'):
         from calibre.ebooks.docx.fields import test_parse_fields
         a(test_parse_fields(return_tests=True))
@@ -10,6 +10,7 @@ __docformat__ = 'restructuredtext en'
 # Imports {{{
 import os, shutil, uuid, json, glob, time, hashlib, errno, sys
 from functools import partial
+from collections import defaultdict
 
 import apsw
 from polyglot.builtins import reraise
@@ -19,7 +20,7 @@ from calibre.constants import (iswindows, filesystem_encoding,
         preferred_encoding)
 from calibre.ptempfile import PersistentTemporaryFile, TemporaryFile
 from calibre.db import SPOOL_SIZE
-from calibre.db.schema_upgrades import SchemaUpgrade
+from calibre.db.schema_upgrades import SchemaUpgrade, change_journal_triggers
 from calibre.db.delete_service import delete_service
 from calibre.db.errors import NoSuchFormat
 from calibre.library.field_metadata import FieldMetadata
@@ -31,7 +32,7 @@ from calibre.utils.date import utcfromtimestamp, parse_date
 from calibre.utils.filenames import (
     is_case_sensitive, samefile, hardlink_file, ascii_filename,
     WindowsAtomicFolderMove, atomic_rename, remove_dir_if_empty,
-    copytree_using_links, copyfile_using_links)
+    copytree_using_links, copyfile_using_links, replace_file)
 from calibre.utils.img import save_cover_data_to
 from calibre.utils.formatter_functions import (load_user_template_functions,
             unload_user_template_functions,
@@ -39,7 +40,7 @@ from calibre.utils.formatter_functions import (load_user_template_functions,
             formatter_functions)
 from calibre.db.tables import (OneToOneTable, ManyToOneTable, ManyToManyTable,
         SizeTable, FormatsTable, AuthorsTable, IdentifiersTable, PathTable,
-        CompositeTable, UUIDTable, RatingTable)
+        CompositeTable, UUIDTable, RatingTable, ONE_ONE)
 # }}}
 
 '''
@@ -344,6 +345,7 @@ class DB(object):
             traceback.print_exc()
 
         self.field_metadata = FieldMetadata()
+        self.columnar_tables = tweaks['columnar_library_tables']
 
         self.library_path = os.path.abspath(library_path)
         self.dbpath = os.path.join(library_path, 'metadata.db')
@@ -410,11 +412,98 @@ class DB(object):
         self.initialize_prefs(default_prefs, restore_all_prefs, progress_callback)
         self.initialize_custom_columns()
         self.initialize_tables()
+        self.initialize_change_journal()
         self.set_user_template_functions(compile_user_template_functions(
                                  self.prefs.get('user_template_functions', [])))
         if load_user_formatter_functions:
             set_global_state(self)
 
+    def initialize_change_journal(self):  # {{{
+        '''
+        The change journal is a table that is maintained by triggers (see
+        :func:`calibre.db.schema_upgrades.change_journal_triggers`) and records
+        which books were changed by every write to metadata.db, made by any
+        process. A running :class:`Cache` uses it to apply only the changes
+        made by other processes, see
+        :meth:`calibre.db.cache.Cache.apply_external_changes`. Here we map the
+        sqlite tables to the names of the in-memory tables that read from them.
+        '''
+        self.journal_seq = 0
+        self.journal_data_version = None
+        self.journal_book_tables = defaultdict(set)
+        self.journal_item_tables = defaultdict(set)
+        for name, table in self.tables.iteritems():
+            m = table.metadata
+            if table.table_type == ONE_ONE:
+                if m.get('table') and m.get('column') and m['datatype'] != 'composite':
+                    self.journal_book_tables[m['table']].add(name)
+            elif name == 'formats':
+                self.journal_book_tables['data'].add(name)
+            elif name == 'identifiers':
+                self.journal_book_tables['identifiers'].add(name)
+            else:
+                self.journal_book_tables[table.link_table].add(name)
+                self.journal_item_tables[m['table']].add(name)
+        self.journal_book_tables['data'].add('size')
+    # }}}
+
+    def current_journal_seq(self):
+        for (seq,) in self.execute('SELECT MAX(seq) FROM change_journal'):
+            return seq or 0
+        return 0
+
+    def data_version(self):
+        ''' A number that changes whenever another connection commits changes
+        to the db, but not when this connection does. '''
+        for (ans,) in self.execute('PRAGMA data_version'):
+            return ans
+
+    def sync_journal_seq(self):
+        ''' Mark all the entries in the journal as seen, must be called when
+        the in-memory data is known to match the db, in a transaction. '''
+        self.journal_seq = self.current_journal_seq()
+        self.journal_data_version = self.data_version()
+
+    def read_change_journal(self):
+        '''
+        Return the changes recorded in the change journal since the last call
+        to this method (or since the tables were last read) as a tuple: a dict
+        mapping sqlite table names to changed book (or item) ids and the set of
+        ids of deleted books. Returns None if the journal has been pruned past
+        the last seen entry, in which case the tables must be read in full.
+        Changes made by this process are already in the in-memory data, they
+        are skipped if no other process has written to the db in the meantime,
+        otherwise they are returned along with the changes from other processes.
+        '''
+        if self.data_version() == self.journal_data_version:
+            # Only this process has written to the db
+            self.journal_seq = self.current_journal_seq()
+            return defaultdict(set), set()
+        ans = self.changes_since(self.journal_seq)
+        if ans is not None:
+            changes, deleted, seq = ans
+            self.journal_seq = max(seq, self.journal_seq)
+            self.journal_data_version = self.data_version()
+            return changes, deleted
+
+    def changes_since(self, seq):
+        ''' Return the changes recorded in the change journal after seq as a
+        tuple (changes, deleted, last seq), see :meth:`read_change_journal`.
+        Returns None if the journal has been pruned past seq. '''
+        changes, deleted = defaultdict(set), set()
+        for (min_seq,) in self.execute('SELECT MIN(seq) FROM change_journal'):
+            if min_seq is not None and min_seq > seq + 1:
+                return None
+        for seq, tbl, book, op in self.execute(
+                'SELECT seq, tbl, book, op FROM change_journal WHERE seq > ? ORDER BY seq', (seq,)):
+            changes[tbl].add(book)
+            if tbl == 'books':
+                if op == 'delete':
+                    deleted.add(book)
+                else:
+                    deleted.discard(book)
+        return changes, deleted, seq
+
     def get_template_functions(self):
         return self._template_functions
 
@@ -1056,6 +1145,11 @@ class DB(object):
                         END;
                 '''.format(table=table),
             ]
+        if normalized:
+            lines.append(change_journal_triggers(table, 'id'))
+            lines.append(change_journal_triggers(lt, 'book'))
+        else:
+            lines.append(change_journal_triggers(table, 'book'))
         script = ' \n'.join(lines)
         self.execute(script)
         self.prefs.set('update_all_last_mod_dates_on_start', True)
@@ -1257,15 +1351,21 @@ class DB(object):
         '''
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
+            self.sync_journal_seq()
             for table in self.tables.itervalues():
                 try:
-                    table.read(self)
+                    self.read_table(table)
                 except:
                     prints('Failed to read table:', table.name)
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
 
+    def read_table(self, table):
+        table.read(self)
+        if self.columnar_tables:
+            table.use_columnar_storage()
+
     def format_abspath(self, book_id, fmt, fname, path):
         path = os.path.join(self.library_path, path)
         fmt = ('.' + fmt.lower()) if fmt else ''
@@ -1416,15 +1516,13 @@ class DB(object):
                     time.sleep(0.2)
                     os.remove(path)
         else:
-            if no_processing:
-                with lopen(path, 'wb') as f:
-                    f.write(data)
-            else:
-                try:
-                    save_cover_data_to(data, path)
-                except (IOError, OSError):
-                    time.sleep(0.2)
-                    save_cover_data_to(data, path)
+            if not no_processing:
+                data = save_cover_data_to(data, data_fmt='jpeg')
+            try:
+                replace_file(path, lambda f: f.write(data))
+            except (IOError, OSError):
+                time.sleep(0.2)
+                replace_file(path, lambda f: f.write(data))
 
     def copy_format_to(self, book_id, fmt, fname, path, dest,
                        windows_atomic_move=None, use_hardlink=False, report_file_size=None):
@@ -1516,9 +1614,10 @@ class DB(object):
                         traceback.print_exc()
 
         if (not getattr(stream, 'name', False) or not samefile(dest, stream.name)):
-            with lopen(dest, 'wb') as f:
+            def write_format(f):
                 shutil.copyfileobj(stream, f)
-                size = f.tell()
+                return f.tell()
+            size = replace_file(dest, write_format)
             if mtime is not None:
                 os.utime(dest, (mtime, mtime))
         elif os.path.exists(dest):
@@ -18,11 +18,13 @@ from calibre import isbytestring, as_unicode
 from calibre.constants import iswindows, preferred_encoding
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postimport, run_plugins_on_postadd
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
-from calibre.db.categories import get_categories
+from calibre.db.categories import get_categories, CategoryCache
+from calibre.db.composites import CompositeValueStore, changed_books_for_journal, set_composite_dependencies
 from calibre.db.locking import create_locks, DowngradeLockError, SafeReadLock
 from calibre.db.errors import NoSuchFormat, NoSuchBook
 from calibre.db.fields import create_field, IDENTITY, InvalidLinkTable
 from calibre.db.search import Search
+from calibre.db.sorting import CollationKeyCache, SortKeyCache
 from calibre.db.tables import VirtualTable
 from calibre.db.write import get_series_values, uniq
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
@@ -119,6 +121,12 @@ class Cache(object):
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        self.sort_key_cache = SortKeyCache()
+        self.category_cache = CategoryCache()
+        self.collation_keys = CollationKeyCache()
+        self.composite_store = None
+        self._fts_db = None
+        self.fts_indexer = None
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -210,16 +218,46 @@ class Cache(object):
     @write_api
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
+        self._set_composite_dependencies()
+
+    def _set_composite_dependencies(self):
+        set_composite_dependencies(self.composites, self.fields, self.field_metadata, self.backend.get_template_functions())
+        persistent = [f for f in self.composites.itervalues() if f.is_persistent]
+        if persistent and self.composite_store is None:
+            from calibre.constants import cache_dir
+            path = os.path.join(cache_dir(), 'composite-values', '%s.sqlite' % self.backend.library_id)
+            self.composite_store = CompositeValueStore(path, self._validate_composite_values)
+        for field in self.composites.itervalues():
+            field.value_store = self.composite_store if field.is_persistent else None
+            field.get_journal_seq = lambda: self.backend.journal_seq
+            field.clear_caches()
+
+    def _validate_composite_values(self, store):
+        # Called with the store locked, from inside the read_api or write_api
+        # that first needs the values of a composite column
+        store.validate(
+            self.backend.current_journal_seq(), self.backend.changes_since,
+            partial(changed_books_for_journal, backend=self.backend, fields=self.fields),
+            {f.template_hash:f.dependencies for f in self.composites.itervalues() if f.is_persistent})
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
+    def clear_composite_caches(self, book_ids=None, fields=None):
+        ''' Clear the rendered values of composite columns. If fields is
+        specified, only the columns whose templates refer to one of fields are
+        cleared. '''
         for field in self.composites.itervalues():
-            field.clear_caches(book_ids=book_ids)
+            field.clear_caches(book_ids=book_ids, fields=fields)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, fields)
+
+    @read_api
+    def search_cache_stats(self):
+        ''' Return a dict with the hit, miss, eviction and invalidation
+        counts and the memory used by the search result cache. '''
+        return self._search_api.cache.stats()
 
     @read_api
     def last_modified(self):
@@ -232,11 +270,14 @@ class Cache(object):
         for field in self.fields.itervalues():
             if hasattr(field, 'clear_caches'):
                 field.clear_caches(book_ids=book_ids)  # Clear the composite cache and ondevice caches
+        self.sort_key_cache.invalidate(book_ids)
+        self.category_cache.invalidate(book_ids)
         if book_ids:
             for book_id in book_ids:
                 self.format_metadata_cache.pop(book_id, None)
         else:
             self.format_metadata_cache.clear()
+            self._search_api.search_index.clear()
         if search_cache:
             self._clear_search_caches(book_ids)
 
@@ -245,11 +286,51 @@ class Cache(object):
         if clear_caches:
             self._clear_caches()
         with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
+            self.backend.sync_journal_seq()
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
             for field in self.fields.itervalues():
                 if hasattr(field, 'table'):
-                    field.table.read(self.backend)  # Reread data from metadata.db
+                    self.backend.read_table(field.table)  # Reread data from metadata.db
+
+    @write_api
+    def apply_external_changes(self):
+        '''
+        Update the in-memory data with changes made to metadata.db by other
+        processes, for example, calibredb, since the data was last read. Unlike
+        :meth:`reload_from_db` only the changed books are re-read, using the
+        change journal maintained by the database. Changes made by this
+        process are skipped, see
+        :meth:`calibre.db.backend.DB.read_change_journal`. Returns the set
+        of ids of changed books or None if a full reload was needed.
+        '''
+        with self.backend.conn:
+            changes = self.backend.read_change_journal()
+            if changes is None:
+                self._reload_from_db()
+                return
+            changes, deleted = changes
+            tables = {name:field.table for name, field in self.fields.iteritems() if hasattr(field, 'table')}
+            changed_books = set(deleted)
+            for dbtable, book_ids in changes.iteritems():
+                if dbtable not in self.backend.journal_book_tables:
+                    continue
+                changed_books |= book_ids
+                for name in self.backend.journal_book_tables[dbtable]:
+                    tables[name].refresh_books(book_ids, self.backend)
+            if deleted:
+                for table in tables.itervalues():
+                    table.refresh_books(deleted, self.backend)
+            for dbtable, item_ids in changes.iteritems():
+                for name in self.backend.journal_item_tables.get(dbtable, ()):
+                    changed_books |= tables[name].refresh_items(item_ids, self.backend)
+            for table in tables.itervalues():
+                table.compact_storage()
+        if changed_books:
+            self._clear_caches(book_ids=changed_books)
+            for book_id in deleted:
+                self.dirtied_cache.pop(book_id, None)
+        return changed_books
 
     @property
     def field_metadata(self):
@@ -318,16 +399,21 @@ class Cache(object):
         mi.application_id = book_id
         mi.id = book_id
         composites = []
+        user_metadata = mi.get_all_user_metadata(make_copy=False)
         for key, meta in self.field_metadata.custom_iteritems():
-            mi.set_user_metadata(key, meta)
+            # Equivalent to mi.set_user_metadata() followed by mi.set(), but
+            # avoids their overhead, which adds up for libraries with many
+            # custom columns. The values in meta are shared, not copied.
+            um = user_metadata[key] = dict(meta)
             if meta['datatype'] == 'composite':
+                um['#value#'] = None
                 composites.append(key)
             else:
                 val = self._field_for(key, book_id)
                 if isinstance(val, tuple):
                     val = list(val)
-                extra = self._field_for(key+'_index', book_id)
-                mi.set(key, val=val, extra=extra)
+                um['#value#'] = val
+                um['#extra#'] = self._field_for(key+'_index', book_id)
         for key in composites:
             mi.set(key, val=self._composite_for(key, book_id, mi))
 
@@ -379,6 +465,10 @@ class Cache(object):
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+                field.use_collation_key_cache(self.collation_keys)
+            from calibre.constants import cache_dir
+            self.collation_keys.path = os.path.join(cache_dir(), 'sort-keys', '%s.msgpack' % self.backend.library_id)
+            self._set_composite_dependencies()
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -920,8 +1010,15 @@ class Cache(object):
         '''
         ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
         virtual_fields = virtual_fields or {}
+        if not self.collation_keys.loaded:
+            self.collation_keys.load()
+        lang_maps = []
+
+        def lang_map():
+            if not lang_maps:
+                lang_maps.append(self.fields['languages'].book_value_map)
+            return lang_maps[0]
 
         fm = {'title':'sort', 'authors':'author_sort'}
 
@@ -930,51 +1027,46 @@ class Cache(object):
             idx = field + '_index'
             is_series = idx in self.fields
             try:
-                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map())
             except KeyError:
                 if field == 'id':
                     return IDENTITY
                 else:
-                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map())
             if is_series:
-                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map)
+                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map())
 
                 def skf(book_id):
                     return (func(book_id), idx_func(book_id))
                 return skf
             return func
 
+        def sort_dependencies(field):
+            ''' The fields whose values the sort keys for field are calculated
+            from, or None if the sort keys cannot be cached '''
+            f = self.fields.get(fm.get(field, field))
+            if f is None or f.is_composite or isinstance(f.table, VirtualTable):
+                return None
+            ans = {f.name}
+            if field + '_index' in self.fields:
+                ans |= {field + '_index', 'languages'}
+            return ans
+
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
 
-        if len(fields) == 1:
-            return sorted(ids_to_sort, key=sort_key_func(fields[0][0]),
-                          reverse=not fields[0][1])
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey(object):
-
-            __slots__ = ('book_id', 'sort_key')
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def __cmp__(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-        return sorted(ids_to_sort, key=SortKey)
+        # Sort by the least significant field first, relying on the sort being
+        # stable (even when reversed). The sort keys for cacheable fields are
+        # replaced by the precomputed ranks of the books.
+        ans = list(ids_to_sort)
+        for field, ascending in reversed(fields):
+            deps = sort_dependencies(field)
+            if deps is None:
+                key = sort_key_func(field)
+            else:
+                key = self.sort_key_cache.ranks_for(field, deps, partial(sort_key_func, field), ans).__getitem__
+            ans.sort(key=key, reverse=not ascending)
+        return ans
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
@@ -1021,19 +1113,25 @@ class Cache(object):
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, fields=None):
+        ''' fields is the set of fields that were changed, used to limit the
+        search results that need to be updated, None means any field. '''
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
+            if fields is not None:
+                fields = set(fields) | {'last_modified'}
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, fields)
+            self.sort_key_cache.invalidate(book_ids, fields)
+            self.category_cache.invalidate(book_ids, fields)
+            self._clear_search_caches(book_ids, fields)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, fields=None):
+        self._update_last_modified(book_ids, fields=fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1098,10 +1196,25 @@ class Cache(object):
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
 
-        self._mark_as_dirty(dirtied)
+        self._mark_as_dirty(dirtied, fields=self._fields_changed_by(name))
 
         return dirtied
 
+    def _fields_changed_by(self, name):
+        # The fields whose values can change when the field name is set
+        ans = {name, 'path'}
+        f = self.fields[name]
+        if f.metadata['datatype'] == 'series':
+            ans.add(name + '_index')
+        elif name.endswith('_index') and name[:-len('_index')] in self.fields:
+            # Setting a series index can remove the series (see remove_items())
+            ans.add(name[:-len('_index')])
+        if name == 'title':
+            ans.add('sort')
+        elif name == 'authors':
+            ans.add('author_sort')
+        return ans
+
     @write_api
     def update_path(self, book_ids, mark_as_dirtied=True):
         for book_id in book_ids:
@@ -1414,7 +1527,9 @@ class Cache(object):
 
             max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
             self.fields['size'].table.update_sizes({book_id: max_size})
-            self._update_last_modified((book_id,))
+            self._update_last_modified((book_id,), fields=('formats', 'size'))
+            if self._is_fts_enabled():
+                self.fts_db.dirty_formats(((book_id, fmt),))
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -1458,7 +1573,9 @@ class Cache(object):
 
         size_map = table.remove_formats(formats_map, self.backend)
         self.fields['size'].table.update_sizes(size_map)
-        self._update_last_modified(tuple(formats_map.iterkeys()))
+        self._update_last_modified(tuple(formats_map.iterkeys()), fields=('formats', 'size'))
+        if self._is_fts_enabled():
+            self.fts_db.remove_formats(formats_map)
 
     @read_api
     def get_next_series_num_for(self, series, field='series', current_indices=False):
@@ -1576,6 +1693,8 @@ class Cache(object):
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        # A new book can match cached queries on any field
+        self._clear_search_caches({book_id})
 
         return book_id
 
@@ -1629,10 +1748,13 @@ class Cache(object):
                 continue  # Some fields like ondevice do not have tables
             else:
                 table.remove_books(book_ids, self.backend)
+                table.compact_storage()
         self._search_api.discard_books(book_ids)
         self._clear_caches(book_ids=book_ids, template_cache=False, search_cache=False)
         for cc in self.cover_caches:
             cc.invalidate(book_ids)
+        if self._is_fts_enabled():
+            self.fts_db.remove_books(book_ids)
 
     @read_api
     def author_sort_strings_for_books(self, book_ids):
@@ -1740,7 +1862,8 @@ class Cache(object):
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, fields=self._fields_changed_by(field))
+        f.table.compact_storage()
         return affected_books, id_map
 
     @write_api
@@ -1754,11 +1877,12 @@ class Cache(object):
             restrict_to_book_ids = frozenset(restrict_to_book_ids)
         affected_books = field.table.remove_items(item_ids, self.backend,
                                                   restrict_to_book_ids=restrict_to_book_ids)
+        field.table.compact_storage()
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
             else:
-                self._mark_as_dirty(affected_books)
+                self._mark_as_dirty(affected_books, fields=(field.name,))
         return affected_books
 
     @write_api
@@ -1816,7 +1940,7 @@ class Cache(object):
     def refresh_ondevice(self):
         self.fields['ondevice'].clear_caches()
         self.clear_search_caches()
-        self.clear_composite_caches()
+        self.clear_composite_caches(fields=('ondevice',))
 
     @read_api
     def tags_older_than(self, tag, delta=None, must_have_tag=None, must_have_authors=None):
@@ -1869,6 +1993,9 @@ class Cache(object):
     @write_api
     def set_sort_for_authors(self, author_id_to_sort_map, update_books=True):
         sort_map = self.fields['authors'].table.set_sort_names(author_id_to_sort_map, self.backend)
+        if sort_map:
+            # The sort values of the authors are used in the Tag Browser
+            self.category_cache.invalidate(fields=('authors',))
         changed_books = set()
         if update_books:
             val_map = {}
@@ -2052,6 +2179,138 @@ class Cache(object):
     def vacuum(self):
         self.backend.vacuum()
 
+    # Full text search {{{
+
+    @property
+    def fts_db(self):
+        if self._fts_db is None:
+            from calibre.db.fts import FTSDatabase
+            self._fts_db = FTSDatabase(self.backend.library_path)
+        return self._fts_db
+
+    @read_api
+    def is_fts_enabled(self):
+        return bool(self.backend.prefs.get('fts_enabled', False))
+
+    @write_api
+    def enable_fts(self, enabled=True):
+        ''' Turn full text indexing of the book files on or off. When turned
+        on, all existing book files are queued for indexing. The indexing
+        happens in the background, see :meth:`start_fts_indexer`. When turned
+        off the full text index is deleted. '''
+        self.backend.prefs.set('fts_enabled', bool(enabled))
+        if enabled:
+            fmap = self.fields['formats'].table.book_col_map
+            self.fts_db.dirty_formats((book_id, fmt) for book_id, fmts in fmap.iteritems() for fmt in fmts)
+        else:
+            self._stop_fts_indexer()
+            fts, self._fts_db = self.fts_db, None
+            fts.close()
+            try:
+                os.remove(fts.dbpath)
+            except EnvironmentError:
+                pass
+
+    @write_api
+    def reindex_fts(self):
+        ''' Discard the full text index and queue all book files for indexing
+        again. Does nothing if full text search is not enabled. '''
+        if not self._is_fts_enabled():
+            return
+        self.fts_db.clear()
+        fmap = self.fields['formats'].table.book_col_map
+        self.fts_db.dirty_formats((book_id, fmt) for book_id, fmts in fmap.iteritems() for fmt in fmts)
+
+    @write_api
+    def start_fts_indexer(self, num_workers=1):
+        ''' Start the background threads that extract text from the book
+        files and index it. Does nothing if full text search is not enabled.
+        Returns the :class:`calibre.db.fts.FTSIndexer` or None. '''
+        if not self._is_fts_enabled():
+            return
+        if self.fts_indexer is None or not self.fts_indexer.is_alive():
+            from calibre.db.fts import FTSIndexer
+            self.fts_indexer = FTSIndexer(self, num_workers=num_workers)
+            self.fts_indexer.start()
+        return self.fts_indexer
+
+    def _stop_fts_indexer(self):
+        if self.fts_indexer is not None:
+            # Do not join, the indexer threads might be waiting for the lock
+            self.fts_indexer.stop()
+            self.fts_indexer = None
+
+    @write_api
+    def get_next_fts_job(self):
+        ''' Used by the indexer. Return (job_id, book_id, fmt, path, size)
+        for the next book file to index, or None. '''
+        if not self._is_fts_enabled():
+            return
+        fts = self.fts_db
+        while True:
+            job = fts.next_job()
+            if job is None:
+                return
+            job_id, book_id, fmt = job
+            path = self._format_abspath(book_id, fmt)
+            if path:
+                try:
+                    size = os.path.getsize(path)
+                except EnvironmentError:
+                    pass
+                else:
+                    return job_id, book_id, fmt, path, size
+            # The format no longer exists
+            fts.cancel_job(job_id)
+
+    @write_api
+    def release_fts_job(self, job_id):
+        if self._fts_db is not None:
+            self._fts_db.release_job(job_id)
+
+    @write_api
+    def commit_fts_result(self, job_id, book_id, fmt, size, text, err_msg=None):
+        ''' Used by the indexer to store the text extracted from a book file '''
+        if self._is_fts_enabled() and fmt in self.fields['formats'].table.book_col_map.get(book_id, ()):
+            self.fts_db.commit_result(job_id, book_id, fmt, size, text, err_msg)
+        elif self._fts_db is not None:
+            self._fts_db.cancel_job(job_id)
+
+    @read_api
+    def fts_indexing_progress(self):
+        ''' Return (number of book files waiting to be indexed, number of
+        book files indexed). '''
+        if not self._is_fts_enabled():
+            return 0, 0
+        return self.fts_db.indexing_progress()
+
+    @read_api
+    def fts_search(self, query, restrict_to_book_ids=None, return_text=True, highlight_start='\x1d', highlight_end='\x1d', snippet_size=32):
+        '''
+        Search the text of the book files. The query uses the SQLite FTS5
+        query syntax. Returns a tuple of dicts of the form ``{'book_id':
+        book_id, 'format': fmt, 'text': snippet}``, best matches first. The
+        matched words in the snippet are surrounded by highlight_start and
+        highlight_end. Raises ValueError if the query is invalid.
+
+        :param restrict_to_book_ids: An optional set of book ids to restrict the search to
+        :param return_text: If False, the snippets are not generated, which is faster
+        '''
+        if not self._is_fts_enabled():
+            return ()
+        import apsw
+        try:
+            results = tuple(self.fts_db.search(
+                query, book_ids=restrict_to_book_ids, return_text=return_text, highlight_start=highlight_start,
+                highlight_end=highlight_end, snippet_size=snippet_size))
+        except apsw.SQLError as err:
+            raise ValueError(_('Invalid full text search query: {0} ({1})').format(query, as_unicode(err)))
+        for r in results:
+            del r['id']
+        return results
+
+    # }}}
+
     @write_api
     def close(self):
         from calibre.customize.ui import available_library_closed_plugins
@@ -2061,6 +2320,16 @@ class Cache(object):
             except Exception:
                 import traceback
                 traceback.print_exc()
+        self._stop_fts_indexer()
+        if self._fts_db is not None:
+            self._fts_db.close()
+        try:
+            self.collation_keys.save()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        if self.composite_store is not None:
+            self.composite_store.close()
         self.backend.close()
 
     @write_api
@@ -9,6 +9,7 @@ __docformat__ = 'restructuredtext en'
 
 import copy
 from functools import partial
+from threading import Lock
 from polyglot.builtins import map
 
 from calibre.ebooks.metadata import author_to_author_sort
@@ -65,6 +66,70 @@ class Tag(object):
         return ans
 
 
+class CategoryItems(object):
+
+    __slots__ = ('items', 'dirty', 'dependencies')
+
+    def __init__(self, dependencies):
+        self.items = {}
+        self.dirty = set()
+        self.dependencies = dependencies
+
+
+class CategoryCache(object):
+
+    '''
+    Caches the per item data (number of books, name, sort value and average
+    rating) used to build the Tag Browser categories, for every category. When
+    books are changed, only the items they are linked to are recalculated,
+    instead of every item in the category. Restricting the categories to a
+    virtual library is done by intersecting the cached book id sets.
+    '''
+
+    MAX_DIRTY = 50000
+
+    def __init__(self):
+        self.fields = {}
+        # Categories are calculated with only the read lock held
+        self.lock = Lock()
+
+    def clear(self):
+        with self.lock:
+            self.fields.clear()
+
+    def invalidate(self, book_ids=None, fields=None):
+        ''' Invalidate the items linked to book_ids (None means all books) in
+        the categories that depend on any of fields (None means any field) '''
+        if book_ids is None and fields is None:
+            return self.clear()
+        with self.lock:
+            for name, ci in tuple(self.fields.iteritems()):
+                if fields is None or not ci.dependencies.isdisjoint(fields):
+                    if book_ids is None:
+                        del self.fields[name]
+                    else:
+                        ci.dirty.update(book_ids)
+                        if len(ci.dirty) > self.MAX_DIRTY:
+                            # Cheaper to start afresh
+                            del self.fields[name]
+
+    def categories_for(self, field, dependencies, get_categories):
+        ''' Return get_categories(cached) where cached is the dict of item data
+        for field, from which the items linked to changed books have been
+        removed. '''
+        with self.lock:
+            ci = self.fields.get(field.name)
+            if ci is None or ci.dependencies != dependencies:
+                ci = self.fields[field.name] = CategoryItems(dependencies)
+            if ci.dirty:
+                items = ci.items
+                for book_id in ci.dirty:
+                    for item_id in field.ids_for_book(book_id):
+                        items.pop(item_id, None)
+                ci.dirty = set()
+            return get_categories(ci.items)
+
+
 def find_categories(field_metadata):
     for category, cat in field_metadata.iteritems():
         if (cat['is_category'] and cat['kind'] not in {'user', 'search'}):
@@ -159,15 +224,17 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
             cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
         else:
             cat = fm[category]
-            brm = book_rating_map
+            brm, rating_field = book_rating_map, 'rating'
             dt = cat['datatype']
             if dt == 'rating':
                 if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                    brm, rating_field = dbcache.fields[category].book_value_map, category
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
-            cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
+            field = dbcache.fields[category]
+            cats = dbcache.category_cache.categories_for(
+                field, frozenset((category, rating_field, 'languages')),
+                partial(field.get_categories, tag_class, brm, lang_map, book_ids))
             if (category != 'authors' and dt == 'text' and
                 cat['is_multiple'] and cat['display'].get('is_names', False)):
                 for item in cats:
@@ -176,14 +243,18 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
         categories[category] = cats
 
     # Needed for legacy databases that have multiple ratings that
-    # map to n stars
+    # map to n stars. The id_sets can be shared with the tables, so they must
+    # not be modified in place.
+    ratings, seen = [], {}
     for r in categories['rating']:
-        for x in tuple(categories['rating']):
-            if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
-                r.count = len(r.id_set)
-                categories['rating'].remove(x)
-                break
+        x = seen.get(r.name)
+        if x is None:
+            seen[r.name] = r
+            ratings.append(r)
+        else:
+            x.id_set = x.id_set | r.id_set
+            x.count = len(x.id_set)
+    categories['rating'] = ratings
 
     # User categories
     user_categories = clean_user_categories(dbcache).copy()
@@ -226,7 +297,7 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
                             # average rating
                             t = names_seen[n]
                             other_tag = taglist[label][n]
-                            t.id_set |= other_tag.id_set
+                            t.id_set = t.id_set | other_tag.id_set
                             t.count = len(t.id_set)
                             t.original_categories.add(other_tag.category)
 
@@ -240,8 +311,10 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
                             if total_rating and count:
                                 t.avg_rating = total_rating/count
                         else:
-                            # Must deepcopy so we don't share the id_set between nodes
-                            t = copy.deepcopy(taglist[label][n])
+                            # Must copy so we don't share the node with the
+                            # source category, the id_set is never modified in
+                            # place
+                            t = copy.copy(taglist[label][n])
                             t.original_categories = {t.category}
                             names_seen[n] = t
                             items.append(t)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from calibre import prints
+
+readonly = False
+version = 0  # change this if you change signature of implementation()
+
+
+def implementation(db, notify_changes, action, num_workers=1):
+    if action == 'status':
+        return db.is_fts_enabled(), db.fts_indexing_progress()
+    if action == 'enable':
+        if not db.is_fts_enabled():
+            db.enable_fts()
+        db.start_fts_indexer(num_workers=num_workers)
+    elif action == 'disable':
+        db.enable_fts(False)
+    elif action == 'reindex':
+        if not db.is_fts_enabled():
+            return False, (0, 0)
+        db.reindex_fts()
+        db.start_fts_indexer(num_workers=num_workers)
+    return db.is_fts_enabled(), db.fts_indexing_progress()
+
+
+def option_parser(get_parser, args):
+    parser = get_parser(
+        _(
+            '''\
+%prog fts_index [options] {0}
+
+Control the full text indexing of the books in the library, used by the
+{1} command and the fulltext: search.
+
+    {2} - Turn on full text indexing and queue all book files for indexing
+    {3} - Turn off full text indexing and delete the index
+    {4} - Discard the index and index all book files again
+    {5} - Show the indexing progress
+
+The indexing happens in the background, in the program that has the library
+open, for example, the calibre GUI or the content server. When running
+against a library directly, use the --wait-for-completion option to index the
+books before this command exits.
+'''
+        ).format('enable/disable/reindex/status', 'fts_search', 'enable', 'disable', 'reindex', 'status')
+    )
+    parser.add_option(
+        '--wait-for-completion',
+        default=False,
+        action='store_true',
+        help=_('Wait until all book files have been indexed, showing the indexing progress')
+    )
+    parser.add_option(
+        '--indexing-workers',
+        type='int',
+        default=1,
+        help=_('The number of book files to index in parallel. Default: %default')
+    )
+    return parser
+
+
+def show_progress(left, done):
+    prints(_('Book files indexed: {0}, waiting to be indexed: {1}').format(done, left))
+
+
+def main(opts, args, dbctx):
+    if len(args) < 1 or args[0] not in ('enable', 'disable', 'reindex', 'status'):
+        raise SystemExit(_('Error: You must specify the action, one of: {}').format('enable, disable, reindex, status'))
+    action = args[0]
+    enabled, (left, done) = dbctx.run('fts_index', action, max(1, opts.indexing_workers))
+    if not enabled:
+        if action == 'reindex':
+            raise SystemExit(_('Full text searching is not enabled for this library'))
+        prints(_('Full text searching is not enabled for this library'))
+        return 0
+    if opts.wait_for_completion and action in ('enable', 'reindex'):
+        last = None
+        while left > 0:
+            if (left, done) != last:
+                show_progress(left, done)
+                last = left, done
+            time.sleep(1)
+            enabled, (left, done) = dbctx.run('fts_index', 'status')
+            if not enabled:
+                raise SystemExit(_('Full text searching was turned off for this library'))
+    show_progress(left, done)
+    return 0
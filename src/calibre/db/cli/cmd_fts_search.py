@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from calibre import prints
+
+readonly = True
+version = 0  # change this if you change signature of implementation()
+
+
+def implementation(db, notify_changes, action, *args):
+    if action == 'search':
+        query, include_snippets, restrict_to = args
+        book_ids = db.search(restrict_to) if restrict_to else None
+        results = db.fts_search(
+            query, restrict_to_book_ids=book_ids, return_text=include_snippets,
+            highlight_start='>>', highlight_end='<<')
+        titles = {r['book_id']: db.field_for('title', r['book_id']) for r in results}
+        return results, titles
+    if action == 'status':
+        return db.is_fts_enabled(), db.fts_indexing_progress()
+
+
+def option_parser(get_parser, args):
+    parser = get_parser(
+        _(
+            '''\
+%prog fts_search [options] search expression
+
+Search the text of the books in the library, using the full text index. The
+search expression uses the SQLite FTS5 query syntax, for example: {0}
+
+Full text indexing must have been enabled for the library, with the {1}
+command, and the books must have been indexed, for results to be found. Use
+--status to see the indexing progress.
+'''
+        ).format('"dark side" AND moon', 'fts_index')
+    )
+    parser.add_option(
+        '-s',
+        '--include-snippets',
+        default=False,
+        action='store_true',
+        help=_('Include snippets of the text surrounding each match')
+    )
+    parser.add_option(
+        '-r',
+        '--restrict-to',
+        default='',
+        help=_('Restrict the searched books, using a normal search expression. For example: {}').format('tags:science')
+    )
+    parser.add_option(
+        '--output-format',
+        choices=('text', 'json'),
+        default='text',
+        help=_('The format to output the search results in. Either "%default" for plain text or "json" for JSON output.')
+    )
+    parser.add_option(
+        '--status',
+        default=False,
+        action='store_true',
+        help=_('Show the status of the full text index, instead of searching')
+    )
+    return parser
+
+
+def main(opts, args, dbctx):
+    if opts.status:
+        enabled, (left, done) = dbctx.run('fts_search', 'status')
+        if not enabled:
+            prints(_('Full text searching is not enabled for this library'))
+        else:
+            prints(_('Book files indexed: {0}, waiting to be indexed: {1}').format(done, left))
+        return 0
+    if len(args) < 1:
+        raise SystemExit(_('Error: You must specify the search expression'))
+    q = ' '.join(args)
+    st = time.time()
+    try:
+        results, titles = dbctx.run('fts_search', 'search', q, opts.include_snippets, opts.restrict_to)
+    except ValueError as err:
+        raise SystemExit(err.args[0] if err.args else repr(err))
+    if opts.output_format == 'json':
+        import json
+        for r in results:
+            r['title'] = titles.get(r['book_id'], '')
+        prints(json.dumps(results, indent=2))
+        return 0
+    if not results:
+        raise SystemExit(_('No books matching the search expression:') + ' ' + q)
+    for r in results:
+        prints('{0} [{1}] {2}'.format(r['book_id'], r['format'], titles.get(r['book_id'], '')))
+        if opts.include_snippets and r.get('text'):
+            prints('\t' + r['text'].replace('\n', ' '))
+    prints(_('{0} results in {1:.2f} seconds').format(len(results), time.time() - st))
+    return 0
@@ -0,0 +1,405 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+'''
+Compact, array backed replacements for the dicts used by the in-memory
+tables in :mod:`calibre.db.tables`. For large libraries the per entry overhead
+of dicts, sets and boxed integers dominates the memory used by the tables. The
+classes here store the same data in dense book id indexed arrays and CSR
+(offsets + indices) arrays, while exposing the subset of the dict API that the
+rest of calibre.db uses, so that the tables can be switched transparently.
+
+Mutations are stored in small overlay dicts on top of the compact base
+arrays, since edits are rare compared to the size of the library. Calling
+compact() folds the overlay back into the arrays, maybe_compact() does so
+once the overlay has grown large, see :func:`overlay_is_large`.
+'''
+
+from array import array
+
+MISSING_ID = -1
+MIN_OVERLAY_SIZE = 1024
+_null = object()
+
+
+def overlay_is_large(overlay_size, base_size):
+    # Rebuilding the arrays costs time proportional to their size, so only do
+    # it once the overlay holds a quarter as many entries, which amortizes the
+    # cost over the changes that filled the overlay
+    return overlay_size > max(MIN_OVERLAY_SIZE, base_size // 4)
+
+
+def max_key(keys):
+    return max(keys) if keys else -1
+
+
+class BookColumn(object):
+
+    '''
+    A mapping of book_id -> value stored as a dense array indexed by book_id.
+    When is_int is True, values must be non-negative integers (for example
+    item ids) and are stored unboxed in a typed array.
+    '''
+
+    __slots__ = ('data', 'count', 'is_int')
+
+    def __init__(self, src=None, is_int=False):
+        self.is_int = is_int
+        src = src or {}
+        self.data = self._empty(max_key(src) + 1)
+        data = self.data
+        for k, v in src.iteritems():
+            data[k] = v
+        self.count = len(src)
+
+    def _empty(self, size):
+        if self.is_int:
+            return array(b'l', [MISSING_ID]) * size
+        return [_null] * size
+
+    def _is_missing(self, val):
+        return val == MISSING_ID if self.is_int else val is _null
+
+    def get(self, key, default=None):
+        if key < 0:
+            return default
+        try:
+            ans = self.data[key]
+        except (IndexError, TypeError):
+            return default
+        return default if self._is_missing(ans) else ans
+
+    def __getitem__(self, key):
+        ans = self.get(key, _null)
+        if ans is _null:
+            raise KeyError(key)
+        return ans
+
+    def __setitem__(self, key, val):
+        if key < 0:
+            raise KeyError(key)
+        if key >= len(self.data):
+            self.data.extend(self._empty(key + 1 - len(self.data)))
+        if self._is_missing(self.data[key]):
+            self.count += 1
+        self.data[key] = val
+
+    def pop(self, key, default=_null):
+        ans = self.get(key, _null)
+        if ans is _null:
+            if default is _null:
+                raise KeyError(key)
+            return default
+        self.data[key] = MISSING_ID if self.is_int else _null
+        self.count -= 1
+        return ans
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.get(key, _null) is not _null
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+    __bool__ = __nonzero__
+
+    def update(self, other):
+        for k, v in getattr(other, 'iteritems', other.items)():
+            self[k] = v
+
+    def iteritems(self):
+        if self.is_int:
+            for k, v in enumerate(self.data):
+                if v != MISSING_ID:
+                    yield k, v
+        else:
+            for k, v in enumerate(self.data):
+                if v is not _null:
+                    yield k, v
+
+    def iterkeys(self):
+        for k, v in self.iteritems():
+            yield k
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for k, v in self.iteritems():
+            yield v
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def compact(self):
+        last = len(self.data)
+        while last > 0 and self._is_missing(self.data[last - 1]):
+            last -= 1
+        del self.data[last:]
+
+
+class LinkColumn(object):
+
+    '''
+    A mapping of book_id -> tuple of item ids stored in CSR form: the item ids
+    for book_id are indices[offsets[book_id]:offsets[book_id+1]]. Books that
+    are changed after construction are stored in an overlay dict.
+    '''
+
+    __slots__ = ('offsets', 'indices', 'overlay', 'count')
+
+    def __init__(self, src=None):
+        self.build(src or {})
+
+    def build(self, src):
+        size = max_key(src) + 1
+        self.offsets = offsets = array(b'l', [0]) * (size + 1)
+        self.indices = indices = array(b'l')
+        pos = 0
+        for book_id in xrange(size):
+            offsets[book_id] = pos
+            vals = src.get(book_id)
+            if vals:
+                indices.extend(vals)
+                pos += len(vals)
+        offsets[size] = pos
+        self.overlay = {}
+        self.count = sum(1 for v in src.itervalues() if v)
+
+    def _base(self, key):
+        try:
+            start, end = self.offsets[key], self.offsets[key + 1]
+        except (IndexError, TypeError):
+            return None
+        if key < 0 or start == end:
+            return None
+        return tuple(self.indices[start:end])
+
+    def get(self, key, default=None):
+        ans = self.overlay.get(key, _null)
+        if ans is _null:
+            ans = self._base(key)
+            if ans is None:
+                return default
+        elif ans is None:
+            return default
+        return ans
+
+    def __getitem__(self, key):
+        ans = self.get(key, _null)
+        if ans is _null:
+            raise KeyError(key)
+        return ans
+
+    def __contains__(self, key):
+        return self.get(key, _null) is not _null
+
+    has_key = __contains__
+
+    def __setitem__(self, key, val):
+        if key not in self:
+            self.count += 1
+        self.overlay[key] = tuple(val)
+
+    def pop(self, key, default=_null):
+        ans = self.get(key, _null)
+        if ans is _null:
+            if default is _null:
+                raise KeyError(key)
+            return default
+        # None in the overlay masks the value in the base arrays
+        self.overlay[key] = None
+        self.count -= 1
+        return ans
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+    __bool__ = __nonzero__
+
+    def update(self, other):
+        for k, v in getattr(other, 'iteritems', other.items)():
+            self[k] = v
+
+    def iteritems(self):
+        overlay, offsets, indices = self.overlay, self.offsets, self.indices
+        for book_id in xrange(len(offsets) - 1):
+            if book_id in overlay:
+                continue
+            start, end = offsets[book_id], offsets[book_id + 1]
+            if start != end:
+                yield book_id, tuple(indices[start:end])
+        for book_id, val in overlay.items():
+            if val is not None:
+                yield book_id, val
+
+    def iterkeys(self):
+        for k, v in self.iteritems():
+            yield k
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for k, v in self.iteritems():
+            yield v
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def compact(self):
+        self.build(self.copy())
+
+    def maybe_compact(self):
+        if overlay_is_large(len(self.overlay), self.count):
+            self.compact()
+            return True
+        return False
+
+
+class BookSetMap(object):
+
+    '''
+    A mapping of item_id -> set of book ids, stored in CSR form. Sets are only
+    materialized when requested. Sets requested via ``map[item_id]`` are kept
+    in an overlay, since callers use that form to mutate them, mirroring the
+    behavior of the defaultdict(set) it replaces. Sets returned by get() must
+    be treated as read only, as with the original dict.
+    '''
+
+    __slots__ = ('item_pos', 'offsets', 'indices', 'overlay', 'removed')
+
+    def __init__(self, src=None):
+        self.build(src or {})
+
+    def build(self, src):
+        self.item_pos = item_pos = {}
+        self.offsets = offsets = array(b'l', [0])
+        self.indices = indices = array(b'l')
+        for item_id, book_ids in src.iteritems():
+            if book_ids:
+                item_pos[item_id] = len(offsets) - 1
+                indices.extend(sorted(book_ids))
+                offsets.append(len(indices))
+        self.overlay = {}
+        self.removed = set()
+
+    def _base(self, key):
+        pos = self.item_pos.get(key)
+        if pos is None or key in self.removed:
+            return None
+        return set(self.indices[self.offsets[pos]:self.offsets[pos + 1]])
+
+    def get(self, key, default=None):
+        ans = self.overlay.get(key)
+        if ans is None:
+            ans = self._base(key)
+            if ans is None:
+                return default
+        return ans
+
+    def __getitem__(self, key):
+        ans = self.overlay.get(key)
+        if ans is None:
+            ans = self._base(key)
+            if ans is None:
+                ans = set()
+            self.overlay[key] = ans
+        return ans
+
+    def __setitem__(self, key, val):
+        self.overlay[key] = val
+
+    def __contains__(self, key):
+        return key in self.overlay or (key in self.item_pos and key not in self.removed)
+
+    has_key = __contains__
+
+    def pop(self, key, default=_null):
+        ans = self.overlay.pop(key, None)
+        if key in self.item_pos and key not in self.removed:
+            if ans is None:
+                ans = self._base(key)
+            self.removed.add(key)
+        if ans is None:
+            if default is _null:
+                raise KeyError(key)
+            return default
+        return ans
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def iterkeys(self):
+        overlay, removed = self.overlay, self.removed
+        for key in self.item_pos:
+            if key not in overlay and key not in removed:
+                yield key
+        for key in overlay.keys():
+            yield key
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return sum(1 for k in self.iterkeys())
+
+    def __nonzero__(self):
+        return bool(self.overlay) or len(self.removed) < len(self.item_pos)
+    __bool__ = __nonzero__
+
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key, self.get(key)
+
+    def itervalues(self):
+        for k, v in self.iteritems():
+            yield v
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, other):
+        for k, v in getattr(other, 'iteritems', other.items)():
+            self[k] = v
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def compact(self):
+        self.build(self.copy())
+
+    def maybe_compact(self):
+        if overlay_is_large(len(self.overlay) + len(self.removed), len(self.item_pos)):
+            self.compact()
+            return True
+        return False
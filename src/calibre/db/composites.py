@@ -0,0 +1,318 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+'''
+Support for composite columns that are not re-rendered after every restart and
+every edit. The fields that the template of a composite column refers to are
+found without evaluating it, so that only edits to those fields invalidate the
+rendered values. Rendered values are stored in a sidecar SQLite database, keyed
+by (template hash, book id). Every stored value is stamped with the last entry
+of the change journal of metadata.db that the process that rendered it had
+seen. When the values are first needed, any value for a book that has changed
+according to the journal since then is discarded, so values are never stale,
+even if metadata.db is changed by other processes or programs.
+'''
+
+import hashlib
+import json
+import os
+import traceback
+from collections import defaultdict
+from threading import RLock
+
+import apsw
+
+from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS composite_values(
+    template TEXT NOT NULL,
+    book INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    val TEXT NOT NULL,
+    PRIMARY KEY (template, book)
+);
+'''
+
+# The fields read by template functions that get data from the book other
+# than through their arguments. Other functions are either pure (see
+# FormatterFunction.is_pure), or can return different values without the
+# book changing, for example today(), in which case the rendered values
+# cannot be stored.
+FUNCTION_FIELDS = {
+    'approximate_formats': ('formats',),
+    'assign': (),
+    'author_links': ('authors',),
+    'author_sorts': ('authors', 'author_sort'),
+    'booksize': ('size',),
+    'eval': (),
+    'field': (),
+    'formats_modtimes': ('formats',),
+    'formats_paths': ('formats', 'path'),
+    'formats_sizes': ('formats',),
+    'has_cover': ('cover',),
+    'print': (),
+    'raw_field': (),
+    'raw_list': (),
+    'series_sort': ('series',),
+    'template': (),
+}
+# Fields whose values are not stored in metadata.db
+VOLATILE_FIELDS = frozenset(('ondevice', 'marked'))
+# Names that templates can use for fields, other than the field names, see
+# calibre.db.lazy.getters
+KEY_FIELDS = {
+    'application_id': None, 'id': None, 'book_size': 'size', 'db_approx_formats': 'formats',
+    'has_cover': 'cover', 'language': 'languages', 'ondevice_col': 'ondevice',
+    'title_sort': 'sort',
+}
+
+
+def template_hash(template, field_metadata=()):
+    '''
+    A hash of everything that can affect the values rendered by template,
+    other than the books. field_metadata is the metadata of the fields the
+    template refers to, which includes the templates of composite columns and
+    the display settings, such as date formats, of custom columns. The
+    metadata of custom columns is not recorded in the change journal, so
+    changes to it must result in a different hash.
+    '''
+    from calibre.constants import numeric_version
+    from calibre.utils.config import tweaks
+    from calibre.utils.localization import get_lang
+    sig = repr((template, numeric_version, get_lang(), sorted(tweaks.iteritems())))
+    sig += json.dumps(field_metadata, sort_keys=True, default=repr)
+    return hashlib.sha1(sig.encode('utf-8')).hexdigest()
+
+
+def display_metadata(names, fields):
+    ' The metadata of the fields that affects how their values are rendered by templates '
+    ans = []
+    for name in sorted(names):
+        m = fields[name].metadata
+        ans.append((name, m.get('datatype'), m.get('is_multiple'), m.get('display')))
+    return ans
+
+
+def set_composite_dependencies(composites, fields, field_metadata, template_functions):
+    '''
+    Set the dependencies of all the composite fields: the names of the fields
+    their templates refer to, directly or through other composite columns, or
+    None if that cannot be determined. Composite fields whose values depend
+    only on data from metadata.db are marked as being persistent. Also sets
+    the hashes their stored values are keyed by, see :func:`template_hash`.
+    '''
+    from calibre.utils.formatter import template_references
+    from calibre.utils.formatter_functions import formatter_functions
+    builtins = formatter_functions().get_builtins_and_aliases()
+    ans = {}
+
+    def field_for_key(key):
+        # Return the field name for key, '' if it refers to no field and None
+        # if it is not known
+        key = key.lower()
+        if key in fields or key in VOLATILE_FIELDS:
+            return key
+        if key in KEY_FIELDS:
+            return KEY_FIELDS[key] or ''
+        if key in TOP_LEVEL_IDENTIFIERS:
+            return 'identifiers'
+        key = field_metadata.search_term_to_field_key(key)
+        if key in fields:
+            return key
+
+    def dependencies(name):
+        if name in ans:
+            return ans[name]
+        ans[name] = (None, False, None)  # Guard against recursive templates
+        refs, functions = template_references(composites[name].metadata['display']['composite_template'])
+        # referenced is deps plus the composite columns deps come from
+        deps, persistent, referenced = set(), True, set()
+        for func in functions:
+            f = builtins.get(func)
+            if f is None or template_functions.get(func) is not f:
+                # A user defined function, that can read anything
+                refs, persistent = None, False
+                break
+            if not f.is_pure:
+                if func not in FUNCTION_FIELDS:
+                    persistent = False
+                deps.update(FUNCTION_FIELDS.get(func, ()))
+        for key in refs or ():
+            if not key:
+                continue
+            field = field_for_key(key)
+            if not field:
+                if field is None:
+                    # Could be something like virtual_libraries, that is not
+                    # in metadata.db at all
+                    refs, persistent = None, False
+                    break
+                continue
+            if field in VOLATILE_FIELDS:
+                persistent = False
+            if field in composites:
+                fdeps, fpersistent, freferenced = dependencies(field)
+                persistent = persistent and fpersistent
+                if fdeps is None:
+                    refs = None
+                    break
+                deps |= fdeps
+                referenced |= freferenced
+                referenced.add(field)
+            else:
+                deps.add(field)
+        if refs is None:
+            ans[name] = None, persistent, None
+        else:
+            ans[name] = frozenset(deps), persistent, frozenset(deps | referenced)
+        return ans[name]
+
+    for name, field in composites.iteritems():
+        field.dependencies, field.is_persistent, referenced = dependencies(name)
+        if referenced is None:
+            # The template can refer to any field
+            referenced = fields
+        field.template_hash = template_hash(
+            field.metadata['display']['composite_template'],
+            display_metadata((x for x in referenced if x in fields), fields))
+
+
+class CompositeValueStore(object):
+
+    '''
+    The sidecar database holding rendered composite values. Values are added
+    in batches. Before the values are first read, the stored values are
+    checked against the change journal of metadata.db, see :meth:`validate`.
+    '''
+
+    BUSY_TIMEOUT = 10000  # milliseconds
+    BATCH_SIZE = 5000
+
+    def __init__(self, path, validate):
+        self.path = path
+        self.validate_callback = validate
+        self.lock = RLock()
+        self.pending = {}
+        self.validated = self.broken = False
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except EnvironmentError:
+                pass
+            self._conn = apsw.Connection(self.path)
+            self._conn.setbusytimeout(self.BUSY_TIMEOUT)
+            self._conn.cursor().execute(SCHEMA)
+        return self._conn
+
+    def execute(self, sql, bindings=None):
+        return self.conn.cursor().execute(sql, bindings)
+
+    def values_for(self, template_hash):
+        ''' Return a dict mapping book ids to the stored values rendered with
+        the template. Errors are printed and result in nothing being stored or
+        returned, as the values can always be rendered again. '''
+        with self.lock:
+            if self.broken:
+                return {}
+            try:
+                if not self.validated:
+                    # Prevent other processes adding values while we validate
+                    self.execute('BEGIN IMMEDIATE')
+                    try:
+                        self.validate_callback(self)
+                    except:
+                        self.execute('ROLLBACK')
+                        raise
+                    self.execute('COMMIT')
+                    self.validated = True
+                return dict(self.execute('SELECT book, val FROM composite_values WHERE template=?', (template_hash,)))
+            except Exception:
+                self.broken = True
+                traceback.print_exc()
+                return {}
+
+    def validate(self, current_seq, changes_since, changed_books, templates):
+        '''
+        Discard stored values that might be stale. changes_since(seq) must
+        return the (changes, deleted, seq) recorded in the change journal, or
+        None, see :meth:`calibre.db.backend.DB.changes_since`.
+        changed_books(changes) must return a dict mapping the names of
+        changed fields to book ids. templates maps the hashes of the current
+        templates to their dependencies. Remaining values are stamped with
+        current_seq.
+        '''
+        c = self.conn.cursor()
+        current = frozenset(templates)
+        for (h,) in tuple(c.execute('SELECT DISTINCT template FROM composite_values')):
+            if h not in current:
+                c.execute('DELETE FROM composite_values WHERE template=?', (h,))
+        for (min_seq,) in c.execute('SELECT MIN(seq) FROM composite_values'):
+            break
+        if min_seq is None or min_seq >= current_seq:
+            return
+        changes = changes_since(min_seq)
+        if changes is None:
+            c.execute('DELETE FROM composite_values')
+            return
+        changes, deleted = changed_books(changes[0]), changes[1]
+        all_changed = set(deleted)
+        for book_ids in changes.itervalues():
+            all_changed |= book_ids
+        for h, dependencies in templates.iteritems():
+            if dependencies is None:
+                book_ids = all_changed
+            else:
+                book_ids = set(deleted)
+                for name in dependencies:
+                    book_ids |= changes.get(name, set())
+            c.executemany('DELETE FROM composite_values WHERE template=? AND book=?', ((h, book_id) for book_id in book_ids))
+        c.execute('UPDATE composite_values SET seq=?', (current_seq,))
+
+    def add(self, template_hash, book_id, seq, val):
+        with self.lock:
+            if self.validated:
+                self.pending[(template_hash, book_id)] = (seq, val)
+                if len(self.pending) >= self.BATCH_SIZE:
+                    self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending or self.broken:
+                return
+            pending, self.pending = self.pending, {}
+            try:
+                with self.conn:
+                    self.conn.cursor().executemany(
+                        'INSERT OR REPLACE INTO composite_values (template, book, seq, val) VALUES (?, ?, ?, ?)',
+                        ((h, book_id, seq, val) for (h, book_id), (seq, val) in pending.iteritems()))
+            except Exception:
+                self.broken = True
+                traceback.print_exc()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def changed_books_for_journal(changes, backend, fields):
+    ' Map the sqlite table names in changes from the change journal to field names and book ids '
+    ans = defaultdict(set)
+    for dbtable, ids in changes.iteritems():
+        for name in backend.journal_book_tables.get(dbtable, ()):
+            ans[name] |= ids
+        for name in backend.journal_item_tables.get(dbtable, ()):
+            field = fields[name]
+            for item_id in ids:
+                ans[name] |= field.books_for(item_id)
+    return ans
@@ -95,6 +95,12 @@ class Field(object):
     def metadata(self):
         return self.table.metadata
 
+    def use_collation_key_cache(self, collation_keys):
+        ''' Use collation_keys, a memoized version of sort_key(), to generate
+        the sort keys for this field '''
+        if self._sort_key is sort_key:
+            self._sort_key = collation_keys
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -143,32 +149,64 @@ class Field(object):
         '''
         raise NotImplementedError()
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def category_values(self, item_id, item_book_ids, book_rating_map, lang_map):
+        ''' Return the name, sort value and average rating of the category
+        item item_id, with the books item_book_ids '''
+        ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
+                                    book_id in item_book_ids) if r > 0)
+        avg = sum(ratings)/len(ratings) if ratings else 0
+        try:
+            name = self.category_formatter(self.table.id_map[item_id])
+        except KeyError:
+            # db has entries in the link table without entries in the
+            # id table, for example, see
+            # https://bugs.launchpad.net/bugs/1218783
+            raise InvalidLinkTable(self.name)
+        sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
+            if hasattr(self, 'category_sort_value') else name)
+        return name, sval, avg
+
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, cached=None):
+        '''
+        cached is an optional dict mapping item ids to (number of books, name,
+        sort value, average rating) for all the books in the library, that is
+        used instead of recalculating the values for items whose number of
+        books has not changed. It is updated with newly calculated values.
+        '''
         ans = []
         if not self.is_many:
             return ans
 
-        id_map = self.table.id_map
-        special_sort = hasattr(self, 'category_sort_value')
-        for item_id, item_book_ids in self.table.col_book_map.iteritems():
+        if cached is None:
+            cached = {}
+        category_values = self.category_values
+        num_items = 0
+        for item_id, all_book_ids in self.table.col_book_map.iteritems():
+            if not all_book_ids:
+                continue
+            num_items += 1
+            count = len(all_book_ids)
+            c = cached.get(item_id)
+            if c is None or c[0] != count:
+                c = cached[item_id] = (count,) + category_values(
+                    item_id, all_book_ids, book_rating_map, lang_map)
+            item_book_ids, name, sval, avg = all_book_ids, c[1], c[2], c[3]
             if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
-                                            book_id in item_book_ids) if r > 0)
-                avg = sum(ratings)/len(ratings) if ratings else 0
-                try:
-                    name = self.category_formatter(id_map[item_id])
-                except KeyError:
-                    # db has entries in the link table without entries in the
-                    # id table, for example, see
-                    # https://bugs.launchpad.net/bugs/1218783
-                    raise InvalidLinkTable(self.name)
-                sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
-                    if special_sort else name)
-                c = tag_class(name, id=item_id, sort=sval, avg=avg,
-                              id_set=item_book_ids, count=len(item_book_ids))
-                ans.append(c)
+                item_book_ids = all_book_ids.intersection(book_ids)
+                if not item_book_ids:
+                    continue
+                if len(item_book_ids) != count:
+                    name, sval, avg = category_values(
+                        item_id, item_book_ids, book_rating_map, lang_map)
+            c = tag_class(name, id=item_id, sort=sval, avg=avg,
+                          id_set=item_book_ids, count=len(item_book_ids))
+            ans.append(c)
+        if len(cached) > num_items:
+            # Forget items that have been removed
+            cbm = self.table.col_book_map
+            for item_id in tuple(cached):
+                if not cbm.get(item_id):
+                    del cached[item_id]
         return ans
 
 
@@ -203,12 +241,20 @@ class OneToOneField(Field):
 class CompositeField(OneToOneField):
 
     is_composite = True
+    # Set by calibre.db.composites.set_composite_dependencies()
+    dependencies = None
+    is_persistent = False
+    template_hash = None
+    # Set by the Cache if rendered values are persisted
+    value_store = None
+    get_journal_seq = None
     SIZE_SUFFIX_MAP = {suffix:i for i, suffix in enumerate(('', 'K', 'M', 'G', 'T', 'P', 'E'))}
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions):
         OneToOneField.__init__(self, name, table, bools_are_tristate, get_template_functions)
 
         self._render_cache = {}
+        self._values_loaded = False
         self._lock = Lock()
         m = self.metadata
         self._composite_name = '#' + m['label']
@@ -264,26 +310,45 @@ class CompositeField(OneToOneField):
 
     def __render_composite(self, book_id, mi, formatter, template_cache):
         ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
+        if self.value_store is not None:
+            seq = self.get_journal_seq()
         ans = formatter.safe_format(
             self.metadata['display']['composite_template'], mi, _('TEMPLATE ERROR'),
             mi, column_name=self._composite_name, template_cache=template_cache,
             template_functions=self.get_template_functions()).strip()
         with self._lock:
             self._render_cache[book_id] = ans
+        if self.value_store is not None:
+            # Stamp the value with the last journal entry that had been seen
+            # before rendering started, so that it is discarded if anything
+            # changed after that
+            self.value_store.add(self.template_hash, book_id, seq, ans)
         return ans
 
+    def __cached_value(self, book_id):
+        ' INTERNAL USE ONLY. Must be called with the lock held. '
+        if self.value_store is not None and not self._values_loaded:
+            self._values_loaded = True
+            for k, val in self.value_store.values_for(self.template_hash).iteritems():
+                self._render_cache.setdefault(k, val)
+        return self._render_cache.get(book_id, None)
+
     def _render_composite_with_cache(self, book_id, mi, formatter, template_cache):
         ''' INTERNAL USE ONLY. DO NOT USE METHOD DIRECTLY. INSTEAD USE
          db.composite_for() OR mi.get(). Those methods make sure there is no
          risk of infinite recursion when evaluating templates that refer to
          themselves. '''
         with self._lock:
-            ans = self._render_cache.get(book_id, None)
+            ans = self.__cached_value(book_id)
         if ans is None:
             return self.__render_composite(book_id, mi, formatter, template_cache)
         return ans
 
-    def clear_caches(self, book_ids=None):
+    def clear_caches(self, book_ids=None, fields=None):
+        ''' Clear the rendered values. If fields is specified, the values are
+        only cleared if the template refers to one of fields. '''
+        if fields is not None and self.dependencies is not None and self.dependencies.isdisjoint(fields):
+            return
         with self._lock:
             if book_ids is None:
                 self._render_cache.clear()
@@ -293,7 +358,7 @@ class CompositeField(OneToOneField):
 
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
-            ans = self._render_cache.get(book_id, None)
+            ans = self.__cached_value(book_id)
         if ans is None:
             mi = get_metadata(book_id)
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
@@ -570,7 +635,7 @@ class IdentifiersField(ManyToManyField):
             if val:
                 yield val, {book_id}
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, cached=None):
         ans = []
 
         for id_key, item_book_ids in self.table.col_book_map.iteritems():
@@ -621,7 +686,7 @@ class FormatsField(ManyToManyField):
         for val, book_ids in val_map.iteritems():
             yield val, book_ids
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, cached=None):
         ans = []
 
         for fmt, item_book_ids in self.table.col_book_map.iteritems():
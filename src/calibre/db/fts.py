@@ -0,0 +1,351 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+'''
+Full text search for calibre libraries. The text of the book files is stored
+in a sidecar SQLite database (next to metadata.db) with an FTS5 index on it.
+Text is extracted from the book files by worker processes, driven by a
+throttled pool of background threads, see :class:`FTSIndexer`.
+'''
+
+import os
+import traceback
+import weakref
+from threading import Event, Lock, RLock, Thread
+from time import time
+
+import apsw
+
+from calibre import prints
+
+FTS_DB_NAME = 'full-text-search.db'
+# Formats for which text can be extracted, in order of preference
+FTS_FORMATS = (
+    'EPUB', 'KEPUB', 'AZW3', 'MOBI', 'AZW', 'PRC', 'DOCX', 'TXT', 'TXTZ',
+    'HTMLZ', 'FB2', 'ODT', 'RTF', 'LIT', 'PDB', 'PDF',
+)
+EXTRACTION_TIMEOUT = 900  # seconds
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirtied_formats(
+    id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    UNIQUE(book, format)
+);
+CREATE TABLE IF NOT EXISTS books_text(
+    id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    format_size INTEGER NOT NULL DEFAULT 0,
+    searchable_text TEXT NOT NULL DEFAULT '',
+    err_msg TEXT,
+    UNIQUE(book, format)
+);
+CREATE INDEX IF NOT EXISTS books_text_book_idx ON books_text (book);
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    searchable_text, content='books_text', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS books_fts_insert_trg AFTER INSERT ON books_text BEGIN
+    INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_delete_trg AFTER DELETE ON books_text BEGIN
+    INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES ('delete', OLD.id, OLD.searchable_text);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_update_trg AFTER UPDATE ON books_text BEGIN
+    INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES ('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+END;
+'''
+
+
+def is_fts_format(fmt):
+    return (fmt or '').upper() in FTS_FORMATS
+
+
+class FTSDatabase(object):  # {{{
+
+    '''
+    The sidecar database holding the extracted text. All access is serialized
+    with a lock, as the connection is shared between the indexing threads and
+    the threads using the db API.
+    '''
+
+    BUSY_TIMEOUT = 10000  # milliseconds
+
+    def __init__(self, library_path):
+        self.dbpath = os.path.join(library_path, FTS_DB_NAME)
+        self.lock = RLock()
+        self.jobs_in_progress = set()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = apsw.Connection(self.dbpath)
+            self._conn.setbusytimeout(self.BUSY_TIMEOUT)
+            self._conn.cursor().execute(SCHEMA)
+        return self._conn
+
+    def execute(self, sql, bindings=None):
+        return self.conn.cursor().execute(sql, bindings)
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def dirty_formats(self, book_fmts):
+        ''' Mark the (book_id, fmt) pairs as needing to be (re-)indexed.
+        Re-dirtying a format that is being indexed gives it a new job id, so
+        the in-flight result does not clear it. '''
+        with self.lock, self.conn:
+            self.conn.cursor().executemany(
+                'INSERT OR REPLACE INTO dirtied_formats(book, format) VALUES (?, ?)',
+                tuple((book_id, fmt.upper()) for book_id, fmt in book_fmts if is_fts_format(fmt)))
+
+    def remove_formats(self, formats_map):
+        vals = tuple((book_id, fmt.upper()) for book_id, fmts in formats_map.iteritems() for fmt in fmts)
+        with self.lock, self.conn:
+            c = self.conn.cursor()
+            c.executemany('DELETE FROM dirtied_formats WHERE book=? AND format=?', vals)
+            c.executemany('DELETE FROM books_text WHERE book=? AND format=?', vals)
+
+    def remove_books(self, book_ids):
+        vals = tuple((book_id,) for book_id in book_ids)
+        with self.lock, self.conn:
+            c = self.conn.cursor()
+            c.executemany('DELETE FROM dirtied_formats WHERE book=?', vals)
+            c.executemany('DELETE FROM books_text WHERE book=?', vals)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.execute('DELETE FROM dirtied_formats; DELETE FROM books_text;')
+            # Also drops entries for rows that no longer exist in books_text
+            self.execute("INSERT INTO books_fts(books_fts) VALUES('delete-all')")
+
+    def next_job(self):
+        ''' Return (job_id, book_id, fmt) for a dirtied format that is not
+        already being indexed, or None. '''
+        with self.lock:
+            for job_id, book_id, fmt in self.execute(
+                    'SELECT id, book, format FROM dirtied_formats ORDER BY id'):
+                if job_id not in self.jobs_in_progress:
+                    self.jobs_in_progress.add(job_id)
+                    return job_id, book_id, fmt
+
+    def release_job(self, job_id):
+        with self.lock:
+            self.jobs_in_progress.discard(job_id)
+
+    def cancel_job(self, job_id):
+        with self.lock, self.conn:
+            self.jobs_in_progress.discard(job_id)
+            self.execute('DELETE FROM dirtied_formats WHERE id=?', (job_id,))
+
+    def commit_result(self, job_id, book_id, fmt, format_size, text, err_msg=None):
+        with self.lock, self.conn:
+            self.jobs_in_progress.discard(job_id)
+            c = self.conn.cursor()
+            # Not INSERT OR REPLACE, as the rows it replaces do not fire the
+            # delete trigger, leaving their text in the FTS index
+            c.execute('DELETE FROM books_text WHERE book=? AND format=?', (book_id, fmt.upper()))
+            c.execute(
+                'INSERT INTO books_text(book, format, format_size, searchable_text, err_msg) VALUES (?, ?, ?, ?, ?)',
+                (book_id, fmt.upper(), format_size, text or '', err_msg))
+            c.execute('DELETE FROM dirtied_formats WHERE id=?', (job_id,))
+
+    def check_integrity(self):
+        ''' Raise apsw.CorruptError if the FTS index does not match the stored
+        text. The rank of 1 makes FTS5 compare the index with the content
+        table, instead of only checking the index itself. '''
+        with self.lock:
+            self.execute("INSERT INTO books_fts(books_fts, rank) VALUES('integrity-check', 1)")
+
+    def search(self, query, book_ids=None, highlight_start='\x1d', highlight_end='\x1d', snippet_size=32, return_text=True):
+        ''' Run an FTS5 query. Yields dicts of the form {'id': row_id,
+        'book_id': book_id, 'format': fmt, 'text': snippet}. Raises
+        apsw.SQLError for malformed queries. '''
+        if return_text:
+            sql = ('SELECT books_text.id, books_text.book, books_text.format, snippet(books_fts, 0, ?, ?, ?, ?)'
+                   ' FROM books_fts JOIN books_text ON books_fts.rowid = books_text.id'
+                   ' WHERE books_fts MATCH ? ORDER BY rank')
+            bindings = (highlight_start, highlight_end, '…', max(1, min(snippet_size, 64)), query)
+        else:
+            sql = ('SELECT books_text.id, books_text.book, books_text.format, NULL'
+                   ' FROM books_fts JOIN books_text ON books_fts.rowid = books_text.id'
+                   ' WHERE books_fts MATCH ?')
+            bindings = (query,)
+        with self.lock:
+            rows = tuple(self.execute(sql, bindings))
+        for row_id, book_id, fmt, text in rows:
+            if book_ids is None or book_id in book_ids:
+                yield {'id': row_id, 'book_id': book_id, 'format': fmt, 'text': text}
+
+    def indexing_progress(self):
+        ''' Return (number of formats left to index, number indexed) '''
+        with self.lock:
+            left = self.execute('SELECT COUNT(*) FROM dirtied_formats').next()[0]
+            done = self.execute('SELECT COUNT(*) FROM books_text').next()[0]
+        return left, done
+# }}}
+
+
+def extract_text(pathtoebook):
+    ''' Run in a worker process. Converts the book to plain text using the
+    conversion pipeline, so that every format with an input plugin is
+    supported. '''
+    from calibre.ebooks.conversion.plumber import Plumber
+    from calibre.ptempfile import TemporaryDirectory
+    from calibre.utils.logging import Log
+    log = Log()
+    log.outputs = []
+    with TemporaryDirectory('fts_text') as tdir:
+        output_path = os.path.join(tdir, 'book.txt')
+        plumber = Plumber(pathtoebook, output_path, log)
+        plumber.run()
+        with open(output_path, 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+
+
+def run_extract_text(pathtoebook, abort=None):
+    from calibre.utils.ipc.simple_worker import fork_job
+    ans = fork_job('calibre.db.fts', 'extract_text', args=(pathtoebook,),
+                   timeout=EXTRACTION_TIMEOUT, no_output=True, abort=abort)
+    return ans['result']
+
+
+class Abort(Exception):
+    pass
+
+
+class FTSIndexer(object):
+
+    '''
+    Continuously extract the text of dirtied formats and add it to the full
+    text index. Extraction runs in worker processes, one per indexing thread.
+    The threads are throttled by waiting scheduling_interval seconds between
+    books, so that a large library does not monopolize the machine.
+    '''
+
+    def __init__(self, db, num_workers=1, interval=2, scheduling_interval=0.5, extract=run_extract_text):
+        self._db = weakref.ref(getattr(db, 'new_api', db))
+        self.stop_running = Event()
+        self.interval = interval
+        self.scheduling_interval = scheduling_interval
+        self.extract = extract
+        self.stats_lock = Lock()
+        self.num_indexed = self.num_failed = 0
+        self.first_job_at = self.last_job_at = None
+        self.workers = []
+        for i in xrange(max(1, num_workers)):
+            t = Thread(target=self.run, name='FTSIndexer-%d' % i)
+            t.daemon = True
+            self.workers.append(t)
+
+    @property
+    def db(self):
+        ans = self._db()
+        if ans is None:
+            raise Abort()
+        return ans
+
+    def start(self):
+        for t in self.workers:
+            t.start()
+
+    def stop(self):
+        self.stop_running.set()
+
+    def join(self, timeout=None):
+        for t in self.workers:
+            t.join(timeout)
+
+    def is_alive(self):
+        return any(t.is_alive() for t in self.workers)
+
+    def wait(self, interval):
+        if self.stop_running.wait(interval):
+            raise Abort()
+
+    def run(self):
+        while not self.stop_running.is_set():
+            try:
+                if not self.do_one():
+                    self.wait(self.interval)
+            except Abort:
+                break
+
+    @property
+    def books_per_second(self):
+        ''' The indexing throughput, in books per second, measured from the
+        start of the first indexing job to the end of the last one. '''
+        with self.stats_lock:
+            if self.first_job_at is None or self.last_job_at is None:
+                return 0.0
+            elapsed = self.last_job_at - self.first_job_at
+            return (self.num_indexed / elapsed) if elapsed > 0 else 0.0
+
+    def report(self):
+        with self.stats_lock:
+            indexed, failed = self.num_indexed, self.num_failed
+        return _('Indexed {0} book files ({1} failed) at {2:.2f} books/sec').format(
+            indexed, failed, self.books_per_second)
+
+    def do_one(self):
+        ''' Index one format, returning False if there was nothing to do '''
+        try:
+            job = self.db.get_next_fts_job()
+        except Abort:
+            raise
+        except:
+            # Happens during interpreter shutdown
+            return False
+        if job is None:
+            return False
+        job_id, book_id, fmt, path, size = job
+        with self.stats_lock:
+            if self.first_job_at is None:
+                self.first_job_at = time()
+
+        text = err_msg = None
+        try:
+            text = self.extract(path, abort=self.stop_running)
+        except:
+            if not self.stop_running.is_set():
+                err_msg = traceback.format_exc()
+                prints('Failed to extract text from', fmt, 'for book id:', book_id)
+        if self.stop_running.is_set():
+            # The worker was killed because we were asked to stop, leave the
+            # format dirtied so that it is indexed the next time
+            db = self._db()
+            if db is not None:
+                db.release_fts_job(job_id)
+            raise Abort()
+
+        try:
+            self.db.commit_fts_result(job_id, book_id, fmt, size, text, err_msg)
+        except Abort:
+            raise
+        except:
+            prints('Failed to store extracted text for book id:', book_id)
+            traceback.print_exc()
+        with self.stats_lock:
+            self.last_job_at = time()
+            if err_msg is None:
+                self.num_indexed += 1
+            else:
+                self.num_failed += 1
+
+        # Give the GUI a chance to do something, see the comment in
+        # MetadataBackup.do_one()
+        self.wait(self.scheduling_interval)
+        return True
+
+    def break_cycles(self):
+        pass
@@ -13,6 +13,29 @@ from calibre import prints
 from calibre.utils.date import isoformat, DEFAULT_DATE
 
 
+def change_journal_triggers(table, key):
+    ''' Return the SQL to create the triggers that record changes to table in
+    the change_journal table. key is the column of table that contains the
+    book id (or the item id, for tables of items). '''
+    ans = []
+    for op, row in (('insert', 'NEW'), ('delete', 'OLD'), ('update', 'NEW')):
+        extra = ''
+        if op == 'update':
+            # If the key itself was changed, record the old value as well
+            extra = '''
+            INSERT INTO change_journal (tbl, book, op) SELECT '{table}', OLD.{key}, 'delete'
+                WHERE OLD.{key} <> NEW.{key};'''.format(table=table, key=key)
+        ans.append('''
+        DROP TRIGGER IF EXISTS journal_{op}_{table};
+        CREATE TRIGGER journal_{op}_{table}
+            AFTER {OP} ON {table}
+            BEGIN
+            INSERT INTO change_journal (tbl, book, op) VALUES ('{table}', {row}.{key}, '{op}');{extra}
+        END;
+        '''.format(op=op, OP=op.upper(), table=table, row=row, key=key, extra=extra))
+    return ''.join(ans)
+
+
 class SchemaUpgrade(object):
 
     def __init__(self, db, library_path, field_metadata):
@@ -696,3 +719,44 @@ CREATE TRIGGER fkc_lrp_update
         END;
 
         ''')
+
+    def upgrade_version_23(self):
+        ''' Create the change journal, used to apply changes made by other
+        processes without re-reading all the tables. '''
+        script = ['''
+        DROP TABLE IF EXISTS change_journal;
+        CREATE TABLE change_journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            book INTEGER NOT NULL,
+            op TEXT NOT NULL
+        );
+
+        -- Keep only the last 100,000 entries, pruning every 10,000 entries
+        DROP TRIGGER IF EXISTS journal_prune;
+        CREATE TRIGGER journal_prune
+            AFTER INSERT ON change_journal
+            WHEN NEW.seq % 10000 = 0
+            BEGIN
+            DELETE FROM change_journal WHERE seq <= NEW.seq - 100000;
+        END;
+        ''']
+        script.append(change_journal_triggers('books', 'id'))
+        for table in ('comments', 'data', 'identifiers'):
+            script.append(change_journal_triggers(table, 'book'))
+        for table in ('authors', 'languages', 'publishers', 'ratings', 'series', 'tags'):
+            script.append(change_journal_triggers(table, 'id'))
+            script.append(change_journal_triggers('books_%s_link' % table, 'book'))
+
+        tables = {x[0] for x in self.db.get('SELECT name FROM sqlite_master WHERE type="table"')}
+        for num, normalized in self.db.get('SELECT id, normalized FROM custom_columns'):
+            table, link_table = 'custom_column_%d' % num, 'books_custom_column_%d_link' % num
+            if table not in tables:
+                continue
+            if normalized:
+                script.append(change_journal_triggers(table, 'id'))
+                if link_table in tables:
+                    script.append(change_journal_triggers(link_table, 'book'))
+            else:
+                script.append(change_journal_triggers(table, 'book'))
+        self.db.execute('\n'.join(script))
@@ -7,11 +7,14 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, weakref, operator
+import re, weakref, operator, unicodedata
+from array import array
 from functools import partial
 from datetime import timedelta
 from collections import deque, OrderedDict
+from threading import Lock
 
+from calibre import as_unicode
 from calibre.constants import preferred_encoding
 from calibre.db.utils import force_to_bool
 from calibre.utils.config_base import prefs
@@ -448,8 +451,9 @@ class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, search_index=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.search_index = search_index
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -457,6 +461,7 @@ class Parser(SearchQueryParser):  # {{{
         self.limit_search_columns, self.limit_search_columns_to = (
             limit_search_columns, limit_search_columns_to)
         self.virtual_fields = virtual_fields or {}
+        self.fields_used = set()
         if 'marked' not in self.virtual_fields:
             self.virtual_fields['marked'] = self
         SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search, parse_cache=parse_cache)
@@ -483,8 +488,18 @@ class Parser(SearchQueryParser):  # {{{
 
     def parse(self, *args, **kwargs):
         self.virtual_field_used = False
+        self.fields_used = set()
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    def note_field_used(self, field):
+        ''' Record that the query being parsed depends on the specified field.
+        None means the query can depend on any field. '''
+        if self.fields_used is not None:
+            if field is None:
+                self.fields_used = None
+            else:
+                self.fields_used.add(field)
+
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
@@ -499,6 +514,7 @@ class Parser(SearchQueryParser):  # {{{
             return matches
 
         if location == 'vl':
+            self.note_field_used(None)
             vl = self.dbcache._pref('virtual_libraries', {}).get(query) if query else None
             if not vl:
                 raise ParseException(_('No such virtual library: {}').format(query))
@@ -507,6 +523,18 @@ class Parser(SearchQueryParser):  # {{{
             except RuntimeError:
                 raise ParseException(_('Virtual library search is recursive: {}').format(query))
 
+        if location == 'fulltext':
+            # The full text index changes as the background indexer runs,
+            # so results of such searches must not be cached
+            self.virtual_field_used = True
+            if not query:
+                return set()
+            try:
+                results = self.dbcache._fts_search(query, restrict_to_book_ids=candidates, return_text=False)
+            except ValueError as err:
+                raise ParseException(as_unicode(err))
+            return {r['book_id'] for r in results}
+
         if (len(location) > 2 and location.startswith('@') and
                     location[1:] in self.grouped_search_terms):
             location = location[1:]
@@ -538,6 +566,13 @@ class Parser(SearchQueryParser):  # {{{
             raise ParseException(
                        _('Recursive query group detected: {0}').format(query))
 
+        if location == 'all' or location.startswith('@') or (
+                location in self.field_metadata and self.field_metadata[location]['datatype'] == 'composite'):
+            # Composite columns can depend on any field
+            self.note_field_used(None)
+        else:
+            self.note_field_used('timestamp' if location == 'date' else location)
+
         # If the user has asked to restrict searching over all field, apply
         # that restriction
         if (location == 'all' and self.limit_search_columns and
@@ -699,7 +734,13 @@ class Parser(SearchQueryParser):  # {{{
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
+                vals = None
+                if self.search_index is not None and location not in self.virtual_fields:
+                    vals = self.search_index.candidate_values(
+                        self.dbcache, location, q, matchkind, upf, case_sensitive, current_candidates)
+                if vals is None:
+                    vals = self.field_iter(location, current_candidates)
+                for val, book_ids in vals:
                     if val is not None:
                         if isinstance(val, basestring):
                             val = (val,)
@@ -798,8 +839,388 @@ class LRUCache(object):  # {{{
 # }}}
 
 
+class CompactBookSet(object):
+
+    ''' An immutable set of book ids stored as a sorted array of C ints,
+    which uses a fraction of the memory of a python set of the same ids. '''
+
+    __slots__ = ('ids',)
+
+    def __init__(self, book_ids):
+        self.ids = array(b'i', sorted(book_ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.itemsize * len(self.ids)
+
+    def to_set(self):
+        return set(self.ids)
+
+
+class SearchResultCache(object):  # {{{
+
+    '''
+    A Least-Recently-Used cache of search results, bounded by the memory used
+    by the results rather than by the number of results. Results are stored
+    as :class:`CompactBookSet` objects. Every entry also records the set of
+    fields the query depends on (None meaning any field), so that changes to
+    a field only affect the queries that use it.
+    '''
+
+    ENTRY_OVERHEAD = 200  # approximate bytes used by an entry besides its result
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.item_map = OrderedDict()
+        self.size = 0
+        # The cache is used with only the read lock held, so needs its own lock
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def entry_size(self, key, result):
+        return self.ENTRY_OVERHEAD + 2 * len(key) + result.nbytes
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.item_map.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.item_map[key] = entry
+            self.hits += 1
+        return entry[0].to_set()
+
+    def add(self, key, book_ids, fields=None):
+        ''' Cache the result of the query key. fields is the set of fields
+        the query depends on or None if it depends on all fields. '''
+        result = CompactBookSet(book_ids)
+        sz = self.entry_size(key, result)
+        with self.lock:
+            self._remove(key)
+            if sz > self.max_size:
+                return
+            while self.size + sz > self.max_size and self.item_map:
+                self._remove(next(iter(self.item_map)))
+                self.evictions += 1
+            self.item_map[key] = (result, None if fields is None else frozenset(fields), sz)
+            self.size += sz
+
+    def _remove(self, key):
+        entry = self.item_map.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+        return entry
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self._remove(key)
+        return default if entry is None else entry[0].to_set()
+
+    def peek(self, key):
+        ''' Return the result for key without affecting its age or the hit
+        and miss counters '''
+        entry = self.item_map.get(key)
+        return None if entry is None else entry[0].to_set()
+
+    def replace(self, key, book_ids):
+        ''' Replace the result for an existing entry, keeping its age '''
+        result = CompactBookSet(book_ids)
+        with self.lock:
+            entry = self.item_map.get(key)
+            if entry is not None:
+                sz = self.entry_size(key, result)
+                self.item_map[key] = (result, entry[1], sz)
+                self.size += sz - entry[2]
+
+    def queries_depending_on(self, fields=None):
+        ''' Return the cached queries that depend on any of the specified
+        fields. If fields is None, all cached queries are returned. '''
+        with self.lock:
+            if fields is None:
+                return list(self.item_map)
+            fields = frozenset(fields)
+            return [key for key, (result, deps, sz) in self.item_map.iteritems()
+                    if deps is None or not deps.isdisjoint(fields)]
+
+    def invalidate(self, queries):
+        with self.lock:
+            for key in queries:
+                if self._remove(key) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.item_map)
+            self.item_map.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self.item_map
+
+    def __len__(self):
+        return len(self.item_map)
+
+    def __iter__(self):
+        for key in self.queries_depending_on():
+            ans = self.item_map.get(key)
+            if ans is not None:
+                yield key, ans[0].to_set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self.item_map),
+                'size': self.size, 'max_size': self.max_size,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+# }}}
+
+
+# Search index {{{
+
+
+def fold_for_index(text):
+    ' Lowercase text and strip accents, used to build the search index '
+    text = icu_lower(text)
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    return text
+
+
+def is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def required_regex_literal(pat):
+    ''' Return the longest run of literal characters that any string matching
+    the regular expression pat must contain, or None if no such run can be
+    determined with certainty. '''
+    if not pat or '|' in pat or '\\' in pat or '(' in pat:
+        return None
+    runs, cur = [], []
+    in_class = in_count = False
+    for c in pat:
+        if in_class:
+            in_class = c != ']'
+            continue
+        if in_count:
+            in_count = c != '}'
+            continue
+        if c in '*?{':
+            # The previous character is optional
+            if cur:
+                cur.pop()
+            in_count = c == '{'
+        elif c not in '[.^$+':
+            cur.append(c)
+            continue
+        in_class = c == '['
+        runs.append(''.join(cur))
+        cur = []
+    runs.append(''.join(cur))
+    ans = max(runs, key=len)
+    return ans or None
+
+
+class FieldIndex(object):
+
+    ''' An inverted index of the whitespace separated, folded words in the
+    values of a single field. The keys are book ids for one-one fields and
+    item ids for the others. '''
+
+    def __init__(self, is_many):
+        self.is_many = is_many
+        self.postings = {}
+        self.key_text = {}
+        self.nonascii_tokens = set()
+
+    def add(self, key, text):
+        if self.key_text.get(key) is not None:
+            self.remove(key)
+        if not text or not isinstance(text, basestring):
+            return
+        self.key_text[key] = text
+        for token in frozenset(fold_for_index(text).split()):
+            keys = self.postings.get(token)
+            if keys is None:
+                keys = self.postings[token] = set()
+                if not is_ascii(token):
+                    self.nonascii_tokens.add(token)
+            keys.add(key)
+
+    def remove(self, key):
+        text = self.key_text.pop(key, None)
+        if text is None:
+            return
+        for token in frozenset(fold_for_index(text).split()):
+            keys = self.postings.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[token]
+                    self.nonascii_tokens.discard(token)
+
+    def sync(self, key_val_map):
+        ' Make the index match key_val_map, which must be a mapping of all keys to their current values '
+        for key in tuple(self.key_text):
+            if key not in key_val_map:
+                self.remove(key)
+        for key, val in key_val_map.iteritems():
+            if self.key_text.get(key) is not val:
+                self.add(key, val)
+
+    def keys_containing(self, part, include_nonascii):
+        ans = set()
+        for token, keys in self.postings.iteritems():
+            if part in token:
+                ans |= keys
+        if include_nonascii:
+            for token in self.nonascii_tokens:
+                ans |= self.postings[token]
+        return ans
+
+    def matching_keys(self, query, matchkind, use_primary_find, case_sensitive):
+        ''' Return the set of keys whose values can possibly match query. Every
+        key whose value matches is in the returned set, but the set can
+        contain keys that do not match. Returns None if the index cannot be
+        used for this query. '''
+        if query.startswith('.'):
+            # Hierarchical matching, see _match()
+            return None
+        if matchkind == EQUALS_MATCH:
+            ans = None
+            for part in fold_for_index(query).split():
+                keys = self.postings.get(part, set())
+                ans = set(keys) if ans is None else (ans & keys)
+            return ans
+        if matchkind == REGEXP_MATCH:
+            query = required_regex_literal(query)
+            if query is None:
+                return None
+        parts = fold_for_index(query).split()
+        if not parts:
+            return None
+        # ICU primary strength matching and case insensitive regular
+        # expressions can match characters that do not fold to the same
+        # ASCII character, so always consider values with non-ASCII words
+        include_nonascii = matchkind == REGEXP_MATCH or (use_primary_find and not case_sensitive)
+        if include_nonascii and not all(map(is_ascii, parts)):
+            return None
+        ans = None
+        for part in parts:
+            keys = self.keys_containing(part, include_nonascii)
+            ans = keys if ans is None else (ans & keys)
+            if not ans:
+                break
+        return ans
+
+
+class SearchIndex(object):
+
+    '''
+    Inverted indices of the words in text fields, used by the Parser to find
+    the few values that can match a text search instead of testing every
+    value in the field. Indices are built lazily on first use and are kept up
+    to date as books are changed, see :meth:`books_changed`.
+    '''
+
+    INDEXED_DATATYPES = frozenset({'text', 'series', 'enumeration'})
+
+    def __init__(self):
+        self.indices = {}
+
+    def clear(self):
+        self.indices.clear()
+
+    def is_indexable(self, field):
+        return (
+            hasattr(field, 'table') and not field.is_composite and
+            field.name not in {'formats', 'identifiers'} and
+            field.metadata['datatype'] in self.INDEXED_DATATYPES)
+
+    def key_val_map(self, field):
+        return field.table.id_map if field.is_many else field.table.book_col_map
+
+    def index_for(self, field):
+        idx = self.indices.get(field.name)
+        vmap = self.key_val_map(field)
+        if idx is None:
+            idx = FieldIndex(field.is_many)
+            idx.sync(vmap)
+            self.indices[field.name] = idx
+        elif len(idx.key_text) != len(vmap):
+            # Books or items were added or removed directly
+            idx.sync(vmap)
+        return idx
+
+    def books_changed(self, dbcache, book_ids, fields=None):
+        for name, idx in self.indices.iteritems():
+            if fields is not None and name not in fields:
+                continue
+            field = dbcache.fields[name]
+            vmap = self.key_val_map(field)
+            keys = book_ids
+            if idx.is_many:
+                keys = {item_id for book_id in book_ids for item_id in field.ids_for_book(book_id)}
+            for key in keys:
+                val = vmap.get(key)
+                if val is None:
+                    idx.remove(key)
+                elif idx.key_text.get(key) is not val:
+                    idx.add(key, val)
+
+    def books_removed(self, book_ids):
+        for idx in self.indices.itervalues():
+            if not idx.is_many:
+                for book_id in book_ids:
+                    idx.remove(book_id)
+
+    def candidate_values(self, dbcache, name, query, matchkind, use_primary_find, case_sensitive, candidates):
+        ''' Return a list of (value, book_ids) pairs, as returned by
+        field.iter_searchable_values() that contains every value that can
+        match the query, or None if the index cannot answer this query. '''
+        field = dbcache.fields.get(name)
+        if field is None or not self.is_indexable(field):
+            return None
+        idx = self.index_for(field)
+        keys = idx.matching_keys(query, matchkind, use_primary_find, case_sensitive)
+        if keys is None:
+            return None
+        table = field.table
+        if idx.is_many:
+            ans = []
+            cbm, id_map, empty = table.col_book_map, table.id_map, set()
+            for item_id in keys:
+                val = id_map.get(item_id)
+                if val is not None:
+                    book_ids = cbm.get(item_id, empty).intersection(candidates)
+                    if book_ids:
+                        ans.append((val, book_ids))
+            return ans
+        bcm = table.book_col_map
+        return [(bcm.get(book_id), {book_id}) for book_id in keys.intersection(candidates)]
+# }}}
+
+
 class Search(object):
 
+    # Cached results for queries that depend on a changed field are updated
+    # in place if number of changed books * number of affected queries is
+    # at most MAX_CACHE_UPDATE, otherwise they are dropped
     MAX_CACHE_UPDATE = 50
 
     def __init__(self, db, opt_name, all_search_locations=()):
@@ -809,8 +1230,9 @@ class Search(object):
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        self.cache = SearchResultCache()
         self.parse_cache = LRUCache(limit=100)
+        self.search_index = SearchIndex()
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -821,31 +1243,46 @@ class Search(object):
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
-        else:
+    def update_or_clear(self, dbcache, book_ids=None, fields=None):
+        ''' Update the cached results after the books in book_ids were changed.
+        fields is the set of fields that were changed, None meaning any
+        field. If book_ids is None, all cached results are dropped. '''
+        if not book_ids:
             self.clear_caches()
+            return
+        self.search_index.books_changed(dbcache, book_ids, fields)
+        queries = self.cache.queries_depending_on(fields)
+        if queries:
+            if len(book_ids) * len(queries) <= self.MAX_CACHE_UPDATE:
+                self.update_caches(dbcache, book_ids, queries)
+            else:
+                self.cache.invalidate(queries)
 
     def clear_caches(self):
         self.cache.clear()
 
-    def update_caches(self, dbcache, book_ids):
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
-        for query, result in self.cache:
-            result.difference_update(book_ids)
+        self.search_index.books_removed(book_ids)
+        for query, result in tuple(self.cache):
+            if not result.isdisjoint(book_ids):
+                self.cache.replace(query, result - book_ids)
 
-    def _update_caches(self, sqp, book_ids):
-        book_ids = sqp.all_book_ids = set(book_ids)
+    def _update_caches(self, sqp, book_ids, queries=None):
+        book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        for query in (self.cache.queries_depending_on() if queries is None else queries):
+            result = self.cache.peek(query)
+            if result is None:
+                continue
+            sqp.all_book_ids = book_ids
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -855,8 +1292,8 @@ class Search(object):
                 result.difference_update(book_ids - matches)
                 # add books that now match but did not before
                 result.update(matches)
-        for query in remove:
-            self.cache.pop(query)
+                self.cache.replace(query, result)
+        self.cache.invalidate(remove)
 
     def create_parser(self, dbcache, virtual_fields=None):
         return Parser(
@@ -865,7 +1302,8 @@ class Search(object):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache,
+            self.search_index)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
         '''
@@ -901,7 +1339,7 @@ class Search(object):
                 sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
                 restricted_ids = sqp.parse(search_restriction)
                 if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                    self.cache.add(search_restriction.strip(), restricted_ids)
+                    self.cache.add(search_restriction.strip(), restricted_ids, sqp.fields_used)
             else:
                 restricted_ids = cached
                 if book_ids is not None:
@@ -921,6 +1359,6 @@ class Search(object):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.cache.add(query, result, sqp.fields_used)
 
         return result
@@ -0,0 +1,178 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2018, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+'''
+Caches used to speed up sorting the books in a library. ICU collation keys
+for text values are memoized and persisted across restarts, since computing
+them dominates the time taken to sort large libraries. For every sort field,
+the sort keys of the books and the rank of each book when sorted by that
+field are kept, so that sorting on multiple fields is a sequence of stable
+sorts on integer ranks.
+'''
+
+import os
+from array import array
+from threading import Lock
+
+from calibre.utils.icu import sort_key
+
+_null = object()
+
+
+def collation_id():
+    ' An identifier for the collation rules used for sort keys '
+    from calibre.utils.icu import _icu, sort_collator
+    c = sort_collator()
+    return '%s:%s:%s' % (_icu.icu_version, c.actual_locale, int(bool(c.numeric)))
+
+
+class CollationKeyCache(object):
+
+    '''
+    A memoized version of :func:`calibre.utils.icu.sort_key`, that can be
+    saved to and loaded from disk. The saved keys are discarded if the ICU
+    version or collation settings change.
+    '''
+
+    MAX_ENTRIES = 2000000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = {}
+        self.loaded = self.dirty = False
+
+    def __call__(self, val):
+        try:
+            return self.keys[val]
+        except KeyError:
+            ans = self.keys[val] = sort_key(val)
+            self.dirty = True
+            return ans
+        except TypeError:  # unhashable
+            return sort_key(val)
+
+    def load(self):
+        self.loaded = True
+        if not self.path:
+            return
+        from calibre.utils.serialize import msgpack_loads
+        try:
+            with lopen(self.path, 'rb') as f:
+                data = msgpack_loads(f.read())
+        except EnvironmentError:
+            return
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return
+        if data.get('collation') == collation_id():
+            keys = data['keys']
+            keys.update(self.keys)
+            self.keys = keys
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        from calibre.utils.serialize import msgpack_dumps
+        from calibre.utils.filenames import atomic_rename
+        if len(self.keys) > self.MAX_ENTRIES:
+            # Start afresh the next time, so that stale values do not
+            # accumulate forever
+            self.keys = {}
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except EnvironmentError:
+            pass
+        tpath = self.path + '.tmp'
+        with lopen(tpath, 'wb') as f:
+            f.write(msgpack_dumps({'collation': collation_id(), 'keys': self.keys}))
+        atomic_rename(tpath, self.path)
+        self.dirty = False
+
+
+class SortRanks(object):
+
+    __slots__ = ('keys', 'ranks', 'dependencies')
+
+    def __init__(self, dependencies):
+        self.keys = {}
+        self.ranks = None
+        self.dependencies = dependencies
+
+
+def rank_array(keys):
+    ''' Return an array that maps book_id to the rank of the book when the books
+    are sorted by keys. Books with equal keys have the same rank. '''
+    order = sorted(keys, key=keys.__getitem__)
+    ans = array(b'l', [-1]) * (max(order) + 1 if order else 0)
+    prev, rank = _null, -1
+    for book_id in order:
+        k = keys[book_id]
+        if prev is _null or k != prev:
+            rank += 1
+            prev = k
+        ans[book_id] = rank
+    return ans
+
+
+class SortKeyCache(object):
+
+    '''
+    Caches the sort keys of books and the resulting rank array for every sort
+    field. Entries for individual books are invalidated when the fields a sort
+    field depends on are changed.
+    '''
+
+    def __init__(self):
+        self.fields = {}
+        # Sorting happens with only the read lock held
+        self.lock = Lock()
+
+    def clear(self):
+        with self.lock:
+            self.fields.clear()
+
+    def invalidate(self, book_ids=None, fields=None):
+        ''' Invalidate the sort keys for book_ids (None means all books) that
+        depend on any of fields (None means any field) '''
+        if book_ids is None and fields is None:
+            return self.clear()
+        with self.lock:
+            self._invalidate(book_ids, fields)
+
+    def _invalidate(self, book_ids, fields):
+        for name, sr in tuple(self.fields.iteritems()):
+            if fields is None or not sr.dependencies.isdisjoint(fields):
+                if book_ids is None:
+                    self.fields.pop(name, None)
+                else:
+                    keys = sr.keys
+                    for book_id in book_ids:
+                        keys.pop(book_id, None)
+                    sr.ranks = None
+
+    def ranks_for(self, name, dependencies, create_key_func, book_ids):
+        ''' Return the rank array for the sort field name. create_key_func()
+        must return a function used to calculate the sort keys for books that
+        do not have a cached sort key. '''
+        with self.lock:
+            return self._ranks_for(name, dependencies, create_key_func, book_ids)
+
+    def _ranks_for(self, name, dependencies, create_key_func, book_ids):
+        sr = self.fields.get(name)
+        if sr is None:
+            sr = self.fields[name] = SortRanks(frozenset(dependencies))
+        keys = sr.keys
+        missing = set(book_ids).difference(keys)
+        if missing:
+            key_func = create_key_func()
+            for book_id in missing:
+                keys[book_id] = key_func(book_id)
+            sr.ranks = None
+        ranks = sr.ranks
+        if ranks is None:
+            ranks = sr.ranks = rank_array(keys)
+        return ranks
@@ -11,6 +11,7 @@ from datetime import datetime, timedelta
 from collections import defaultdict
 
 from calibre.constants import plugins
+from calibre.db.columnar import BookColumn, LinkColumn, BookSetMap
 from calibre.utils.date import parse_date, UNDEFINED_DATE, utc_tz
 from calibre.ebooks.metadata import author_to_author_sort
 
@@ -48,6 +49,17 @@ ONE_ONE, MANY_ONE, MANY_MANY = xrange(3)
 null = object()
 
 
+def rows_for_ids(db, query, ids, chunk_size=500):
+    ''' Run query, which must contain a single %s in place of the list of ids
+    in an IN clause, for all the specified ids, in chunks to stay under the
+    sqlite limit on the number of parameters. '''
+    ids = tuple(ids)
+    for i in xrange(0, len(ids), chunk_size):
+        chunk = ids[i:i+chunk_size]
+        for row in db.execute(query % ','.join('?' * len(chunk)), chunk):
+            yield row
+
+
 class Table(object):
 
     def __init__(self, name, metadata, link_table=None):
@@ -72,6 +84,30 @@ class Table(object):
     def fix_link_table(self, db):
         pass
 
+    def use_columnar_storage(self):
+        ''' Replace the dicts read from the db with the compact, array backed
+        mappings from :mod:`calibre.db.columnar`. Called after read(). '''
+        pass
+
+    def compact_storage(self):
+        ''' Fold the changes made to the columnar mappings back into their
+        arrays, once there are enough of them. Must only be called when no
+        sets obtained from col_book_map[item_id] are still being changed. '''
+        for m in (getattr(self, 'book_col_map', None), getattr(self, 'col_book_map', None)):
+            if hasattr(m, 'maybe_compact'):
+                m.maybe_compact()
+
+    def refresh_books(self, book_ids, db):
+        ''' Re-read the data for only the specified books from the db, used to
+        apply changes made by other processes. The default implementation
+        simply re-reads the whole table. '''
+        self.read(db)
+
+    def refresh_items(self, item_ids, db):
+        ''' Re-read the specified items (for example after a rename by another
+        process). Returns the set of ids of books that were affected. '''
+        return set()
+
     def fix_case_duplicates(self, db):
         ''' If this table contains entries that differ only by case, then merge
         those entries. This can happen in databases created with old versions
@@ -91,6 +127,9 @@ class VirtualTable(Table):
         self.table_type = table_type
         Table.__init__(self, name, metadata)
 
+    def refresh_books(self, book_ids, db):
+        pass
+
 
 class OneToOneTable(Table):
 
@@ -119,6 +158,22 @@ class OneToOneTable(Table):
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
 
+    def use_columnar_storage(self):
+        self.book_col_map = BookColumn(self.book_col_map)
+
+    def refresh_books(self, book_ids, db):
+        idcol = 'id' if self.metadata['table'] == 'books' else 'book'
+        query = 'SELECT {0}, {1} FROM {2} WHERE {0} IN (%s)'.format(
+            idcol, self.metadata['column'], self.metadata['table'])
+        vals = dict(rows_for_ids(db, query, book_ids))
+        us = self.unserialize or (lambda x: x)
+        for book_id in book_ids:
+            val = vals.get(book_id, null)
+            if val is null:
+                self.book_col_map.pop(book_id, None)
+            else:
+                self.book_col_map[book_id] = us(val)
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
@@ -144,6 +199,16 @@ class SizeTable(OneToOneTable):
             'WHERE data.book=books.id) FROM books')
         self.book_col_map = dict(query)
 
+    def refresh_books(self, book_ids, db):
+        query = ('SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
+            'WHERE data.book=books.id) FROM books WHERE books.id IN (%s)')
+        vals = dict(rows_for_ids(db, query, book_ids))
+        for book_id in book_ids:
+            if book_id in vals:
+                self.book_col_map[book_id] = vals[book_id]
+            else:
+                self.book_col_map.pop(book_id, None)
+
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
 
@@ -154,6 +219,12 @@ class UUIDTable(OneToOneTable):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in self.book_col_map.iteritems()}
 
+    def refresh_books(self, book_ids, db):
+        for book_id in book_ids:
+            self.uuid_to_id_map.pop(self.book_col_map.get(book_id, None), None)
+        OneToOneTable.refresh_books(self, book_ids, db)
+        self.update_uuid_cache({book_id:self.book_col_map[book_id] for book_id in book_ids if book_id in self.book_col_map})
+
     def update_uuid_cache(self, book_id_val_map):
         for book_id, uuid in book_id_val_map.iteritems():
             self.uuid_to_id_map.pop(self.book_col_map.get(book_id, None), None)  # discard old uuid
@@ -183,6 +254,12 @@ class CompositeTable(OneToOneTable):
         self.composite_sort = d.get('composite_sort', False)
         self.use_decorations = d.get('use_decorations', False)
 
+    def use_columnar_storage(self):
+        pass
+
+    def refresh_books(self, book_ids, db):
+        pass
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -223,6 +300,59 @@ class ManyToOneTable(Table):
             cbm[item_id].add(book)
             bcm[book] = item_id
 
+    def use_columnar_storage(self):
+        self.book_col_map = BookColumn(self.book_col_map, is_int=True)
+        self.col_book_map = BookSetMap(self.col_book_map)
+
+    def unlink_books(self, book_ids):
+        ' Remove the specified books from the in-memory maps only '
+        for book_id in book_ids:
+            item_ids = self.book_col_map.pop(book_id, None)
+            if item_ids is None:
+                continue
+            for item_id in (item_ids if self.table_type == MANY_MANY else (item_ids,)):
+                books = self.col_book_map.get(item_id)
+                if books is not None:
+                    books = self.col_book_map[item_id]
+                    books.discard(book_id)
+                    if not books:
+                        del self.col_book_map[item_id]
+
+    def refresh_id_maps(self, item_ids, db):
+        ''' Re-read only the specified items, removing the ones that no longer
+        exist in the db. '''
+        query = 'SELECT id, {0} FROM {1} WHERE id IN (%s)'.format(
+            self.metadata['column'], self.metadata['table'])
+        vals = dict(rows_for_ids(db, query, item_ids))
+        us = self.unserialize or (lambda x: x)
+        for item_id in item_ids:
+            if item_id in vals:
+                self.id_map[item_id] = us(vals[item_id])
+            else:
+                self.id_map.pop(item_id, None)
+
+    def refresh_books(self, book_ids, db):
+        self.unlink_books(book_ids)
+        query = 'SELECT book, {0} FROM {1} WHERE book IN (%s)'.format(
+            self.metadata['link_column'], self.link_table)
+        for book_id, item_id in rows_for_ids(db, query, book_ids):
+            self.book_col_map[book_id] = item_id
+            self.col_book_map[item_id].add(book_id)
+        self.refresh_unknown_items((self.book_col_map.get(book_id) for book_id in book_ids), db)
+
+    def refresh_unknown_items(self, item_ids, db):
+        # Read the items that were created by another process
+        item_ids = {item_id for item_id in item_ids if item_id is not None and item_id not in self.id_map}
+        if item_ids:
+            self.refresh_id_maps(item_ids, db)
+
+    def refresh_items(self, item_ids, db):
+        self.refresh_id_maps(item_ids, db)
+        affected_books = set()
+        for item_id in item_ids:
+            affected_books |= self.col_book_map.get(item_id, set())
+        return affected_books
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_id in self.book_col_map.itervalues()}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -359,6 +489,12 @@ class RatingTable(ManyToOneTable):
             db.execute('DELETE FROM {0} WHERE {1}=0'.format(
                 self.metadata['table'], self.metadata['column']))
 
+    def refresh_id_maps(self, item_ids, db):
+        ManyToOneTable.refresh_id_maps(self, item_ids, db)
+        for item_id in item_ids:
+            if self.id_map.get(item_id) == 0:
+                del self.id_map[item_id]
+
 
 class ManyToManyTable(ManyToOneTable):
 
@@ -382,6 +518,22 @@ class ManyToManyTable(ManyToOneTable):
 
         self.book_col_map = {k:tuple(v) for k, v in bcm.iteritems()}
 
+    def use_columnar_storage(self):
+        self.book_col_map = LinkColumn(self.book_col_map)
+        self.col_book_map = BookSetMap(self.col_book_map)
+
+    def refresh_books(self, book_ids, db):
+        self.unlink_books(book_ids)
+        bcm = defaultdict(list)
+        query = 'SELECT book, {0} FROM {1} WHERE book IN (%s) ORDER BY id'.format(
+            self.metadata['link_column'], self.link_table)
+        for book_id, item_id in rows_for_ids(db, query, book_ids):
+            bcm[book_id].append(item_id)
+            self.col_book_map[item_id].add(book_id)
+        for book_id, item_ids in bcm.iteritems():
+            self.book_col_map[book_id] = tuple(item_ids)
+        self.refresh_unknown_items((item_id for item_ids in bcm.itervalues() for item_id in item_ids), db)
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in self.book_col_map.itervalues() for item_id in item_ids}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -538,6 +690,21 @@ class AuthorsTable(ManyToManyTable):
             sm[aid] = (sort or author_to_author_sort(name))
             lm[aid] = link
 
+    def refresh_id_maps(self, item_ids, db):
+        vals = {aid:(name, sort, link) for aid, name, sort, link in rows_for_ids(
+            db, 'SELECT id, name, sort, link FROM authors WHERE id IN (%s)', item_ids)}
+        us = self.unserialize
+        for aid in item_ids:
+            if aid in vals:
+                name, sort, link = vals[aid]
+                name = us(name)
+                self.id_map[aid] = name
+                self.asort_map[aid] = (sort or author_to_author_sort(name))
+                self.alink_map[aid] = link
+            else:
+                for m in (self.id_map, self.asort_map, self.alink_map):
+                    m.pop(aid, None)
+
     def set_sort_names(self, aus_map, db):
         aus_map = {aid:(a or '').strip() for aid, a in aus_map.iteritems()}
         aus_map = {aid:a for aid, a in aus_map.iteritems() if a != self.asort_map.get(aid, None)}
@@ -583,9 +750,15 @@ class FormatsTable(ManyToManyTable):
     def read_id_maps(self, db):
         pass
 
+    def refresh_id_maps(self, item_ids, db):
+        pass
+
     def fix_case_duplicates(self, db):
         pass
 
+    def use_columnar_storage(self):
+        pass
+
     def read_maps(self, db):
         self.fname_map = fnm = defaultdict(dict)
         self.size_map = sm = defaultdict(dict)
@@ -602,6 +775,23 @@ class FormatsTable(ManyToManyTable):
 
         self.book_col_map = {k:tuple(sorted(v)) for k, v in bcm.iteritems()}
 
+    def refresh_books(self, book_ids, db):
+        self.unlink_books(book_ids)
+        for book_id in book_ids:
+            self.fname_map.pop(book_id, None)
+            self.size_map.pop(book_id, None)
+        bcm = defaultdict(list)
+        for book, fmt, name, sz in rows_for_ids(
+                db, 'SELECT book, format, name, uncompressed_size FROM data WHERE book IN (%s)', book_ids):
+            if fmt is not None:
+                fmt = fmt.upper()
+                self.col_book_map[fmt].add(book)
+                bcm[book].append(fmt)
+                self.fname_map[book][fmt] = name
+                self.size_map[book][fmt] = sz
+        for book_id, fmts in bcm.iteritems():
+            self.book_col_map[book_id] = tuple(sorted(fmts))
+
     def remove_books(self, book_ids, db):
         clean = ManyToManyTable.remove_books(self, book_ids, db)
         for book_id in book_ids:
@@ -667,9 +857,15 @@ class IdentifiersTable(ManyToManyTable):
     def read_id_maps(self, db):
         pass
 
+    def refresh_id_maps(self, item_ids, db):
+        pass
+
     def fix_case_duplicates(self, db):
         pass
 
+    def use_columnar_storage(self):
+        pass
+
     def read_maps(self, db):
         self.book_col_map = defaultdict(dict)
         self.col_book_map = defaultdict(set)
@@ -678,6 +874,14 @@ class IdentifiersTable(ManyToManyTable):
                 self.col_book_map[typ].add(book)
                 self.book_col_map[book][typ] = val
 
+    def refresh_books(self, book_ids, db):
+        self.unlink_books(book_ids)
+        for book, typ, val in rows_for_ids(
+                db, 'SELECT book, type, val FROM identifiers WHERE book IN (%s)', book_ids):
+            if typ is not None and val is not None:
+                self.col_book_map[typ].add(book)
+                self.book_col_map[book][typ] = val
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
@@ -305,3 +305,65 @@ class AddRemoveTest(BaseTest):
         self.assertEqual(len(old), len(new))
         self.assertNotIn(prefix, cache.fields['formats'].format_fname(1, 'FMT1'))
     # }}}
+
+    def test_fts(self):  # {{{
+        ' Test full text indexing and searching of book files '
+        from calibre.db.fts import FTSIndexer
+        ae = self.assertEqual
+        cache = self.init_cache()
+        ae(cache.fts_search('moon'), ())
+        cache.add_format(1, 'TXT', BytesIO(b'The dark side of the moon'), run_hooks=False)
+        cache.enable_fts()
+        cache.add_format(2, 'TXT', BytesIO('Une lune sombre, another moon'.encode('utf-8')), run_hooks=False)
+        cache.add_format(3, 'EPUB', BytesIO(b'not a valid epub'), run_hooks=False)
+        ae(cache.fts_indexing_progress(), (3, 0))
+
+        def extract(path, abort=None):
+            if path.endswith('.epub'):
+                raise ValueError('Invalid EPUB')
+            with open(path, 'rb') as f:
+                return f.read().decode('utf-8')
+
+        indexer = FTSIndexer(cache, scheduling_interval=0, extract=extract)
+        while indexer.do_one():
+            pass
+        ae(indexer.num_indexed, 2), ae(indexer.num_failed, 1)
+        self.assertIn('books/sec', indexer.report())
+        ae(cache.fts_indexing_progress(), (0, 3))
+        ae({r['book_id'] for r in cache.fts_search('moon')}, {1, 2})
+        ae(cache.fts_search('dark moon', highlight_start='[', highlight_end=']')[0]['text'], 'The [dark] side of the [moon]')
+        ae(cache.fts_search('lune'), ({'book_id':2, 'format':'TXT', 'text':'Une \x1dlune\x1d sombre, another moon'},))
+        ae(cache.fts_search('moon', restrict_to_book_ids={2}, return_text=False), ({'book_id':2, 'format':'TXT', 'text':None},))
+        ae(cache.search('fulltext:moon'), {1, 2})
+        ae(cache.search('fulltext:"dark side" and not title:"Title Two"'), {1})
+        self.assertRaises(ValueError, cache.fts_search, 'moon AND')
+
+        # Re-indexing on format changes
+        cache.add_format(2, 'TXT', BytesIO(b'Replaced text'), run_hooks=False)
+        ae(cache.search('fulltext:moon'), {1, 2})
+        while indexer.do_one():
+            pass
+        ae(cache.search('fulltext:moon'), {1})
+        ae(cache.fts_search('replaced', return_text=False), ({'book_id':2, 'format':'TXT', 'text':None},))
+        # Re-indexing must remove the old text from the FTS index
+        cache.fts_db.check_integrity()
+        cache.add_format(2, 'TXT', BytesIO(b'Replaced again'), run_hooks=False)
+        while indexer.do_one():
+            pass
+        ae(cache.fts_search('again', return_text=False), ({'book_id':2, 'format':'TXT', 'text':None},))
+        cache.fts_db.check_integrity()
+        cache.reindex_fts()
+        ae(cache.fts_indexing_progress(), (3, 0))
+        ae(cache.fts_search('moon'), ())
+        while indexer.do_one():
+            pass
+        ae(cache.fts_indexing_progress(), (0, 3))
+        cache.fts_db.check_integrity()
+        cache.remove_formats({1:('TXT',)})
+        ae(cache.search('fulltext:moon'), set())
+        cache.remove_books((2,))
+        ae(cache.fts_indexing_progress(), (0, 1))
+        cache.enable_fts(False)
+        ae(cache.fts_search('replaced'), ())
+        self.assertFalse(os.path.exists(os.path.join(cache.backend.library_path, 'full-text-search.db')))
+    # }}}
@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, cProfile
+import os, sys, cProfile, time
 from tempfile import gettempdir
 
 from calibre.db.legacy import LibraryDatabase
@@ -41,5 +41,145 @@ def main():
     print('Stats saved to', stats)
 
 
+def deep_size(obj, seen=None):
+    ' Approximate number of bytes used by obj and everything it references '
+    from array import array
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    ans = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        ans += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        ans += sum(deep_size(x, seen) for x in obj)
+    elif hasattr(obj, '__slots__') and not isinstance(obj, array):
+        ans += sum(deep_size(getattr(obj, x, None), seen) for x in obj.__slots__)
+    return ans
+
+
+def table_maps_size(cache):
+    ans = 0
+    for field in cache.fields.itervalues():
+        table = getattr(field, 'table', None)
+        for attr in ('book_col_map', 'col_book_map'):
+            m = getattr(table, attr, None)
+            if m is not None:
+                ans += deep_size(m)
+    return ans
+
+
+def benchmark_columnar(path='~/test library'):
+    ' Compare memory use and access latency of the dict and columnar tables '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    path = os.path.expanduser(path)
+    for columnar in (False, True):
+        backend = DB(path)
+        backend.columnar_tables = columnar
+        cache = Cache(backend)
+        st = time.time()
+        cache.init()
+        init_time = time.time() - st
+        all_ids = cache.all_book_ids()
+        st = time.time()
+        for field in ('title', 'authors', 'tags', 'series', 'timestamp'):
+            for book_id in all_ids:
+                cache.field_for(field, book_id)
+        read_time = time.time() - st
+        st = time.time()
+        for query in ('tags:a', 'authors:e', 'series:true', 'title:the'):
+            cache.search(query)
+        search_time = time.time() - st
+        st = time.time()
+        cache.multisort([('authors', True), ('series', True), ('title', True)])
+        sort_time = time.time() - st
+        print('%s layout:' % ('Columnar' if columnar else 'Dict'))
+        print('  Memory used by tables: %.1f MB' % (table_maps_size(cache) / (1024 * 1024)))
+        print('  init(): %.3fs field_for(): %.3fs search: %.3fs multisort: %.3fs' % (
+            init_time, read_time, search_time, sort_time))
+        backend.close()
+        del cache, backend
+
+
+def benchmark_multisort(path='~/test library'):
+    ' Time multisort with cold, persisted and warm sort key caches '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    path = os.path.expanduser(path)
+    fields = [('authors', True), ('series', True), ('title', True)]
+    for run in ('First', 'Restarted'):
+        cache = Cache(DB(path))
+        cache.init()
+        st = time.time()
+        cache.multisort(fields)
+        cold = time.time() - st
+        st = time.time()
+        cache.multisort(fields)
+        warm = time.time() - st
+        # Simulate an edit without changing the library
+        cache.sort_key_cache.invalidate({next(iter(cache.all_book_ids()))}, {'sort'})
+        st = time.time()
+        cache.multisort(fields)
+        changed = time.time() - st
+        print('%s run: cold: %.3fs warm: %.3fs after an edit: %.3fs' % (run, cold, warm, changed))
+        cache.close()
+
+
+def benchmark_metadata(path='~/test library', repeat=3):
+    ' Time the creation of Metadata objects, both empty and for every book in the library '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.ebooks.metadata.book.base import Metadata
+    num = 10000
+    st = time.time()
+    for i in xrange(num):
+        Metadata(None)
+    print('Metadata(None): %.1f us per object' % ((time.time() - st) * 1e6 / num))
+    cache = Cache(DB(os.path.expanduser(path)))
+    cache.init()
+    all_ids = cache.all_book_ids()
+    print('Library has %d books and %d custom columns' % (len(all_ids), len(cache.field_metadata.custom_field_keys())))
+    for i in xrange(repeat):
+        st = time.time()
+        for book_id in all_ids:
+            cache.get_metadata(book_id)
+        print('get_metadata(): %.1f us per book' % ((time.time() - st) * 1e6 / max(1, len(all_ids))))
+    cache.close()
+
+
+def benchmark_templates(path='~/test library', repeat=3):
+    ' Time rendering program mode and single function mode composite column templates for every book '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.utils.formatter import compiled_programs
+    templates = {
+        'program': 'program: t = field("title"); a = field("authors"); strcat(uppercase(t), " by ", a, " ", test(field("series"), "S", ""), add(1, 2))',
+        'function': '{title:uppercase()} {series:|[|]}{authors:\'strcat($, " ", lowercase("X"))\'}',
+    }
+    cache = Cache(DB(os.path.expanduser(path)))
+    cache.init()
+    all_ids = cache.all_book_ids()
+    print('Library has %d books' % len(all_ids))
+    for name, template in templates.iteritems():
+        for i in xrange(repeat):
+            compiled_programs.clear()
+            st = time.time()
+            for book_id in all_ids:
+                mi = cache.get_proxy_metadata(book_id)
+                mi.formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi)
+            print('%s template: %.1f us per book' % (name, (time.time() - st) * 1e6 / max(1, len(all_ids))))
+    cache.close()
+
+
 if __name__ == '__main__':
-    main()
+    if 'columnar' in sys.argv[1:]:
+        benchmark_columnar()
+    elif 'multisort' in sys.argv[1:]:
+        benchmark_multisort()
+    elif 'metadata' in sys.argv[1:]:
+        benchmark_metadata()
+    elif 'templates' in sys.argv[1:]:
+        benchmark_templates()
+    else:
+        main()
@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import datetime
+import datetime, os
 from io import BytesIO
 from time import time
 
@@ -214,6 +214,38 @@ class ReadingTest(BaseTest):
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
     # }}}
 
+    def test_sort_key_cache(self):  # {{{
+        ' Test the caching of sort keys and ranks used by multisort '
+        from calibre.db.sorting import CollationKeyCache
+        from calibre.utils.icu import sort_key
+        ae = self.assertEqual
+        cache = self.init_cache()
+        sorts = ([('series', True), ('title', False)], [('authors', True), ('tags', False)],
+                 [('#yesno', True), ('rating', False), ('id', True)], [('publisher', False), ('title', True)])
+
+        def check():
+            other = self.init_cache(cache.backend.library_path)
+            for s in sorts:
+                ae(cache.multisort(s), other.multisort(s), 'Sorting by %s failed' % (s,))
+        check()
+        cache.set_field('title', {1:'zzz'})
+        cache.set_field('series_index', {2:0.5})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One'):'aaa'})
+        cache.set_field('#yesno', {3:True})
+        check()
+        ae(cache.sort_key_cache.fields['series'].dependencies, {'series', 'series_index', 'languages'})
+        cache.remove_books((1,))
+        check()
+
+        path = os.path.join(self.library_path, 'sort-keys.msgpack')
+        ck = CollationKeyCache(path)
+        ae(ck('Abc'), sort_key('Abc'))
+        ck.save()
+        ck = CollationKeyCache(path)
+        ck.load()
+        ae(ck.keys, {'Abc':sort_key('Abc')})
+    # }}}
+
     def test_get_metadata(self):  # {{{
         'Test get_metadata() returns the same data for both backends'
         from calibre.library.database2 import LibraryDatabase2
@@ -232,9 +264,21 @@ class ReadingTest(BaseTest):
 
         new_metadata = {i:cache.get_metadata(
             i, get_cover=True, cover_as_data=True) for i in xrange(1, 4)}
-        cache = None
         for mi2, mi1 in zip(new_metadata.values(), old_metadata.values()):
             self.compare_metadata(mi1, mi2)
+
+        # Check that no mutable state is shared between Metadata objects
+        from calibre.ebooks.metadata.book.base import Metadata, NULL_VALUES
+        mi1, mi2 = Metadata(None), Metadata(None)
+        mi1.tags.append('x'), mi1.identifiers.update({'isbn': '1'}), mi1.authors.append('y')
+        self.assertEqual((mi2.tags, mi2.identifiers, mi2.authors), ([], {}, [_('Unknown')]))
+        self.assertEqual((NULL_VALUES['tags'], NULL_VALUES['identifiers']), ([], {}))
+        mi1, mi2 = cache.get_metadata(1), cache.get_metadata(1)
+        mi1.set('#tags', ['changed'])
+        mi1.get_user_metadata('#tags', False)['name'] = 'changed'
+        self.assertNotEqual(mi2.get('#tags'), ['changed'])
+        self.assertNotEqual(mi2.get_user_metadata('#tags', False)['name'], 'changed')
+        self.assertNotEqual(cache.field_metadata['#tags']['name'], 'changed')
     # }}}
 
     def test_serialize_metadata(self):  # {{{
@@ -518,38 +562,18 @@ class ReadingTest(BaseTest):
 
     def test_search_caching(self):  # {{{
         ' Test caching of searches '
-        from calibre.db.search import LRUCache
-
-        class TestCache(LRUCache):
-            hit_counter = 0
-            miss_counter = 0
-
-            def get(self, key, default=None):
-                ans = LRUCache.get(self, key, default=default)
-                if ans is not None:
-                    self.hit_counter += 1
-                else:
-                    self.miss_counter += 1
-
-            @property
-            def cc(self):
-                self.hit_counter = self.miss_counter = 0
-
-            @property
-            def counts(self):
-                return self.hit_counter, self.miss_counter
-
+        from calibre.db.search import CompactBookSet
         cache = self.init_cache()
-        cache._search_api.cache = c = TestCache()
+        c = cache._search_api.cache
 
         ae = self.assertEqual
 
         def test(hit, result, *args, **kw):
-            c.cc
-            num = kw.get('num', 2)
+            c.reset_stats()
             ae(cache.search(*args), result)
-            ae(c.counts, (num, 0) if hit else (0, num))
-            c.cc
+            stats = cache.search_cache_stats()
+            ae(stats['hits'], 1 if hit else 0)
+            ae(bool(stats['misses']), not hit)
 
         test(False, {3}, 'Unknown')
         test(True, {3}, 'Unknown')
@@ -558,18 +582,43 @@ class ReadingTest(BaseTest):
         cache.set_field('title', {3:'xxx'})
         test(False, {3}, 'Unknown')  # cache cleared
         test(True, {3}, 'Unknown')
-        c.limit = 5
+        # Limit the cache to the size of five entries
+        c.clear()
+        c.max_size = 5 * c.entry_size('nomatch_0', CompactBookSet(()))
         for i in range(6):
             test(False, set(), 'nomatch_%s' % i)
-        test(False, {3}, 'Unknown')  # cached search expired
-        test(False, {3}, '', 'unknown', num=1)
-        test(True, {3}, '', 'unknown', num=1)
-        test(True, {3}, 'Unknown', 'unknown', num=1)
+        ae(cache.search_cache_stats()['evictions'], 1)
+        ae(len(c), 5)
+        test(False, set(), 'nomatch_0')  # cached search expired
+        c.max_size = 1024 * 1024
+        test(False, {3}, '', 'unknown')
+        test(True, {3}, '', 'unknown')
+        test(True, {3}, 'Unknown', 'unknown')
         cache._search_api.MAX_CACHE_UPDATE = 100
         test(False, {2, 3}, 'title:=xxx or title:"=Title One"')
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Only queries that depend on a changed field are affected
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        c.clear()
+        test(False, {2}, 'tags:"=Tag One" and not tags:News')
+        test(False, {3}, 'title:=xxx')
+        test(False, {3}, 'xxx')
+        c.reset_stats()
+        cache.set_field('tags', {3:('Tag One',)})
+        ae(cache.search_cache_stats()['invalidations'], 2)
+        test(True, {3}, 'title:=xxx')
+        test(False, {2, 3}, 'tags:"=Tag One" and not tags:News')
+        test(False, {3}, 'xxx')
+        cache._search_api.MAX_CACHE_UPDATE = 100
+        cache.set_field('title', {1:'xxx'})
+        test(True, {1, 3}, 'title:=xxx')
+        test(True, {2, 3}, 'tags:"=Tag One" and not tags:News')
+        test(True, {1, 3}, 'xxx')
+        cache.remove_books((3,))
+        test(True, {1}, 'title:=xxx')
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -678,6 +727,54 @@ class ReadingTest(BaseTest):
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_template_programs(self):  # {{{
+        ' Test compiled template programs, including constant folding '
+        from calibre.utils.formatter import EvalFormatter, compile_program
+        from calibre.utils.formatter_functions import formatter_functions
+        cache = self.init_cache()
+        cache.create_custom_column('prog', 'CC1', 'composite', False, display={
+            'composite_template': 'program: t = field("title"); strcat(uppercase(t), add(1, 2), test(t, "+", "-"))'})
+        cache.create_custom_column('embedded', 'CC2', 'composite', False, display={
+            'composite_template': '{title:\'strcat($, lowercase("X"))\'}'})
+        cache = self.init_cache()
+        for book_id in cache.all_book_ids():
+            title = cache.field_for('title', book_id)
+            self.assertEqual(cache.field_for('#prog', book_id), title.upper() + '3.0+')
+            self.assertEqual(cache.field_for('#embedded', book_id), title + 'x')
+        cache.set_field('title', {1:'changed'})
+        self.assertEqual(cache.field_for('#prog', 1), 'CHANGED3.0+')
+
+        ef = EvalFormatter()
+
+        def t(template, expected, **kwargs):
+            self.assertEqual(ef.safe_format(template, kwargs, 'ERR', None), expected)
+        t('program: a = "x"; strcat(a, a)', 'xx')
+        t('program: assign(a, add(1, 1)); a', '2.0')
+        t('program: strcat("a"; "b", "c")', 'bc')
+        t('{a:|[|]}{b:|[|]}', '[1]', a='1', b='')
+        t('program: nosuch(1)', 'ERR Formatter: unknown function nosuch near  nosuch')
+        t('program: add(1)', 'ERR Formatter: incorrect number of arguments for function add near  )')
+        t('program: missing', 'ERR Formatter: Unknown identifier missing near  missing')
+        t('program: divide(1, 0)', 'ERR float division by zero')
+        self.assertTrue(ef.safe_format('program: add(1, ', {}, 'ERR', None).startswith('ERR'))
+
+        # Calls with constant arguments are evaluated once, unless the
+        # function is replaced
+        prog = compile_program('uppercase(strcat("a", "b"))')
+        self.assertIs(prog, compile_program('uppercase(strcat("a", "b"))'))
+        t('program: uppercase(strcat("a", "b"))', 'AB')
+        funcs = formatter_functions().get_functions().copy()
+
+        class Replaced(object):
+            arg_count = 1
+
+            def eval_(self, formatter, kwargs, mi, locals, val):
+                return 'replaced'
+        funcs['uppercase'] = Replaced()
+        self.assertEqual(ef.safe_format('program: uppercase(strcat("a", "b"))', {}, 'ERR', None,
+                                        template_functions=funcs), 'replaced')
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.ebooks.metadata.book.base import Metadata
@@ -711,3 +808,89 @@ class ReadingTest(BaseTest):
         cache.set_last_read_position(1, 'EPUB', 'user', 'device')
         self.assertFalse(cache.get_last_read_positions(1, 'ePuB', 'user'))
     # }}}
+
+    def test_columnar_storage(self):  # {{{
+        'Test that the compact columnar tables behave the same as the dict based tables'
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        from calibre.db.columnar import BookColumn, LinkColumn, BookSetMap
+        cache = self.init_cache(self.cloned_library)
+        backend = DB(self.cloned_library)
+        backend.columnar_tables = True
+        ccache = Cache(backend)
+        ccache.init()
+        self.assertIsInstance(ccache.fields['title'].table.book_col_map, BookColumn)
+        self.assertIsInstance(ccache.fields['tags'].table.book_col_map, LinkColumn)
+        self.assertIsInstance(ccache.fields['series'].table.col_book_map, BookSetMap)
+
+        def compare():
+            self.assertEqual(cache.all_book_ids(), ccache.all_book_ids())
+            for field in cache.fields:
+                if field in ('ondevice', 'marked'):
+                    continue
+                for book_id in cache.all_book_ids():
+                    self.assertEqual(cache.field_for(field, book_id), ccache.field_for(field, book_id),
+                                     'Field %s differs for book %d' % (field, book_id))
+                if cache.fields[field].is_many:
+                    for item_id in cache.all_field_ids(field):
+                        self.assertEqual(cache.books_for_field(field, item_id), ccache.books_for_field(field, item_id))
+            for query in ('tags:one', 'series:one', 'authors:one', '#tags:two', 'tags:false', '#authors:true', 'title:two'):
+                self.assertEqual(cache.search(query), ccache.search(query), 'Search %s differs' % query)
+            self.assertEqual(cache.multisort([('tags', True), ('title', False)]), ccache.multisort([('tags', True), ('title', False)]))
+
+        compare()
+        # Fold the changes into the arrays after every change
+        import calibre.db.columnar as columnar
+        orig, columnar.MIN_OVERLAY_SIZE = columnar.MIN_OVERLAY_SIZE, 0
+        try:
+            for c in (cache, ccache):
+                c.set_field('tags', {1:('One', 'New Tag'), 2:(), 3:('New Tag',)})
+                c.set_field('series', {1:'A Series One', 2:None, 3:'Another Series'})
+                c.set_field('title', {2:'Changed title'})
+                c.rename_items('tags', {c.get_item_id('tags', 'New Tag'):'Renamed Tag'})
+                c.remove_items('series', (c.get_item_id('series', 'Another Series'),))
+        finally:
+            columnar.MIN_OVERLAY_SIZE = orig
+        self.assertFalse(ccache.fields['tags'].table.book_col_map.overlay)
+        self.assertFalse(ccache.fields['series'].table.col_book_map.overlay)
+        compare()
+        for c in (cache, ccache):
+            c.remove_books((2,))
+        compare()
+        ccache.reload_from_db()
+        self.assertIsInstance(ccache.fields['tags'].table.book_col_map, LinkColumn)
+        compare()
+    # }}}
+
+    def test_search_index(self):  # {{{
+        'Test that searching using the inverted index gives the same results as a full scan'
+        from calibre.ebooks.metadata.book.base import Metadata
+        cache = self.init_cache(self.cloned_library)
+        scan = self.init_cache(self.cloned_library)
+        scan._search_api.search_index.candidate_values = lambda *a: None
+        queries = (
+            'title:one', 'title:"title one"', 'title:=title one', 'title:="Title One"', 'title:~^t.tle',
+            'title:~on(e|x)', 'title:ne', 'tags:one', 'tags:=one', 'tags:="tag one"', 'tags:~g o',
+            'authors:one', 'authors:"author o"', 'series:one', 'publisher:two', '#tags:two', '#enum:one',
+            '#authors:custom', 'one', 'two', '"my comments"', 'languages:eng', 'tags:.tag', 'tags:..one',
+            'title:tîtle', 'title:TITLE', 'title:e o',
+        )
+
+        def check():
+            for q in queries:
+                self.assertEqual(scan.search(q), cache.search(q), 'Search %s differs' % q)
+                cache._search_api.cache.clear(), scan._search_api.cache.clear()
+
+        check()
+        self.assertIn('title', cache._search_api.search_index.indices)
+        for c in (cache, scan):
+            c.set_field('title', {1:'Café Society', 2:'Ørsted'})
+            c.set_field('tags', {1:('New Tag', 'Tag One'), 3:('one more',)})
+            c.rename_items('authors', {c.get_item_id('authors', 'Author One'):'Author Renamed'})
+            c.create_book_entry(Metadata('New one title', ['New One']))
+        queries += ('title:cafe', 'title:orsted', 'title:society', 'tags:new', 'authors:renamed', 'sort:new', 'authors:=new one')
+        check()
+        for c in (cache, scan):
+            c.remove_books((1,))
+        check()
+    # }}}
@@ -639,6 +639,111 @@ class WritingTest(BaseTest):
         test_invalidate()
     # }}}
 
+    def test_category_cache(self):  # {{{
+        ' Test that the cached Tag Browser categories are properly invalidated on writes '
+        cache = self.init_cache()
+
+        def as_tuples(categories):
+            return {k:sorted((t.name, t.id, t.count, t.avg_rating, t.sort, tuple(sorted(t.id_set))) for t in v)
+                    for k, v in categories.iteritems()}
+
+        def test_invalidate():
+            c = self.init_cache()
+            for book_ids in (None, {1, 2}, {3}):
+                self.assertEqual(as_tuples(cache.get_categories(book_ids=book_ids)),
+                                 as_tuples(c.get_categories(book_ids=book_ids)))
+
+        test_invalidate()
+        cache.set_field('tags', {1:('a', 'b'), 2:('a',), 3:()})
+        test_invalidate()
+        cache.set_field('rating', {1:4, 2:8})
+        test_invalidate()
+        cache.set_field('series', {1:'s1', 3:'s1'})
+        test_invalidate()
+        cache.set_field('languages', {1:('fra',)})
+        test_invalidate()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'a'):'b'})
+        test_invalidate()
+        cache.remove_items('tags', (cache.get_item_id('tags', 'b'),))
+        test_invalidate()
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'):'meow'}, update_books=False)
+        test_invalidate()
+        cache.remove_books((2,))
+        test_invalidate()
+    # }}}
+
+    def test_persistent_composite_values(self):  # {{{
+        ' Test the invalidation and persistence of rendered composite column values '
+        from calibre.utils.formatter import template_references
+        self.assertEqual(template_references('{title}{#c:|(|)}'), ({'title', '#c'}, set()))
+        self.assertEqual(template_references('{tags:uppercase()}'), ({'tags'}, {'uppercase'}))
+        self.assertEqual(template_references("program: strcat(field('series'), raw_field(f))"), (None, {'field', 'raw_field', 'strcat'}))
+        self.assertEqual(template_references("{#a:'re($, 'x', 'y')'}"), ({'#a'}, {'re'}))
+        self.assertEqual(template_references("{:'template(\"[[title]] [[#b:lowercase()]]\")'}"), ({'title', '#b'}, {'template', 'lowercase'}))
+
+        cache = self.init_cache()
+        cache.create_custom_column('ct', 'CT', 'composite', False, display={'composite_template':'{title}'})
+        cache.create_custom_column('ctags', 'CTags', 'composite', False, display={'composite_template':'{tags}'})
+        cache.create_custom_column('cct', 'CCT', 'composite', False, display={'composite_template':'x{#ct}'})
+        cache.create_custom_column('cdev', 'CDev', 'composite', False, display={'composite_template':'{ondevice}'})
+        cache.close()
+        cache = self.init_cache()
+        ct, ctags, cct, cdev = (cache.fields[x] for x in ('#ct', '#ctags', '#cct', '#cdev'))
+        self.assertEqual(ct.dependencies, {'title'})
+        self.assertEqual(cct.dependencies, {'title'})
+        self.assertEqual(cdev.dependencies, {'ondevice'})
+        self.assertTrue(ct.is_persistent and ctags.is_persistent and cct.is_persistent)
+        self.assertFalse(cdev.is_persistent)
+        all_ids = cache.all_book_ids()
+        for book_id in all_ids:
+            for f in ('#ct', '#ctags', '#cct', '#cdev'):
+                cache.field_for(f, book_id)
+        cache.set_field('tags', {1:('newtag',)})
+        self.assertIn(1, ct._render_cache)
+        self.assertNotIn(1, ctags._render_cache)
+        self.assertEqual(cache.field_for('#ctags', 1), 'newtag')
+        cache.refresh_ondevice()
+        self.assertIn(1, ct._render_cache)
+        self.assertNotIn(1, cdev._render_cache)
+        cache.close()
+
+        # Values are re-used on restart, unless the book was changed, even by
+        # another process
+        other = self.init_cache()
+        other.set_field('title', {2:'changed'})
+        other.close()
+        cache = self.init_cache()
+        ct = cache.fields['#ct']
+        self.assertEqual(cache.field_for('#ct', 2), 'changed')
+        self.assertIn(3, ct._render_cache)
+        self.assertEqual(cache.field_for('#cct', 2), 'xchanged')
+        self.assertEqual(cache.field_for('#ctags', 1), 'newtag')
+        self.assertEqual(cache.fields['#cdev']._render_cache, {})
+        cache.create_custom_column('cdate', 'CDate', 'composite', False, display={'composite_template':'{#date}'})
+        cache.close()
+
+        # Changing the template of a referenced composite column or the
+        # display settings of a referenced column discards the stored values
+        cache = self.init_cache()
+        for book_id in all_ids:
+            for f in ('#cct', '#cdate', '#ctags'):
+                cache.field_for(f, book_id)
+        self.assertNotEqual(cache.field_for('#cdate', 2), '2011')
+        fm = cache.field_metadata
+        # Change the metadata directly, as the db API would also mark all
+        # books as changed on the next restart
+        cache.backend.set_custom_column_metadata(fm['#ct']['colnum'], display={'composite_template':'{title}y'})
+        cache.backend.set_custom_column_metadata(fm['#date']['colnum'], display={'date_format':'yyyy'})
+        cache.close()
+        cache = self.init_cache()
+        self.assertEqual(cache.field_for('#cct', 2), 'xchangedy')
+        self.assertEqual(cache.field_for('#cdate', 2), '2011')
+        self.assertEqual(cache.field_for('#ctags', 1), 'newtag')
+        self.assertIn(3, cache.fields['#ctags']._render_cache)
+        self.assertNotIn(3, cache.fields['#cct']._render_cache)
+        cache.close()
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         cache = self.init_cache()
@@ -748,3 +853,71 @@ class WritingTest(BaseTest):
         prefs['test mutable'] = {k:k for k in reversed(range(10))}
         self.assertEqual(len(changes), 3, 'The database was written to despite there being no change in value')
     # }}}
+
+    def test_external_changes(self):  # {{{
+        ' Test applying changes made by another process using the change journal '
+        cache = self.init_cache()
+        other = self.init_cache()
+        self.assertEqual(cache.apply_external_changes(), set())
+        other.set_field('title', {1:'changed title'})
+        other.set_field('tags', {2:('x', 'y'), 3:('y',)})
+        other.set_field('#tags', {1:('z',)})
+        other.set_field('series', {3:'new series'})
+        other.set_field('identifiers', {1:{'isbn':'123'}})
+        other.rename_items('authors', {other.get_item_id('authors', 'Author One'):'Author Renamed'})
+        other.remove_formats({1:{'FMT1'}})
+        self.assertEqual(cache.apply_external_changes(), {1, 2, 3})
+        self.assertEqual(cache.search('tags:=y'), {2, 3})
+        for field in ('title', 'tags', '#tags', 'series', 'identifiers', 'authors', 'formats', 'size', 'last_modified', 'author_sort'):
+            for book_id in cache.all_book_ids():
+                self.assertEqual(cache.field_for(field, book_id), other.field_for(field, book_id),
+                                 'Field %s differs for book %d' % (field, book_id))
+        self.assertEqual(cache.apply_external_changes(), set())
+        other.remove_books((2,))
+        self.assertEqual(cache.apply_external_changes(), {2})
+        self.assertEqual(cache.all_book_ids(), {1, 3})
+        self.assertEqual(cache.search('tags:=x'), set())
+        self.assertNotIn(2, cache.fields['tags'].table.book_col_map)
+        # The journal has been pruned past the last seen entry
+        other.set_field('title', {1:'pruned title'})
+        other.backend.execute('DELETE FROM change_journal')
+        other.set_field('title', {1:'another title'})
+        self.assertIsNone(cache.apply_external_changes())
+        self.assertEqual(cache.field_for('title', 1), 'another title')
+        # The full reload must have caught up with the journal
+        other.set_field('title', {3:'after reload'})
+        self.assertEqual(cache.apply_external_changes(), {3})
+        self.assertEqual(cache.field_for('title', 3), 'after reload')
+
+        # All the changes so far were made by other
+        self.assertEqual(other.apply_external_changes(), set())
+
+        # Changes made by this process are not re-applied
+        cache.set_field('title', {1:'own title'})
+        cache.set_field('tags', {1:('own',)})
+        self.assertEqual(cache.apply_external_changes(), set())
+        cache.set_field('title', {1:'own title again'})
+        other.set_field('title', {3:'other title'})
+        self.assertEqual(cache.apply_external_changes(), {1, 3})
+        self.assertEqual(cache.field_for('title', 3), 'other title')
+        # other wrote after cache, so it cannot tell its own changes apart
+        self.assertEqual(other.apply_external_changes(), {1, 3})
+        self.assertEqual(other.field_for('title', 1), 'own title again')
+
+        # The journal is pruned by a trigger
+        backend = cache.backend
+        backend.execute('UPDATE sqlite_sequence SET seq=199990 WHERE name="change_journal"')
+        for i in xrange(20):
+            cache.set_field('title', {1:'title %d' % i})
+        self.assertGreater(backend.current_journal_seq(), 200000)
+        self.assertGreater(backend.execute('SELECT MIN(seq) FROM change_journal').next()[0], 100000)
+        self.assertIsNone(other.apply_external_changes())
+        self.assertEqual(other.field_for('title', 1), 'title 19')
+
+        # Changes to new custom columns are recorded as well
+        num = cache.create_custom_column('newcol', 'New', 'text', True)
+        table, lt = cache.backend.custom_table_names(num)
+        triggers = {x[0] for x in cache.backend.execute('SELECT name FROM sqlite_master WHERE type="trigger"')}
+        self.assertIn('journal_insert_' + table, triggers)
+        self.assertIn('journal_update_' + lt, triggers)
+    # }}}
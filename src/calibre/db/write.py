@@ -366,6 +366,7 @@ def many_one(book_id_val_map, db, field, allow_case_change, *args):
             del table.id_map[item_id]
             table.col_book_map.pop(item_id, None)
 
+    table.compact_storage()
     return dirtied
 # }}}
 
@@ -472,6 +473,7 @@ def many_many(book_id_val_map, db, field, allow_case_change, *args):
                 table.asort_map.pop(item_id, None)
                 table.alink_map.pop(item_id, None)
 
+    table.compact_storage()
     return dirtied
 
 # }}}
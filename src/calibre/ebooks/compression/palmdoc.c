@@ -42,6 +42,11 @@ typedef struct {
 
 #define CHAR(x) (( (x) > 127 ) ? (x)-256 : (x))
 
+// The largest size of the compressed form of len bytes. A byte with the
+// high bit set that is followed by a character that is not is written as two
+// bytes, so compression can make data up to 50% larger.
+#define COMPRESSED_SIZE(len) ((len) + (len)/2 + 16)
+
 static PyObject *
 cpalmdoc_decompress(PyObject *self, PyObject *args) {
     const char *_input = NULL; Py_ssize_t input_len = 0;
@@ -82,51 +87,49 @@ cpalmdoc_decompress(PyObject *self, PyObject *args) {
     return ans;
 }
 
-static bool 
-cpalmdoc_memcmp( Byte *a, Byte *b, Py_ssize_t len) {
-    Py_ssize_t i;
-    for (i = 0; i < len; i++) if (a[i] != b[i]) return false;
-    return true;
-}
-
+// Find the longest earlier copy, of 3 to 10 bytes, of the bytes at pos that
+// does not overlap them and is close enough for its distance to be encoded in
+// 11 bits. Of copies of the same length, the closest is used. Returns the
+// length of the copy and stores its distance in dist, or returns 0 if there is
+// no copy. Scans the window only once, instead of once per length.
 static Py_ssize_t
-cpalmdoc_rfind(Byte *data, Py_ssize_t pos, Py_ssize_t chunk_length) {
-    Py_ssize_t i;
-    for (i = pos - chunk_length; i > -1; i--) 
-        if (cpalmdoc_memcmp(data+i, data+pos, chunk_length)) return i;
-    return pos;
+cpalmdoc_find_repeat(Byte *data, Py_ssize_t pos, Py_ssize_t *dist) {
+    Py_ssize_t j, k, n, best = 0, stop = MAX(0, pos - 2047);
+    for (j = pos - 3; j >= stop; j--) {
+        n = MIN(10, pos - j);
+        for (k = 0; k < n && data[j+k] == data[pos+k]; k++);
+        if (k > best) {
+            best = k; *dist = pos - j;
+            if (best == 10) break;
+        }
+    }
+    return (best < 3) ? 0 : best;
 }
 
 
+// Does not use the Python API, so it can be called without holding the GIL
 static Py_ssize_t
 cpalmdoc_do_compress(buffer *b, char *output) {
     Py_ssize_t i = 0, j, chunk_len, dist;
     unsigned int compound;
     Byte c, n;
-    bool found;
     char *head;
-    buffer temp; 
+    Byte temp_data[8];
+    buffer temp;
     head = output;
-    temp.data = (Byte *)PyMem_Malloc(sizeof(Byte)*8); temp.len = 0;
-    if (temp.data == NULL) return 0;
+    temp.data = temp_data; temp.len = 0;
     while (i < b->len) {
         c = b->data[i];
         //do repeats
         if ( i > 10 && (b->len - i) > 10) {
-            found = false;
-            for (chunk_len = 10; chunk_len > 2; chunk_len--) {
-                j = cpalmdoc_rfind(b->data, i, chunk_len);
-                dist = i - j;
-                if (j < i && dist <= 2047) {
-                    found = true;
-                    compound = (unsigned int)((dist << 3) + chunk_len-3);
-                    *(output++) = CHAR(0x80 + (compound >> 8 ));
-                    *(output++) = CHAR(compound & 0xFF);
-                    i += chunk_len;
-                    break;
-                }
+            chunk_len = cpalmdoc_find_repeat(b->data, i, &dist);
+            if (chunk_len) {
+                compound = (unsigned int)((dist << 3) + chunk_len-3);
+                *(output++) = CHAR(0x80 + (compound >> 8 ));
+                *(output++) = CHAR(compound & 0xFF);
+                i += chunk_len;
+                continue;
             }
-            if (found) continue;
         }
 
         //write single character
@@ -152,7 +155,6 @@ cpalmdoc_do_compress(buffer *b, char *output) {
             for (j=0; j < temp.len; j++) *(output++) = (char)temp.data[j];
         }
     }
-    PyMem_Free(temp.data);
     return output - head;
 }
 
@@ -172,16 +174,82 @@ cpalmdoc_compress(PyObject *self, PyObject *args) {
     b.len = input_len;
     // Make the output buffer larger than the input as sometimes
     // compression results in a larger block
-    output = (char *)PyMem_Malloc(sizeof(char) * (int)(1.25*b.len));
-    if (output == NULL) return PyErr_NoMemory();
+    output = (char *)PyMem_Malloc(sizeof(char) * COMPRESSED_SIZE(b.len));
+    if (output == NULL) { PyMem_Free(b.data); return PyErr_NoMemory(); }
+    Py_BEGIN_ALLOW_THREADS;
     j = cpalmdoc_do_compress(&b, output);
-    if ( j == 0) return PyErr_NoMemory();
+    Py_END_ALLOW_THREADS;
     ans = Py_BuildValue("s#", output, j);
     PyMem_Free(output);
     PyMem_Free(b.data);
     return ans;
 }
 
+static PyObject *
+cpalmdoc_compress_records(PyObject *self, PyObject *args) {
+    PyObject *records = NULL, *seq = NULL, *offsets = NULL, *ans = NULL, *item;
+    buffer *bufs = NULL;
+    char *output = NULL, *_input;
+    Py_ssize_t num = 0, i, j, total = 0, pos = 0, *sizes = NULL;
+
+    if (!PyArg_ParseTuple(args, "O", &records)) return NULL;
+    seq = PySequence_Fast(records, "records must be a sequence of bytestrings");
+    if (seq == NULL) return NULL;
+    num = PySequence_Fast_GET_SIZE(seq);
+    bufs = (buffer *)PyMem_Malloc(sizeof(buffer) * MAX(num, 1));
+    sizes = (Py_ssize_t *)PyMem_Malloc(sizeof(Py_ssize_t) * MAX(num, 1));
+    if (bufs == NULL || sizes == NULL) { PyErr_NoMemory(); goto end; }
+    for (i = 0; i < num; i++) bufs[i].data = NULL;
+
+    // Map chars to bytes
+    for (i = 0; i < num; i++) {
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyBytes_Check(item)) {
+            PyErr_SetString(PyExc_TypeError, "records must be a sequence of bytestrings");
+            goto end;
+        }
+        _input = PyBytes_AS_STRING(item);
+        bufs[i].len = PyBytes_GET_SIZE(item);
+        bufs[i].data = (Byte *)PyMem_Malloc(sizeof(Byte) * MAX(bufs[i].len, 1));
+        if (bufs[i].data == NULL) { PyErr_NoMemory(); goto end; }
+        for (j = 0; j < bufs[i].len; j++)
+            bufs[i].data[j] = (_input[j] < 0) ? _input[j]+256 : _input[j];
+        total += COMPRESSED_SIZE(bufs[i].len);
+    }
+    output = (char *)PyMem_Malloc(sizeof(char) * MAX(total, 1));
+    if (output == NULL) { PyErr_NoMemory(); goto end; }
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (i = 0; i < num; i++) {
+        sizes[i] = bufs[i].len ? cpalmdoc_do_compress(bufs + i, output + pos) : 0;
+        pos += sizes[i];
+    }
+    Py_END_ALLOW_THREADS;
+
+    offsets = PyTuple_New(num + 1);
+    if (offsets == NULL) goto end;
+    PyTuple_SET_ITEM(offsets, 0, PyInt_FromSsize_t(0));
+    for (i = 0, pos = 0; i < num; i++) {
+        pos += sizes[i];
+        PyTuple_SET_ITEM(offsets, i + 1, PyInt_FromSsize_t(pos));
+    }
+    for (i = 0; i <= num; i++) {
+        if (PyTuple_GET_ITEM(offsets, i) == NULL) goto end;
+    }
+    ans = Py_BuildValue("s#O", output, pos, offsets);
+
+end:
+    if (bufs != NULL) {
+        for (i = 0; i < num; i++) { if (bufs[i].data != NULL) PyMem_Free(bufs[i].data); }
+        PyMem_Free(bufs);
+    }
+    if (sizes != NULL) PyMem_Free(sizes);
+    if (output != NULL) PyMem_Free(output);
+    Py_XDECREF(offsets);
+    Py_DECREF(seq);
+    return ans;
+}
+
 static PyMethodDef cPalmdocMethods[] = {
     {"decompress", cpalmdoc_decompress, METH_VARARGS,
     "decompress(bytestring) -> decompressed bytestring\n\n"
@@ -192,6 +260,14 @@ static PyMethodDef cPalmdocMethods[] = {
     "compress(bytestring) -> compressed bytestring\n\n"
     		"Palmdoc compress a byte string. "
     },
+
+    {"compress_records", cpalmdoc_compress_records, METH_VARARGS,
+    "compress_records(sequence of bytestrings) -> (compressed bytestring, offsets)\n\n"
+    		"Palmdoc compress every byte string in the sequence separately. Returns the "
+    		"concatenation of the compressed byte strings and a tuple of their offsets in it, "
+    		"which has one more item than the sequence, the length of the concatenation. "
+    		"The GIL is released while compressing."
+    },
     {NULL, NULL, 0, NULL}
 };
 
@@ -7,7 +7,9 @@ __copyright__ = '2008, Kovid Goyal <kovid at kovidgoyal.net>'
 
 from cStringIO import StringIO
 from struct import pack
+from threading import Thread
 
+from calibre import detect_ncpus
 from calibre.constants import plugins
 cPalmdoc = plugins['cPalmdoc'][0]
 if not cPalmdoc:
@@ -25,6 +27,45 @@ def compress_doc(data):
     return cPalmdoc.compress(data)
 
 
+def compress_doc_records(records, max_threads=None, min_records_per_thread=64):
+    '''
+    Compress every bytestring in records separately, returning the list of
+    compressed bytestrings. Many records are split into batches that are
+    compressed in parallel by several threads, since the compressor does not
+    hold the GIL.
+    '''
+    records = list(records)
+    if max_threads is None:
+        max_threads = detect_ncpus()
+    num = max(1, min(max_threads, len(records) // min_records_per_thread))
+    size = -(-len(records) // num)
+    batches = [records[i:i+size] for i in xrange(0, len(records), size)]
+    results = [None] * len(batches)
+
+    def compress(i):
+        try:
+            results[i] = cPalmdoc.compress_records(batches[i]), None
+        except Exception as err:
+            results[i] = None, err
+
+    threads = [Thread(target=compress, args=(i,), name='PalmdocCompress') for i in xrange(1, len(batches))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    if batches:
+        compress(0)
+    for t in threads:
+        t.join()
+
+    ans = []
+    for result, err in results:
+        if err is not None:
+            raise err
+        data, offsets = result
+        ans.extend(data[offsets[i]:offsets[i+1]] for i in xrange(len(offsets) - 1))
+    return ans
+
+
 def test():
     TESTS = [
             'abc\x03\x04\x05\x06ms',  # Test binary writing
@@ -46,6 +87,11 @@ def test():
         print('\t\t', repr(decompress_doc(x)))
         assert decompress_doc(x) == test
         print()
+    print('Testing compression of records...')
+    records = TESTS + ['', '\x80a' * 3000]
+    for max_threads in (1, 3):
+        x = compress_doc_records(records * 50, max_threads=max_threads, min_records_per_thread=20)
+        assert x == [compress_doc(r) if r else b'' for r in records * 50]
 
 
 def py_compress_doc(data):
@@ -183,6 +183,8 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'document_memory_limit',
+                     'transform_workers',
                      ]
                     )),
               (_('LOOK AND FEEL') , (
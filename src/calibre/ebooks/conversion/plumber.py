@@ -94,6 +94,7 @@ class Plumber(object):
             output = output.decode(filesystem_encoding)
         self.original_input_arg = input
         self.for_regex_wizard = for_regex_wizard
+        self.memory_at_start = None
         self.input = os.path.abspath(input)
         self.output = os.path.abspath(output)
         self.log = log
@@ -124,6 +125,27 @@ OptionRecommendation(name='debug_pipeline',
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='document_memory_limit',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Approximate limit, in MB, for the memory used to hold the '
+                   'parsed HTML files of the book during conversion. When it '
+                   'is exceeded, the least recently used files are written to '
+                   'temporary files and read back when they are needed. '
+                   'Useful when converting very large books or when running '
+                   'many conversions at once. The default of zero means no limit.')
+        ),
+
+OptionRecommendation(name='transform_workers',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Number of worker processes used to run the transforms that '
+                   'work on each HTML file of the book separately, such as '
+                   'the flattening of CSS. Useful for converting books with '
+                   'many large HTML files on computers with many CPU cores. '
+                   'Use -1 for as many workers as there are CPU cores. The '
+                   'default of zero runs these transforms in the conversion '
+                   'process itself.')
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1041,6 +1063,7 @@ OptionRecommendation(name='search_replace',
         '''
         Run the conversion pipeline
         '''
+        self.memory_at_start = self.memory_usage()
         # Setup baseline option values
         self.setup_options()
         if self.opts.verbose:
@@ -1117,6 +1140,8 @@ OptionRecommendation(name='search_replace',
                     for_regex_wizard=self.for_regex_wizard, removed_items=getattr(self.input_plugin, 'removed_items_to_ignore', ()))
             if self.for_regex_wizard:
                 return
+            if self.oeb.document_cache is None:
+                self.oeb.set_memory_budget(self.opts.document_memory_limit * 1024**2)
             self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
             self.opts.is_image_collection = self.input_plugin.is_image_collection
             pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
@@ -1215,6 +1240,13 @@ OptionRecommendation(name='search_replace',
             transform_css_rules = self.opts.transform_css_rules
             if isinstance(transform_css_rules, basestring):
                 transform_css_rules = json.loads(transform_css_rules)
+        parallel = None
+        if self.opts.transform_workers:
+            from calibre import detect_ncpus
+            from calibre.ebooks.oeb.transforms.parallel import ParallelTransforms
+            workers = self.opts.transform_workers
+            parallel = ParallelTransforms(self.oeb, self.opts,
+                    max_workers=detect_ncpus() if workers < 0 else workers)
         flattener = CSSFlattener(fbase=fbase, fkey=fkey,
                 lineh=line_height,
                 untable=needs_old_markup,
@@ -1223,8 +1255,12 @@ OptionRecommendation(name='search_replace',
                     'lit'),
                 transform_css_rules=transform_css_rules,
                 specializer=partial(self.output_plugin.specialize_css_for_output,
-                    self.log, self.opts))
-        flattener(self.oeb, self.opts)
+                    self.log, self.opts), parallel=parallel)
+        try:
+            flattener(self.oeb, self.opts)
+        finally:
+            if parallel is not None:
+                parallel.shutdown()
         self.opts._final_base_font_size = fbase
 
         self.opts.insert_blank_line = oibl
@@ -1273,8 +1309,35 @@ OptionRecommendation(name='search_replace',
         run_plugins_on_postprocess(self.output, self.output_fmt)
 
         self.log(self.output_fmt.upper(), 'output written to', self.output)
+        self.report_memory_usage()
         self.flush()
 
+    def memory_usage(self):
+        from calibre.utils.mem import get_memory, get_peak_memory
+        try:
+            return get_memory(), get_peak_memory()
+        except Exception:
+            return None
+
+    def report_memory_usage(self):
+        # The peak memory usage is for the whole lifetime of the process, which
+        # can have run other conversions before this one, so it is compared to
+        # the memory usage at the start of this conversion
+        start, end = self.memory_at_start, self.memory_usage()
+        if start is None or end is None:
+            return
+        mb = lambda x: x / float(1024**2)
+        (used, peak_before), peak = start, end[1]
+        if peak > peak_before:
+            msg = 'Peak memory usage: %.1f MB, %.1f MB more than at the start of the conversion' % (
+                mb(peak), mb(peak - used))
+        else:
+            msg = 'Peak memory usage: lower than the peak of %.1f MB before the start of the conversion' % mb(peak_before)
+        dc = self.oeb.document_cache
+        if dc is not None:
+            msg += ', HTML files unloaded from memory: %d times' % dc.unloaded_count
+        self.log(msg)
+
 
 # This has to be global as create_oebbook can be called from other locations
 # (for example in the html input plugin)
@@ -1297,6 +1360,7 @@ def create_oebbook(log, path_or_stream, opts, reader=None,
         encoding = None
     oeb = OEBBook(log, html_preprocessor,
             pretty_print=opts.pretty_print, input_encoding=encoding)
+    oeb.set_memory_budget(getattr(opts, 'document_memory_limit', 0) * 1024**2)
     if not populate:
         return oeb
     if specialize is not None:
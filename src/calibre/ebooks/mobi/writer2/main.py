@@ -13,7 +13,7 @@ from struct import pack
 
 from calibre.ebooks import normalize
 from calibre.ebooks.mobi.writer2.serializer import Serializer
-from calibre.ebooks.compression.palmdoc import compress_doc
+from calibre.ebooks.compression.palmdoc import compress_doc_records
 from calibre.ebooks.mobi.langcodes import iana2mobi
 from calibre.utils.filenames import ascii_filename
 from calibre.ebooks.mobi.writer2 import (PALMDOC, UNCOMPRESSED)
@@ -169,11 +169,15 @@ class MobiWriter(object):
         if self.compression != UNCOMPRESSED:
             self.oeb.logger.info('  Compressing markup content...')
 
+        records, overlaps = [], []
         while text.tell() < self.text_length:
             data, overlap = create_text_record(text)
-            if self.compression == PALMDOC:
-                data = compress_doc(data)
+            records.append(data)
+            overlaps.append(overlap)
+        if self.compression == PALMDOC:
+            records = compress_doc_records(records)
 
+        for data, overlap in zip(records, overlaps):
             data += overlap
             data += pack(b'>B', len(overlap))
 
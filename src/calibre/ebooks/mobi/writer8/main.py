@@ -20,7 +20,7 @@ from lxml import etree
 from calibre import isbytestring, force_unicode
 from calibre.ebooks.mobi.utils import (create_text_record, to_base,
         is_guide_ref_start)
-from calibre.ebooks.compression.palmdoc import compress_doc
+from calibre.ebooks.compression.palmdoc import compress_doc_records
 from calibre.ebooks.oeb.base import (OEB_DOCS, OEB_STYLES, SVG_MIME, XPath,
         extract, XHTML, urlnormalize)
 from calibre.ebooks.oeb.normalize_css import condense_sheet
@@ -345,12 +345,16 @@ class KF8Writer(object):
         if self.compress:
             self.oeb.logger.info('\tCompressing markup...')
 
+        records, overlaps = [], []
         while text.tell() < self.text_length:
             data, overlap = create_text_record(text)
             self.uncompressed_record_lengths.append(len(data))
-            if self.compress:
-                data = compress_doc(data)
+            records.append(data)
+            overlaps.append(overlap)
+        if self.compress:
+            records = compress_doc_records(records)
 
+        for data, overlap in zip(records, overlaps):
             data += overlap
             data += pack(b'>B', len(overlap))
 
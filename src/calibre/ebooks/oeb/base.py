@@ -6,8 +6,8 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import os, re, logging
-from collections import defaultdict
+import os, re, logging, sys
+from collections import defaultdict, OrderedDict
 from itertools import count
 from urlparse import urldefrag, urlparse, urlunparse, urljoin
 from urllib import unquote
@@ -1042,13 +1042,19 @@ class Manifest(object):
                     data = self._parse_txt(data)
                     self.media_type = XHTML_MIME
                 self._data = data
+                if self.oeb.document_cache is not None and mt in OEB_DOCS:
+                    self.oeb.document_cache.touch(self)
                 return data
 
             def fset(self, value):
                 self._data = value
+                if self.oeb.document_cache is not None:
+                    self.oeb.document_cache.discard(self)
 
             def fdel(self):
                 self._data = None
+                if self.oeb.document_cache is not None:
+                    self.oeb.document_cache.discard(self)
             return property(fget, fset, fdel, doc=doc)
 
         def unload_data_from_memory(self, memory=None):
@@ -1167,6 +1173,8 @@ class Manifest(object):
         """Removes :param:`item` from the manifest."""
         if item in self.ids:
             item = self.ids[item]
+        if self.oeb.document_cache is not None:
+            self.oeb.document_cache.discard(item)
         del self.ids[item.id]
         if item.href in self.hrefs:
             del self.hrefs[item.href]
@@ -1761,6 +1769,104 @@ class PageList(object):
         return pmap
 
 
+class DocumentCache(object):
+
+    """Keeps the parsed (X)HTML documents of a book within a memory budget.
+
+    When the estimated memory used by the parsed documents exceeds the budget,
+    the least recently used documents are serialized to temporary files and
+    transparently re-parsed when their :attr:`Manifest.Item.data` is next
+    accessed. A document is never unloaded while any of its elements is
+    referenced from outside the manifest item, for example by a transform that
+    is still working on it, as changes made through that reference would be
+    lost.
+    """
+
+    # Approximate memory used by a parsed node, including its text and
+    # attributes
+    NODE_SIZE = 256
+    # The number of documents checked for being unloadable, every time a
+    # document is loaded
+    MAX_CHECKS = 8
+
+    def __init__(self, oeb, budget):
+        self.oeb = oeb
+        self.budget = budget
+        self.loaded = OrderedDict()
+        self.total = 0
+        self.unloaded_count = 0
+        self.parser = etree.XMLParser(
+            no_network=True, resolve_entities=False, huge_tree=True, remove_blank_text=False)
+
+    def size_of(self, root):
+        return int(root.xpath('count(//node()|//@*)')) * self.NODE_SIZE
+
+    def touch(self, item):
+        if item in self.loaded:
+            # Mark as most recently used
+            self.loaded[item] = self.loaded.pop(item)
+            return
+        if not isinstance(item._data, etree._Element):
+            return
+        size = self.size_of(item._data)
+        self.loaded[item] = size
+        self.total += size
+        if self.total > self.budget:
+            self.unload_documents(item)
+
+    def discard(self, item):
+        size = self.loaded.pop(item, None)
+        if size is not None:
+            self.total -= size
+
+    def unload_documents(self, current):
+        checked = []
+        for item in tuple(self.loaded):
+            if self.total <= self.budget or len(checked) >= self.MAX_CHECKS:
+                break
+            if item is current:
+                continue
+            if not self.unload(item):
+                checked.append(item)
+        for item in checked:
+            # Documents that are in use are checked again only after the
+            # other documents
+            self.touch(item)
+
+    def unload(self, item):
+        root = item._data
+        if not isinstance(root, etree._Element):
+            self.discard(item)
+            return True
+        # Any references other than those from item._data, the variables in
+        # this function and the argument to getrefcount() mean that the
+        # document is in use
+        if sys.getrefcount(root) > 3:
+            return False
+        for elem in root.iterdescendants():
+            if sys.getrefcount(elem) > 2:
+                return False
+        from calibre.ptempfile import PersistentTemporaryFile
+        pt = PersistentTemporaryFile(suffix='_oeb_base_doc_unloader.xml')
+        with pt:
+            pt.write(etree.tostring(root.getroottree(), encoding='utf-8'))
+        self.oeb._temp_files.append(pt.name)
+        root = elem = None
+        orig_loader, parser = item._loader, self.parser
+
+        def loader(*args):
+            item._loader = orig_loader
+            with open(pt.name, 'rb') as f:
+                raw = f.read()
+            os.remove(pt.name)
+            return etree.fromstring(raw, parser=parser)
+        item._loader = loader
+        item._data = None
+        self.discard(item)
+        self.unloaded_count += 1
+        return True
+
+
 class OEBBook(object):
     """Representation of a book in the IDPF OEB data model."""
 
@@ -1820,6 +1926,19 @@ class OEBBook(object):
         self.pages = PageList()
         self.auto_generated_toc = True
         self._temp_files = []
+        self.document_cache = None
+
+    def set_memory_budget(self, budget):
+        """Limit the memory used by parsed (X)HTML documents to approximately
+        :param:`budget` bytes, see :class:`DocumentCache`. A budget of zero
+        means no limit."""
+        if budget > 0:
+            self.document_cache = DocumentCache(self, budget)
+            for item in self.manifest:
+                if item.media_type in OEB_DOCS:
+                    self.document_cache.touch(item)
+        else:
+            self.document_cache = None
 
     def clean_temp_files(self):
         for path in self._temp_files:
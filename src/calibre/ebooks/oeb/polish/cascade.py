@@ -12,7 +12,7 @@ import re
 
 from css_parser.css import CSSStyleSheet, CSSRule, Property
 
-from css_selectors import Select, INAPPROPRIATE_PSEUDO_CLASSES, SelectorError
+from css_selectors import Select, INAPPROPRIATE_PSEUDO_CLASSES
 from calibre import as_unicode
 from calibre.ebooks.css_transform_rules import all_properties
 from calibre.ebooks.oeb.base import OEB_STYLES, XHTML
@@ -166,26 +166,17 @@ def resolve_styles(container, name, select=None, sheet_callback=None):
     pseudo_style_map = defaultdict(list)
     rule_index_counter = count()
     pseudo_pat = re.compile(u':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
+    rules = []
 
     def process_sheet(sheet, sheet_name):
         if sheet_callback is not None:
             sheet_callback(sheet, sheet_name)
         for rule, sheet_name, rule_index in iterrules(container, sheet_name, rules=sheet, rule_index_counter=rule_index_counter, rule_type='STYLE_RULE'):
+            style = normalize_style_declaration(rule.style, sheet_name)
             for selector in rule.selectorList:
                 text = selector.selectorText
-                try:
-                    matches = tuple(select(text))
-                except SelectorError as err:
-                    container.log.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
-                    continue
                 m = pseudo_pat.search(text)
-                style = normalize_style_declaration(rule.style, sheet_name)
-                if m is None:
-                    for elem in matches:
-                        style_map[elem].append(StyleDeclaration(specificity(rule_index, selector), style, None))
-                else:
-                    for elem in matches:
-                        pseudo_style_map[elem].append(StyleDeclaration(specificity(rule_index, selector), style, m.group(1)))
+                rules.append((text, StyleDeclaration(specificity(rule_index, selector), style, None if m is None else m.group(1))))
 
     process_sheet(html_css_stylesheet(container), 'user-agent.css')
 
@@ -211,6 +202,14 @@ def resolve_styles(container, name, select=None, sheet_callback=None):
                 continue
         process_sheet(sheet, sheet_name)
 
+    def on_error(text, decl, err):
+        container.log.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
+
+    # Match the rules from all the sheets in a single pass over the tree
+    for elem, decls in select.match_rules(rules, on_error=on_error):
+        for decl in decls:
+            (style_map if decl.pseudo_element is None else pseudo_style_map)[elem].append(decl)
+
     for elem in root.xpath('//*[@style]'):
         text = elem.get('style')
         if text:
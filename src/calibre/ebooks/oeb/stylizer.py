@@ -8,8 +8,11 @@ from __future__ import with_statement
 __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
-import os, re, logging, copy, unicodedata
+import os, re, logging, copy, unicodedata, hashlib
+from collections import OrderedDict
+from functools import partial
 from weakref import WeakKeyDictionary
+from lxml import etree
 from xml.dom import SyntaxErr as CSSSyntaxError
 from css_parser.css import (CSSStyleRule, CSSPageRule, CSSFontFaceRule,
         cssproperties)
@@ -19,7 +22,7 @@ from calibre import force_unicode, as_unicode
 from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import XHTML, XHTML_NS, CSS_MIME, OEB_STYLES, xpath, urlnormalize
 from calibre.ebooks.oeb.normalize_css import DEFAULTS, normalizers
-from css_selectors import Select, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES
+from css_selectors import Select, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES, parse as parse_selector
 from tinycss.media3 import CSSMedia3Parser
 
 css_parser_log.setLevel(logging.WARN)
@@ -94,6 +97,162 @@ def test_media_ok():
     assert not media_ok('screen and (device-width:10px)')
 
 
+def sheet_fingerprint(sheet):
+    ''' Return the objects that change whenever the rules of sheet are
+    changed, together with the number of rules and declarations. Changing a
+    rule via the css_parser API replaces its selector list or the sequence of
+    its declarations, or that of the value of one of the declarations, so
+    comparing the identities of these objects is enough to detect changes,
+    without the cost of serializing the sheet. '''
+    objects, sizes = [], []
+
+    def add(rules):
+        objects.append(rules)
+        sizes.append(len(rules))
+        for rule in rules:
+            objects.append(rule)
+            if rule.type == rule.MEDIA_RULE:
+                sizes.append(rule.media.mediaText)
+                add(rule.cssRules)
+                continue
+            objects.append(getattr(rule, 'selectorList', None))
+            style = getattr(rule, 'style', None)
+            if style is not None:
+                objects.append(style.seq)
+                sizes.append(len(style.seq))
+                for item in style.seq:
+                    val = getattr(item.value, 'propertyValue', None)
+                    if val is not None:
+                        objects.append(val.seq)
+    add(sheet.cssRules)
+    return objects, sizes
+
+
+class FlatSheet(object):
+
+    ''' The rules of a stylesheet, flattened by :meth:`Stylizer.flatten_style`.
+    Rules are stored as (specificity, selector, style, selector text), where
+    the last element of specificity is the index of the rule in the sheet. '''
+
+    def __init__(self, sheet, stylizer):
+        self.objects, self.sizes = sheet_fingerprint(sheet)
+        self.rules = []
+        self.page_style = {}
+        self.font_face_rules = []
+        index = 0
+        for rule in sheet.cssRules:
+            if rule.type == rule.MEDIA_RULE:
+                if media_ok(rule.media.mediaText):
+                    for subrule in rule.cssRules:
+                        self.flatten_rule(subrule, index, stylizer)
+                        index += 1
+            else:
+                self.flatten_rule(rule, index, stylizer)
+                index += 1
+        self.count = index
+
+    def flatten_rule(self, rule, index, stylizer):
+        if isinstance(rule, CSSStyleRule):
+            style = stylizer.flatten_style(rule.style)
+            for selector in rule.selectorList:
+                self.rules.append((selector.specificity + (index,), list(selector.seq), style, selector.selectorText))
+        elif isinstance(rule, CSSPageRule):
+            self.page_style.update(stylizer.flatten_style(rule.style))
+        elif isinstance(rule, CSSFontFaceRule):
+            if rule.style.length > 1:
+                # Ignore the meaningless font face rules generated by the
+                # benighted MS Word that contain only a font-family declaration
+                # and nothing else
+                self.font_face_rules.append(rule)
+
+    def is_current(self, sheet):
+        objects, sizes = sheet_fingerprint(sheet)
+        return sizes == self.sizes and len(objects) == len(self.objects) and all(
+            a is b for a, b in zip(objects, self.objects))
+
+
+class StyleCache(object):
+
+    '''
+    Work shared by all the :class:`Stylizer` objects created for a book, so
+    that transforms that each stylize every file in the book do not have to
+    re-parse the same CSS, flatten the same stylesheets and match the same
+    selectors against unchanged documents over and over. Cached results are
+    checked against the current state of the stylesheets and documents
+    before being used, so transforms are free to change either.
+    '''
+
+    def __init__(self):
+        self.sheets = {}
+        self.flat_sheets = WeakKeyDictionary()
+        self.selectors = {}
+        self.matches = {}
+
+    def parsed_sheet(self, key, parse):
+        ''' Return the sheet parsed from CSS source by parse(). key must
+        identify the source and everything else that parse() depends on. The
+        returned sheet must not be modified. '''
+        try:
+            return self.sheets[key]
+        except KeyError:
+            sheet = parse()
+            # The contents of sheets imported by @import rules can change
+            if not any(rule.type == rule.IMPORT_RULE for rule in sheet.cssRules):
+                self.sheets[key] = sheet
+            return sheet
+
+    def flat_sheet(self, sheet, stylizer):
+        flat_sheets = self.flat_sheets.get(sheet)
+        if flat_sheets is None:
+            self.flat_sheets[sheet] = flat_sheets = {}
+        ans = flat_sheets.get(stylizer.context)
+        if ans is None or not ans.is_current(sheet):
+            flat_sheets[stylizer.context] = ans = FlatSheet(sheet, stylizer)
+        return ans
+
+    def parsed_selector(self, text):
+        try:
+            ans = self.selectors[text]
+        except KeyError:
+            try:
+                ans = parse_selector(text)
+            except SelectorError as err:
+                ans = err
+            self.selectors[text] = ans
+        if isinstance(ans, SelectorError):
+            raise ans
+        return ans
+
+    def fingerprint(self, tree):
+        return hashlib.sha1(etree.tostring(tree)).digest()
+
+    def matches_for(self, path, tree):
+        ''' Return an empty dict in which to store the elements matched by
+        selectors when stylizing the document at path, and a dict mapping
+        selectors to the elements they matched the last time the document was
+        stylized, if it has not changed since. '''
+        matched, cached = {}, {}
+        entry = self.matches.get(path)
+        if entry is not None:
+            fingerprint, indices = entry
+            if fingerprint == self.fingerprint(tree):
+                elements = tuple(tree.iter())
+                cached = {text: tuple(elements[i] for i in idx) for text, idx in indices.iteritems()}
+        return matched, cached
+
+    def store_matches(self, path, tree, matched):
+        elements = {elem: i for i, elem in enumerate(tree.iter())}
+        self.matches[path] = self.fingerprint(tree), {
+            text: tuple(elements[elem] for elem in matches) for text, matches in matched.iteritems()}
+
+
+def style_cache(oeb):
+    ans = getattr(oeb, 'style_cache', None)
+    if ans is None:
+        ans = oeb.style_cache = StyleCache()
+    return ans
+
+
 class Stylizer(object):
     STYLESHEETS = WeakKeyDictionary()
 
@@ -119,8 +278,10 @@ class Stylizer(object):
         basename = os.path.basename(path)
         cssname = os.path.splitext(basename)[0] + '.css'
         stylesheets = [html_css_stylesheet()]
+        cache = style_cache(oeb)
+        self.context = (self.profile.fbase, tuple(sorted(self.profile.fnames.iteritems())), self.opts.change_justification)
         if base_css:
-            stylesheets.append(parseString(base_css, validate=False))
+            stylesheets.append(cache.parsed_sheet(('base', base_css), partial(parseString, base_css, validate=False)))
         style_tags = xpath(tree, '//*[local-name()="style" or local-name()="link"]')
 
         # Add css_parser parsing profiles from output_profile
@@ -143,12 +304,7 @@ class Stylizer(object):
                     if t:
                         text += u'\n\n' + force_unicode(t, u'utf-8')
                 if text:
-                    text = oeb.css_preprocessor(text)
-                    # We handle @import rules separately
-                    parser.setFetcher(lambda x: ('utf-8', b''))
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
-                    parser.setFetcher(self._fetch_css_file)
+                    stylesheet = cache.parsed_sheet(('style', item.href, text), partial(self.parse_style_tag, parser, text, item, cssname))
                     for rule in stylesheet.cssRules:
                         if rule.type == rule.IMPORT_RULE:
                             ihref = item.abshref(rule.href)
@@ -163,10 +319,6 @@ class Stylizer(object):
                                 self.logger.warn('CSS @import of non-CSS file %r' % rule.href)
                                 continue
                             stylesheets.append(sitem.data)
-                    # Make links to resources absolute, since these rules will
-                    # be folded into a stylesheet at the root
-                    replaceUrls(stylesheet, item.abshref,
-                            ignoreImportRules=True)
                     stylesheets.append(stylesheet)
             elif (elem.tag == XHTML('link') and elem.get('href') and elem.get(
                     'rel', 'stylesheet').lower() == 'stylesheet' and elem.get(
@@ -190,9 +342,7 @@ class Stylizer(object):
         for w, x in csses.items():
             if x:
                 try:
-                    text = x
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
+                    stylesheet = cache.parsed_sheet((w, cssname, x), partial(parser.parseString, x, href=cssname, validate=False))
                     stylesheets.append(stylesheet)
                 except:
                     self.logger.exception('Failed to parse %s, ignoring.'%w)
@@ -205,34 +355,56 @@ class Stylizer(object):
         for sheet_index, stylesheet in enumerate(stylesheets):
             href = stylesheet.href
             self.stylesheets.add(href)
-            for rule in stylesheet.cssRules:
-                if rule.type == rule.MEDIA_RULE:
-                    if media_ok(rule.media.mediaText):
-                        for subrule in rule.cssRules:
-                            rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
-                else:
-                    rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
+            flat = cache.flat_sheet(stylesheet, self)
+            sheet_index = 0 if sheet_index == 0 else 1
+            for specificity, selector, style, text in flat.rules:
+                specificity = (sheet_index,) + specificity[:-1] + (index + specificity[-1],)
+                rules.append((specificity, selector, style, text, href))
+            self.page_rule.update(flat.page_style)
+            self.font_face_rules.extend(flat.font_face_rules)
+            index += flat.count
         rules.sort()
         self.rules = rules
         self._styles = {}
         pseudo_pat = re.compile(u':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
-        select = Select(tree, ignore_inappropriate_pseudo_classes=True)
-
-        for _, _, cssdict, text, _ in rules:
-            fl = pseudo_pat.search(text)
+        matched, cached_matches = cache.matches_for(item.href, tree)
+        tree_modified = False
+        invalid = set()
+        missing = []
+        for text in OrderedDict((r[3], None) for r in rules if r[3] not in cached_matches):
             try:
-                matches = tuple(select(text))
+                missing.append((cache.parsed_selector(text), text))
             except SelectorError as err:
+                invalid.add(text)
+                self.logger.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
+        if missing:
+            # Match all selectors in a single pass over the tree
+            found = {text:[] for _, text in missing}
+
+            def on_error(selector, text, err):
+                invalid.add(text)
                 self.logger.error('Ignoring CSS rule with invalid selector: %r (%s)' % (text, as_unicode(err)))
+
+            select = Select(tree, ignore_inappropriate_pseudo_classes=True)
+            for elem, texts in select.match_rules(missing, on_error=on_error):
+                for text in texts:
+                    found[text].append(elem)
+            for text, matches in found.iteritems():
+                if text not in invalid:
+                    cached_matches[text] = tuple(matches)
+
+        for _, _, cssdict, text, _ in rules:
+            if text in invalid:
                 continue
+            fl = pseudo_pat.search(text)
+            matched[text] = matches = cached_matches[text]
 
             if fl is not None:
                 fl = fl.group(1)
                 if fl == 'first-letter' and getattr(self.oeb,
                         'plumber_output_format', '').lower() in {u'mobi', u'docx'}:
                     # Fake first-letter
+                    tree_modified = True
                     for elem in matches:
                         for x in elem.iter('*'):
                             if x.text:
@@ -276,6 +448,7 @@ class Stylizer(object):
                     val = elem.get(prop, '').strip()
                     try:
                         del elem.attrib[prop]
+                        tree_modified = True
                     except:
                         pass
                     if val:
@@ -284,6 +457,21 @@ class Stylizer(object):
                         upd[prop] = val
                 if upd:
                     style._update_cssdict(upd)
+        if not tree_modified:
+            # The matches are only valid for the tree as it was before
+            # stylizing changed it
+            cache.store_matches(item.href, tree, matched)
+
+    def parse_style_tag(self, parser, text, item, cssname):
+        text = self.oeb.css_preprocessor(text)
+        # We handle @import rules separately
+        parser.setFetcher(lambda x: ('utf-8', b''))
+        stylesheet = parser.parseString(text, href=cssname, validate=False)
+        parser.setFetcher(self._fetch_css_file)
+        # Make links to resources absolute, since these rules will
+        # be folded into a stylesheet at the root
+        replaceUrls(stylesheet, item.abshref, ignoreImportRules=True)
+        return stylesheet
 
     def _fetch_css_file(self, path):
         hrefs = self.oeb.manifest.hrefs
@@ -297,27 +485,6 @@ class Stylizer(object):
         data = item.data.cssText
         return ('utf-8', data)
 
-    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
-        results = []
-        sheet_index = 0 if is_user_agent_sheet else 1
-        if isinstance(rule, CSSStyleRule):
-            style = self.flatten_style(rule.style)
-            for selector in rule.selectorList:
-                specificity = (sheet_index,) + selector.specificity + (index,)
-                text = selector.selectorText
-                selector = list(selector.seq)
-                results.append((specificity, selector, style, text, href))
-        elif isinstance(rule, CSSPageRule):
-            style = self.flatten_style(rule.style)
-            self.page_rule.update(style)
-        elif isinstance(rule, CSSFontFaceRule):
-            if rule.style.length > 1:
-                # Ignore the meaningless font face rules generated by the
-                # benighted MS Word that contain only a font-family declaration
-                # and nothing else
-                self.font_face_rules.append(rule)
-        return results
-
     def flatten_style(self, cssstyle):
         style = {}
         for prop in cssstyle:
@@ -7,7 +7,8 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
 import re, operator, math
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from functools import partial
 from xml.dom import SyntaxErr
 
 from lxml import etree
@@ -149,7 +150,7 @@ class CSSFlattener(object):
 
     def __init__(self, fbase=None, fkey=None, lineh=None, unfloat=False,
                  untable=False, page_break_on_body=False, specializer=None,
-                 transform_css_rules=()):
+                 transform_css_rules=(), parallel=None):
         self.fbase = fbase
         self.transform_css_rules = transform_css_rules
         if self.transform_css_rules:
@@ -161,6 +162,7 @@ class CSSFlattener(object):
         self.untable = untable
         self.specializer = specializer
         self.page_break_on_body = page_break_on_body
+        self.parallel = parallel
 
     @classmethod
     def config(cls, cfg):
@@ -212,10 +214,13 @@ class CSSFlattener(object):
         # like the AZW3 output inline ToC.
         self.oeb.store_embed_font_rules = EmbedFontsCSSRules(self.body_font_family,
                 self.embed_font_rules)
-        self.stylize_spine()
-        self.sbase = self.baseline_spine() if self.fbase else None
-        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
-        self.flatten_spine()
+        if self.parallel is not None and len(self.items) > 1:
+            self.flatten_in_workers()
+        else:
+            self.stylize_spine()
+            self.sbase = self.baseline_spine() if self.fbase else None
+            self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+            self.flatten_spine()
         if epub3_nav is not None:
             self.opts.epub3_nav_parsed = epub3_nav.data
 
@@ -285,36 +290,38 @@ class CSSFlattener(object):
 
     def stylize_spine(self):
         self.stylizers = {}
-        profile = self.context.source
-        css = ''
         for item in self.items:
-            html = item.data
-            body = html.find(XHTML('body'))
-            if 'style' in html.attrib:
-                b = body.attrib.get('style', '')
-                body.set('style',  html.get('style') + ';' + b)
-                del html.attrib['style']
-            bs = body.get('style', '').split(';')
-            bs.append('margin-top: 0pt')
-            bs.append('margin-bottom: 0pt')
-            if float(self.context.margin_left) >= 0:
-                bs.append('margin-left : %gpt'%
-                        float(self.context.margin_left))
-            if float(self.context.margin_right) >= 0:
-                bs.append('margin-right : %gpt'%
-                        float(self.context.margin_right))
-            bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
-            if self.page_break_on_body:
-                bs.extend(['page-break-before: always'])
-            if self.context.change_justification != 'original':
-                bs.append('text-align: '+ self.context.change_justification)
-            if self.body_font_family:
-                bs.append(u'font-family: '+self.body_font_family)
-            body.set('style', '; '.join(bs))
-            stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
-                    user_css=self.context.extra_css,
-                    extra_css=css)
-            self.stylizers[item] = stylizer
+            self.prepare_body(item.data)
+            self.stylizers[item] = self.stylize(item)
+
+    def prepare_body(self, html):
+        body = html.find(XHTML('body'))
+        if 'style' in html.attrib:
+            b = body.attrib.get('style', '')
+            body.set('style',  html.get('style') + ';' + b)
+            del html.attrib['style']
+        bs = body.get('style', '').split(';')
+        bs.append('margin-top: 0pt')
+        bs.append('margin-bottom: 0pt')
+        if float(self.context.margin_left) >= 0:
+            bs.append('margin-left : %gpt'%
+                    float(self.context.margin_left))
+        if float(self.context.margin_right) >= 0:
+            bs.append('margin-right : %gpt'%
+                    float(self.context.margin_right))
+        bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
+        if self.page_break_on_body:
+            bs.extend(['page-break-before: always'])
+        if self.context.change_justification != 'original':
+            bs.append('text-align: '+ self.context.change_justification)
+        if self.body_font_family:
+            bs.append(u'font-family: '+self.body_font_family)
+        body.set('style', '; '.join(bs))
+
+    def stylize(self, item):
+        return Stylizer(item.data, item.href, self.oeb, self.context,
+                self.context.source, user_css=self.context.extra_css,
+                extra_css='')
 
     def baseline_node(self, node, stylizer, sizes, csize):
         csize = stylizer.style(node)['font-size']
@@ -325,14 +332,18 @@ class CSSFlattener(object):
             if child.tail:
                 sizes[csize] += len(COLLAPSE.sub(' ', child.tail))
 
+    def baseline_item(self, item, stylizer, sizes):
+        body = item.data.find(XHTML('body'))
+        fsize = self.context.source.fbase
+        self.baseline_node(body, stylizer, sizes, fsize)
+
     def baseline_spine(self):
         sizes = defaultdict(float)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            body = html.find(XHTML('body'))
-            fsize = self.context.source.fbase
-            self.baseline_node(body, stylizer, sizes, fsize)
+            self.baseline_item(item, self.stylizers[item], sizes)
+        return self.source_base_font_size(sizes)
+
+    def source_base_font_size(self, sizes):
         try:
             sbase = max(sizes.items(), key=operator.itemgetter(1))[0]
         except:
@@ -534,7 +545,7 @@ class CSSFlattener(object):
 
         pseudo_classes = style.pseudo_classes(self.filter_css)
         if cssdict or pseudo_classes:
-            keep_classes = set()
+            keep_classes = []
 
             if cssdict:
                 items = sorted(cssdict.iteritems())
@@ -547,11 +558,9 @@ class CSSFlattener(object):
                 if css in styles:
                     match = styles[css]
                 else:
-                    match = klass + str(names[klass] or '')
-                    styles[css] = match
-                    names[klass] += 1
+                    match = styles[css] = self.new_class_name(names, klass)
                 node.attrib['class'] = match
-                keep_classes.add(match)
+                keep_classes.append(match)
 
             for psel, cssdict in pseudo_classes.iteritems():
                 items = sorted(cssdict.iteritems())
@@ -566,11 +575,9 @@ class CSSFlattener(object):
                     # If the pcalibre class for a:hover and a:link is the same,
                     # then the class attribute for a.x tags will contain both
                     # that class and the class for a.x:hover, which is wrong.
-                    klass = 'pcalibre'
-                    match = klass + str(names[klass] or '')
-                    pstyles[css] = match
-                    names[klass] += 1
-                keep_classes.add(match)
+                    match = pstyles[css] = self.new_class_name(names, 'pcalibre')
+                if match not in keep_classes:
+                    keep_classes.append(match)
                 node.attrib['class'] = ' '.join(keep_classes)
 
         elif 'class' in node.attrib:
@@ -580,6 +587,11 @@ class CSSFlattener(object):
         for child in node:
             self.flatten_node(child, stylizer, names, styles, pseudo_styles, psize, item_id)
 
+    def new_class_name(self, names, klass):
+        ans = klass + str(names[klass] or '')
+        names[klass] += 1
+        return ans
+
     def flatten_head(self, item, href, global_href):
         html = item.data
         head = html.find(XHTML('head'))
@@ -664,13 +676,60 @@ class CSSFlattener(object):
         names = defaultdict(int)
         styles, pseudo_styles = {}, defaultdict(dict)
         for item in self.items:
-            html = item.data
-            stylizer = self.stylizers[item]
-            if self.specializer is not None:
-                self.specializer(item, stylizer)
-            body = html.find(XHTML('body'))
-            fsize = self.context.dest.fbase
-            self.flatten_node(body, stylizer, names, styles, pseudo_styles, fsize, item.id)
+            self.flatten_item(item, self.stylizers[item], names, styles, pseudo_styles)
+        self.write_css(styles, pseudo_styles)
+
+    def flatten_item(self, item, stylizer, names, styles, pseudo_styles):
+        if self.specializer is not None:
+            self.specializer(item, stylizer)
+        body = item.data.find(XHTML('body'))
+        fsize = self.context.dest.fbase
+        self.flatten_node(body, stylizer, names, styles, pseudo_styles, fsize, item.id)
+
+    def worker_state(self):
+        return {'fbase':self.fbase, 'fkey':self.fkey, 'lineh':self.lineh,
+                'unfloat':self.unfloat, 'untable':self.untable,
+                'filter_css':self.filter_css, 'body_font_family':self.body_font_family}
+
+    def flatten_in_workers(self):
+        '''
+        Does the work of :meth:`stylize_spine`, :meth:`baseline_spine` and
+        :meth:`flatten_spine` with the files stylized and flattened in the
+        worker processes of self.parallel. The workers count the characters
+        in each font size and return the classes they created, which are
+        merged here into the classes for the whole book, with the same names
+        as they would have had if the files had been flattened here.
+        '''
+        for item in self.items:
+            self.prepare_body(item.data)
+        state = self.worker_state()
+        self.sbase = None
+        if self.fbase:
+            sizes = defaultdict(float)
+            for item_sizes in self.parallel.map(__name__, 'baseline_in_worker', self.items, state):
+                for size, count in item_sizes.iteritems():
+                    sizes[size] += count
+            self.sbase = self.source_base_font_size(sizes)
+        self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+        state['sbase'] = self.sbase
+        results = self.parallel.map(__name__, 'flatten_in_worker', self.items, state)
+
+        names = defaultdict(int)
+        styles, pseudo_styles = {}, defaultdict(dict)
+        self.stylizers = {}
+        for item, (classes, page_rule, font_faces, body_font_size) in zip(self.items, results):
+            renames = {}
+            for i, (klass, psel, css) in enumerate(classes):
+                cstyles = styles if psel is None else pseudo_styles[psel]
+                if css not in cstyles:
+                    cstyles[css] = self.new_class_name(names, klass)
+                renames[WorkerCSSFlattener.placeholder(i)] = cstyles[css]
+            rename_classes(item.data.find(XHTML('body')), renames)
+            self.stylizers[item] = FlatStylizer(page_rule, map(FontFaceRule, font_faces),
+                                                body_font_size, self.context.source)
+        self.write_css(styles, pseudo_styles)
+
+    def write_css(self, styles, pseudo_styles):
         items = sorted(((key, val) for (val, key) in styles.iteritems()), key=lambda x:numeric_sort_key(x[0]))
         # :hover must come after link and :active must come after :hover
         psels = sorted(pseudo_styles.iterkeys(), key=lambda x :
@@ -687,5 +746,80 @@ class CSSFlattener(object):
         href = self.replace_css(css)
         global_css = self.collect_global_css()
         for item in self.items:
-            stylizer = self.stylizers[item]
             self.flatten_head(item, href, global_css[item])
+
+
+FontFaceRule = namedtuple('FontFaceRule', 'cssText')
+# The parts of a Stylizer that are used after its file has been flattened
+FlatStylizer = namedtuple('FlatStylizer', 'page_rule font_face_rules body_font_size profile')
+
+
+def rename_classes(node, names):
+    # Visits the same nodes as CSSFlattener.flatten_node(), classes that were
+    # not created by the worker are left alone
+    if not isinstance(node.tag, basestring) or namespace(node.tag) != XHTML_NS:
+        return
+    classes = node.get('class')
+    if classes:
+        node.set('class', ' '.join(names.get(x, x) for x in classes.split()))
+    for child in node:
+        rename_classes(child, names)
+
+
+class WorkerCSSFlattener(CSSFlattener):
+
+    ''' Stylizes and flattens single files in a worker process, for
+    :meth:`CSSFlattener.flatten_in_workers`. The classes it creates get
+    placeholder names, that are replaced by their final names in the parent
+    process. '''
+
+    def __init__(self, oeb, opts, state):
+        CSSFlattener.__init__(self, fbase=state['fbase'], fkey=state['fkey'],
+                lineh=state['lineh'], unfloat=state['unfloat'], untable=state['untable'])
+        self.oeb, self.context = oeb, opts
+        self.filter_css, self.body_font_family = state['filter_css'], state['body_font_family']
+        if 'sbase' in state:
+            self.sbase = state['sbase']
+            self.fmap = FontMapper(self.sbase, self.fbase, self.fkey)
+        fmt = getattr(oeb, 'plumber_output_format', None)
+        if fmt:
+            from calibre.customize.ui import plugin_for_output_format
+            plugin = plugin_for_output_format(fmt)
+            if plugin is not None:
+                self.specializer = partial(plugin.specialize_css_for_output, oeb.log, opts)
+        self.class_names = []
+
+    @staticmethod
+    def placeholder(i):
+        return 'calibre_parallel_%d' % i
+
+    def new_class_name(self, names, klass):
+        ans = self.placeholder(len(self.class_names))
+        self.class_names.append(klass)
+        return ans
+
+
+def baseline_in_worker(oeb, opts, item, state):
+    flattener = WorkerCSSFlattener(oeb, opts, state)
+    sizes = defaultdict(float)
+    flattener.baseline_item(item, flattener.stylize(item), sizes)
+    return dict(sizes), False
+
+
+def flatten_in_worker(oeb, opts, item, state):
+    flattener = WorkerCSSFlattener(oeb, opts, state)
+    stylizer = flattener.stylize(item)
+    names = defaultdict(int)
+    styles, pseudo_styles = {}, defaultdict(dict)
+    flattener.flatten_item(item, stylizer, names, styles, pseudo_styles)
+    # The classes in the order they were created, as (class name prefix,
+    # pseudo selector, css)
+    classes = [None] * len(flattener.class_names)
+    index = {flattener.placeholder(i):i for i in xrange(len(classes))}
+    for css, name in styles.iteritems():
+        classes[index[name]] = (flattener.class_names[index[name]], None, css)
+    for psel, pstyles in pseudo_styles.iteritems():
+        for css, name in pstyles.iteritems():
+            classes[index[name]] = (flattener.class_names[index[name]], psel, css)
+    font_faces = [r.cssText for r in stylizer.font_face_rules]
+    return (classes, stylizer.page_rule, font_faces, stylizer.body_font_size), True
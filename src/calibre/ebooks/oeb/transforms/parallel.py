@@ -0,0 +1,311 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+Run transforms that work on each (X)HTML file of a book independently of the
+other files in a pool of worker processes. Each worker gets a copy of the
+stylesheets of the book and of the conversion options, and the files are sent
+to the workers one at a time, as serialized markup. Everything that depends on
+more than one file must be merged from the results in the parent process.
+'''
+
+import cPickle
+from importlib import import_module
+
+from lxml import etree
+
+from calibre import as_unicode
+from calibre.ebooks.oeb.base import OEB_STYLES, OEB_DOCS
+from calibre.utils.ipc.pool import Pool, Failure
+from calibre.utils.logging import Log
+
+MODULE = 'calibre.ebooks.oeb.transforms.parallel'
+
+
+def serialize(root):
+    return etree.tostring(root, encoding='utf-8')
+
+
+def parse(raw):
+    # The same parser settings as used by DocumentCache in oeb.base, so that
+    # parsing serialized markup gives back the original tree
+    parser = etree.XMLParser(no_network=True, resolve_entities=False,
+                             huge_tree=True, remove_blank_text=False)
+    return etree.fromstring(raw, parser=parser)
+
+
+class RecordingStream(object):
+
+    ''' Records what is logged in a worker, so that it can be replayed into the
+    log of the conversion. '''
+
+    def __init__(self):
+        self.records = []
+
+    def prints(self, level, *args, **kwargs):
+        self.records.append((level, tuple(map(as_unicode, args)), {
+            k:v for k, v in kwargs.iteritems() if k in ('sep', 'end')}))
+
+    def flush(self):
+        pass
+
+
+def pickle_options(opts):
+    ''' Return the picklable conversion options and the names of the options
+    that cannot be pickled, such as functions or open files stored on opts by
+    the conversion plugins. Output and input profiles are sent by name. The options that
+    cannot be pickled are not present in the workers, so transforms that use
+    them fail, instead of running with different options. '''
+    from calibre.customize.profiles import InputProfile, OutputProfile
+    ans, dropped = {}, []
+    for name, val in vars(opts).iteritems():
+        if isinstance(val, InputProfile):
+            val = ('profile', 'input', val.short_name)
+        elif isinstance(val, OutputProfile):
+            val = ('profile', 'output', val.short_name)
+        else:
+            try:
+                cPickle.dumps(val, -1)
+            except Exception:
+                dropped.append(name)
+                continue
+        ans[name] = val
+    return ans, tuple(sorted(dropped))
+
+
+def unpickle_options(data):
+    from calibre.customize.ui import input_profiles, output_profiles
+    from calibre.ebooks.conversion.plumber import OptionValues
+    profiles = {'input':{p.short_name:p for p in input_profiles()},
+                'output':{p.short_name:p for p in output_profiles()}}
+    opts = OptionValues()
+    for name, val in data.iteritems():
+        if isinstance(val, tuple) and len(val) == 3 and val[0] == 'profile':
+            val = profiles[val[1]].get(val[2], profiles[val[1]]['default'])
+        setattr(opts, name, val)
+    return opts
+
+
+def book_data(oeb, opts):
+    sheets = tuple((item.id, item.href, item.media_type, item.data.cssText)
+                   for item in oeb.manifest.values() if item.media_type in OEB_STYLES)
+    opts, dropped = pickle_options(opts)
+    return {'sheets':sheets, 'opts':opts, 'dropped_options':dropped, 'filter_level':oeb.log.filter_level,
+            'output_format':getattr(oeb, 'plumber_output_format', None)}
+
+
+class WorkerBook(object):
+
+    ''' The copy of the book in a worker process. Only the stylesheets are
+    present, each job adds the file it works on to the manifest for as long as
+    the job runs. The book is kept for as long as the parent sends the same
+    book data, so that caches such as the one used by the
+    :class:`Stylizer` are shared by all the jobs run in a worker. '''
+
+    def __init__(self, data):
+        from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+        from calibre.ebooks.oeb.base import OEBBook
+        import css_parser
+        self.stream = RecordingStream()
+        log = Log(level=data['filter_level'])
+        log.outputs = [self.stream]
+        self.opts = unpickle_options(data['opts'])
+        self.oeb = OEBBook(log, HTMLPreProcessor(log, self.opts))
+        if data['output_format'] is not None:
+            self.oeb.plumber_output_format = data['output_format']
+        # The sheets in the parent have already had their @import rules
+        # resolved, do not try to fetch the remaining ones
+        parser = css_parser.CSSParser(fetcher=lambda x: ('utf-8', b''), validate=False)
+        for id_, href, media_type, css in data['sheets']:
+            sheet = parser.parseString(css, href=href, validate=False)
+            self.oeb.manifest.add(id_, href, media_type, data=sheet)
+
+    def __call__(self, func, item_id, href, media_type, raw, data):
+        del self.stream.records[:]
+        item = self.oeb.manifest.add(item_id, href, media_type, data=parse(raw))
+        try:
+            result, changed = func(self.oeb, self.opts, item, data)
+            raw = serialize(item.data) if changed else None
+        finally:
+            self.oeb.manifest.remove(item)
+        return result, raw, list(self.stream.records)
+
+
+worker_book = None
+
+
+def run_job(module, func, item_id, href, media_type, raw, common_data=None):
+    ''' Run func(oeb, opts, item, data) from module in a worker, where data is
+    the data for the current round of jobs. func must return a picklable
+    result and whether it changed the markup of item. '''
+    global worker_book
+    bdata = common_data['book']
+    if worker_book is None or worker_book[0] != bdata['token']:
+        worker_book = bdata['token'], WorkerBook(bdata)
+    func = getattr(import_module(module), func)
+    return worker_book[1](func, item_id, href, media_type, raw, common_data['data'])
+
+
+class ParallelTransforms(object):
+
+    ''' Run per file transforms for the :class:`Plumber` in a pool of worker
+    processes. The pool is only started when it is first needed and must be
+    shutdown with :meth:`shutdown`. '''
+
+    def __init__(self, oeb, opts, max_workers=None):
+        self.oeb, self.opts, self.log = oeb, opts, oeb.log
+        self.max_workers = max_workers
+        self.pool = None
+        self.book = None
+        self.dropped_options = set()
+
+    def current_book_data(self):
+        data = book_data(self.oeb, self.opts)
+        if self.book is None or self.book[1] != data:
+            dropped = set(data['dropped_options']) - self.dropped_options
+            if dropped:
+                self.dropped_options |= dropped
+                self.log.warn('The conversion options: %s cannot be sent to the worker processes,'
+                              ' transforms run in the workers cannot use them' % ', '.join(sorted(dropped)))
+            token = 0 if self.book is None else self.book[0] + 1
+            self.book = token, data
+        ans = dict(self.book[1])
+        ans['token'] = self.book[0]
+        return ans
+
+    def map(self, module, func, items, data=None):
+        ''' Run func from module on every item in items, see :func:`run_job`.
+        Items whose markup is changed by func have it replaced by the version
+        from the worker. Returns the results in the order of items. Raises
+        :class:`Failure` if a worker process crashes and re-raises errors from
+        func as a :class:`ValueError`. '''
+        for item in items:
+            if item.media_type not in OEB_DOCS:
+                raise ValueError('%s is not an HTML file' % item.href)
+        if self.pool is None:
+            self.pool = Pool(max_workers=self.max_workers, name='ConversionTransforms')
+        self.pool.set_common_data({'book':self.current_book_data(), 'data':data})
+        for i, item in enumerate(items):
+            self.pool(i, MODULE, 'run_job', module, func, item.id, item.href,
+                      item.media_type, serialize(item.data))
+        self.pool.wait_for_tasks()
+        results = {}
+        while len(results) < len(items):
+            wr = self.pool.results.get()
+            if wr.is_terminal_failure:
+                raise Failure(self.pool.terminal_failure)
+            if wr.result.err:
+                self.log.error(wr.result.traceback)
+                raise ValueError('Failed to process %s in worker process with error: %s' % (
+                    items[wr.id].href, wr.result.err))
+            results[wr.id] = wr.result.value
+        ans = []
+        for i, item in enumerate(items):
+            result, raw, records = results[i]
+            for level, args, kwargs in records:
+                self.log.prints(level, *args, **kwargs)
+            if raw is not None:
+                item.data = parse(raw)
+            ans.append(result)
+        return ans
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def find_tests():
+    import unittest
+    from calibre.customize.ui import input_profiles, output_profiles
+    from calibre.ebooks.conversion.plumber import OptionValues
+    from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+    from calibre.ebooks.oeb.base import OEBBook, XHTML, XHTML_MIME, CSS_MIME
+    from calibre.ebooks.oeb.transforms.flatcss import CSSFlattener, rename_classes
+
+    CSS = '''
+    p.a { color: red; font-size: large } @media screen { .b { margin: 1em } } @page { margin: 2pt }
+    div > p { text-align: justify } a:hover { color: blue } a:link { color: red } a.x:hover { color: green }
+    @font-face { font-family: Foo; src: url(foo.ttf) } h1 { font-size: 2em } .big { font-size: 24pt }
+    '''
+
+    def html(i):
+        return '''<html xmlns="http://www.w3.org/1999/xhtml"><head><link rel="stylesheet" href="../style.css"/>
+        <style>p + p {{ font-weight: bold }} .c{0} {{ margin-left: {1}em }}</style></head>
+        <body><h1 class="title">Chapter {1}</h1><div><p class="a">one <font size="+1">big</font></p>
+        <p class="b c{0}">two <a href="#" class="x">link</a> <a href="#">l2</a></p>
+        <svg xmlns="http://www.w3.org/2000/svg" class="calibre_parallel_0"><text>x</text></svg>
+        <p class="big" align="center">{2}</p><span class="x">s</span></div></body></html>'''.format(i % 3, i, 'text ' * (i + 3))
+
+    def conversion_options():
+        opts = OptionValues()
+        for name, val in dict(
+            filter_css='', embed_font_family=None, margin_left=5, margin_right=5, margin_top=5, margin_bottom=5,
+            change_justification='original', extra_css='span.x { color: green }', disable_font_rescaling=False,
+            minimum_line_height=120., remove_paragraph_spacing=False, insert_blank_line=False, insert_blank_line_size=1.,
+            remove_paragraph_spacing_indent_size=1.5, epub3_nav_href=None
+        ).iteritems():
+            setattr(opts, name, val)
+        opts.input_profile = opts.source = {p.short_name:p for p in input_profiles()}['default']
+        opts.output_profile = opts.dest = {p.short_name:p for p in output_profiles()}['kindle']
+        return opts
+
+    def flatten(fmt, fbase, transform_workers):
+        log = Log()
+        log.outputs = []
+        oeb = OEBBook(log, HTMLPreProcessor())
+        oeb.plumber_output_format = fmt
+        oeb.manifest.add('css', 'style.css', CSS_MIME, data=CSS)
+        for i in xrange(7):
+            oeb.spine.add(oeb.manifest.add('html%d' % i, 'text/index%d.html' % i, XHTML_MIME, data=html(i)), True)
+        opts = conversion_options()
+        parallel = ParallelTransforms(oeb, opts, max_workers=transform_workers) if transform_workers else None
+        try:
+            CSSFlattener(fbase=fbase, fkey=[8, 9, 10, 12, 14, 18, 24], lineh=None, parallel=parallel)(oeb, opts)
+        finally:
+            if parallel is not None:
+                parallel.shutdown()
+        markup = [(item.href, serialize(item.data)) for item in oeb.spine]
+        sheets = sorted((item.href, item.data.cssText) for item in oeb.manifest.values() if item.media_type in OEB_STYLES)
+        return markup, sheets, opts._stored_page_margins
+
+    class TestParallelTransforms(unittest.TestCase):
+
+        def test_flatten_in_workers(self):
+            for fmt in ('epub', 'mobi'):
+                for fbase in (None, 12.0):
+                    markup, sheets, margins = flatten(fmt, fbase, 0)
+                    pmarkup, psheets, pmargins = flatten(fmt, fbase, 2)
+                    self.assertEqual(markup, pmarkup)
+                    self.assertEqual(sheets, psheets)
+                    self.assertEqual(margins, pmargins)
+                    self.assertIn(b'pcalibre', b''.join(raw for href, raw in markup))
+
+        def test_rename_classes(self):
+            root = parse('<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+                         '<p class="calibre_parallel_0 other">x</p><p class="calibre_parallel_1">y</p></body></html>')
+            body = root.find(XHTML('body'))
+            rename_classes(body, {'calibre_parallel_0':'calibre1', 'calibre_parallel_1':'pcalibre'})
+            self.assertEqual([p.get('class') for p in body], ['calibre1 other', 'pcalibre'])
+
+        def test_pickle_options(self):
+            opts = conversion_options()
+            opts.report_progress = lambda x: x
+            data, dropped = pickle_options(opts)
+            self.assertEqual(dropped, ('report_progress',))
+            self.assertNotIn('report_progress', data)
+            wopts = unpickle_options(data)
+            self.assertIs(wopts.output_profile, opts.output_profile)
+            self.assertEqual(wopts.extra_css, opts.extra_css)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestParallelTransforms)
+
+
+if __name__ == '__main__':
+    from calibre.utils.run_tests import run_cli
+    run_cli(find_tests())
@@ -339,6 +339,7 @@ class BooksModel(QAbstractTableModel):  # {{{
         from calibre.db.backup import MetadataBackup
         self.metadata_backup = MetadataBackup(self.db)
         self.metadata_backup.start()
+        self.db.new_api.start_fts_indexer()
 
     def stop_metadata_backup(self):
         if getattr(self, 'metadata_backup', None) is not None:
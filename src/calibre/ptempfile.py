@@ -152,6 +152,16 @@ def reset_base_dir():
     base_dir()
 
 
+def swap_base_dir(path):
+    ''' Use path as the directory for temporary files, returning the
+    directory that was being used, so that it can be restored. Used by long
+    lived worker processes to remove the temporary files of each job as soon
+    as it is finished. '''
+    global _base_dir
+    ans, _base_dir = _base_dir, path
+    return ans
+
+
 def force_unicode(x):
     # Cannot use the implementation in calibre.__init__ as it causes a circular
     # dependency
@@ -211,24 +211,27 @@ def books(ctx, rd, library_id):
                     ids = {int(x) for x in ids}
                 except Exception:
                     raise HTTPNotFound('ids must a comma separated list of integers')
-        last_modified = None
         category_urls = rd.query.get('category_urls', 'true').lower() == 'true'
         device_compatible = rd.query.get('device_compatible', 'false').lower() == 'true'
         device_for_template = rd.query.get('device_for_template', None)
-        ans = {}
         allowed_book_ids = ctx.allowed_book_ids(rd, db)
-        for book_id in ids:
-            if book_id not in allowed_book_ids:
-                ans[book_id] = None
-                continue
-            data, lm = book_to_json(
+
+        def render(book_id):
+            return book_to_json(
                 ctx, rd, db, book_id, get_category_urls=category_urls,
-                device_compatible=device_compatible, device_for_template=device_for_template)
-            last_modified = lm if last_modified is None else max(lm, last_modified)
-            ans[book_id] = data
+                device_compatible=device_compatible, device_for_template=device_for_template)[0]
+
+        # The output format preference determines the main format of the
+        # books. The device save template can be changed at any time, so
+        # filenames generated from it are not cached.
+        variant = 'ajax', category_urls, device_compatible, prefs['output_format']
+        ans, last_modified = ctx.books_as_json(
+            db, [book_id for book_id in ids if book_id in allowed_book_ids], render, variant,
+            use_cache=not device_for_template)
+        ans.extend((book_id, b'null') for book_id in ids if book_id not in allowed_book_ids)
     if last_modified is not None:
         rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return ans
+    return ans.as_json()
 
 # }}}
 
@@ -6,21 +6,34 @@ from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
 from hashlib import sha1
 from functools import partial
-from threading import RLock, Lock
+from collections import Counter
+from threading import RLock, Lock, Thread
 from cPickle import dumps
 import errno, os, tempfile, shutil, time, json as jsonlib
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
 from calibre.srv.metadata import book_as_json
-from calibre.srv.render_book import RENDER_VERSION
-from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.render_book import (
+    RENDER_VERSION, MANIFEST_NAME, PENDING_NAME, RENDERED_NAME, REQUESTS_NAME, RENDER_STATE_NAMES)
+from calibre.srv.errors import HTTPNotFound, BookNotFound, HTTPServiceUnavailable
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_db
+from calibre.utils.filenames import atomic_rename, hardlink_file
 
 cache_lock = RLock()
 queued_jobs = {}
 failed_jobs = {}
+render_states = {}
+# The names of the files of a rendered book that are links to files in the
+# shared store and their hashes
+SHARED_NAME = 'calibre-book-shared.json'
+# Files smaller than this are not worth sharing
+MIN_SHARED_SIZE = 4096
+# How long a request for a file of a book that is being rendered waits for the
+# file, before telling the client to retry after RENDER_RETRY_AFTER seconds
+RENDER_WAIT = 0.5
+RENDER_RETRY_AFTER = 1
 
 
 def abspath(x):
@@ -38,7 +51,7 @@ def books_cache_dir():
     if _books_cache_dir:
         return _books_cache_dir
     base = abspath(os.path.join(cache_dir(), 'srvb'))
-    for d in 'sf':
+    for d in 'sfr':
         try:
             os.makedirs(os.path.join(base, d))
         except EnvironmentError as e:
@@ -65,7 +78,148 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+class RenderState(object):
+
+    ''' The progress of a book that is being rendered, read from the files
+    written by the render job, so that the manifest and rendered files can be
+    served before rendering is complete. '''
+
+    def __init__(self, tdir):
+        self.tdir = tdir
+        self.lock = Lock()
+        self.pending = None
+        self.rendered, self.rendered_pos = set(), 0
+        self.requested = set()
+
+    def path(self, name):
+        return os.path.join(self.tdir, name)
+
+    def update(self):
+        if self.pending is None:
+            try:
+                with lopen(self.path(PENDING_NAME), 'rb') as f:
+                    self.pending = frozenset(jsonlib.load(f))
+            except (EnvironmentError, ValueError):
+                return
+        try:
+            with lopen(self.path(RENDERED_NAME), 'rb') as f:
+                f.seek(self.rendered_pos)
+                raw = f.read()
+        except EnvironmentError:
+            return
+        idx = raw.rfind(b'\n')
+        if idx > -1:
+            self.rendered_pos += idx + 1
+            self.rendered |= set(raw[:idx].decode('utf-8').splitlines())
+
+    def manifest(self):
+        ' The manifest, if the render job has written it, else None '
+        with self.lock:
+            self.update()
+            if self.pending is not None:
+                with lopen(self.path(MANIFEST_NAME), 'rb') as f:
+                    return jsonlib.load(f)
+
+    @property
+    def progress(self):
+        with self.lock:
+            self.update()
+            if self.pending is not None:
+                return {'rendered': len(self.rendered & self.pending), 'total': len(self.pending)}
+
+    def is_rendered(self, name):
+        with self.lock:
+            self.update()
+            return self.pending is not None and (name not in self.pending or name in self.rendered)
+
+    def request(self, name):
+        ' Ask the render job to render name next '
+        with self.lock:
+            if name not in self.requested:
+                self.requested.add(name)
+                with lopen(self.path(REQUESTS_NAME), 'ab') as f:
+                    f.write(name.encode('utf-8') + b'\n')
+
+
+def wait_for_rendered_file(bhash, name, timeout=RENDER_WAIT):
+    ''' Return the path to the specified file of a book that is being
+    rendered, if it is rendered within timeout seconds, False if it is still
+    being rendered after that, or None if the book is not being rendered or
+    rendering failed. The wait is kept short, as it ties up a server thread,
+    clients should retry instead. '''
+    st = time.time()
+    while True:
+        with cache_lock:
+            rs = render_states.get(bhash)
+        if rs is None:
+            return
+        path = abspath(rs.path(name))
+        if not path.startswith(abspath(rs.tdir) + os.sep):
+            return
+        if rs.is_rendered(name):
+            return path
+        if rs.pending is not None:
+            try:
+                rs.request(name)
+            except EnvironmentError:
+                pass
+        if time.time() - st >= timeout:
+            return False
+        time.sleep(0.05)
+
+
+def file_hash(path):
+    h = sha1()
+    with lopen(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest().decode('ascii')
+
+
+def share_files(book_dir, store_dir):
+    ''' Replace the files of the rendered book in book_dir that have identical
+    copies in the content addressed store in store_dir, with hard links to
+    them, and add the rest to the store. '''
+    shared = {}
+    ignore = frozenset((MANIFEST_NAME, SHARED_NAME) + RENDER_STATE_NAMES)
+    for dirpath, dirnames, filenames in os.walk(book_dir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            name = os.path.relpath(path, book_dir).replace(os.sep, '/')
+            if name in ignore:
+                continue
+            try:
+                if os.path.getsize(path) < MIN_SHARED_SIZE:
+                    continue
+                h = file_hash(path)
+                sdir = os.path.join(store_dir, h[:2])
+                spath = os.path.join(sdir, h)
+                if not os.path.exists(sdir):
+                    os.makedirs(sdir)
+                try:
+                    hardlink_file(path, spath)
+                except Exception:
+                    if not os.path.exists(spath):
+                        raise
+                    tpath = path + '.shared'
+                    hardlink_file(spath, tpath)
+                    atomic_rename(tpath, path)
+            except Exception:
+                continue  # Hard links are not supported, or the store is being pruned
+            shared[name] = h
+    with lopen(os.path.join(book_dir, SHARED_NAME), 'wb') as f:
+        f.write(jsonlib.dumps(shared))
+
+
+def render_book(pathtoebook, output_dir, book_hash=None, start_at=None, store_dir=None):
+    ' Run in a worker process to render the book and add its files to the shared store '
+    from calibre.srv.render_book import render
+    render(pathtoebook, output_dir, book_hash=book_hash, start_at=start_at)
+    if store_dir:
+        share_files(output_dir, store_dir)
+
+
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, start_at=None):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
@@ -76,54 +230,166 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
-    job_id = ctx.start_job('Render book %s (%s)' % (book_id, fmt), 'calibre.srv.render_book', 'render', args=(
+    job_id = ctx.start_job('Render book %s (%s)' % (book_id, fmt), 'calibre.srv.books', 'render_book', args=(
         pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
+        kwargs={'start_at':start_at, 'store_dir':os.path.join(books_cache_dir(), 'r')},
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, ctx.opts.max_render_cache_size * 1024 * 1024))
     queued_jobs[bhash] = job_id
+    render_states[bhash] = RenderState(tdir)
     return job_id
 
 
-last_final_clean_time = 0
+# The render cache {{{
+cache_stats = Counter()
+prune_thread = None
+
+
+def render_cache_stats():
+    ' Statistics about the cache of rendered books, for diagnostics '
+    with cache_lock:
+        ans = dict(cache_stats)
+    lookups = ans.get('hits', 0) + ans.get('misses', 0)
+    ans['hit_rate'] = ans.get('hits', 0) / lookups if lookups else 0
+    return ans
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
+def book_dir_usage(book_dir):
+    ' Return the size of the files in book_dir that are not shared and the hashes of the shared files '
+    try:
+        with lopen(os.path.join(book_dir, SHARED_NAME), 'rb') as f:
+            shared = jsonlib.load(f)
+    except (EnvironmentError, ValueError):
+        shared = {}
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(book_dir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            if os.path.relpath(path, book_dir).replace(os.sep, '/') not in shared:
+                try:
+                    size += os.path.getsize(path)
+                except EnvironmentError:
+                    pass
+    return size, frozenset(shared.itervalues())
+
+
+def prune_render_cache(max_size, max_age=24 * 60 * 60, min_age=10 * 60):
+    ''' Remove books that have not been read for max_age seconds and then the
+    least recently read books, until the cache is no larger than max_size
+    bytes, keeping books read in the last min_age seconds. Files in the shared
+    store that are no longer used by any book are removed. '''
     now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
+    fdir, store_dir = os.path.join(books_cache_dir(), 'f'), os.path.join(books_cache_dir(), 'r')
+    books, refs = [], Counter()
+    for bhash in os.listdir(fdir):
+        book_dir = os.path.join(fdir, bhash)
         try:
-            tm = os.path.getmtime(os.path.join(fdir, x,  'calibre-book-manifest.json'))
+            last_read = os.path.getmtime(os.path.join(book_dir, MANIFEST_NAME))
         except EnvironmentError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+            last_read = 0
+        size, hashes = book_dir_usage(book_dir)
+        books.append((last_read, book_dir, size, hashes))
+        refs.update(hashes)
+
+    total = 0
+    blob_sizes = {}
+    for sdir in os.listdir(store_dir):
+        for h in os.listdir(os.path.join(store_dir, sdir)):
+            path = os.path.join(store_dir, sdir, h)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            # Recently added files may belong to books that are still being rendered
+            if not refs[h] and now - st.st_mtime > max_age:
+                safe_remove(path, True)
+                continue
+            blob_sizes[h] = st.st_size
+            total += st.st_size
+    total += sum(size for last_read, book_dir, size, hashes in books)
+
+    num_evicted = 0
+    for last_read, book_dir, size, hashes in sorted(books):
+        if now - last_read < max_age and (not max_size or total <= max_size):
+            break
+        if now - last_read < min_age:
+            break
+        safe_remove(book_dir, False)
+        num_evicted += 1
+        total -= size
+        for h in hashes:
+            refs[h] -= 1
+            if not refs[h] and h in blob_sizes:
+                safe_remove(os.path.join(store_dir, h[:2], h), True)
+                total -= blob_sizes.pop(h)
+    saved = sum(size * max(0, refs[h] - 1) for h, size in blob_sizes.iteritems())
+    with cache_lock:
+        cache_stats['size'] = total
+        cache_stats['books'] = len(books) - num_evicted
+        cache_stats['evicted'] += num_evicted
+        cache_stats['saved_by_sharing'] = saved
+
+
+def prune_render_cache_in_background(max_size):
+    global prune_thread
+    with cache_lock:
+        if prune_thread is not None and prune_thread.is_alive():
+            return
+        prune_thread = Thread(target=prune_render_cache, args=(max_size,), name='PruneRenderCache')
+        prune_thread.daemon = True
+        prune_thread.start()
+# }}}
 
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, max_cache_size = job.data
         queued_jobs.pop(bhash, None)
+        render_states.pop(bhash, None)
         safe_remove(pathtoebook)
         if job.failed:
             failed_jobs[bhash] = (job.was_aborted, job.traceback)
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
+                for x in RENDER_STATE_NAMES:
+                    safe_remove(os.path.join(tdir, x), True)
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
                 os.rename(tdir, dest)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
+            prune_render_cache_in_background(max_cache_size)
+
+
+def add_book_data(ans, db, book_id, fmt, rd):
+    ans['metadata'] = book_as_json(db, book_id)
+    user = rd.username or None
+    ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
+    return ans
+
+
+def start_position(db, book_id, fmt, rd):
+    ' Where the user is likely to start reading, used to decide what to render first '
+    start_at = rd.query.get('start_at')
+    if start_at:
+        return start_at
+    user = rd.username or None
+    positions = db.get_last_read_positions(book_id, fmt, user) if user else ()
+    if positions:
+        return max(positions, key=lambda x: x['epoch'])['pos_frac']
 
 
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
 def book_manifest(ctx, rd, book_id, fmt):
+    '''
+    Return the manifest of the book, rendering it if needed. While the book is
+    being rendered, the job status is returned, along with the manifest and
+    rendering progress, once the manifest is available. Files from the
+    manifest can then be downloaded, they are sent as soon as they have been
+    rendered. Optional: ?start_at=name of the file to render first,
+    defaults to the file at the last read position of the user
+    '''
     db, library_id = get_library_data(ctx, rd)[:2]
     force_reload = rd.query.get('force_reload') == '1'
     if plugin_for_input_format(fmt) is None:
@@ -137,17 +403,15 @@ def book_manifest(ctx, rd, book_id, fmt):
         size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
         bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, MANIFEST_NAME))
             if force_reload:
                 safe_remove(mpath, True)
             try:
                 os.utime(mpath, None)
                 with lopen(mpath, 'rb') as f:
                     ans = jsonlib.load(f)
-                ans['metadata'] = book_as_json(db, book_id)
-                user = rd.username or None
-                ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
-                return ans
+                cache_stats['hits'] += 1
+                return add_book_data(ans, db, book_id, fmt, rd)
             except EnvironmentError as e:
                 if e.errno != errno.ENOENT:
                     raise
@@ -156,9 +420,24 @@ def book_manifest(ctx, rd, book_id, fmt):
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
-                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                cache_stats['misses'] += 1
+                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime,
+                                   start_at=start_position(db, book_id, fmt, rd))
+            rs = render_states.get(bhash)
+    # The jobs manager holds its lock while calling job_done(), which takes
+    # cache_lock, so the job status must not be queried with cache_lock held
     status, result, tb, aborted = ctx.job_status(job_id)
-    return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
+    ans = {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
+    if status == 'running' and rs is not None:
+        ans['progress'] = rs.progress
+        try:
+            manifest = rs.manifest()
+        except (EnvironmentError, ValueError):
+            manifest = None
+        if manifest is not None:
+            manifest.update(ans)
+            return add_book_data(manifest, db, book_id, fmt, rd)
+    return ans
 
 
 @endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
@@ -176,7 +455,18 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     except EnvironmentError as e:
         if e.errno != errno.ENOENT:
             raise
-        raise HTTPNotFound('No book file with hash: %s and name: %s' % (bhash, name))
+    # The book may still be rendering
+    path = wait_for_rendered_file(bhash, name)
+    if path is False:
+        raise HTTPServiceUnavailable('The file: %s is still being rendered' % name, retry_after=RENDER_RETRY_AFTER)
+    for path in (path, mpath):
+        if path is not None:
+            try:
+                return rd.filesystem_file_with_custom_etag(lopen(path, 'rb'), bhash, name)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    raise HTTPNotFound('No book file with hash: %s and name: %s' % (bhash, name))
 
 
 @endpoint('/book-get-last-read-position/{library_id}/{+which}', postprocess=json)
@@ -23,7 +23,16 @@ from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+def cmd_may_write(which, version):
+    try:
+        m = module_for_cmd(which)
+    except ImportError:
+        return False
+    return not getattr(m, 'readonly', False)
+
+
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache',
+          may_write=cmd_may_write)
 def cdb_run(ctx, rd, which, version):
     try:
         m = module_for_cmd(which)
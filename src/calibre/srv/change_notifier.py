@@ -0,0 +1,360 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Push notifications of changes to the books in a library, over WebSocket.
+
+Clients connect to the /changes WebSocket endpoint, specifying the library and
+optionally a virtual library. When authentication is enabled, they must first
+get a token from /changes-token, as browsers do not send credentials along with
+WebSocket connections. The client is then sent a message of the form::
+
+    {"type": "ready", "library_id": ...}
+
+followed, whenever books are changed, by messages of the form::
+
+    {"type": "changes", "library_id": ..., "added": [...], "changed": [...],
+     "removed": [...], "saved_searches_changed": false}
+
+The book ids are relative to the view of the client, that is, books that
+start matching its virtual library are reported as added and books that no
+longer match it as removed. If too many changes pile up for a client, it is
+sent a message of type "reset" instead, after which it should re-load
+everything.
+
+The ids of the changed books are taken from the change events passed to
+:meth:`ChangeNotifier.notify`, which include the changes applied from the
+change journal in a multi-process server. Changes that are not notified, such
+as the ones made by the calibre GUI, are detected by comparing the last
+modified timestamps of all books, when the in-memory data of the library
+changes. Changes are batched and coalesced per connection, and a connection is
+only sent a new message once the previous one has been fully written to it.
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import hmac
+import json
+import os
+import time
+from binascii import hexlify, unhexlify
+from threading import Event, Lock, Thread
+
+from calibre import as_unicode
+from calibre.srv.changes import SavedSearchesChanged
+from calibre.srv.errors import HTTPNotFound
+from calibre.srv.library_broker import path_for_db
+from calibre.srv.routes import endpoint, json as json_postprocess
+from calibre.srv.utils import get_db
+from calibre.utils.search_query_parser import ParseException
+
+# Policy violation, see srv/web_socket.py
+POLICY_VIOLATION = 1008
+TOKEN_MAX_AGE = 300  # seconds
+
+
+class Subscription(object):
+
+    __slots__ = ('conn_ref', 'library_id', 'vl', 'username', 'ready', 'added',
+                 'changed', 'removed', 'saved_searches_changed', 'reset', 'view')
+
+    def __init__(self, conn_ref, library_id, vl, username):
+        self.conn_ref, self.library_id, self.vl, self.username = conn_ref, library_id, vl, username
+        self.ready = False
+        # The books in the virtual library of the client, when it was last
+        # sent a message, None if the client sees all books
+        self.view = None
+        self.clear()
+
+    def clear(self):
+        self.added, self.changed, self.removed = set(), set(), set()
+        self.saved_searches_changed = self.reset = False
+
+    @property
+    def num_pending(self):
+        return len(self.added) + len(self.changed) + len(self.removed)
+
+    @property
+    def has_pending(self):
+        return bool(self.reset or self.saved_searches_changed or self.added or self.changed or self.removed)
+
+    def merge(self, added, changed, removed):
+        if self.reset:
+            return
+        self.added -= removed
+        self.changed -= removed
+        self.removed |= removed
+        self.removed -= added
+        self.added |= added
+        self.changed |= changed - self.added
+
+
+class LibraryState(object):
+
+    ' The last modified timestamps of all books in a library, used to detect changes '
+
+    def __init__(self, db):
+        self.signature, self.timestamps = self.read(db)
+
+    def current_signature(self, db):
+        # Writes in this process change the modification time of the database,
+        # changes applied from the journal clear the search caches
+        return db.clear_search_cache_count, db.last_modified()
+
+    def read(self, db):
+        return self.current_signature(db), db.all_field_for('last_modified', db.all_book_ids())
+
+    def update(self, db, force=False):
+        ''' Return the (added, changed, removed) book ids since the last call
+        or None if nothing has changed. Compares the timestamps of all books,
+        so it is only used for changes that were not notified. '''
+        if not force and self.signature == self.current_signature(db):
+            return
+        old, (self.signature, self.timestamps) = self.timestamps, self.read(db)
+        new = self.timestamps
+        added = {book_id for book_id in new if book_id not in old}
+        removed = {book_id for book_id in old if book_id not in new}
+        changed = {book_id for book_id, ts in new.iteritems() if book_id in old and old[book_id] != ts}
+        if added or removed or changed:
+            return added, changed, removed
+
+    def apply(self, db, book_ids):
+        ''' Same as :meth:`update`, for changes to only the specified books,
+        whose ids come from change events. Changes that were not notified and
+        were made at the same time as the notified ones are not detected. '''
+        self.signature = self.current_signature(db)
+        present = {book_id for book_id in book_ids if db.has_id(book_id)}
+        timestamps = db.all_field_for('last_modified', present)
+        added = {book_id for book_id in present if book_id not in self.timestamps}
+        changed = present - added
+        removed = {book_id for book_id in book_ids if book_id not in present and book_id in self.timestamps}
+        self.timestamps.update(timestamps)
+        for book_id in removed:
+            del self.timestamps[book_id]
+        if added or removed or changed:
+            return added, changed, removed
+
+
+class ChangeNotifier(object):
+
+    ''' The WebSocket handler for the /changes endpoint. Connections are
+    grouped by library and all processing happens in a separate thread, that is
+    started when the first connection is made. '''
+
+    POLL_INTERVAL = 1  # seconds
+    BATCH_DELAY = 0.2  # seconds
+    MAX_PENDING = 1000  # book ids
+
+    def __init__(self, ctx, strip_path=None):
+        self.ctx = ctx
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.subscriptions = {}
+        self.library_states = {}
+        # Maps library ids to the ids of the books in change events, None when
+        # a change event did not say which books changed
+        self.notified_books, self.saved_searches_changed = {}, set()
+        self.secret = os.urandom(32)
+        self.thread = None
+        self.shutting_down = False
+        self.url_path = (strip_path or ()) + ('changes',)
+
+    @property
+    def log(self):
+        return self.ctx.log
+
+    # Tokens {{{
+    def signature(self, msg):
+        return hmac.new(self.secret, msg, hashlib.sha256).hexdigest()
+
+    def create_token(self, username, library_id):
+        msg = '%x:%s:%s' % (int(time.time()), hexlify((username or '').encode('utf-8')), hexlify(library_id.encode('utf-8')))
+        return msg + ':' + self.signature(msg.encode('ascii'))
+
+    def validate_token(self, token):
+        ' Return (username, library_id) if the token is valid, raises ValueError otherwise '
+        try:
+            msg, signature = token.encode('ascii').rpartition(b':')[::2]
+            timestamp, username, library_id = msg.split(b':')
+            timestamp = int(timestamp, 16)
+        except Exception:
+            raise ValueError('Malformed token')
+        if not hmac.compare_digest(self.signature(msg), signature):
+            raise ValueError('Invalid token')
+        if abs(time.time() - timestamp) > TOKEN_MAX_AGE:
+            raise ValueError('Token has expired')
+        return unhexlify(username).decode('utf-8') or None, unhexlify(library_id).decode('utf-8')
+    # }}}
+
+    # WebSocket handler API {{{
+    def handle_websocket_upgrade(self, connection_id, connection_ref, inheaders):
+        conn = connection_ref()
+        try:
+            if conn.path != self.url_path:
+                raise ValueError('No WebSocket endpoint at: /%s' % '/'.join(conn.path))
+            token, library_id = conn.query.get('token'), conn.query.get('library_id')
+            if token:
+                username, library_id = self.validate_token(token)
+            elif self.ctx.opts.auth:
+                raise ValueError('A token from /changes-token is required')
+            else:
+                username = None
+            library_id = library_id or self.ctx.library_broker.default_library
+            # The library is loaded by the notifier thread, so as to not block
+            # the server loop
+            if library_id not in self.ctx.library_broker.lmap:
+                raise ValueError('Library %r not found' % library_id)
+        except Exception as err:
+            conn.websocket_close(POLICY_VIOLATION, as_unicode(err))
+            return
+        with self.lock:
+            self.subscriptions[connection_id] = Subscription(connection_ref, library_id, conn.query.get('vl') or '', username)
+            if self.thread is None:
+                self.thread = Thread(name='ChangeNotifier', target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def handle_websocket_data(self, connection_id, data, message_starting, message_finished):
+        pass
+
+    def handle_websocket_pong(self, connection_id, data):
+        pass
+
+    def handle_websocket_close(self, connection_id):
+        with self.lock:
+            self.subscriptions.pop(connection_id, None)
+    # }}}
+
+    def notify(self, library_path, change_event):
+        ''' Called when a change is made to the library at library_path.
+        change_event can be None if it is not known which books changed. '''
+        with self.lock:
+            if not self.subscriptions:
+                return
+        broker = self.ctx.library_broker
+        with broker:
+            dbs = broker.loaded_dbs.items()
+        library_ids = [library_id for library_id, db in dbs if db is not None and path_for_db(db) == library_path]
+        with self.lock:
+            for library_id in library_ids:
+                if isinstance(change_event, SavedSearchesChanged):
+                    self.saved_searches_changed.add(library_id)
+                    continue
+                book_ids = getattr(change_event, 'book_ids', None)
+                if book_ids is None:
+                    self.notified_books[library_id] = None
+                elif self.notified_books.get(library_id, ()) is not None:
+                    self.notified_books.setdefault(library_id, set()).update(book_ids)
+        self.wakeup.set()
+
+    def run(self):
+        while not self.shutting_down:
+            if self.wakeup.wait(self.POLL_INTERVAL):
+                # Give bursts of changes a chance to be coalesced
+                time.sleep(self.BATCH_DELAY)
+            self.wakeup.clear()
+            if self.shutting_down:
+                break
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception('Error while sending change notifications')
+
+    def flush(self):
+        ''' Detect changes in all libraries that have connections, and send
+        them to all connections that are ready to receive more data. '''
+        with self.lock:
+            subscriptions = {}
+            for connection_id, s in self.subscriptions.iteritems():
+                subscriptions.setdefault(s.library_id, []).append(s)
+            for library_id in tuple(self.library_states):
+                if library_id not in subscriptions:
+                    del self.library_states[library_id]
+            notified, self.notified_books = self.notified_books, {}
+            saved_searches_changed, self.saved_searches_changed = self.saved_searches_changed, set()
+
+        for library_id, subs in subscriptions.iteritems():
+            db = self.ctx.library_broker.get(library_id)
+            if db is None:
+                continue
+            state, changes = self.library_states.get(library_id), None
+            book_ids = notified.get(library_id, ())
+            if state is None:
+                self.library_states[library_id] = LibraryState(db)
+            elif book_ids is None:
+                changes = state.update(db, force=True)
+            elif book_ids:
+                changes = state.apply(db, book_ids)
+            else:
+                changes = state.update(db)
+            for s in subs:
+                if changes is not None:
+                    s.merge(*changes)
+                    if s.num_pending > self.MAX_PENDING:
+                        s.clear()
+                        s.reset = True
+                if library_id in saved_searches_changed:
+                    s.saved_searches_changed = True
+                self.send(db, s)
+
+    def send(self, db, s):
+        conn = s.conn_ref()
+        if conn is None or conn.websocket_output_pending:
+            return  # The client is not keeping up, continue coalescing changes
+        if not s.ready:
+            s.ready = True
+            s.view = self.view_for(db, s)
+            msg = {'type': 'ready'}
+        elif not s.has_pending:
+            return
+        elif s.reset:
+            s.view = self.view_for(db, s)
+            msg = {'type': 'reset'}
+        else:
+            msg = self.changes_message(db, s)
+        msg['library_id'] = s.library_id
+        s.clear()
+        msg = json.dumps(msg, ensure_ascii=False)
+        if not isinstance(msg, type('')):
+            msg = msg.decode('utf-8')
+        conn.send_websocket_message(msg)  # A text message
+
+    def view_for(self, db, s):
+        ' The books the client can see, None if it can see all books '
+        restriction = self.ctx.user_manager.library_restriction(s.username, path_for_db(db)) if s.username else ''
+        if s.vl or restriction:
+            try:
+                return db.books_in_virtual_library(s.vl, restriction)
+            except ParseException:
+                return frozenset()
+
+    def changes_message(self, db, s):
+        added, changed, removed = s.added, s.changed, s.removed
+        view = self.view_for(db, s)
+        if view is not None:
+            old_view, s.view = s.view or frozenset(), view
+            books = added | changed | removed
+            added = {book_id for book_id in books if book_id in view and book_id not in old_view}
+            removed = {book_id for book_id in books if book_id in old_view and book_id not in view}
+            changed = {book_id for book_id in changed if book_id in view and book_id in old_view}
+        return {'type': 'changes', 'added': sorted(added), 'changed': sorted(changed), 'removed': sorted(removed),
+                'saved_searches_changed': s.saved_searches_changed}
+
+    def shutdown(self):
+        self.shutting_down = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(self.POLL_INTERVAL + 1)
+
+
+@endpoint('/changes-token/{library_id=None}', postprocess=json_postprocess)
+def changes_token(ctx, rd, library_id):
+    ''' Return a token that can be used to connect to the /changes WebSocket
+    endpoint, to get notified of changes to the specified library. '''
+    db = get_db(ctx, rd, library_id)
+    if ctx.change_notifier is None:
+        raise HTTPNotFound('Change notifications are not available')
+    return {'token': ctx.change_notifier.create_token(rd.username, db.server_library_id)}
@@ -10,6 +10,7 @@ import random
 import shutil
 import sys
 import zipfile
+from functools import partial
 from json import load as load_json_file
 from threading import Lock
 
@@ -21,7 +22,8 @@ from calibre.srv.errors import (
     BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound
 )
 from calibre.srv.metadata import (
-    book_as_json, categories_as_json, categories_settings, icon_map
+    book_as_json, categories_as_json, categories_settings, encode_json_with_books,
+    icon_map
 )
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
@@ -199,19 +201,15 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['field_metadata'] = db.field_metadata.all_metadata()
         ans['virtual_libraries'] = db._pref('virtual_libraries', {})
         ans['book_display_fields'] = get_field_list(db)
-        mdata = ans['metadata'] = {}
         try:
             extra_books = set(
                 int(x) for x in rd.query.get('extra_books', '').split(',')
             )
         except Exception:
             extra_books = ()
-        for coll in (ans['search_result']['book_ids'], extra_books):
-            for book_id in coll:
-                if book_id not in mdata:
-                    data = book_as_json(db, book_id)
-                    if data is not None:
-                        mdata[book_id] = data
+        book_ids = list(ans['search_result']['book_ids'])
+        book_ids.extend(extra_books - set(book_ids))
+        ans['metadata'] = ctx.books_as_json(db, book_ids, partial(book_as_json, db))[0]
     return ans
 
 
@@ -231,7 +229,7 @@ def books(ctx, rd):
     library_id, db, sorts, orders, vl = get_basic_query_data(ctx, rd)
     ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
     ans['library_id'] = library_id
-    return ans
+    return encode_json_with_books(ans)
 
 
 @endpoint('/interface-data/init', postprocess=json)
@@ -261,7 +259,7 @@ def interface_data(ctx, rd):
     except Exception:
         raise HTTPNotFound('Invalid number of books: %r' % rd.query.get('num'))
     ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
-    return ans
+    return encode_json_with_books(ans)
 
 
 @endpoint('/interface-data/more-books', postprocess=json, methods=POSTABLE)
@@ -292,13 +290,9 @@ def more_books(ctx, rd):
         ans['search_result'] = search_result(
             ctx, rd, db, query, num, offset, sorts, orders, vl
         )
-        mdata = ans['metadata'] = {}
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        ans['metadata'] = ctx.books_as_json(db, ans['search_result']['book_ids'], partial(book_as_json, db))[0]
 
-    return ans
+    return encode_json_with_books(ans)
 
 
 @endpoint('/interface-data/set-session-data', postprocess=json, methods=POSTABLE)
@@ -334,7 +328,6 @@ def get_books(ctx, rd):
     searchq = rd.query.get('search', '')
     db = get_library_data(ctx, rd)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
     with db.safe_read_lock:
         try:
             ans['search_result'] = search_result(
@@ -344,11 +337,8 @@ def get_books(ctx, rd):
             # This must not be translated as it is used by the front end to
             # detect invalid search expressions
             raise HTTPBadRequest('Invalid search expression: %s' % as_unicode(err))
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
-    return ans
+        ans['metadata'] = ctx.books_as_json(db, ans['search_result']['book_ids'], partial(book_as_json, db))[0]
+    return encode_json_with_books(ans)
 
 
 @endpoint('/interface-data/book-metadata/{book_id=0}', postprocess=json)
@@ -382,7 +372,7 @@ def tag_browser(ctx, rd):
     db, library_id = get_library_data(ctx, rd)[:2]
     opts = categories_settings(rd.query, db)
     vl = rd.query.get('vl') or ''
-    etag = cPickle.dumps([db.last_modified().isoformat(), rd.username, library_id, vl, list(opts)], -1)
+    etag = cPickle.dumps([db.last_modified().isoformat(), rd.username, library_id, vl, rd.lang_code, list(opts)], -1)
     etag = hashlib.sha1(etag).hexdigest()
 
     def generate():
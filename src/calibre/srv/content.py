@@ -8,7 +8,6 @@ __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, errno
 from binascii import hexlify
-from io import BytesIO
 from threading import Lock
 from polyglot.builtins import map
 from functools import partial
@@ -24,11 +23,11 @@ from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import HTTPNotFound, BookNotFound
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import ThumbnailCache, render_thumbnail
 from calibre.srv.utils import http_date, get_db, get_use_roman
-from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
 from calibre.utils.img import scale_image, image_from_data
-from calibre.utils.filenames import ascii_filename, atomic_rename
+from calibre.utils.filenames import ascii_filename, atomic_rename, is_replaced_in_place
 from calibre.utils.shared_file import share_open
 
 plugboard_content_server_value = 'content_server'
@@ -115,6 +114,33 @@ def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func
         return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mtime, extra_etag_data)
 
 
+def library_file(ctx, rd, prefix, library_id, book_id, path, extra_etag_data=''):
+    ''' Serve a file directly from the library folder, so that it can be sent
+    with sendfile(), without any copying, if the serve_library_files option is
+    enabled. Files in the library are usually replaced rather than modified in
+    place when they change (see :func:`calibre.utils.filenames.replace_file`),
+    so the open file remains a consistent snapshot. Files that would be
+    modified in place and all files on Windows, where open files would lock the
+    library, are not served directly. Returns None if the file cannot be served
+    directly, in which case :func:`create_file_copy` should be used. '''
+    if iswindows or not ctx.opts.serve_library_files:
+        return
+    try:
+        ans = share_open(path, 'rb')
+    except EnvironmentError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return
+    st = os.fstat(ans.fileno())
+    if is_replaced_in_place(st):
+        ans.close()
+        return
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = 'direct'
+        rd.outheaders['Tempfile'] = hexlify(path.encode('utf-8'))
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, st.st_mtime, st.st_ino, st.st_size, extra_etag_data)
+
+
 def write_generated_cover(db, book_id, width, height, destf):
     mi = db.get_metadata(book_id)
     set_use_roman(get_use_roman())
@@ -137,23 +163,51 @@ def generated_cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, partial(write_generated_cover, db, book_id, width, height))
 
 
+def thumbnail_cache(ctx, rd):
+    with lock:
+        if ctx.thumbnail_cache is None:
+            location = os.path.join(rd.tdir, 'thumbnails') if ctx.testing else None
+            ctx.thumbnail_cache = ThumbnailCache(ctx.opts.thumbnail_cache_size, location, ctx.log)
+        return ctx.thumbnail_cache
+
+
+def thumbnail(ctx, rd, library_id, db, book_id, width, height, mtime):
+    ''' Resized covers are stored in a persistent cache, shared by all server
+    threads and processes, so that they survive server restarts. '''
+    cache = thumbnail_cache(ctx, rd)
+    timestamp = timestampfromdt(mtime)
+    ans = cache.get(db.library_id, book_id, width, height, timestamp)
+    used_cache = 'yes'
+    if ans is None:
+        used_cache = 'no'
+        data = render_thumbnail(db, book_id, width, height)
+        if data is None:  # The cover was removed
+            return generated_cover(ctx, rd, library_id, db, book_id, width, height)
+        ans = cache.insert(db.library_id, book_id, width, height, timestamp, data)
+        if ans is None:
+            rd.outheaders['Content-Type'] = 'image/jpeg'
+            ans = data
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+    if isinstance(ans, bytes):
+        return ans
+    return rd.filesystem_file_with_custom_etag(ans, 'cover-%sx%s' % (width, height), library_id, book_id, timestamp)
+
+
 def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     mtime = db.cover_last_modified(book_id)
     if mtime is None:
         return generated_cover(ctx, rd, library_id, db, book_id, width, height)
+    if width is not None or height is not None:
+        return thumbnail(ctx, rd, library_id, db, book_id, width, height, mtime)
     prefix = 'cover'
-    if width is None and height is None:
-        def copy_func(dest):
-            db.copy_cover_to(book_id, dest)
-    else:
-        prefix += '-%sx%s' % (width, height)
+    path = db.format_abspath(book_id, '__COVER_INTERNAL__')
+    ans = None if path is None else library_file(ctx, rd, prefix, library_id, book_id, path)
+    if ans is not None:
+        return ans
 
-        def copy_func(dest):
-            buf = BytesIO()
-            db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
+    def copy_func(dest):
+        db.copy_cover_to(book_id, dest)
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
 
 
@@ -210,6 +264,10 @@ def book_fmt(ctx, rd, library_id, db, book_id, fmt):
     rd.outheaders['Content-Disposition'] = '''attachment; filename="%s"; filename*=utf-8''%s''' % (
         book_filename(rd, book_id, mi, fmt), book_filename(rd, book_id, mi, fmt, as_encoded_unicode=True))
 
+    if not update_metadata:
+        ans = library_file(ctx, rd, 'fmt', library_id, book_id, mdata['path'])
+        if ans is not None:
+            return ans
     return create_file_copy(ctx, rd, 'fmt', library_id, book_id, fmt, mtime, copy_func, extra_etag_data=extra_etag_data)
 # }}}
 
@@ -107,18 +107,19 @@ def convert_book(path_to_ebook, opf_path, cover_path, output_fmt, recs):
     if cover_path:
         recs.append(('cover', cover_path, OptionRecommendation.HIGH))
     log = Log()
+    # The worker process restores the working directory after the job
     os.chdir(os.path.dirname(path_to_ebook))
-    status_file = share_open('status', 'wb')
+    with share_open('status', 'wb') as status_file:
 
-    def notification(percent, msg=''):
-        status_file.write('{}:{}|||\n'.format(percent, msg).encode('utf-8'))
-        status_file.flush()
+        def notification(percent, msg=''):
+            status_file.write('{}:{}|||\n'.format(percent, msg).encode('utf-8'))
+            status_file.flush()
 
-    output_path = os.path.abspath('output.' + output_fmt.lower())
-    plumber = Plumber(path_to_ebook, output_path, log,
-                      report_progress=notification, override_input_metadata=True)
-    plumber.merge_ui_recommendations(recs)
-    plumber.run()
+        output_path = os.path.abspath('output.' + output_fmt.lower())
+        plumber = Plumber(path_to_ebook, output_path, log,
+                          report_progress=notification, override_input_metadata=True)
+        plumber.merge_ui_recommendations(recs)
+        plumber.run()
 
 
 def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
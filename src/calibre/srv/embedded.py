@@ -75,7 +75,7 @@ class Server(object):
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(self.handler.dispatch, self.handler.websocket_handler),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -19,13 +19,14 @@ class RouteError(ValueError):
 
 class HTTPSimpleResponse(Exception):
 
-    def __init__(self, http_code, http_message='', close_connection=False, location=None, authenticate=None, log=None):
+    def __init__(self, http_code, http_message='', close_connection=False, location=None, authenticate=None, log=None, retry_after=None):
         Exception.__init__(self, http_message)
         self.http_code = http_code
         self.close_connection = close_connection
         self.location = location
         self.authenticate = authenticate
         self.log = log
+        self.retry_after = retry_after
 
 
 class HTTPRedirect(HTTPSimpleResponse):
@@ -64,6 +65,12 @@ class HTTPInternalServerError(HTTPSimpleResponse):
         HTTPSimpleResponse.__init__(self, httplib.INTERNAL_SERVER_ERROR, http_message, close_connection, log=log)
 
 
+class HTTPServiceUnavailable(HTTPSimpleResponse):
+
+    def __init__(self, http_message='', retry_after=1, close_connection=False):
+        HTTPSimpleResponse.__init__(self, httplib.SERVICE_UNAVAILABLE, http_message, close_connection, retry_after=retry_after)
+
+
 class BookNotFound(HTTPNotFound):
 
     def __init__(self, book_id, db):
@@ -9,6 +9,7 @@ from importlib import import_module
 from threading import Lock
 
 from calibre.srv.auth import AuthController
+from calibre.srv.change_notifier import ChangeNotifier
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
 from calibre.srv.routes import Router
@@ -22,6 +23,12 @@ class Context(object):
     log = None
     url_for = None
     jobs_manager = None
+    # Used when running with multiple server processes, see srv/prefork.py
+    forward_request = data_changed = None
+    # The persistent cache of resized covers, see srv/thumbnails.py
+    thumbnail_cache = None
+    # Pushes change notifications to clients, see srv/change_notifier.py
+    change_notifier = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
 
@@ -38,6 +45,8 @@ class Context(object):
     def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
+        if self.change_notifier is not None:
+            self.change_notifier.notify(library_path, change_event)
 
     def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
         return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
@@ -156,6 +165,13 @@ class Context(object):
                 cache[key] = old
             return old[1]
 
+    def books_as_json(self, db, book_ids, render, variant=None, use_cache=True):
+        ''' Return the serialized JSON data for the books in book_ids, using
+        the per-library cache. See :meth:`calibre.srv.metadata.BookJSONCache.get` '''
+        with self.lock:
+            cache = self.library_broker.book_json_caches[db.server_library_id]
+        return cache.get(db, book_ids, render, variant, use_cache)
+
     def search(self, request_data, db, query, vl='', report_restriction_errors=False):
         try:
             restrict_to_ids = self.get_effective_book_ids(db, request_data, vl, report_parse_errors=report_restriction_errors)
@@ -182,7 +198,7 @@ class Context(object):
             return old[1]
 
 
-SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert')
+SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'change_notifier')
 
 
 class Handler(object):
@@ -202,6 +218,7 @@ class Handler(object):
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
         self.dispatch = self.router.dispatch
+        self.websocket_handler = ctx.change_notifier = ChangeNotifier(ctx, self.router.strip_path)
 
     def set_log(self, log):
         self.router.ctx.log = log
@@ -212,6 +229,7 @@ class Handler(object):
         self.router.ctx.jobs_manager = jobs_manager
 
     def close(self):
+        self.websocket_handler.shutdown()
         self.router.ctx.library_broker.close()
 
     @property
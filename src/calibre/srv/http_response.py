@@ -7,11 +7,12 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, httplib, hashlib, uuid, struct, repr as reprlib
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from io import BytesIO, DEFAULT_BUFFER_SIZE
 from itertools import chain, repeat, izip_longest
 from operator import itemgetter
 from functools import wraps
+from threading import Lock
 
 from polyglot.builtins import reraise, map, is_py3
 
@@ -37,6 +38,13 @@ else:
     if zlib2_err:
         raise RuntimeError('Failed to load the zlib2 module with error: ' + zlib2_err)
     del zlib2_err
+try:
+    import brotli
+    if not hasattr(brotli, 'Compressor'):
+        brotli = None  # Too old to support streaming compression
+except ImportError:
+    brotli = None
+SUPPORTED_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
 
 
 def header_list_to_file(buf):  # {{{
@@ -95,6 +103,15 @@ def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
 # }}}
 
 
+def preferred_encoding(val, allowed=SUPPORTED_ENCODINGS):  # {{{
+    ' The first of the allowed encodings that is acceptable to the client '
+    accepted = frozenset(x.lower() for x in sort_q_values(val))
+    for x in allowed:
+        if x in accepted:
+            return x
+# }}}
+
+
 def preferred_lang(val, get_translator_for_lang):  # {{{
     for x in sort_q_values(val):
         x = x.lower()
@@ -183,6 +200,78 @@ def compress_readable_output(src_file, compress_level=6):
             data = gzip_prefix() + data
         yield data
     yield zobj.flush() + struct.pack(b"<L", crc & 0xffffffff) + struct.pack(b"<L", size)
+
+
+def brotli_compress_readable_output(src_file, quality=5):
+    c = brotli.Compressor(quality=quality)
+    while True:
+        data = src_file.read(DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        data = c.process(data)
+        if data:
+            yield data
+    yield c.finish()
+
+
+compressors = {'gzip': compress_readable_output, 'br': brotli_compress_readable_output}
+# }}}
+
+
+def compressed_cache_key(request, etag, encoding):
+    # Different URLs can have the same ETag, for example, MathJax files. The
+    # same URL can have different, translated, bodies with the same ETag,
+    # for example, the Tag browser.
+    return request.path, tuple(sorted(request.query.items())), request.lang_code, etag, encoding
+
+
+class CompressedCache(object):  # {{{
+
+    ''' An LRU cache of compressed response bodies, keyed by URL, language,
+    ETag and encoding, so that responses that have an ETag are compressed
+    only once. The Content-Type is stored with the body, as it can be set
+    while the body is generated, which does not happen for cached bodies. '''
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_item_size=8 * 1024 * 1024):
+        self.max_size, self.max_item_size = max_size, max_item_size
+        self.items = OrderedDict()
+        self.size = self.hits = self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        ' Return (compressed data, uncompressed length, content type) or None '
+        with self.lock:
+            ans = self.items.pop(key, None)
+            if ans is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items[key] = ans
+            return ans
+
+    def set(self, key, data, uncompressed_length, content_type=None):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.items[key] = data, uncompressed_length, content_type
+            self.size += len(data)
+            while self.size > self.max_size and self.items:
+                self.size -= len(self.items.popitem(last=False)[1][0])
+
+    def caching_output(self, key, chunks, uncompressed_length, content_type=None):
+        ' Yield the compressed chunks, adding them to the cache once they have all been sent '
+        parts, size = [], 0
+        for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size > self.max_item_size:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.set(key, b''.join(parts), uncompressed_length, content_type)
 # }}}
 
 
@@ -360,6 +449,7 @@ class StaticOutput(object):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    compressed_cache = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -479,6 +569,8 @@ class HTTPConnection(HTTPRequest):
                     eh['Location'] = e.location
                 if e.authenticate:
                     eh['WWW-Authenticate'] = e.authenticate
+                if e.retry_after is not None:
+                    eh['Retry-After'] = '%d' % e.retry_after
                 if e.log:
                     self.log.warn(e.log)
                 return self.simple_response(e.http_code, msg=e.message or '', close_after_response=e.close_connection, extra_headers=eh)
@@ -636,8 +728,22 @@ class HTTPConnection(HTTPRequest):
 
         opts = self.opts
         outheaders = request.outheaders
+        encoding = None
+        if request.status_code == httplib.OK and opts.compress_min_size > -1 and not is_http1:
+            encoding = preferred_encoding(request.inheaders.get('Accept-Encoding', ''))
+        compressed = key = None
+        if encoding is not None and isinstance(output, ETaggedDynamicOutput) and self.compressed_cache is not None:
+            # Avoid generating the response at all, if it is already cached
+            key = compressed_cache_key(request, output.etag, encoding)
+            compressed = self.compressed_cache.get(key)
         stat_result = file_metadata(output)
-        if stat_result is not None:
+        if compressed is not None:
+            # The body is replaced by the cached compressed body below
+            output = ReadableOutput(ReadOnlyFileBuffer(b''), etag=output.etag, content_length=compressed[1])
+            output.accept_ranges = False
+            if compressed[2]:
+                outheaders.set('Content-Type', compressed[2], replace_all=True)
+        elif stat_result is not None:
             output = filesystem_file_output(output, outheaders, stat_result)
             if 'Content-Type' not in outheaders:
                 mt = guess_type(output.name)[0]
@@ -658,9 +764,8 @@ class HTTPConnection(HTTPRequest):
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
                         ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == httplib.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+        compressible = compressed is not None or (
+            compressible and encoding is not None and output.content_length >= opts.compress_min_size)
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == httplib.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -687,15 +792,29 @@ class HTTPConnection(HTTPRequest):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        chunked = output.content_length is None
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
-            if getattr(output, 'content_length', None):
-                outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
+            uncompressed_length = getattr(output, 'content_length', None)
+            if uncompressed_length:
+                outheaders.set('Calibre-Uncompressed-Length', '%d' % uncompressed_length)
+            if key is None and output.etag and self.compressed_cache is not None:
+                key = compressed_cache_key(request, output.etag, encoding)
+                compressed = self.compressed_cache.get(key)
+            if compressed is None:
+                body = compressors[encoding](output.src_file)
+                if key is not None:
+                    body = self.compressed_cache.caching_output(key, body, uncompressed_length, outheaders.get('Content-Type'))
+                output = GeneratedOutput(body, etag=output.etag)
+                chunked = True
+            else:
+                output = ReadableOutput(ReadOnlyFileBuffer(compressed[0]), etag=output.etag, content_length=len(compressed[0]))
+                output.accept_ranges = False
+                compressible = False
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', '%d' % output.content_length, replace_all=True)
 
-        if compressible or output.content_length is None:
+        if chunked:
             outheaders.set('Transfer-Encoding', 'chunked', replace_all=True)
 
         if ranges:
@@ -718,6 +837,7 @@ def create_http_handler(handler=None, websocket_handler=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_cache = CompressedCache()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -730,5 +850,6 @@ def create_http_handler(handler=None, websocket_handler=None):
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
         ans.translator_cache = translator_cache
+        ans.compressed_cache = compressed_cache
         return ans
     return wrapper
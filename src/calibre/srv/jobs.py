@@ -4,32 +4,270 @@
 
 from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
-import os, time
+import os, time, sys, cPickle
 from itertools import count
 from collections import namedtuple, deque
 from functools import partial
-from threading import RLock, Thread, Event
+from threading import Lock, RLock, Thread, Event
 from Queue import Queue, Empty
 
-from calibre import detect_ncpus, force_unicode
+from calibre import detect_ncpus, force_unicode, as_unicode
 from calibre.utils.monotonic import monotonic
-from calibre.utils.ipc.simple_worker import fork_job, WorkerError
+from calibre.utils.ipc import eintr_retry_call
+from calibre.utils.ipc.simple_worker import WorkerError
 
 StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
+# Modules that are expensive to import and are needed by most jobs, they are
+# imported when a worker process starts, rather than when it runs its first job
+WORKER_PRELOAD = ('lxml.etree', 'css_parser', 'calibre.customize.ui', 'calibre.ebooks.oeb.base')
+
+
+# Persistent worker processes {{{
+
+class PoolWorker(object):
+
+    ''' A long lived worker process, that runs jobs one after the other. Uses
+    the worker launching machinery of :mod:`calibre.utils.ipc.pool`. '''
+
+    def __init__(self, listener, worker_data):
+        from calibre.utils.ipc.pool import start_worker
+        self.process = start_worker(
+            'from calibre.utils.ipc.pool import run_main; from calibre.srv.jobs import worker_main; run_main(worker_main)', 'ServerJobs')
+        eintr_retry_call(self.process.stdin.write, worker_data)
+        self.process.stdin.flush(), self.process.stdin.close()
+        self.conn = eintr_retry_call(listener.accept)
+        self.jobs_done = 0
+        self.memory_used = 0
+
+    @property
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self, close_connection=True):
+        if close_connection:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except EnvironmentError:
+                pass  # already dead
+        t = Thread(target=self.process.wait, name='ReapServerJobsWorker')
+        t.daemon = True
+        t.start()
+
+    def shutdown(self):
+        try:
+            eintr_retry_call(self.conn.send_bytes, cPickle.dumps(None, -1))
+        except Exception:
+            pass
+        self.kill()
+
+
+class AbortEvent(object):
+
+    ''' An event that kills the worker process running the job when it is set,
+    so that :meth:`WorkerPool.run_job` can block until the job is done,
+    instead of checking for aborts periodically. '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.event = Event()
+        self.worker = None
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def set(self):
+        with self.lock:
+            self.event.set()
+            worker = self.worker
+        if worker is not None:
+            # Do not close the connection, it is in use by the thread running
+            # the job, which will be woken up by the death of the worker
+            worker.kill(close_connection=False)
+
+    def attach(self, worker):
+        ' Returns True if the event was already set '
+        with self.lock:
+            self.worker = worker
+            return self.event.is_set()
+
+
+class WorkerPool(object):
+
+    ''' Runs jobs in a pool of persistent worker processes, so that the cost of
+    starting a new process and importing the conversion machinery is paid
+    only once per worker, not once per job. Workers are restarted after
+    max_jobs_per_worker jobs or when they use more than max_memory bytes. The
+    pool does not limit the number of workers, that is done by the
+    :class:`JobsManager`. '''
+
+    def __init__(self, max_jobs_per_worker=50, max_memory=0):
+        self.max_jobs_per_worker, self.max_memory = max(1, max_jobs_per_worker), max_memory
+        self.lock = Lock()
+        self.idle_workers = []
+        self.listener = self.worker_data = None
+        self.shutting_down = False
+
+    def get_worker(self):
+        with self.lock:
+            if self.idle_workers:
+                return self.idle_workers.pop()
+            if self.listener is None:
+                from calibre.utils.ipc.server import create_listener
+                auth_key = os.urandom(32)
+                address, self.listener = create_listener(auth_key)
+                self.worker_data = cPickle.dumps((address, auth_key), -1)
+            # The listener accepts only one connection at a time
+            return PoolWorker(self.listener, self.worker_data)
+
+    def release_worker(self, worker):
+        if worker.jobs_done >= self.max_jobs_per_worker or (
+                self.max_memory and worker.memory_used > self.max_memory) or not worker.is_alive:
+            worker.shutdown()
+            return
+        with self.lock:
+            if not self.shutting_down:
+                self.idle_workers.append(worker)
+                return
+        worker.shutdown()
+
+    def run_job(self, mod_name, func_name, args=(), kwargs={}, timeout=300, abort=None):
+        ''' Run the job in a worker process, with the same semantics as
+        :func:`calibre.utils.ipc.simple_worker.fork_job`: returns a dictionary
+        with the keys result and stdout_stderr, raises WorkerError on
+        failure and kills the worker process if abort is set. An abort that
+        is not an :class:`AbortEvent` is only checked before the job starts. '''
+        from calibre.ptempfile import PersistentTemporaryFile
+        with PersistentTemporaryFile(prefix='srv-job-', suffix='.log') as f:
+            log_path = f.name
+        ans = {'result':None, 'stdout_stderr':log_path}
+        try:
+            worker = self.get_worker()
+        except Exception as err:
+            import traceback
+            raise WorkerError('Failed to start worker process: %s' % as_unicode(err), traceback.format_exc(), log_path)
+        attach = getattr(abort, 'attach', None)
+        if (abort is not None and abort.is_set()) or (attach is not None and attach(worker)):
+            worker.kill()
+            return ans
+        try:
+            eintr_retry_call(worker.conn.send_bytes, cPickle.dumps((mod_name, func_name, args, kwargs, log_path), -1))
+            # Wakes up when the job is done, or the worker dies (which
+            # includes being killed by an abort)
+            if not eintr_retry_call(worker.conn.poll, timeout):
+                worker.kill()
+                raise WorkerError('Worker appears to have hung', log_path=log_path)
+            res = cPickle.loads(eintr_retry_call(worker.conn.recv_bytes))
+        except WorkerError:
+            worker.kill()
+            raise
+        except Exception:
+            import traceback
+            tb, died = traceback.format_exc(), not worker.is_alive
+            worker.kill()
+            if abort is not None and abort.is_set():
+                return ans
+            raise WorkerError('The worker process died' if died else 'Failed to communicate with worker process', tb, log_path)
+        finally:
+            if attach is not None:
+                attach(None)
+        worker.jobs_done += 1
+        worker.memory_used = res.get('memory_used', 0)
+        self.release_worker(worker)
+        if res.get('tb'):
+            raise WorkerError('Worker failed', res['tb'], log_path)
+        ans['result'] = res['result']
+        return ans
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            workers, self.idle_workers = self.idle_workers, []
+        for w in workers:
+            w.shutdown()
+        if self.listener is not None:
+            try:
+                self.listener.close()
+            except Exception:
+                pass
+
+
+def worker_main(conn):
+    from importlib import import_module
+    for mod in WORKER_PRELOAD:
+        try:
+            import_module(mod)
+        except Exception:
+            pass
+    import gc, tempfile
+    from calibre.ptempfile import base_dir, swap_base_dir, remove_dir
+    orig_stdout, orig_stderr = os.dup(1), os.dup(2)
+    orig_cwd = os.getcwdu()
+    while True:
+        try:
+            job = cPickle.loads(eintr_retry_call(conn.recv_bytes))
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        mod_name, func_name, args, kwargs, log_path = job
+        # Send the output of each job to its own log file, as fork_job() does
+        sys.stdout.flush(), sys.stderr.flush()
+        with lopen(log_path, 'ab') as f:
+            os.dup2(f.fileno(), 1), os.dup2(f.fileno(), 2)
+        # Give each job its own directory for temporary files, so that they
+        # are removed when it is done, not when the worker exits
+        job_tdir = tempfile.mkdtemp(prefix='job-', dir=base_dir())
+        orig_tdir = swap_base_dir(job_tdir)
+        try:
+            try:
+                mod = import_module(mod_name)
+            except ImportError:
+                import_module('calibre.customize.ui')  # Load plugins
+                mod = import_module(mod_name)
+            res = {'result':getattr(mod, func_name)(*args, **kwargs)}
+        except:
+            import traceback
+            res = {'tb': traceback.format_exc()}
+        finally:
+            sys.stdout.flush(), sys.stderr.flush()
+            os.dup2(orig_stdout, 1), os.dup2(orig_stderr, 2)
+            # Do not let the job change the environment of the next job
+            os.chdir(orig_cwd)
+            swap_base_dir(orig_tdir)
+            # Close the files the job left open, that are no longer
+            # referenced, before removing its temporary files
+            gc.collect()
+            remove_dir(job_tdir)
+        try:
+            from calibre.utils.mem import get_memory
+            res['memory_used'] = get_memory()
+        except Exception:
+            pass
+        try:
+            eintr_retry_call(conn.send_bytes, cPickle.dumps(res, -1))
+        except EOFError:
+            break
+    return 0
+# }}}
 
 
 class Job(Thread):
 
     daemon = True
 
-    def __init__(self, start_event, events_queue):
+    def __init__(self, start_event, events_queue, worker_pool):
         Thread.__init__(self, name='JobsMonitor%s' % start_event.job_id)
-        self.abort_event = Event()
+        self.abort_event = AbortEvent()
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
+        self.func = partial(worker_pool.run_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
@@ -91,6 +329,7 @@ class JobsManager(object):
         self.log = log
         self.max_jobs = max(1, mj)
         self.max_job_time = max(0, opts.max_job_time * 60)
+        self.worker_pool = WorkerPool(opts.max_jobs_per_worker, opts.max_worker_memory * 1024 * 1024)
         self.lock = RLock()
         self.jobs = {}
         self.finished_jobs = {}
@@ -148,6 +387,7 @@ class JobsManager(object):
             for job in self.jobs.itervalues():
                 job.abort_event.set()
             self.events.put(False)
+        self.worker_pool.shutdown()
 
     def wait_for_shutdown(self, wait_till):
         for job in self.jobs.itervalues():
@@ -186,7 +426,7 @@ class JobsManager(object):
         with self.lock:
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
                 ev = self.waiting_jobs.popleft()
-                self.jobs[ev.job_id] = Job(ev, self.events)
+                self.jobs[ev.job_id] = Job(ev, self.events, self.worker_pool)
                 self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
 
@@ -253,3 +493,4 @@ def sleep_test(x):
 
 def error_test():
     raise Exception('a testing error')
+
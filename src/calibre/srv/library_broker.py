@@ -11,6 +11,7 @@ from threading import RLock as Lock
 from calibre import filesystem_encoding
 from calibre.db.cache import Cache
 from calibre.db.legacy import LibraryDatabase, create_backend, set_global_state
+from calibre.srv.metadata import BookJSONCache
 from calibre.utils.filenames import samefile as _samefile
 from calibre.utils.monotonic import monotonic
 
@@ -90,6 +91,7 @@ class LibraryBroker(object):
         self.category_caches, self.search_caches, self.tag_browser_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
             defaultdict(OrderedDict))
+        self.book_json_caches = defaultdict(BookJSONCache)
 
     def get(self, library_id=None):
         with self:
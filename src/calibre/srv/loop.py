@@ -7,6 +7,7 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import ssl, socket, select, os, traceback
+from collections import deque
 from io import BytesIO
 from Queue import Empty, Full
 from functools import partial
@@ -16,6 +17,8 @@ from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.pool import ThreadPool, PluginPool
 from calibre.srv.opts import Options
+from calibre.srv.poller import (
+    create_poller, TimerWheel, BadFileDescriptor, POLL_READ, POLL_WRITE)
 from calibre.srv.jobs import JobsManager
 from calibre.srv.utils import (
     socket_errors_socket_closed, socket_errors_nonblocking, HandleInterrupt,
@@ -28,6 +31,7 @@ from calibre.utils.mdns import get_external_ip
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = bytes(bytearray(xrange(2)))
+INTEREST = {READ: POLL_READ, WRITE: POLL_WRITE, RDWR: POLL_READ | POLL_WRITE, WAIT: 0}
 
 
 class ReadBuffer(object):  # {{{
@@ -120,6 +124,10 @@ class ReadBuffer(object):  # {{{
 
 class Connection(object):  # {{{
 
+    # Called with the connection whenever wait_for changes, set by the server
+    # loop so that it can update the events it polls for
+    interest_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -131,7 +139,7 @@ class Connection(object):  # {{{
         self.is_local_connection = self.remote_addr in ('127.0.0.1', '::1')
         self.orig_send_bufsize = self.send_bufsize = 4096
         self.tdir = tdir
-        self.wait_for = READ
+        self._wait_for = READ
         self.response_started = False
         self.read_buffer = ReadBuffer()
         self.handle_event = None
@@ -164,6 +172,17 @@ class Connection(object):  # {{{
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        if val is not self._wait_for:
+            self._wait_for = val
+            if self.interest_changed is not None:
+                self.interest_changed(self)
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -287,7 +306,7 @@ class Connection(object):  # {{{
 
     def close(self):
         self.ready = False
-        self.handle_event = None  # prevent reference cycles
+        self.handle_event = self.interest_changed = None  # prevent reference cycles
         try:
             self.socket.shutdown(socket.SHUT_WR)
             self.socket.close()
@@ -330,6 +349,9 @@ class Connection(object):  # {{{
 class ServerLoop(object):
 
     LISTENING_MSG = 'calibre server listening on'
+    # Allow several processes to listen on the same port, with the kernel
+    # distributing connections between them, see srv/prefork.py
+    reuse_port = False
 
     def __init__(
         self,
@@ -357,6 +379,9 @@ class ServerLoop(object):
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.poller = self.timers = self.listener_fd = None
+        self.buffered = {}
+        self.interest_changes = deque()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -385,7 +410,11 @@ class ServerLoop(object):
             return ssl.ALERT_DESCRIPTION_NO_RENEGOTIATION
 
     def create_control_connection(self):
+        if self.poller is not None:
+            self.poller.unregister(self.control_out.fileno())
         self.control_in, self.control_out = create_sock_pair()
+        if self.poller is not None:
+            self.poller.register(self.control_out.fileno(), POLL_READ)
 
     def __str__(self):
         return "%s(%r)" % (self.__class__.__name__, self.bind_address)
@@ -446,8 +475,14 @@ class ServerLoop(object):
             self.setup_socket()
 
     def serve(self):
-        self.connection_map = {}
+        self.connection_map, self.buffered = {}, {}
+        self.interest_changes.clear()
+        self.poller = create_poller(self.opts.event_loop)
+        self.timers = TimerWheel(self.opts.timeout, now=monotonic())
         self.socket.listen(min(socket.SOMAXCONN, 128))
+        self.listener_fd = self.socket.fileno()
+        self.poller.register(self.listener_fd, POLL_READ)
+        self.poller.register(self.control_out.fileno(), POLL_READ)
         self.bound_address = ba = self.socket.getsockname()
         if isinstance(ba, tuple):
             ba = ':'.join(map(type(''), ba))
@@ -478,6 +513,8 @@ class ServerLoop(object):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -502,65 +539,44 @@ class ServerLoop(object):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in self.connection_map.iteritems():
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
-            self.close(s, conn)
-
-        for x, conn in close_needed:
-            self.close(s, conn)
-
-        if readable:
-            writable = []
+        self.process_interest_changes()
+        self.expire_connections(now)
+        if self.buffered:
+            timeout = 0
         else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
+            timeout = self.opts.timeout
+            next_expiry = self.timers.next_expiry()
+            if next_expiry is not None:
+                timeout = max(0, min(timeout, next_expiry - now))
+        try:
+            readable, writable = self.poller.poll(timeout)
+        except BadFileDescriptor as e:
+            if e.fd in (self.listener_fd, self.control_out.fileno()):
                 self.ready = False
                 self.log.error('Listening socket was unexpectedly terminated')
+            else:
+                conn = self.connection_map.get(e.fd)
+                if conn is not None:
+                    self.close(e.fd, conn)  # Bad socket, discard
+            return
+        except (select.error, EnvironmentError) as e:
+            # select.error has no errno attribute. errno is instead
+            # e.args[0]
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
-            except (select.error, socket.error) as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
-                for s, conn in tuple(self.connection_map.iteritems()):
-                    try:
-                        select.select([s], [], [], 0)
-                    except (select.error, socket.error) as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
-                return
+            raise
 
         if not self.ready:
             return
 
+        if self.buffered:
+            # Connections that have data waiting in their read buffers or in
+            # the SSL layer will not be reported by the poller
+            for s in self.buffered:
+                if s not in readable:
+                    readable.append(s)
+            self.buffered.clear()
+
         ignore = set()
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
@@ -598,6 +614,61 @@ class ServerLoop(object):
                     else:
                         self.log.error('Error in SSL handshake, terminating connection: %s' % as_unicode(e))
                         self.close(s, conn)
+            if conn.ready and self.connection_map.get(s) is conn:
+                self.check_buffered(s, conn)
+
+    def add_connection(self, s, conn):
+        self.connection_map[s] = conn
+        conn.interest_changed = partial(self.queue_interest_change, s)
+        self.update_interest(s, conn)
+        self.timers.add(s, conn, conn.last_activity + self.opts.timeout)
+
+    def queue_interest_change(self, s, conn):
+        # Can be called from any thread, the change is applied in the loop
+        # thread at the start of the next tick
+        self.interest_changes.append((s, conn))
+
+    def process_interest_changes(self):
+        while True:
+            try:
+                s, conn = self.interest_changes.popleft()
+            except IndexError:
+                break
+            if self.connection_map.get(s) is conn:
+                self.update_interest(s, conn)
+                self.check_buffered(s, conn)
+
+    def update_interest(self, s, conn):
+        try:
+            self.poller.set_interest(s, INTEREST[conn.wait_for])
+        except (EnvironmentError, ValueError):
+            self.close(s, conn)  # Bad socket, discard
+
+    def check_buffered(self, s, conn):
+        wf = conn.wait_for
+        if wf is READ or wf is RDWR:
+            if not conn.read_buffer.has_data and self.ssl_context is not None and conn.socket.pending():
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    self.close(s, conn)
+                    return
+            if conn.read_buffer.has_data:
+                self.buffered[s] = conn
+                return
+        self.buffered.pop(s, None)
+
+    def expire_connections(self, now):
+        for s, conn in self.timers.expire(now):
+            if self.connection_map.get(s) is not conn:
+                continue
+            if now - conn.last_activity > self.opts.timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                    self.close(s, conn)
+                    continue
+            self.timers.add(s, conn, conn.last_activity + self.opts.timeout)
 
     def wakeup(self):
         self.control_in.sendall(WAKEUP)
@@ -616,11 +687,17 @@ class ServerLoop(object):
                 yield s, conn, (ok, result)
 
     def close(self, s, conn):
-        self.connection_map.pop(s, None)
+        if self.connection_map.get(s) is conn:
+            del self.connection_map[s]
+            # Must be done before the socket is closed, as the fd can be
+            # re-used immediately after
+            self.timers.remove(s)
+            self.poller.unregister(s)
+            self.buffered.pop(s, None)
         conn.close()
 
     def get_actions(self, readable, writable):
-        listener = self.socket.fileno()
+        listener = self.listener_fd
         control = self.control_out.fileno()
         for s in readable:
             if s == listener:
@@ -628,8 +705,9 @@ class ServerLoop(object):
                 if sock is not None:
                     s = sock.fileno()
                     if s > -1:
-                        self.connection_map[s] = conn = self.handler(
+                        conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        self.add_connection(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -682,6 +760,8 @@ class ServerLoop(object):
             pass
         for s, conn in tuple(self.connection_map.iteritems()):
             self.close(s, conn)
+        if self.poller is not None:
+            self.poller.close()
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
 import os
 from copy import copy
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from datetime import datetime, time
 from functools import partial
 from threading import Lock
@@ -21,6 +21,7 @@ from calibre.utils.formatter import EvalFormatter
 from calibre.utils.file_type_icons import EXT_MAP
 from calibre.utils.icu import collation_order
 from calibre.utils.localization import calibre_langcode_to_name
+from calibre.utils.serialize import json_dumps
 from calibre.library.comments import comments_to_html, markdown
 from calibre.library.field_metadata import category_icon_map
 
@@ -91,6 +92,98 @@ def book_as_json(db, book_id):
     return ans
 
 
+class BooksAsJSON(list):
+
+    ''' A list of (book_id, JSON) pairs, where JSON is the already serialized
+    data for the book, as returned by :meth:`BookJSONCache.get`. It is encoded
+    as a JSON object mapping book ids to the data by simply concatenating the
+    serialized data. '''
+
+    def as_json(self):
+        return b'{' + b','.join(b'"%d":%s' % (book_id, raw) for book_id, raw in self) + b'}'
+
+
+def encode_json_with_books(data):
+    ''' Encode data, which must be a dict, as JSON. Any values that are
+    :class:`BooksAsJSON` instances are spliced into the output without being
+    decoded and encoded again. Returns UTF-8 encoded bytes. '''
+    books = [(k, v) for k, v in data.iteritems() if isinstance(v, BooksAsJSON)]
+    if not books:
+        return json_dumps(data)
+    ans = json_dumps({k:v for k, v in data.iteritems() if not isinstance(v, BooksAsJSON)})
+    parts = [json_dumps(k) + b':' + v.as_json() for k, v in books]
+    return ans[:-1] + (b',' if len(ans) > 2 else b'') + b','.join(parts) + b'}'
+
+
+class BookJSONCache(object):
+
+    ''' A cache of the serialized JSON data for the books in a library, so
+    that the data for lists of books can be assembled without re-creating it
+    from the database each time. Entries are keyed by the book id and a
+    variant, which describes the type of data, and are valid only for the
+    last_modified value of the book and the set of fields in the library at
+    the time they were created. Since any change to a book updates its
+    last_modified value, there is no need for explicit invalidation.
+    The least recently used entries are removed when the total size of the
+    cache exceeds max_size bytes. '''
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.total_size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.hits = self.misses = 0
+
+    def get(self, db, book_ids, render, variant=None, use_cache=True):
+        ''' Return a :class:`BooksAsJSON` for the books in book_ids that
+        exist. render(book_id) must return the data for the book, or None if
+        the book does not exist. Must be called with the read lock held.
+        Returns the max. last_modified value of the books as well. If
+        use_cache is False, the data is always rendered and not stored. '''
+        db = db.new_api
+        fields_key = hash(tuple(db.field_metadata.all_field_keys()))
+        ans = BooksAsJSON()
+        max_last_modified = None
+        for book_id in book_ids:
+            key = book_id, variant
+            lm = db._field_for('last_modified', book_id)
+            with self.lock:
+                entry = self.items.pop(key, None) if use_cache else None
+                if entry is not None:
+                    if entry[:2] == (lm, fields_key):
+                        self.items[key] = entry
+                        self.hits += 1
+                    else:
+                        self.total_size -= len(entry[2])
+                        entry = None
+            if entry is None:
+                data = render(book_id)
+                if data is None:
+                    continue
+                raw = json_dumps(data)
+                if use_cache:
+                    self.insert(key, (lm, fields_key, raw))
+            else:
+                raw = entry[2]
+            ans.append((book_id, raw))
+            if lm is not None and (max_last_modified is None or lm > max_last_modified):
+                max_last_modified = lm
+        return ans, max_last_modified
+
+    def insert(self, key, entry):
+        with self.lock:
+            self.misses += 1
+            self.items[key] = entry
+            self.total_size += len(entry[2])
+            while self.total_size > self.max_size and self.items:
+                self.total_size -= len(self.items.popitem(last=False)[1][2])
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.total_size = 0
+
+
 _include_fields = frozenset(Tag.__slots__) - frozenset({
     'state', 'is_editable', 'is_searchable', 'original_name', 'use_sort_as_name', 'is_hierarchical'
 })
@@ -68,6 +68,17 @@ raw_options = (
     'worker_count', 10,
     None,
 
+    _('Max. size of the cover thumbnail cache (in MB)'),
+    'thumbnail_cache_size', 200,
+    _('Resized covers are stored on disk, so that they do not have to be re-created after'
+      ' the server is restarted. When the cache becomes larger than this size, the least'
+      ' recently used thumbnails are removed.'),
+
+    _('Mechanism used to wait for network events'), 'event_loop', Choices('auto', 'epoll', 'poll', 'select'),
+    _('The mechanism the server uses to wait for activity on its connections. The default, "auto",'
+      ' uses the most scalable one available on this computer (epoll on Linux). "select" works'
+      ' everywhere, but is limited to about a thousand simultaneous connections.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -80,6 +91,24 @@ raw_options = (
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set'
       ' to zero for no limit.'),
 
+    _('Maximum number of jobs run by a worker process'),
+    'max_jobs_per_worker', 50,
+    _('Worker processes are re-used for many jobs, to avoid the cost of starting'
+      ' a new process for every job. After running this many jobs, a worker'
+      ' process is replaced by a new one. Set to one to use a new worker process'
+      ' for every job.'),
+
+    _('Maximum size of the cache of books for the in-browser viewer'),
+    'max_render_cache_size', 2048,
+    _('Books are converted into a form suitable for the in-browser viewer and'
+      ' stored in a cache. When the cache is larger than this size (in MB), the'
+      ' least recently read books are removed from it. Set to zero for no limit.'),
+
+    _('Maximum memory used by worker processes'),
+    'max_worker_memory', 1024,
+    _('A worker process that is using more than this much memory (in MB) after'
+      ' running a job is replaced by a new one. Set to zero for no limit.'),
+
     _('The port on which to listen for connections'),
     'port', 8080,
     None,
@@ -125,6 +154,13 @@ raw_options = (
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Serve book files directly from the library'),
+    'serve_library_files', False,
+    _('Send book files and covers that do not need to be modified straight from the calibre'
+    ' library folder, instead of first copying them into a cache. This saves time and disk'
+    ' space, but a file that is changed in place, for example when metadata is embedded into'
+    ' it, while it is being downloaded can cause a corrupted download. Has no effect on Windows.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
@@ -0,0 +1,276 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2017, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import select, errno
+
+from calibre.srv.utils import socket_errors_eintr
+
+POLL_READ, POLL_WRITE = 1, 2
+
+
+class Poller(object):  # {{{
+
+    ''' Tracks the set of file descriptors the server loop is interested in.
+    Interest is updated incrementally via :meth:`register`,
+    :meth:`modify` and :meth:`unregister`, so that :meth:`poll` does not
+    have to look at every connection on every iteration. '''
+
+    name = None
+
+    def __init__(self):
+        self.interest = {}
+
+    def __len__(self):
+        return len(self.interest)
+
+    def __contains__(self, fd):
+        return fd in self.interest
+
+    def set_interest(self, fd, mask):
+        ' Register, modify or unregister fd, as needed. A mask of zero unregisters. '
+        current = self.interest.get(fd)
+        if current == mask:
+            return
+        if not mask:
+            self.unregister(fd)
+        elif current is None:
+            self.register(fd, mask)
+        else:
+            self.modify(fd, mask)
+
+    def register(self, fd, mask):
+        self.interest[fd] = mask
+
+    def modify(self, fd, mask):
+        self.interest[fd] = mask
+
+    def unregister(self, fd):
+        self.interest.pop(fd, None)
+
+    def poll(self, timeout):
+        ''' Wait for at most timeout seconds, returning the lists of
+        readable and writable file descriptors. Only events that match the
+        registered interest are reported. '''
+        raise NotImplementedError()
+
+    def close(self):
+        self.interest.clear()
+
+
+class EpollPoller(Poller):
+
+    name = 'epoll'
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.epoll = select.epoll()
+        self.rmask = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP | select.EPOLLERR
+        self.wmask = select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR
+
+    def events(self, mask):
+        ans = 0
+        if mask & POLL_READ:
+            ans |= select.EPOLLIN | select.EPOLLPRI
+        if mask & POLL_WRITE:
+            ans |= select.EPOLLOUT
+        return ans
+
+    def register(self, fd, mask):
+        self.epoll.register(fd, self.events(mask))
+        self.interest[fd] = mask
+
+    def modify(self, fd, mask):
+        self.epoll.modify(fd, self.events(mask))
+        self.interest[fd] = mask
+
+    def unregister(self, fd):
+        if self.interest.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (EnvironmentError, ValueError):
+                pass  # fd was already closed
+
+    def poll(self, timeout):
+        readable, writable = [], []
+        if timeout is None or timeout < 0:
+            timeout = -1
+        for fd, ev in self.epoll.poll(timeout):
+            mask = self.interest.get(fd, 0)
+            if mask & POLL_READ and ev & self.rmask:
+                readable.append(fd)
+            if mask & POLL_WRITE and ev & self.wmask:
+                writable.append(fd)
+        return readable, writable
+
+    def close(self):
+        Poller.close(self)
+        self.epoll.close()
+
+
+class PollPoller(EpollPoller):
+
+    name = 'poll'
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.epoll = select.poll()
+        self.rmask = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+        self.wmask = select.POLLOUT | select.POLLHUP | select.POLLERR
+
+    def events(self, mask):
+        ans = 0
+        if mask & POLL_READ:
+            ans |= select.POLLIN | select.POLLPRI
+        if mask & POLL_WRITE:
+            ans |= select.POLLOUT
+        return ans
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = -1 if timeout < 0 else int(timeout * 1000)
+        return EpollPoller.poll(self, timeout)
+
+    def close(self):
+        Poller.close(self)
+
+
+class SelectPoller(Poller):
+
+    ''' Portable fallback, limited to FD_SETSIZE file descriptors. The read
+    and write lists are maintained incrementally, rather than being
+    rebuilt on every call. '''
+
+    name = 'select'
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.read_fds, self.write_fds = set(), set()
+
+    def register(self, fd, mask):
+        self.modify(fd, mask)
+
+    def modify(self, fd, mask):
+        self.interest[fd] = mask
+        (self.read_fds.add if mask & POLL_READ else self.read_fds.discard)(fd)
+        (self.write_fds.add if mask & POLL_WRITE else self.write_fds.discard)(fd)
+
+    def unregister(self, fd):
+        self.interest.pop(fd, None)
+        self.read_fds.discard(fd), self.write_fds.discard(fd)
+
+    def poll(self, timeout):
+        try:
+            readable, writable, _ = select.select(self.read_fds, self.write_fds, (), timeout)
+        except (select.error, EnvironmentError, ValueError) as e:
+            if getattr(e, 'errno', e.args[0] if e.args else None) in socket_errors_eintr:
+                return [], []
+            # Some file descriptor is bad, find and discard it
+            for fd in tuple(self.interest):
+                try:
+                    select.select([fd], [], [], 0)
+                except (select.error, EnvironmentError, ValueError) as e:
+                    if getattr(e, 'errno', e.args[0] if e.args else None) not in socket_errors_eintr:
+                        self.unregister(fd)
+                        raise BadFileDescriptor(fd)
+            return [], []
+        return readable, writable
+
+    def close(self):
+        Poller.close(self)
+        self.read_fds.clear(), self.write_fds.clear()
+
+
+class BadFileDescriptor(ValueError):
+
+    def __init__(self, fd):
+        ValueError.__init__(self, 'Bad file descriptor: %s' % fd)
+        self.fd = fd
+        self.errno = errno.EBADF
+
+
+backends = (EpollPoller, PollPoller, SelectPoller)
+
+
+def create_poller(backend='auto'):
+    ''' Create the best available poller, or the one named by backend. Falls
+    back to select() when the requested mechanism is not available on this
+    platform. '''
+    for cls in backends:
+        if backend not in ('auto', cls.name):
+            continue
+        try:
+            return cls()
+        except (AttributeError, EnvironmentError):
+            continue  # Not available on this platform
+    return SelectPoller()
+# }}}
+
+
+class TimerWheel(object):  # {{{
+
+    ''' Track deadlines for a large number of objects with O(1) insertion and
+    removal. Time is divided into slots of width granularity and each object
+    lives in the slot after its deadline, so expiry only needs to look at the
+    slots that have passed, not at every object. Since no deadline is ever more
+    than span seconds in the future, the slots are reused cyclically. '''
+
+    def __init__(self, span, granularity=None, now=0):
+        self.granularity = granularity or max(0.001, span / 64)
+        self.num_slots = int(span / self.granularity) + 3
+        self.slots = [{} for i in xrange(self.num_slots)]
+        self.slot_map = {}
+        self.current_tick = self.tick_for(now)
+
+    def __len__(self):
+        return len(self.slot_map)
+
+    def tick_for(self, t):
+        return int(t / self.granularity)
+
+    def add(self, key, obj, deadline):
+        ' Add or reschedule the object identified by key '
+        self.remove(key)
+        tick = max(self.tick_for(deadline) + 1, self.current_tick + 1)
+        tick = min(tick, self.current_tick + self.num_slots - 1)
+        self.slots[tick % self.num_slots][key] = obj
+        self.slot_map[key] = tick
+
+    def remove(self, key):
+        tick = self.slot_map.pop(key, None)
+        if tick is not None:
+            self.slots[tick % self.num_slots].pop(key, None)
+
+    def expire(self, now):
+        ' Remove and return the (key, obj) pairs whose slots have passed '
+        ans = []
+        target = self.tick_for(now)
+        if not self.slot_map:
+            self.current_tick = max(self.current_tick, target)
+            return ans
+        while self.current_tick < target:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % self.num_slots]
+            if slot:
+                for key, obj in slot.iteritems():
+                    del self.slot_map[key]
+                    ans.append((key, obj))
+                slot.clear()
+                if not self.slot_map:
+                    self.current_tick = target
+                    break
+        return ans
+
+    def next_expiry(self):
+        ' The time at which the next non-empty slot expires, or None '
+        if not self.slot_map:
+            return None
+        for i in xrange(1, self.num_slots):
+            tick = self.current_tick + i
+            if self.slots[tick % self.num_slots]:
+                return tick * self.granularity
+# }}}
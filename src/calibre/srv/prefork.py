@@ -0,0 +1,250 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Run the Content server in several processes, to make use of more than one CPU
+core. The processes share the listening port, using SO_REUSEPORT where
+available, so that the kernel distributes incoming connections between them.
+
+The process that is started by the user is the primary. It forks the replicas
+before any library is opened. Requests that could change data are forwarded by
+the replicas to the primary over a private listening socket on the loopback
+interface, so all writes happen in a single process. Forwarded requests carry
+a secret shared by the server processes and the address of the client that
+made them, which the primary uses in place of the loopback address the
+request came from. After a write, the primary notifies the replicas, which then
+re-read the changed books using the change journal of the library, see
+:meth:`calibre.db.cache.Cache.apply_external_changes`.
+'''
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hmac
+import httplib
+import os
+import signal
+import socket
+import time
+from functools import partial
+from threading import Lock, Thread
+from urllib import urlencode
+
+from calibre.srv.changes import metadata
+from calibre.srv.errors import HTTPForbidden
+from calibre.srv.http_response import create_http_handler
+from calibre.srv.library_broker import path_for_db
+from calibre.srv.loop import ServerLoop
+from calibre.srv.opts import Options, options
+from calibre.srv.pool import PluginPool
+from calibre.srv.utils import encode_path, socket_errors_eintr
+from calibre.utils.monotonic import monotonic
+
+SECRET_HEADER = 'X-Calibre-Forwarding-Secret'
+PEER_HEADER = 'X-Calibre-Forwarded-Peer'
+# Headers that apply to a single connection, or that are generated by the
+# server when sending the response, or that are set when forwarding
+SKIPPED_REQUEST_HEADERS = frozenset(
+    'connection keep-alive host content-length transfer-encoding accept-encoding te upgrade x-forwarded-for'.split() +
+    [SECRET_HEADER.lower(), PEER_HEADER.lower()])
+SKIPPED_RESPONSE_HEADERS = frozenset(
+    'connection keep-alive content-length transfer-encoding content-encoding etag accept-ranges date server'.split())
+
+
+def header_name(name):
+    return '-'.join(x.capitalize() for x in name.split('-'))
+
+
+def forward_request(address, timeout, secret, data):
+    ''' Send the request to the server at address and copy its response into
+    data, returning the response body. Authentication is performed again by the
+    receiving server, which works as the replica shares its secrets with the
+    primary. The receiving server must check that the request has secret, see
+    :meth:`WorkerProcesses.dispatch_forwarded`. '''
+    uri = encode_path(*data.path)
+    if data.query:
+        uri += '?' + urlencode([(k.encode('utf-8'), v.encode('utf-8')) for k, v in data.query.items()])
+    body = data.request_body_file.read()
+    conn = httplib.HTTPConnection(address[0], address[1], timeout=timeout)
+    try:
+        conn.putrequest(data.method, uri, skip_accept_encoding=True)
+        for name, val in data.inheaders.items():
+            if name.lower() not in SKIPPED_REQUEST_HEADERS:
+                conn.putheader(name, val)
+        if data.forwarded_for:
+            conn.putheader('X-Forwarded-For', data.forwarded_for)
+        conn.putheader(SECRET_HEADER, secret)
+        conn.putheader(PEER_HEADER, data.remote_addr or '')
+        conn.putheader('Content-Length', '%d' % len(body))
+        conn.endheaders(body or None)
+        res = conn.getresponse()
+        data.status_code = res.status
+        for name in frozenset(res.msg.keys()):
+            if name not in SKIPPED_RESPONSE_HEADERS:
+                for val in res.msg.getheaders(name):
+                    data.outheaders[header_name(name)] = val
+        return res.read()
+    finally:
+        conn.close()
+
+
+class WorkerProcesses(object):
+
+    def __init__(self, server, count):
+        self.server, self.count = server, count
+        self.loop, self.log = server.loop, server.loop.log
+        self.ctx = server.handler.router.ctx
+        self.children = {}
+        self.lock = Lock()
+        self.is_primary = True
+        self.write_loop = self.write_thread = None
+        self.secret = os.urandom(32).encode('hex').decode('ascii')
+        self.forwarded_count = 0
+
+    def create_write_loop(self):
+        opts = self.loop.opts
+        wopts = Options(**{name: getattr(opts, name) for name in options})
+        wopts.listen_on, wopts.port = '127.0.0.1', 0
+        wopts.ssl_certfile = wopts.ssl_keyfile = None
+        wopts.allow_socket_preallocation = wopts.fallback_to_detected_interface = False
+        self.write_loop = ServerLoop(create_http_handler(self.dispatch_forwarded), opts=wopts, log=self.log)
+        self.write_loop.LISTENING_MSG = None
+        self.write_loop.initialize_socket()
+
+    def dispatch_forwarded(self, data):
+        ''' Handle a request forwarded by a replica. All forwarded requests
+        come from the loopback interface, so the address of the client that
+        made the request to the replica is used in its place. Otherwise every
+        client would be treated as local, which for example would give
+        anonymous remote clients write access with --enable-local-write. '''
+        secret = data.inheaders.get(SECRET_HEADER) or ''
+        if isinstance(secret, bytes):
+            secret = secret.decode('ascii', 'replace')
+        if not hmac.compare_digest(secret, self.secret):
+            raise HTTPForbidden('Only requests forwarded by another server process are allowed')
+        data.remote_addr = data.inheaders.get(PEER_HEADER) or None
+        data.remote_port = None
+        data.is_local_connection = data.remote_addr in ('127.0.0.1', '::1')
+        self.forwarded_count += 1
+        return self.server.handler.dispatch(data)
+
+    def start(self):
+        ''' Bind the listening sockets and fork the replica processes. Must be
+        called before any libraries are opened and before any threads are
+        started. Returns True in the primary process. '''
+        loop = self.loop
+        loop.reuse_port = hasattr(socket, 'SO_REUSEPORT') and loop.pre_activated_socket is None
+        loop.initialize_socket()
+        address = loop.socket.getsockname()[:2]
+        self.create_write_loop()
+        write_address = self.write_loop.socket.getsockname()[:2]
+        for i in xrange(self.count - 1):
+            primary_end, replica_end = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                primary_end.close()
+                self.become_replica(replica_end, address, write_address)
+                return False
+            replica_end.close()
+            self.children[pid] = primary_end
+        self.become_primary()
+        return True
+
+    def become_primary(self):
+        self.ctx.data_changed = self.notify_replicas
+        self.write_thread = Thread(name='WriteForwarding', target=self.write_loop.serve)
+        self.write_thread.daemon = True
+        self.write_thread.start()
+        self.server.serve_forever = self.loop.serve
+        self.log('Started %d server processes' % self.count)
+
+    def become_replica(self, primary_socket, address, write_address):
+        self.is_primary = False
+        for s in self.children.itervalues():
+            s.close()
+        self.children = {}
+        wl, self.write_loop = self.write_loop, None
+        for s in (wl.socket, wl.control_in, wl.control_out):
+            s.close()
+        loop = self.loop
+        # The control connection is used to wakeup the loop, it must not be
+        # shared with the primary
+        loop.create_control_connection()
+        loop.plugin_pool = PluginPool(loop, ())
+        if loop.reuse_port:
+            loop.socket.close()
+            loop.bind_address = address
+            loop.do_bind()
+        self.ctx.forward_request = partial(
+            forward_request, write_address, max(loop.opts.timeout, loop.opts.ajax_timeout), self.secret)
+        t = Thread(name='WatchPrimary', target=self.watch_primary, args=(primary_socket,))
+        t.daemon = True
+        t.start()
+        self.server.serve_forever = loop.serve
+
+    def notify_replicas(self, data=None):
+        with self.lock:
+            for pid, s in tuple(self.children.iteritems()):
+                try:
+                    s.sendall(b'c')
+                except socket.error:
+                    self.log.error('Server process %d has died' % pid)
+                    s.close()
+                    del self.children[pid]
+
+    def watch_primary(self, primary_socket):
+        while True:
+            try:
+                data = primary_socket.recv(4096)
+            except socket.error as e:
+                if e.errno in socket_errors_eintr:
+                    continue
+                data = b''
+            if not data:
+                break
+            self.apply_changes()
+        self.log('The primary server process has exited, shutting down')
+        self.loop.stop()
+
+    def apply_changes(self):
+        broker = self.ctx.library_broker
+        with broker:
+            dbs = [db for db in broker.loaded_dbs.itervalues() if db is not None]
+        notifier = self.ctx.change_notifier
+        for db in dbs:
+            try:
+                changed = db.apply_external_changes()
+            except Exception:
+                self.log.exception('Failed to apply changes to library: %s' % db.server_library_id)
+                continue
+            # changed is None when the whole library was re-read
+            if notifier is not None and (changed is None or changed):
+                notifier.notify(path_for_db(db), None if changed is None else metadata(changed))
+
+    def shutdown(self):
+        ''' Stop the replica processes and wait for them to exit. In a replica
+        process this does not return, the process exits immediately, so that
+        cleanup handlers inherited from the primary do not run. '''
+        if not self.is_primary:
+            os._exit(0)
+        if self.write_loop is not None:
+            self.write_loop.stop()
+            self.write_thread.join(self.write_loop.opts.shutdown_timeout)
+        with self.lock:
+            children, self.children = self.children, {}
+        for s in children.itervalues():
+            s.close()  # The replicas exit when this socket is closed
+        wait_till = monotonic() + self.loop.opts.shutdown_timeout + 1
+        for pid in children:
+            while True:
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        break
+                except OSError:
+                    break
+                if monotonic() > wait_till:
+                    self.log.warn('Server process %d failed to exit, killing it' % pid)
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.01)
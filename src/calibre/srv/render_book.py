@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
 import sys, os, json, re
 from base64 import standard_b64encode, standard_b64decode
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, deque
 from itertools import count
 from functools import partial
 from polyglot.builtins import map
@@ -28,10 +28,21 @@ from calibre.ebooks.oeb.polish.utils import extract
 from calibre.ebooks.css_transform_rules import StyleDeclaration
 from calibre.ebooks.oeb.polish.toc import get_toc, get_landmarks
 from calibre.ebooks.oeb.polish.utils import guess_type
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.short_uuid import uuid4
 from calibre.utils.logging import default_log
 
 RENDER_VERSION = 1
+# Files used to serve a book while it is still being rendered. The names of all
+# files that still have to be rendered are written to PENDING_NAME before the
+# manifest, then the names of rendered files are appended to RENDERED_NAME as
+# they are written. The server appends the names of files that a client is
+# waiting for to REQUESTS_NAME, they are rendered next.
+MANIFEST_NAME = 'calibre-book-manifest.json'
+PENDING_NAME = 'calibre-book-pending.json'
+RENDERED_NAME = 'calibre-book-rendered.txt'
+REQUESTS_NAME = 'calibre-book-requests.txt'
+RENDER_STATE_NAMES = (PENDING_NAME, RENDERED_NAME, REQUESTS_NAME)
 
 BLANK_JPEG = b'\xff\xd8\xff\xdb\x00C\x00\x03\x02\x02\x02\x02\x02\x03\x02\x02\x02\x03\x03\x03\x03\x04\x06\x04\x04\x04\x04\x04\x08\x06\x06\x05\x06\t\x08\n\n\t\x08\t\t\n\x0c\x0f\x0c\n\x0b\x0e\x0b\t\t\r\x11\r\x0e\x0f\x10\x10\x11\x10\n\x0c\x12\x13\x12\x10\x13\x0f\x10\x10\x10\xff\xc9\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00\xff\xcc\x00\x06\x00\x10\x10\x05\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xd2\xcf \xff\xd9'  # noqa
 
@@ -153,6 +164,32 @@ def get_length(root):
     return ans
 
 
+def spine_index(data, start_at):
+    ''' The index of the spine item to start rendering from. start_at is either
+    the name of a file or a position in the book, as a fraction of its length. '''
+    spine = data['spine']
+    if not start_at or not spine:
+        return 0
+    if isinstance(start_at, basestring):
+        try:
+            return spine.index(start_at)
+        except ValueError:
+            return 0
+    pos = start_at * data['spine_length']
+    for i, name in enumerate(spine):
+        pos -= data['files'].get(name, {}).get('length', 0)
+        if pos < 0:
+            return i
+    return len(spine) - 1
+
+
+def write_atomically(path, data):
+    tpath = path + '.tmp'
+    with lopen(tpath, 'wb') as f:
+        f.write(data)
+    atomic_rename(tpath, path)
+
+
 def toc_anchor_map(toc):
     ans = defaultdict(list)
     seen_map = defaultdict(set)
@@ -172,7 +209,7 @@ class Container(ContainerBase):
 
     tweak_mode = True
 
-    def __init__(self, path_to_ebook, tdir, log=None, book_hash=None):
+    def __init__(self, path_to_ebook, tdir, log=None, book_hash=None, start_at=None):
         log = log or default_log
         book_fmt, opfpath, input_fmt = extract_book(path_to_ebook, tdir, log=log)
         ContainerBase.__init__(self, tdir, opfpath, log)
@@ -232,11 +269,51 @@ class Container(ContainerBase):
                 ans['anchor_map'] = anchor_map(root)
             return ans
         data['files'] = {name:manifest_data(name) for name in set(self.name_path_map) - excluded_names}
-        self.commit()
         for name in excluded_names:
+            self.dirtied.discard(name)
+            self.parsed_cache.pop(name, None)
             os.remove(self.name_path_map[name])
-        with lopen(os.path.join(self.root, 'calibre-book-manifest.json'), 'wb') as f:
-            f.write(json.dumps(self.book_render_data, ensure_ascii=False).encode('utf-8'))
+        # Write the manifest before the files are serialized, so that the
+        # server can start serving the book while the rest of it is rendered
+        self.commit_in_order(spine_index(data, start_at))
+
+    def commit_in_order(self, start):
+        ''' Write the manifest and then commit all dirtied files, resources
+        first, then the spine starting from start and finally everything
+        else, except for files requested by the server, which are committed
+        as soon as possible. '''
+        data = self.book_render_data
+        files = data['files']
+        spine = data['spine']
+        pending = frozenset(self.dirtied)
+        order = sorted(name for name in pending if not files[name]['is_html'])
+        order += [name for name in spine[start:] + spine[:start] if name in pending]
+        order += sorted(pending - frozenset(order))
+        write_atomically(os.path.join(self.root, PENDING_NAME), json.dumps(sorted(pending), ensure_ascii=False).encode('utf-8'))
+        write_atomically(os.path.join(self.root, MANIFEST_NAME), json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        queue, done = deque(order), set()
+        requests_path, requests_pos = os.path.join(self.root, REQUESTS_NAME), 0
+        with lopen(os.path.join(self.root, RENDERED_NAME), 'ab') as rendered:
+            while queue:
+                try:
+                    with lopen(requests_path, 'rb') as f:
+                        f.seek(requests_pos)
+                        raw = f.read()
+                except EnvironmentError:
+                    raw = b''
+                idx = raw.rfind(b'\n')
+                if idx > -1:
+                    requests_pos += idx + 1
+                    for name in reversed(raw[:idx].decode('utf-8').splitlines()):
+                        if name in pending and name not in done:
+                            queue.appendleft(name)
+                name = queue.popleft()
+                if name in done:
+                    continue
+                done.add(name)
+                self.commit_item(name)
+                rendered.write(name.encode('utf-8') + b'\n')
+                rendered.flush()
 
     def create_cover_page(self, input_fmt):
         templ = '''
@@ -520,8 +597,8 @@ def html_as_dict(root):
     return {'ns_map':ns_map, 'tag_map':tags, 'tree':tree}
 
 
-def render(pathtoebook, output_dir, book_hash=None):
-    Container(pathtoebook, output_dir, book_hash=book_hash)
+def render(pathtoebook, output_dir, book_hash=None, start_at=None):
+    Container(pathtoebook, output_dir, book_hash=book_hash, start_at=start_at)
 
 
 if __name__ == '__main__':
@@ -69,7 +69,12 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # For endpoints that make changes only for some of their
+             # arguments: a function that is called with the arguments and
+             # returns True if the request can make changes
+             may_write=None
 
 ):
     from calibre.srv.handler import Context
@@ -87,6 +92,7 @@ def endpoint(route,
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.may_write = may_write
         argspec = inspect.getargspec(f)
         if len(argspec.args) < 2:
             raise TypeError('The endpoint %r must take at least two arguments' % f.route)
@@ -310,7 +316,19 @@ class Router(object):
         self.init_session(endpoint_, data)
         if endpoint_.needs_db_write:
             self.ctx.check_for_write_access(data)
+        may_write = endpoint_.needs_db_write or data.method not in ('GET', 'HEAD') or (
+            endpoint_.may_write is not None and endpoint_.may_write(*args))
+        if may_write:
+            forward_request = getattr(self.ctx, 'forward_request', None)
+            if forward_request is not None:
+                # Requests that could change data are handled by the primary
+                # server process, see srv/prefork.py
+                return forward_request(data)
         ans = endpoint_(self.ctx, data, *args)
+        if may_write:
+            data_changed = getattr(self.ctx, 'data_changed', None)
+            if data_changed is not None:
+                data_changed(data)
         self.finalize_session(endpoint_, data, ans)
         outheaders = data.outheaders
 
@@ -8,7 +8,7 @@ import os
 import signal
 import sys
 
-from calibre import as_unicode
+from calibre import as_unicode, prints
 from calibre.constants import is_running_from_develop, isosx, iswindows, plugins
 from calibre.db.delete_service import shutdown as shutdown_delete_service
 from calibre.db.legacy import LibraryDatabase
@@ -73,7 +73,7 @@ class Server(object):
         if opts.use_bonjour:
             plugins.append(BonJour())
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, self.handler.websocket_handler),
             opts=opts,
             log=log,
             access_log=access_log,
@@ -128,6 +128,24 @@ libraries that the main calibre program knows about will be used.
             help=_('Run process in background as a daemon (Linux only).'))
     parser.add_option(
         '--pidfile', default=None, help=_('Write process PID to the specified file'))
+    if not iswindows:
+        parser.add_option(
+            '--worker-processes',
+            default=1,
+            type='int',
+            help=_(
+                'Number of processes used to serve requests. By default, a single'
+                ' process is used, which can only make use of one CPU core. With more'
+                ' processes, requests are distributed between them. Requests that'
+                ' make changes are always handled by the first process.'))
+    parser.add_option(
+        '--prewarm-thumbnails',
+        default=None,
+        help=_(
+            'Create the cover thumbnails of the specified sizes for all books in'
+            ' the libraries and store them in the thumbnail cache, then exit.'
+            ' Sizes are specified as a comma separated list of WIDTHxHEIGHT, for'
+            ' example: {}').format('60x80,300x400'))
     parser.add_option(
         '--auto-reload',
         default=False,
@@ -159,6 +177,26 @@ libraries that the main calibre program knows about will be used.
 option_parser = create_option_parser
 
 
+def prewarm_thumbnails(libraries, opts):
+    from calibre.srv.library_broker import init_library
+    from calibre.srv.thumbnails import ThumbnailCache, prewarm
+    try:
+        sizes = [tuple(map(int, x.strip().split('x'))) for x in opts.prewarm_thumbnails.split(',') if x.strip()]
+        if not sizes or any(len(x) != 2 or min(x) < 1 for x in sizes):
+            raise ValueError('no valid sizes')
+    except ValueError:
+        raise SystemExit(_('Invalid thumbnail sizes: %s') % opts.prewarm_thumbnails)
+    cache = ThumbnailCache(opts.thumbnail_cache_size, log=prints)
+    for i, library_path in enumerate(libraries):
+        prints(_('Creating thumbnails for the library at: %s') % library_path)
+        db = init_library(library_path, i == 0)
+        try:
+            num = prewarm(cache, db, sizes)
+        finally:
+            db.close()
+        prints(_('Created {} thumbnails').format(num))
+
+
 def ensure_single_instance():
     if b'CALIBRE_NO_SI_DANGER_DANGER' not in os.environ and not singleinstance('db'):
         ext = '.exe' if iswindows else ''
@@ -193,6 +231,10 @@ def main(args=sys.argv):
             raise SystemExit(_('You must specify at least one calibre library'))
         libraries = [prefs['library_path']]
 
+    if opts.prewarm_thumbnails:
+        prewarm_thumbnails(libraries, opts)
+        raise SystemExit(0)
+
     if opts.auto_reload:
         if getattr(opts, 'daemonize', False):
             raise SystemExit(
@@ -219,6 +261,11 @@ def main(args=sys.argv):
     if opts.pidfile:
         with lopen(opts.pidfile, 'wb') as f:
             f.write(str(os.getpid()))
+    workers = None
+    if getattr(opts, 'worker_processes', 1) > 1:
+        from calibre.srv.prefork import WorkerProcesses
+        workers = WorkerProcesses(server, opts.worker_processes)
+        workers.start()
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
@@ -229,3 +276,5 @@ def main(args=sys.argv):
         server.serve_forever()
     finally:
         shutdown_delete_service()
+        if workers is not None:
+            workers.shutdown()
@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import httplib, zlib, json, base64, os
+import httplib, zlib, json, base64, os, time
 from io import BytesIO
 from functools import partial
 from urllib import urlencode, quote
@@ -54,6 +54,40 @@ class ContentTest(LibraryBaseTest):
 
     # }}}
 
+    def test_book_json_cache(self):  # {{{
+        'Test caching of the serialized metadata of books'
+        from calibre.srv.metadata import BooksAsJSON, book_as_json, encode_json_with_books
+        self.ae(json.loads(encode_json_with_books({'a': 1, 'm': BooksAsJSON([(1, b'{"x":1}'), (2, b'null')])})),
+                {'a': 1, 'm': {'1': {'x': 1}, '2': None}})
+        self.ae(json.loads(encode_json_with_books({'m': BooksAsJSON()})), {'m': {}})
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            cache = server.handler.router.ctx.library_broker.book_json_caches[db.server_library_id]
+            conn = server.connect()
+            request = partial(make_request, conn, prefix='')
+
+            def metadata():
+                r, data = request('/interface-data/get-books')
+                self.ae(r.status, httplib.OK)
+                return data['metadata']
+
+            data = metadata()
+            self.ae(set(data), set(map(str, db.all_book_ids())))
+            self.ae(json.loads(json.dumps(book_as_json(db, 1))), data['1'])
+            self.ae((cache.hits, cache.misses), (0, 3))
+            self.ae(metadata(), data)
+            self.ae((cache.hits, cache.misses), (3, 3))
+            db.set_field('title', {1: 'changed'})
+            data = metadata()
+            self.ae(data['1']['title'], 'changed')
+            self.ae((cache.hits, cache.misses), (5, 4))
+
+            r, data = request('/ajax/books?ids=1,2')
+            self.ae(data['1']['title'], 'changed')
+            self.ae(request('/ajax/books?ids=1,2')[1], data)
+            self.ae((cache.hits, cache.misses), (7, 6))
+    # }}}
+
     def test_ajax_categories(self):  # {{{
         'Test /ajax/categories and /ajax/search'
         with self.create_server() as server:
@@ -193,3 +227,175 @@ class ContentTest(LibraryBaseTest):
             d((1,), username='ro', status=FORBIDDEN)
             d((1, data['book_id']))
     # }}}
+
+    def test_srv_worker_processes(self):  # {{{
+        'Test running the server in several processes, with writes forwarded to the primary'
+        if not hasattr(os, 'fork'):
+            return
+        from calibre.srv.prefork import WorkerProcesses, SECRET_HEADER, PEER_HEADER
+        server = self.create_server(local_write=True)
+        workers = WorkerProcesses(server, 2)
+        if not workers.start():
+            # A replica process, it must never return into the test runner
+            try:
+                server.serve_forever()
+            finally:
+                workers.shutdown()
+        server.run = server.serve_forever
+        try:
+            with server:
+                db = server.handler.router.ctx.library_broker.get(None)
+
+                def request(url, method='GET', data=None, headers={}, address=server.address):
+                    conn = httplib.HTTPConnection(address[0], address[1], strict=True, timeout=10)
+                    try:
+                        return make_request(conn, url, prefix='', method=method, data=data, headers=dict(headers))
+                    finally:
+                        conn.close()
+
+                def cmd(which, *args, **kw):
+                    return request('/cdb/cmd/{}/0'.format(which), data=json.dumps(args), headers={
+                        'Content-Type':'application/json', 'Accept':'application/json'}, **kw)
+
+                def wait_for(func):
+                    # The replicas apply changes made by the primary asynchronously
+                    end = time.time() + 10
+                    while not func() and time.time() < end:
+                        time.sleep(0.05)
+                    self.assertTrue(func())
+
+                # The kernel distributes connections between the processes,
+                # so use a new connection for every request
+                book_ids = set()
+                for i in xrange(20):
+                    r, data = request('/cdb/add-book/1/y/test.txt', method='POST', data=b'content')
+                    self.ae(r.status, OK)
+                    book_ids.add(data['book_id'])
+                self.assertGreater(workers.forwarded_count, 0)
+                self.assertTrue(book_ids.issubset(db.all_book_ids()))
+                for book_id in book_ids:
+                    wait_for(lambda: request('/get/txt/{}'.format(book_id))[0].status == OK)
+
+                # Commands that make changes are forwarded even when sent with GET
+                forwarded = workers.forwarded_count
+                for i, book_id in enumerate(sorted(book_ids)):
+                    r, data = cmd('remove', [book_id], True)
+                    self.ae(r.status, OK)
+                    self.assertNotIn('err', data)
+                self.assertGreater(workers.forwarded_count, forwarded)
+                self.assertFalse(book_ids & db.all_book_ids())
+                for book_id in book_ids:
+                    wait_for(lambda: request('/get/txt/{}'.format(book_id))[0].status == NOT_FOUND)
+
+                # Forwarded requests are not treated as coming from the
+                # loopback interface they arrive on
+                book_id = next(iter(db.all_book_ids()))
+                address = workers.write_loop.bound_address[:2]
+                r = cmd('remove', [book_id], True, address=address)[0]
+                self.ae(r.status, FORBIDDEN)
+                r = cmd('remove', [book_id], True, address=address, headers={
+                    SECRET_HEADER: 'x' * len(workers.secret), PEER_HEADER: '127.0.0.1'})[0]
+                self.ae(r.status, FORBIDDEN)
+                r = cmd('remove', [book_id], True, address=address, headers={
+                    SECRET_HEADER: workers.secret, PEER_HEADER: '192.0.2.1'})[0]
+                self.ae(r.status, FORBIDDEN)
+                self.assertIn(book_id, db.all_book_ids())
+                r = cmd('remove', [book_id], True, address=address, headers={
+                    SECRET_HEADER: workers.secret, PEER_HEADER: '127.0.0.1'})[0]
+                self.ae(r.status, OK)
+                self.assertNotIn(book_id, db.all_book_ids())
+        finally:
+            workers.shutdown()
+    # }}}
+
+    def test_book_render_state(self):  # {{{
+        'Test serving of books that are still being rendered'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv import books
+        from calibre.srv.books import RenderState
+        from calibre.srv.render_book import spine_index, PENDING_NAME, RENDERED_NAME, REQUESTS_NAME
+        data = {'spine': ['a', 'b', 'c'], 'spine_length': 30, 'files': {x: {'length': 10} for x in 'abc'}}
+        self.ae(spine_index(data, None), 0)
+        self.ae(spine_index(data, 'c'), 2)
+        self.ae(spine_index(data, 'x'), 0)
+        self.ae(spine_index(data, 0.5), 1)
+        self.ae(spine_index(data, 1.0), 2)
+        with TemporaryDirectory() as tdir:
+            rs = RenderState(tdir)
+            self.assertFalse(rs.is_rendered('a'))
+            self.assertIsNone(rs.progress)
+            with open(os.path.join(tdir, PENDING_NAME), 'wb') as f:
+                f.write(json.dumps(['a', 'b']))
+            self.assertTrue(rs.is_rendered('x'))
+            self.assertFalse(rs.is_rendered('a'))
+            with open(os.path.join(tdir, RENDERED_NAME), 'wb') as f:
+                f.write(b'a\nb')
+            self.assertTrue(rs.is_rendered('a'))
+            self.assertFalse(rs.is_rendered('b'))
+            self.ae(rs.progress, {'rendered': 1, 'total': 2})
+            with open(os.path.join(tdir, RENDERED_NAME), 'ab') as f:
+                f.write(b'\n')
+            self.assertTrue(rs.is_rendered('b'))
+            rs.request('a'), rs.request('a'), rs.request('b')
+            with open(os.path.join(tdir, REQUESTS_NAME), 'rb') as f:
+                self.ae(f.read(), b'a\nb\n')
+
+            # Requests for files that are not rendered yet do not wait long
+            with open(os.path.join(tdir, PENDING_NAME), 'wb') as f:
+                f.write(json.dumps(['a', 'b', 'c']))
+            rs = RenderState(tdir)
+            books.render_states['x'] = rs
+            try:
+                self.ae(books.wait_for_rendered_file('x', 'a'), books.abspath(os.path.join(tdir, 'a')))
+                st = time.time()
+                self.assertIs(books.wait_for_rendered_file('x', 'c', timeout=0.1), False)
+                self.assertLess(time.time() - st, 5)
+                self.assertIsNone(books.wait_for_rendered_file('x', '../c'))
+                self.assertIsNone(books.wait_for_rendered_file('y', 'a'))
+            finally:
+                del books.render_states['x']
+    # }}}
+
+    def test_book_render_cache(self):  # {{{
+        'Test sharing of files between rendered books and pruning of the cache'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv import books
+        from calibre.srv.render_book import MANIFEST_NAME
+        from calibre.utils.filenames import nlinks_file
+        orig, orig_cache_dir = books._books_cache_dir, books.cache_dir
+        with TemporaryDirectory() as tdir:
+            books._books_cache_dir = None
+            books.cache_dir = lambda: tdir
+            try:
+                base = books.books_cache_dir()
+                store = os.path.join(base, 'r')
+                common, data = b'x' * books.MIN_SHARED_SIZE, {}
+
+                def create_book(bhash, last_read, unique_size):
+                    d = os.path.join(base, 'f', bhash)
+                    os.makedirs(os.path.join(d, 'images'))
+                    for name, raw in ((MANIFEST_NAME, b'{}'), ('images/common.jpg', common), ('unique', os.urandom(unique_size))):
+                        with open(os.path.join(d, name), 'wb') as f:
+                            f.write(raw)
+                    books.share_files(d, store)
+                    os.utime(os.path.join(d, MANIFEST_NAME), (last_read, last_read))
+                    data[bhash] = d
+
+                now = time.time()
+                create_book('a', now - 3600, 10000)
+                create_book('b', now - 1800, 10000)
+                create_book('c', now, 100)
+                self.ae(nlinks_file(os.path.join(data['a'], 'images', 'common.jpg')), 4)
+                books.prune_render_cache(0)
+                stats = books.render_cache_stats()
+                self.ae(stats['books'], 3)
+                self.ae(stats['saved_by_sharing'], 2 * len(common))
+                # a and b have to be evicted to get below the limit
+                books.prune_render_cache(len(common) + 5000)
+                self.assertFalse(os.path.exists(data['a']))
+                self.assertFalse(os.path.exists(data['b']))
+                self.assertTrue(os.path.exists(data['c']))
+                self.ae(nlinks_file(os.path.join(data['c'], 'images', 'common.jpg')), 2)
+            finally:
+                books._books_cache_dir, books.cache_dir = orig, orig_cache_dir
+    # }}}
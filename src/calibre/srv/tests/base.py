@@ -138,7 +138,7 @@ class LibraryServer(TestServer):
         self.libraries = libraries or (library_path,)
         self.handler = Handler(self.libraries, opts, testing=True)
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, self.handler.websocket_handler),
             opts=opts,
             plugins=plugins,
             log=ServerLog(level=ServerLog.WARN),
@@ -224,3 +224,90 @@ class ContentTest(LibraryBaseTest):
             self.ae(zlib.decompress(raw, 16+zlib.MAX_WBITS), data)
 
     # }}}
+
+    def test_serve_library_files(self):  # {{{
+        'Test serving of files directly from the library'
+        from calibre.constants import iswindows
+        with self.create_server(serve_library_files=True) as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+
+            def get(what, book_id):
+                conn.request('GET', '/get/%s/%s' % (what, book_id))
+                r = conn.getresponse()
+                return r, r.read()
+
+            direct = 'no' if iswindows else 'direct'
+            r, data = get('fmt1', 1)
+            self.ae(data, db.format(1, 'fmt1'))
+            self.ae(r.getheader('Used-Cache'), direct)
+            r, data = get('cover', 2)
+            self.ae(data, db.cover(2))
+            self.ae(r.getheader('Used-Cache'), direct)
+            if iswindows:
+                return
+            # Replaced files remain readable with their old contents
+            path = binascii.unhexlify(r.getheader('Tempfile')).decode('utf-8')
+            f, fdata = share_open(path, 'rb'), data
+            db.set_cover({2:I('lt.png', data=True)})
+            r, data = get('cover', 2)
+            self.ae(data, db.cover(2))
+            self.ae(r.getheader('Used-Cache'), 'direct')
+            self.ae(f.read(), fdata)
+            f.close()
+
+            # Hardlinked files are written in place, so they are not served directly
+            os.link(path, path + '.link')
+            r, data = get('cover', 2)
+            self.ae(data, db.cover(2))
+            self.ae(r.getheader('Used-Cache'), 'no')
+            db.set_cover({2:I('lt.png', data=True)})
+            self.ae(os.stat(path).st_ino, os.stat(path + '.link').st_ino)
+    # }}}
+
+    def test_thumbnail_cache(self):  # {{{
+        'Test the persistent cache of resized covers'
+        from calibre.srv.thumbnails import ThumbnailCache, prewarm
+        location = os.path.join(self.mkdtemp(), 'thumbnails')
+        c = ThumbnailCache(location=location)
+        self.assertIsNone(c.get('lib', 1, 60, 80, 1.0))
+        with c.insert('lib', 1, 60, 80, 1.0, b'thumb1') as f:
+            self.ae(f.read(), b'thumb1')
+        c.insert('lib', 1, 100, 100, 1.0, b'thumb-100').close()
+        c.insert('lib', 2, 60, 80, 1.0, b'thumb2').close()
+        with c.get('lib', 1, 60, 80, 1.0) as f:
+            self.ae(f.read(), b'thumb1')
+        self.assertIsNone(c.get('lib', 1, 60, 80, 2.0), 'Thumbnail for a changed cover was returned')
+        self.assertIsNone(c.get('lib', 1, 60, 80, 1.0))
+        self.ae(len(c), 2)
+
+        # Test persistence
+        c = ThumbnailCache(location=location)
+        self.ae(len(c), 2)
+        self.ae(c.current_size, len(b'thumb-100') + len(b'thumb2'))
+        with c.get('lib', 2, 60, 80, 1.0) as f:
+            self.ae(f.read(), b'thumb2')
+        c.invalidate('lib', (2,))
+        self.assertIsNone(c.get('lib', 2, 60, 80, 1.0))
+
+        # Test size limits
+        c = ThumbnailCache(location=location, max_size=20 / (1024 * 1024))
+        for i in xrange(1, 4):
+            c.insert('lib', i, 60, 80, 1.0, b'0123456789').close()
+        self.ae(len(c), 2)
+        self.assertIsNone(c.get('lib', 1, 60, 80, 1.0))
+        c.empty()
+        self.ae(len(c), 0)
+        self.ae(ThumbnailCache(location=location).current_size, 0)
+
+        # Test pre-warming
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            c = ThumbnailCache(location=location)
+            self.ae(prewarm(c, db, [(60, 80), (100, 100)], jobs=2), 4)
+            self.ae(prewarm(c, db, [(60, 80), (100, 100)], jobs=2), 0)
+            mtime = db.cover_last_modified(1)
+            from calibre.utils.date import timestampfromdt
+            with c.get(db.library_id, 1, 100, 100, timestampfromdt(mtime)) as f:
+                self.ae(identify(f.read()), ('jpeg', 100, 100))
+    # }}}
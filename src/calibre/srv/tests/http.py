@@ -8,6 +8,7 @@ __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import httplib, hashlib, zlib, string, time, os
 from io import BytesIO
+from functools import partial
 from tempfile import NamedTemporaryFile
 
 from calibre import guess_type
@@ -69,6 +70,10 @@ class TestHTTP(BaseTest):
         test('Case insensitive', 'GZIp', 'gzip')
         test('Multiple', 'gzip, identity', 'gzip')
         test('Priority', '1;q=0.5, 2;q=0.75, 3;q=1.0', '3', {'1', '2', '3'})
+        from calibre.srv.http_response import preferred_encoding
+        self.ae(preferred_encoding('gzip, deflate, br', ('br', 'gzip')), 'br')
+        self.ae(preferred_encoding('gzip, deflate', ('br', 'gzip')), 'gzip')
+        self.ae(preferred_encoding('identity', ('br', 'gzip')), None)
     # }}}
 
     def test_accept_language(self):  # {{{
@@ -338,10 +343,11 @@ class TestHTTP(BaseTest):
             # Test dynamic etagged content
             num_calls = [0]
 
-            def edfunc():
+            def edfunc(conn):
                 num_calls[0] += 1
+                conn.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
                 return b'data'
-            server.change_handler(lambda conn:conn.etagged_dynamic_response("xxx", edfunc))
+            server.change_handler(lambda conn:conn.etagged_dynamic_response("xxx", partial(edfunc, conn)))
             conn = server.connect()
             conn.request('GET', '/an_etagged_path')
             r = conn.getresponse()
@@ -355,6 +361,28 @@ class TestHTTP(BaseTest):
             self.ae(r.read(), b'')
             self.ae(num_calls[0], 1)
 
+            # Test caching of compressed responses
+            for i in range(2):
+                conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), b'data')
+                self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(r.getheader('Calibre-Uncompressed-Length'), '4')
+                # Set while generating the body, which does not happen for cached bodies
+                self.ae(r.getheader('Content-Type'), 'application/json; charset=UTF-8')
+            self.assertTrue(r.getheader('Content-Length'))
+            self.assertFalse(r.getheader('Transfer-Encoding'))
+            self.ae(num_calls[0], 2)
+            conn.request('GET', '/an_etagged_path?x=1', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), b'data')
+            self.ae(num_calls[0], 3)
+            # Responses can be translated
+            conn.request('GET', '/an_etagged_path?x=1', headers={'Accept-Encoding':'gzip', 'Accept-Language':'es'})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), b'data')
+            self.ae(num_calls[0], 4)
+
             # Test getting a filesystem file
             for use_sendfile in (True, False):
                 server.change_handler(lambda conn: f)
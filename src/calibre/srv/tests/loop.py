@@ -10,7 +10,7 @@ import httplib, ssl, os, socket, time
 from collections import namedtuple
 from unittest import skipIf
 from glob import glob
-from threading import Event
+from threading import Event, Timer
 
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
@@ -25,7 +25,6 @@ class LoopTest(BaseTest):
     def test_log_rotation(self):
         'Test log rotation'
         from calibre.srv.utils import RotatingLog
-        from calibre.ptempfile import TemporaryDirectory
         with TemporaryDirectory() as tdir:
             fname = os.path.join(tdir, 'log')
             l = RotatingLog(fname, max_size=100)
@@ -183,6 +182,49 @@ class LoopTest(BaseTest):
         set(b'123456\n7', 4, 2, READ)
         self.ae(buf.readline(), b'56\n')
 
+    def test_event_loop(self):
+        'Test the pollers and the timer wheel used by the server loop'
+        from calibre.srv.poller import TimerWheel, backends
+        w = TimerWheel(10, granularity=1)
+        w.add(1, 'a', 2.5), w.add(2, 'b', 5), w.add(3, 'c', 9.9)
+        self.ae(len(w), 3)
+        self.ae(w.next_expiry(), 3)
+        self.ae(w.expire(2.9), [])
+        self.ae(w.expire(3), [(1, 'a')])
+        w.remove(2)
+        self.ae(w.next_expiry(), 10)
+        w.add(3, 'c', 12)
+        self.ae(w.expire(12.5), [])
+        self.ae(w.expire(13), [(3, 'c')])
+        self.ae(len(w), 0), self.assertIsNone(w.next_expiry())
+
+        for cls in backends:
+            try:
+                cls()
+            except (AttributeError, EnvironmentError):
+                continue
+            with TestServer(lambda data:(data.path[0] + data.read()), event_loop=cls.name) as server:
+                self.ae(server.loop.poller.name, cls.name)
+                conns = [server.connect() for i in xrange(5)]
+                for i in xrange(3):
+                    for j, conn in enumerate(conns):
+                        conn.request('GET', '/%d' % j, 'body')
+                    for j, conn in enumerate(conns):
+                        r = conn.getresponse()
+                        self.ae(r.status, httplib.OK)
+                        self.ae(r.read(), b'%dbody' % j)
+                self.ae(server.loop.num_active_connections, 5)
+                [conn.close() for conn in conns]
+            with TestServer(lambda data:'xxx', event_loop=cls.name, timeout=0.1) as server:
+                conn = server.connect(timeout=5)
+                conn.request('GET', '/')
+                self.ae(conn.getresponse().read(), b'xxx')
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 5:
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, 0)
+                self.ae(len(server.loop.poller), 2)
+
     def test_ssl(self):
         'Test serving over SSL'
         address = '127.0.0.1'
@@ -233,14 +275,14 @@ class LoopTest(BaseTest):
     def test_jobs_manager(self):
         'Test the jobs manager'
         from calibre.srv.jobs import JobsManager
-        O = namedtuple('O', 'max_jobs max_job_time')
+        O = namedtuple('O', 'max_jobs max_job_time max_jobs_per_worker max_worker_memory')
 
         class FakeLog(list):
 
             def error(self, *args):
                 self.append(' '.join(args))
         s = ('waiting', 'running')
-        jm = JobsManager(O(1, 5), FakeLog())
+        jm = JobsManager(O(1, 5, 50, 0), FakeLog())
 
         def job_status(jid):
             return jm.job_status(jid)[0]
@@ -287,3 +329,54 @@ class LoopTest(BaseTest):
         self.assertIn('a testing error', tb)
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
+
+    def test_worker_pool(self):
+        'Test re-use of worker processes by the jobs manager'
+        from calibre.srv.jobs import WorkerPool, AbortEvent
+        from calibre.utils.ipc.simple_worker import WorkerError
+        pool = WorkerPool(max_jobs_per_worker=3)
+        try:
+            def run(func, *args):
+                ans = pool.run_job('calibre.srv.tests.worker_jobs', func, args)
+                with lopen(ans['stdout_stderr'], 'rb') as f:
+                    log = f.read()
+                os.remove(ans['stdout_stderr'])
+                return ans['result'], log
+            pid1, log = run('pid_test')
+            self.assertIn(str(pid1).encode('ascii'), log)
+            # Errors do not kill the worker
+            with self.assertRaises(WorkerError) as cm:
+                pool.run_job('calibre.srv.jobs', 'error_test')
+            self.assertIn('a testing error', cm.exception.orig_tb)
+            pid2, log = run('pid_test')
+            self.assertEqual(pid1, pid2)
+            self.assertEqual(log.count(b'Running in process'), 1)
+            # Recycled after max_jobs_per_worker jobs
+            pid3 = run('pid_test')[0]
+            self.assertNotEqual(pid1, pid3)
+            # Jobs do not leave their working directory and temporary files
+            # behind for the next job
+            with TemporaryDirectory() as tdir:
+                pid, cwd, tname = run('leak_test', tdir)[0]
+                self.assertEqual(pid, pid3)
+                self.assertFalse(os.path.exists(tname))
+                pid, cwd, tname = run('leak_test')[0]
+                self.assertEqual(pid, pid3)
+                self.assertNotEqual(os.path.abspath(cwd), os.path.abspath(tdir))
+            # Aborting a job kills the worker
+            abort = Event()
+            abort.set()
+            self.assertIsNone(pool.run_job('calibre.srv.jobs', 'sleep_test', (10,), abort=abort)['result'])
+            self.assertEqual(len(pool.idle_workers), 0)
+            abort = AbortEvent()
+            Timer(0.2, abort.set).start()
+            st = monotonic()
+            self.assertIsNone(pool.run_job('calibre.srv.jobs', 'sleep_test', (10,), abort=abort)['result'])
+            self.assertLess(monotonic() - st, 5)
+            self.assertEqual(len(pool.idle_workers), 0)
+            # Timeouts
+            with self.assertRaises(WorkerError) as cm:
+                pool.run_job('calibre.srv.jobs', 'sleep_test', (10,), timeout=0.5)
+            self.assertIn('hung', cm.exception.message)
+        finally:
+            pool.shutdown()
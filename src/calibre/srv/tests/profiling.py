@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2017, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import socket, sys, time
+
+from calibre.srv.tests.base import TestServer
+from calibre.srv.utils import ServerLog
+
+
+def raise_fd_limit(needed):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def open_idle_connections(server, count):
+    ans = []
+    for i in xrange(count):
+        s = socket.create_connection(server.address)
+        ans.append(s)
+    # Wait for the server to accept all the connections
+    st = time.time()
+    while server.loop.num_active_connections < count and time.time() - st < 30:
+        time.sleep(0.01)
+    return ans
+
+
+def benchmark_connections(backends=('epoll', 'poll', 'select'), counts=(10, 100, 500, 1000, 2000), num_requests=500):
+    ''' Measure request latency on one active connection while many other
+    connections sit idle, for each event loop backend. '''
+    raise_fd_limit(max(counts) * 2 + 100)
+    for backend in backends:
+        for count in counts:
+            with TestServer(lambda data:'xxx', event_loop=backend, timeout=600, worker_count=4) as server:
+                server.loop.log.filter_level = server.loop.log.ERROR
+                if server.loop.poller.name != backend:
+                    print('%s is not available' % backend)
+                    break
+                try:
+                    idle = open_idle_connections(server, count)
+                except EnvironmentError as err:
+                    print('%s: failed to open %d connections: %s' % (backend, count, err))
+                    break
+                conn = server.connect(timeout=10)
+                try:
+                    st = time.time()
+                    for i in xrange(num_requests):
+                        conn.request('GET', '/')
+                        conn.getresponse().read()
+                    taken = time.time() - st
+                except Exception as err:
+                    print('%s: failed with %d idle connections: %s' % (backend, count, err))
+                    break
+                finally:
+                    conn.close()
+                    [s.close() for s in idle]
+                print('%6s with %4d idle connections: %.3f ms per request' % (
+                    backend, count, 1000 * taken / num_requests))
+
+
+def benchmark_jobs(num_jobs=100, max_jobs=4):
+    ''' Measure the throughput of the jobs manager, with a new worker process
+    for every job and with re-used worker processes. '''
+    from collections import namedtuple
+    from calibre.srv.jobs import JobsManager
+    from calibre.utils.monotonic import monotonic
+    O = namedtuple('O', 'max_jobs max_job_time max_jobs_per_worker max_worker_memory')
+    for jobs_per_worker in (1, 50):
+        jm = JobsManager(O(max_jobs, 5, jobs_per_worker, 0), ServerLog(level=ServerLog.WARN))
+        st = monotonic()
+        job_ids = [jm.start_job('benchmark', 'calibre.srv.jobs', 'sleep_test', args=(0,)) for i in xrange(num_jobs)]
+        for job_id in job_ids:
+            while jm.job_status(job_id)[0] != 'finished':
+                time.sleep(0.001)
+        taken = monotonic() - st
+        jm.shutdown(), jm.wait_for_shutdown(monotonic() + 5)
+        print('%2d jobs per worker: %.0f jobs per minute' % (jobs_per_worker, num_jobs * 60 / taken))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['jobs']:
+        benchmark_jobs()
+    else:
+        benchmark_connections(*[x for x in [tuple(sys.argv[1:])] if x])
@@ -4,13 +4,13 @@
 
 from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
-import socket, os, struct, errno
+import socket, os, struct, errno, time
 from base64 import standard_b64encode
 from collections import deque, namedtuple
 from functools import partial
 from hashlib import sha1
 
-from calibre.srv.tests.base import BaseTest, TestServer
+from calibre.srv.tests.base import BaseTest, LibraryBaseTest, TestServer
 from calibre.srv.web_socket import (
     GUID_STR, BINARY, TEXT, MessageWriter, create_frame, CLOSE, NORMAL_CLOSE,
     PING, PONG, PROTOCOL_ERROR, CONTINUATION, INCONSISTENT_DATA, CONTROL_CODES)
@@ -18,7 +18,7 @@ from calibre.utils.monotonic import monotonic
 from calibre.utils.socket_inheritance import set_socket_inherit
 
 HANDSHAKE_STR = '''\
-GET / HTTP/1.1\r
+GET {} HTTP/1.1\r
 Upgrade: websocket\r
 Connection: Upgrade\r
 Sec-WebSocket-Key: {}\r
@@ -30,12 +30,12 @@ Frame = namedtuple('Frame', 'fin opcode payload')
 
 class WSClient(object):
 
-    def __init__(self, port, timeout=5):
+    def __init__(self, port, timeout=5, path='/'):
         self.timeout = timeout
         self.socket = socket.create_connection(('localhost', port), timeout)
         set_socket_inherit(self.socket, False)
         self.key = standard_b64encode(os.urandom(8))
-        self.socket.sendall(HANDSHAKE_STR.format(self.key).encode('ascii'))
+        self.socket.sendall(HANDSHAKE_STR.format(path, self.key).encode('ascii'))
         self.read_buf = deque()
         self.read_upgrade_response()
         self.mask = memoryview(os.urandom(4))
@@ -314,3 +314,70 @@ class WebSocketTest(BaseTest):
                 sz *= 1024
                 t, b = 'a'*sz, b'a'*sz
                 simple_test([t, b], [t, b])
+
+
+class ChangeNotificationsTest(LibraryBaseTest):
+
+    def test_change_notifications(self):
+        'Test pushing of library changes over the /changes WebSocket endpoint'
+        import json
+        from calibre.srv.change_notifier import Subscription, LibraryState, POLICY_VIOLATION
+        from calibre.srv.changes import books_deleted, metadata, saved_searches
+        from calibre.srv.tests.ajax import make_request
+
+        s = Subscription(None, 'x', '', None)
+        s.merge({1}, {2, 3}, set()), s.merge(set(), {1}, {3}), s.merge({4}, set(), set())
+        self.ae((s.added, s.changed, s.removed), ({1, 4}, {2}, {3}))
+
+        def next_message(client):
+            frame = client.read_frame()
+            self.ae(frame.opcode, TEXT)
+            return json.loads(frame.payload.decode('utf-8'))
+
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            ctx.change_notifier.POLL_INTERVAL = ctx.change_notifier.BATCH_DELAY = 0.01
+            db = ctx.library_broker.get(None)
+            db.set_pref('virtual_libraries', {'12': 'id:1 or id:2 or tags:"=vltag"'})
+            client = WSClient(server.address[1], path='/changes?vl=12')
+            self.ae(next_message(client), {'type': 'ready', 'library_id': db.server_library_id})
+            # Changes that are not notified
+            db.set_field('title', {1: 'changed', 3: 'changed'})
+            msg = next_message(client)
+            self.ae((msg['type'], msg['added'], msg['changed'], msg['removed']), ('changes', [], [1], []))
+            # Stop polling, so that only the notified changes are seen
+            ctx.change_notifier.POLL_INTERVAL = 100
+            time.sleep(0.1)
+            # Books that start matching the virtual library are added
+            db.set_field('tags', {3: ('vltag',)})
+            ctx.notify_changes(db.backend.library_path, metadata((3,)))
+            msg = next_message(client)
+            self.ae((msg['added'], msg['changed'], msg['removed']), ([3], [], []))
+            db.set_field('tags', {3: ()})
+            ctx.notify_changes(db.backend.library_path, metadata((3,)))
+            msg = next_message(client)
+            self.ae((msg['added'], msg['changed'], msg['removed']), ([], [], [3]))
+            db.remove_books((2,))
+            ctx.notify_changes(db.backend.library_path, books_deleted((2,)))
+            msg = next_message(client)
+            self.ae((msg['added'], msg['changed'], msg['removed'], msg['saved_searches_changed']), ([], [], [2], False))
+            ctx.notify_changes(db.backend.library_path, saved_searches(added=('x',)))
+            msg = next_message(client)
+            self.ae((msg['changed'], msg['removed'], msg['saved_searches_changed']), ([], [], True))
+
+            # Only the notified books are checked
+            state = LibraryState(db)
+            self.assertIsNone(state.apply(db, {1000}))
+            db.remove_books((3,))
+            self.ae(state.apply(db, {1, 3}), (set(), {1}, {3}))
+            self.assertNotIn(3, state.timestamps)
+
+        with self.create_server(auth=True, auth_mode='basic') as server:
+            server.handler.ctx.user_manager.add_user('12', 'test')
+            client = WSClient(server.address[1], path='/changes')
+            frame = client.read_frame()
+            self.ae((frame.opcode, struct.unpack_from(b'!H', frame.payload)[0]), (CLOSE, POLICY_VIOLATION))
+            token = make_request(server.connect(), '/changes-token', prefix='', username='12', password='test')[1]['token']
+            client = WSClient(server.address[1], path='/changes?token=' + token)
+            self.ae(next_message(client)['type'], 'ready')
+            self.assertRaises(ValueError, server.handler.ctx.change_notifier.validate_token, token.replace(':', ':0', 1))
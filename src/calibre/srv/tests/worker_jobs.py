@@ -0,0 +1,25 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+# Jobs run in the worker processes of the server by the tests
+
+import os
+
+
+def pid_test():
+    print('Running in process:', os.getpid())
+    return os.getpid()
+
+
+def leak_test(path=None):
+    from calibre.ptempfile import PersistentTemporaryFile
+    if path:
+        os.chdir(path)
+    f = PersistentTemporaryFile('.leak')
+    f.write(b'leaked')
+    return os.getpid(), os.getcwdu(), f.name
@@ -0,0 +1,271 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import os
+import time
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+
+from calibre import as_unicode, detect_ncpus
+from calibre.constants import cache_dir
+from calibre.utils.config_base import tweaks
+from calibre.utils.date import timestampfromdt
+from calibre.utils.filenames import replace_file
+from calibre.utils.img import scale_image
+from calibre.utils.shared_file import share_open
+
+# Entries that have been used more recently than this (in seconds) do not have
+# their file timestamps updated on access
+TOUCH_INTERVAL = 3600
+
+
+def normalize_timestamp(timestamp):
+    # Timestamps are stored in file names with millisecond precision
+    return float('%.3f' % timestamp)
+
+
+class Entry(object):
+
+    __slots__ = ('path', 'size', 'timestamp', 'last_used')
+
+    def __init__(self, path, size, timestamp, last_used):
+        self.path, self.size, self.timestamp, self.last_used = path, size, timestamp, last_used
+
+
+def render_thumbnail(db, book_id, width, height):
+    ' Return the cover of the specified book scaled to fit in width x height, as JPEG data, or None if the book has no cover '
+    buf = BytesIO()
+    if db.copy_cover_to(book_id, buf) is False:
+        return
+    quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+    return scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
+
+
+class ThumbnailCache(object):
+
+    ''' A persistent disk cache of resized covers for the Content server. Unlike
+    :class:`calibre.db.utils.ThumbnailCache`, it stores thumbnails of any number
+    of sizes for every book. Entries are keyed by (library uuid, book id,
+    width, height) and are valid only for the cover timestamp they were created
+    with. When the cache grows beyond max_size, the least recently used
+    thumbnails are removed. The usage order is preserved across restarts via
+    the modification times of the cached files.
+
+    Files in the cache are never modified, only replaced, so they can be safely
+    read and served by any number of threads and server processes. '''
+
+    def __init__(self, max_size=200, location=None, log=None):
+        self.location = location or os.path.join(cache_dir(), 'srv-thumbnails')
+        self.max_size = int(max_size * 1024 * 1024)
+        self.lock = Lock()
+        self.items = None
+        self.total_size = 0
+        if log is not None:
+            self.log = log
+
+    def log(self, *args):
+        pass
+
+    def _do_delete(self, path):
+        try:
+            os.remove(path)
+        except EnvironmentError as err:
+            if err.errno != errno.ENOENT:
+                self.log('Failed to delete cached thumbnail file:', as_unicode(err))
+
+    def _path(self, library_uuid, book_id, width, height, timestamp):
+        return os.path.join(self.location, library_uuid, '%d' % (book_id % 100), '%d-%dx%d-%.3f.jpg' % (
+            book_id, width, height, timestamp))
+
+    def _load_index(self):
+        ' Scan the cache directory, building the index in least recently used order '
+        items = []
+
+        def listdir(*args):
+            try:
+                return os.listdir(os.path.join(*args))
+            except EnvironmentError:
+                return ()  # not a directory or no permission or whatever
+
+        for library_uuid in listdir(self.location):
+            for subdir in listdir(self.location, library_uuid):
+                for name in listdir(self.location, library_uuid, subdir):
+                    path = os.path.join(self.location, library_uuid, subdir, name)
+                    try:
+                        book_id, size, timestamp = name.rpartition('.')[0].split('-')
+                        book_id, timestamp = int(book_id), float(timestamp)
+                        width, height = map(int, size.split('x'))
+                        st = os.stat(path)
+                    except (ValueError, TypeError, EnvironmentError):
+                        continue  # a temporary file or removed by another server process
+                    items.append((st.st_mtime, (library_uuid, book_id, width, height), Entry(path, st.st_size, timestamp, st.st_mtime)))
+        items.sort(key=lambda x: x[0])
+        self.items, self.total_size = OrderedDict(), 0
+        for mtime, key, entry in items:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                # A stale thumbnail for a cover that has since changed
+                keep, discard = (previous, entry) if previous.timestamp > entry.timestamp else (entry, previous)
+                self._do_delete(discard.path)
+                self.total_size -= previous.size
+                entry = keep
+            self.items[key] = entry
+            self.total_size += entry.size
+        self._apply_size()
+
+    def _ensure_index(self):
+        if self.items is None:
+            self._load_index()
+
+    def _remove(self, key):
+        entry = self.items.pop(key, None)
+        if entry is not None:
+            self._do_delete(entry.path)
+            self.total_size -= entry.size
+
+    def _apply_size(self):
+        while self.total_size > self.max_size and self.items:
+            entry = self.items.popitem(last=False)[1]
+            self._do_delete(entry.path)
+            self.total_size -= entry.size
+
+    def get(self, library_uuid, book_id, width, height, timestamp):
+        ''' Return an open file containing the cached thumbnail or None if no
+        thumbnail for the specified cover timestamp is cached. '''
+        key, timestamp = (library_uuid, book_id, width, height), normalize_timestamp(timestamp)
+        with self.lock:
+            self._ensure_index()
+            entry = self.items.pop(key, None)
+            if entry is None:
+                return
+            if entry.timestamp != timestamp:
+                self._do_delete(entry.path)
+                self.total_size -= entry.size
+                return
+            self.items[key] = entry
+            now = time.time()
+            touch = now - entry.last_used > TOUCH_INTERVAL
+            if touch:
+                entry.last_used = now
+        try:
+            ans = share_open(entry.path, 'rb')
+        except EnvironmentError as err:
+            if err.errno != errno.ENOENT:  # ENOENT means removed by another server process
+                self.log('Failed to read cached thumbnail:', entry.path, as_unicode(err))
+            with self.lock:
+                if self.items.get(key) is entry:
+                    del self.items[key]
+                    self.total_size -= entry.size
+            return
+        if touch:
+            try:
+                os.utime(entry.path, None)
+            except EnvironmentError:
+                pass
+        return ans
+
+    def insert(self, library_uuid, book_id, width, height, timestamp, data):
+        ''' Store the thumbnail, returning an open file containing it, or None
+        if it could not be stored. '''
+        if len(data) > self.max_size:
+            return
+        key, timestamp = (library_uuid, book_id, width, height), normalize_timestamp(timestamp)
+        path = self._path(library_uuid, book_id, width, height, timestamp)
+        try:
+            try:
+                replace_file(path, lambda f: f.write(data))
+            except EnvironmentError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except EnvironmentError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                replace_file(path, lambda f: f.write(data))
+            ans = share_open(path, 'rb')
+        except EnvironmentError as err:
+            self.log('Failed to write cached thumbnail:', path, as_unicode(err))
+            return
+        with self.lock:
+            self._ensure_index()
+            entry = self.items.pop(key, None)
+            if entry is not None:
+                self.total_size -= entry.size
+                if entry.path != path:
+                    self._do_delete(entry.path)
+            self.items[key] = Entry(path, len(data), timestamp, time.time())
+            self.total_size += len(data)
+            self._apply_size()
+        return ans
+
+    def invalidate(self, library_uuid, book_ids):
+        ' Remove all cached thumbnails for the specified books '
+        book_ids = frozenset(book_ids)
+        with self.lock:
+            self._ensure_index()
+            for key in tuple(self.items):
+                if key[0] == library_uuid and key[1] in book_ids:
+                    self._remove(key)
+
+    def empty(self):
+        with self.lock:
+            self._ensure_index()
+            for entry in self.items.itervalues():
+                self._do_delete(entry.path)
+            self.items, self.total_size = OrderedDict(), 0
+
+    def __len__(self):
+        with self.lock:
+            self._ensure_index()
+            return len(self.items)
+
+    @property
+    def current_size(self):
+        with self.lock:
+            self._ensure_index()
+            return self.total_size
+
+
+def prewarm(cache, db, sizes, jobs=None, report=None):
+    ''' Render and cache thumbnails of all the specified sizes (a list of
+    (width, height) tuples) for every book in db that has a cover, using jobs
+    threads. Thumbnails that are already cached are skipped. Returns the
+    number of thumbnails rendered. '''
+    from multiprocessing.pool import ThreadPool
+    library_uuid = db.library_id
+
+    def render(book_id):
+        mtime = db.cover_last_modified(book_id)
+        if mtime is None:
+            return 0
+        timestamp = timestampfromdt(mtime)
+        num = 0
+        for width, height in sizes:
+            f = cache.get(library_uuid, book_id, width, height, timestamp)
+            if f is None:
+                data = render_thumbnail(db, book_id, width, height)
+                if data is None:
+                    break
+                f = cache.insert(library_uuid, book_id, width, height, timestamp, data)
+                num += 1
+            if f is not None:
+                f.close()
+        return num
+
+    book_ids = sorted(db.all_book_ids())
+    pool = ThreadPool(processes=jobs or detect_ncpus())
+    total = 0
+    try:
+        for i, num in enumerate(pool.imap_unordered(render, book_ids, chunksize=8)):
+            total += num
+            if report is not None:
+                report(i + 1, len(book_ids))
+    finally:
+        pool.terminate()
+    return total
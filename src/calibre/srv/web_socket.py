@@ -475,6 +475,12 @@ class WebSocketConnection(HTTPConnection):
             HTTPConnection.close(self)
     # }}}
 
+    @property
+    def websocket_output_pending(self):
+        ''' True if some messages sent with :meth:`send_websocket_message` have
+        not yet been completely written to the socket. '''
+        return self.sending is not None or not self.sendq.empty()
+
     def send_websocket_message(self, buf, wakeup=True):
         ''' Send a complete message. This class will take care of splitting it
         into appropriate frames automatically. `buf` must be a file like object. '''
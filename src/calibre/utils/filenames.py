@@ -514,6 +514,47 @@ def atomic_rename(oldpath, newpath):
         os.rename(oldpath, newpath)
 
 
+def is_replaced_in_place(st):
+    ''' Return True if :func:`replace_file` would write in place to the
+    existing file whose stat result is st. This is the case on Windows and for
+    files that have other hardlinks or are owned by another user, since
+    replacing them would break the links or change their ownership. '''
+    return iswindows or st.st_nlink > 1 or st.st_uid != os.geteuid()
+
+
+def replace_file(path, write_data, mode='wb'):
+    ''' Write new contents for the file at path by calling write_data() with an
+    open file object, returning whatever it returns. The data is written to a
+    temporary file that is then renamed to path, so that anyone who has the old
+    file open, continues to see its old contents. When that is not possible
+    (see :func:`is_replaced_in_place`) the file is written in place. '''
+    try:
+        st = os.stat(path)
+    except EnvironmentError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        st = None
+    if iswindows or (st is not None and is_replaced_in_place(st)):
+        with lopen(path, mode) as f:
+            return write_data(f)
+    base, fname = os.path.split(path)
+    tpath = os.path.join(base, '.%s.%s.tmp' % (fname, os.urandom(4).encode('hex')))
+    f = os.fdopen(os.open(tpath, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o666), mode)
+    try:
+        if st is not None:
+            os.chmod(tpath, st.st_mode & 0o7777)
+        with f:
+            ans = write_data(f)
+        os.rename(tpath, path)
+    except:
+        try:
+            os.remove(tpath)
+        except EnvironmentError:
+            pass
+        raise
+    return ans
+
+
 def remove_dir_if_empty(path, ignore_metadata_caches=False):
     ''' Remove a directory if it is empty or contains only the folder metadata
     caches from different OSes. To delete the folder if it contains only
@@ -15,7 +15,27 @@ from calibre.constants import DEBUG
 from calibre.utils.formatter_functions import formatter_functions
 
 
+_no_value = object()
+
+
+def constant_node(val, guards=()):
+    def constant(formatter, kwargs, mi, locals, funcs):
+        return val
+    constant.value, constant.guards = val, guards
+    return constant
+
+
 class _Parser(object):
+
+    '''
+    Compiles a lexed template program into a tree of closures, so that a
+    program is parsed only once, no matter how many times it is evaluated.
+    Every node in the tree is called as node(formatter, kwargs, mi, locals,
+    funcs). Calls to pure functions with only constant arguments are evaluated
+    at compile time, guarded against the function having been replaced in the
+    functions used for an evaluation.
+    '''
+
     LEX_OP  = 1
     LEX_ID  = 2
     LEX_STR = 3
@@ -24,19 +44,14 @@ class _Parser(object):
 
     LEX_CONSTANTS = frozenset([LEX_STR, LEX_NUM])
 
-    def __init__(self, val, prog, funcs, parent):
+    def __init__(self, prog):
         self.lex_pos = 0
         self.prog = prog[0]
         self.prog_len = len(self.prog)
         if prog[1] != '':
             self.error(_('failed to scan program. Invalid input {0}').format(prog[1]))
-        self.parent = parent
-        self.parent_kwargs = parent.kwargs
-        self.parent_book = parent.book
-        self.locals = {'$':val}
-        self.funcs = funcs
 
-    def error(self, message):
+    def error_message(self, message):
         m = 'Formatter: ' + message + _(' near ')
         if self.lex_pos > 0:
             m = '{0} {1}'.format(m, self.prog[self.lex_pos-1][1])
@@ -44,7 +59,10 @@ class _Parser(object):
             m = '{0} {1}'.format(m, self.prog[self.lex_pos+1][1])
         else:
             m = '{0} {1}'.format(m, _('end of program'))
-        raise ValueError(m)
+        return m
+
+    def error(self, message):
+        raise ValueError(self.error_message(message))
 
     def token(self):
         if self.lex_pos >= self.prog_len:
@@ -103,21 +121,33 @@ class _Parser(object):
         return token[0] == self.LEX_EOF
 
     def program(self):
-        val = self.statement()
+        node = self.statement()
         if not self.token_is_eof():
             self.error(_('syntax error - program ends before EOF'))
-        return val
+
+        def program(formatter, val):
+            return node(formatter, formatter.kwargs, formatter.book, {'$':val}, formatter.funcs)
+        return program
 
     def statement(self):
+        nodes = []
         while True:
-            val = self.expr()
-            if self.token_is_eof():
-                return val
-            if not self.token_op_is_a_semicolon():
-                return val
+            nodes.append(self.expr())
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                break
             self.consume()
             if self.token_is_eof():
-                return val
+                break
+        if len(nodes) == 1:
+            return nodes[0]
+        if all(getattr(node, 'value', _no_value) is not _no_value for node in nodes):
+            return constant_node(nodes[-1].value, sum((node.guards for node in nodes), ()))
+
+        def statement(formatter, kwargs, mi, locals, funcs):
+            for node in nodes:
+                val = node(formatter, kwargs, mi, locals, funcs)
+            return val
+        return statement
 
     def expr(self):
         if self.token_is_id():
@@ -127,19 +157,22 @@ class _Parser(object):
                 if self.token_op_is_a_equals():
                     # classic assignment statement
                     self.consume()
-                    cls = self.funcs['assign']
-                    return cls.eval_(self.parent, self.parent_kwargs,
-                                    self.parent_book, self.locals, id, self.expr())
-                val = self.locals.get(id, None)
-                if val is None:
-                    self.error(_('Unknown identifier ') + id)
-                return val
-            # We have a function.
-            # Check if it is a known one. We do this here so error reporting is
-            # better, as it can identify the tokens near the problem.
+                    return self.function_call('assign', [constant_node(id), self.expr()],
+                                              None, None)
+                unknown_identifier = self.error_message(_('Unknown identifier ') + id)
+
+                def variable(formatter, kwargs, mi, locals, funcs):
+                    val = locals.get(id, None)
+                    if val is None:
+                        raise ValueError(unknown_identifier)
+                    return val
+                return variable
+            # We have a function. Whether it is a known one can only be checked
+            # when evaluating, as the functions can differ between
+            # evaluations, but the error message is created here so that it
+            # can identify the tokens near the problem.
             id = id.strip()
-            if id not in self.funcs:
-                self.error(_('unknown function {0}').format(id))
+            unknown_function = self.error_message(_('unknown function {0}').format(id))
 
             # Eat the paren
             self.consume()
@@ -151,28 +184,81 @@ class _Parser(object):
                     # the value.
                     if not self.token_is_id():
                         self.error('assign requires the first parameter be an id')
-                    args.append(self.token())
+                    args.append(constant_node(self.token()))
                 else:
-                    # evaluate the argument (recursive call)
+                    # compile the argument (recursive call)
                     args.append(self.statement())
                 if not self.token_op_is_a_comma():
                     break
                 self.consume()
             if self.token() != ')':
                 self.error(_('missing closing parenthesis'))
-
-            # Evaluate the function
-            cls = self.funcs[id]
-            if cls.arg_count != -1 and len(args) != cls.arg_count:
-                self.error('incorrect number of arguments for function {}'.format(id))
-            return cls.eval_(self.parent, self.parent_kwargs,
-                            self.parent_book, self.locals, *args)
+            return self.function_call(id, args, unknown_function, self.error_message(
+                'incorrect number of arguments for function {}'.format(id)))
         elif self.token_is_constant():
             # String or number
-            return self.token()
+            return constant_node(self.token())
         else:
             self.error(_('expression is not function or constant'))
 
+    def function_call(self, name, args, unknown_function, wrong_arg_count):
+        num_args = len(args)
+
+        def call(formatter, kwargs, mi, locals, funcs):
+            cls = funcs.get(name)
+            if cls is None:
+                raise ValueError(unknown_function or name)
+            vals = [arg(formatter, kwargs, mi, locals, funcs) for arg in args]
+            if wrong_arg_count is not None and cls.arg_count != -1 and num_args != cls.arg_count:
+                raise ValueError(wrong_arg_count)
+            return cls.eval_(formatter, kwargs, mi, locals, *vals)
+
+        vals = [getattr(arg, 'value', _no_value) for arg in args]
+        if any(val is _no_value for val in vals):
+            return call
+        cls = formatter_functions().get_builtins_and_aliases().get(name)
+        if cls is None or not cls.is_pure or cls.arg_count not in (-1, num_args):
+            return call
+        try:
+            val = cls.eval_(None, None, None, None, *vals)
+        except Exception:
+            # Report the error when the program is evaluated
+            return call
+        guards = sum((arg.guards for arg in args), ((name, cls),))
+
+        def folded(formatter, kwargs, mi, locals, funcs):
+            for fname, fcls in guards:
+                if funcs.get(fname) is not fcls:
+                    return call(formatter, kwargs, mi, locals, funcs)
+            return val
+        folded.value, folded.guards = val, guards
+        return folded
+
+
+# Compiled template programs, keyed by the text of the program. Templates and
+# format specifications are similarly cached in their parsed form.
+compiled_programs = {}
+parsed_templates = {}
+exploded_format_strings = {}
+MAX_COMPILED_PROGRAMS = 1000
+
+
+def cache_value(cache, key, val):
+    if len(cache) >= MAX_COMPILED_PROGRAMS:
+        cache.clear()
+    cache[key] = val
+
+
+def compile_program(prog):
+    ''' Return a function that evaluates the template program prog, called
+    as func(formatter, val), where val is the value of $. The compiled
+    programs are cached. '''
+    ans = compiled_programs.get(prog)
+    if ans is None:
+        ans = _Parser(TemplateFormatter.lex_scanner.scan(prog)).program()
+        cache_value(compiled_programs, prog, ans)
+    return ans
+
 
 class TemplateFormatter(string.Formatter):
     '''
@@ -216,6 +302,13 @@ class TemplateFormatter(string.Formatter):
         return unicode(('{0:'+fmt+'}').format(val))
 
     def _explode_format_string(self, fmt):
+        ans = exploded_format_strings.get(fmt)
+        if ans is None:
+            ans = self._do_explode_format_string(fmt)
+            cache_value(exploded_format_strings, fmt, ans)
+        return ans
+
+    def _do_explode_format_string(self, fmt):
         try:
             matches = self.format_string_re.match(fmt)
             if matches is None or matches.lastindex != 3:
@@ -250,24 +343,28 @@ class TemplateFormatter(string.Formatter):
         ], flags=re.DOTALL)
 
     def _eval_program(self, val, prog, column_name):
-        # keep a cache of the lex'ed program under the theory that re-lexing
-        # is much more expensive than the cache lookup. This is certainly true
-        # for more than a few tokens, but it isn't clear for simple programs.
+        # The compiled programs are cached by their text. Templates of columns
+        # are also cached by the column name, avoiding hashing the text.
         if column_name is not None and self.template_cache is not None:
-            lprog = self.template_cache.get(column_name, None)
-            if not lprog:
-                lprog = self.lex_scanner.scan(prog)
-                self.template_cache[column_name] = lprog
+            compiled = self.template_cache.get(column_name, None)
+            if compiled is None:
+                compiled = self.template_cache[column_name] = compile_program(prog)
         else:
-            lprog = self.lex_scanner.scan(prog)
-        parser = _Parser(val, lprog, self.funcs, self)
-        return parser.program()
+            compiled = compile_program(prog)
+        return compiled(self, val)
 
     # ################# Override parent classes methods #####################
 
     def get_value(self, key, args, kwargs):
         raise Exception('get_value must be implemented in the subclass')
 
+    def parse(self, format_string):
+        ans = parsed_templates.get(format_string)
+        if ans is None:
+            ans = tuple(string.Formatter.parse(self, format_string))
+            cache_value(parsed_templates, format_string, ans)
+        return ans
+
     def format_field(self, val, fmt):
         # ensure we are dealing with a string.
         if isinstance(val, (int, float)):
@@ -412,3 +509,87 @@ class EvalFormatter(TemplateFormatter):
 
 # DEPRECATED. This is not thread safe. Do not use.
 eval_formatter = EvalFormatter()
+
+
+# Finding what a template refers to {{{
+
+FIELD_FUNCTIONS = frozenset(('field', 'raw_field', 'raw_list'))
+
+
+def template_references(template):
+    '''
+    Return the (fields, functions) referred to by the template, found without
+    evaluating it. fields is None if the template can refer to fields that
+    cannot be known in advance, for example, by calling field() with an
+    argument that is not a constant.
+    '''
+    fields, functions = set(), set()
+    if _template_references(template, fields, functions):
+        fields.discard('')  # The empty field name is used to call functions
+    else:
+        fields = None
+    return fields, functions
+
+
+def _template_references(template, fields, functions):
+    if template.startswith('program:'):
+        return _program_references(template[8:], fields, functions)
+    try:
+        parsed = tuple(string.Formatter().parse(template))
+    except ValueError:
+        return True  # An invalid template always evaluates to an error
+    known = True
+    for literal_text, field_name, fmt, conversion in parsed:
+        if field_name is None:
+            continue
+        fields.add(field_name)
+        if not fmt:
+            continue
+        if '{' in fmt:
+            known &= _template_references(fmt, fields, functions)
+        # Mirror the handling of functions in TemplateFormatter.format_field()
+        m = TemplateFormatter.format_string_re.match(fmt)
+        if m is not None and m.lastindex == 3:
+            fmt = m.group(1)
+        if fmt.startswith('\''):
+            p = 0
+        else:
+            p = fmt.find(':\'')
+            if p >= 0:
+                p += 1
+        if p >= 0 and fmt[-1] == '\'':
+            known &= _program_references(fmt[p+1:-1], fields, functions)
+            continue
+        p = fmt.find('(')
+        if p >= 0 and fmt[-1] == ')':
+            colon = fmt[0:p].find(':')
+            name = fmt[colon+1:p].strip()
+            functions.add(name)
+            if name in FIELD_FUNCTIONS or name == 'template':
+                known = False
+    return known
+
+
+def _program_references(prog, fields, functions):
+    tokens, remainder = TemplateFormatter.lex_scanner.scan(prog)
+    if remainder:
+        return True  # An invalid program always evaluates to an error
+    known = True
+    for i, (typ, val) in enumerate(tokens):
+        if typ != _Parser.LEX_ID or tokens[i+1:i+2] != [(_Parser.LEX_OP, '(')]:
+            continue
+        name = val.strip()
+        functions.add(name)
+        if name in FIELD_FUNCTIONS or name == 'template':
+            arg = tokens[i+2:i+4]
+            if (len(arg) == 2 and arg[0][0] in _Parser.LEX_CONSTANTS and
+                    arg[1][0] == _Parser.LEX_OP and arg[1][1] in ',)'):
+                if name == 'template':
+                    known &= _template_references(
+                        arg[0][1].replace('[[', '{').replace(']]', '}'), fields, functions)
+                else:
+                    fields.add(arg[0][1])
+            else:
+                known = False
+    return known
+# }}}
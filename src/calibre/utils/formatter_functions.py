@@ -125,6 +125,9 @@ class FormatterFunction(object):
     category = 'Unknown'
     arg_count = 0
     aliases = []
+    # True if the result depends only on the arguments, so that calls with
+    # constant arguments can be evaluated when a template is compiled
+    is_pure = False
 
     def evaluate(self, formatter, kwargs, mi, locals, *args):
         raise NotImplementedError()
@@ -155,6 +158,7 @@ class BuiltinFormatterFunction(FormatterFunction):
 class BuiltinStrcmp(BuiltinFormatterFunction):
     name = 'strcmp'
     arg_count = 5
+    is_pure = True
     category = 'Relational'
     __doc__ = doc = _('strcmp(x, y, lt, eq, gt) -- does a case-insensitive comparison of x '
             'and y as strings. Returns lt if x < y. Returns eq if x == y. '
@@ -173,6 +177,7 @@ class BuiltinCmp(BuiltinFormatterFunction):
     name = 'cmp'
     category = 'Relational'
     arg_count = 5
+    is_pure = True
     __doc__ = doc =   _('cmp(x, y, lt, eq, gt) -- compares x and y after converting both to '
             'numbers. Returns lt if x < y. Returns eq if x == y. Otherwise returns gt.')
 
@@ -190,6 +195,7 @@ class BuiltinFirstMatchingCmp(BuiltinFormatterFunction):
     name = 'first_matching_cmp'
     category = 'Relational'
     arg_count = -1
+    is_pure = True
     __doc__ = doc =   _('first_matching_cmp(val, cmp1, result1, cmp2, r2, ..., else_result) -- '
             'compares "val < cmpN" in sequence, returning resultN for '
             'the first comparison that succeeds. Returns else_result '
@@ -211,6 +217,7 @@ class BuiltinFirstMatchingCmp(BuiltinFormatterFunction):
 class BuiltinStrcat(BuiltinFormatterFunction):
     name = 'strcat'
     arg_count = -1
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('strcat(a, b, ...) -- can take any number of arguments. Returns a '
             'string formed by concatenating all the arguments')
@@ -226,6 +233,7 @@ class BuiltinStrcat(BuiltinFormatterFunction):
 class BuiltinStrlen(BuiltinFormatterFunction):
     name = 'strlen'
     arg_count = 1
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('strlen(a) -- Returns the length of the string passed as '
             'the argument')
@@ -240,6 +248,7 @@ class BuiltinStrlen(BuiltinFormatterFunction):
 class BuiltinAdd(BuiltinFormatterFunction):
     name = 'add'
     arg_count = 2
+    is_pure = True
     category = 'Arithmetic'
     __doc__ = doc = _('add(x, y) -- returns x + y. Throws an exception if either x or y are not numbers.')
 
@@ -252,6 +261,7 @@ class BuiltinAdd(BuiltinFormatterFunction):
 class BuiltinSubtract(BuiltinFormatterFunction):
     name = 'subtract'
     arg_count = 2
+    is_pure = True
     category = 'Arithmetic'
     __doc__ = doc = _('subtract(x, y) -- returns x - y. Throws an exception if either x or y are not numbers.')
 
@@ -264,6 +274,7 @@ class BuiltinSubtract(BuiltinFormatterFunction):
 class BuiltinMultiply(BuiltinFormatterFunction):
     name = 'multiply'
     arg_count = 2
+    is_pure = True
     category = 'Arithmetic'
     __doc__ = doc = _('multiply(x, y) -- returns x * y. Throws an exception if either x or y are not numbers.')
 
@@ -276,6 +287,7 @@ class BuiltinMultiply(BuiltinFormatterFunction):
 class BuiltinDivide(BuiltinFormatterFunction):
     name = 'divide'
     arg_count = 2
+    is_pure = True
     category = 'Arithmetic'
     __doc__ = doc = _('divide(x, y) -- returns x / y. Throws an exception if either x or y are not numbers.')
 
@@ -395,6 +407,7 @@ class BuiltinRawList(BuiltinFormatterFunction):
 class BuiltinSubstr(BuiltinFormatterFunction):
     name = 'substr'
     arg_count = 3
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('substr(str, start, end) -- returns the start\'th through the end\'th '
             'characters of str. The first character in str is the zero\'th '
@@ -439,6 +452,7 @@ class BuiltinLookup(BuiltinFormatterFunction):
 class BuiltinTest(BuiltinFormatterFunction):
     name = 'test'
     arg_count = 3
+    is_pure = True
     category = 'If-then-else'
     __doc__ = doc = _('test(val, text if not empty, text if empty) -- return `text if not '
             'empty` if val is not empty, otherwise return `text if empty`')
@@ -453,6 +467,7 @@ class BuiltinTest(BuiltinFormatterFunction):
 class BuiltinContains(BuiltinFormatterFunction):
     name = 'contains'
     arg_count = 4
+    is_pure = True
     category = 'If-then-else'
     __doc__ = doc = _('contains(val, pattern, text if match, text if not match) -- checks '
             'if val contains matches for the regular expression `pattern`. '
@@ -470,6 +485,7 @@ class BuiltinContains(BuiltinFormatterFunction):
 class BuiltinSwitch(BuiltinFormatterFunction):
     name = 'switch'
     arg_count = -1
+    is_pure = True
     category = 'Iterating over values'
     __doc__ = doc = _('switch(val, pattern, value, pattern, value, ..., else_value) -- '
             'for each `pattern, value` pair, checks if `val` matches '
@@ -492,6 +508,7 @@ class BuiltinSwitch(BuiltinFormatterFunction):
 class BuiltinStrcatMax(BuiltinFormatterFunction):
     name = 'strcat_max'
     arg_count = -1
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('strcat_max(max, string1, prefix2, string2, ...) -- '
             'Returns a string formed by concatenating the arguments. The '
@@ -527,6 +544,7 @@ class BuiltinStrcatMax(BuiltinFormatterFunction):
 class BuiltinInList(BuiltinFormatterFunction):
     name = 'in_list'
     arg_count = -1
+    is_pure = True
     category = 'List lookup'
     __doc__ = doc = _('in_list(val, separator, pattern, found_val, ..., not_found_val) -- '
             'treat val as a list of items separated by separator, '
@@ -557,6 +575,7 @@ class BuiltinInList(BuiltinFormatterFunction):
 class BuiltinStrInList(BuiltinFormatterFunction):
     name = 'str_in_list'
     arg_count = -1
+    is_pure = True
     category = 'List lookup'
     __doc__ = doc = _('str_in_list(val, separator, string, found_val, ..., not_found_val) -- '
             'treat val as a list of items separated by separator, '
@@ -590,6 +609,7 @@ class BuiltinStrInList(BuiltinFormatterFunction):
 class BuiltinIdentifierInList(BuiltinFormatterFunction):
     name = 'identifier_in_list'
     arg_count = 4
+    is_pure = True
     category = 'List lookup'
     __doc__ = doc = _('identifier_in_list(val, id, found_val, not_found_val) -- '
             'treat val as a list of identifiers separated by commas, '
@@ -617,6 +637,7 @@ class BuiltinIdentifierInList(BuiltinFormatterFunction):
 class BuiltinRe(BuiltinFormatterFunction):
     name = 're'
     arg_count = 3
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('re(val, pattern, replacement) -- return val after applying '
             'the regular expression. All instances of `pattern` are replaced '
@@ -665,6 +686,7 @@ class BuiltinReGroup(BuiltinFormatterFunction):
 class BuiltinSwapAroundComma(BuiltinFormatterFunction):
     name = 'swap_around_comma'
     arg_count = 1
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('swap_around_comma(val) -- given a value of the form '
             '"B, A", return "A B". This is most useful for converting names '
@@ -678,6 +700,7 @@ class BuiltinSwapAroundComma(BuiltinFormatterFunction):
 class BuiltinIfempty(BuiltinFormatterFunction):
     name = 'ifempty'
     arg_count = 2
+    is_pure = True
     category = 'If-then-else'
     __doc__ = doc = _('ifempty(val, text if empty) -- return val if val is not empty, '
             'otherwise return `text if empty`')
@@ -692,6 +715,7 @@ class BuiltinIfempty(BuiltinFormatterFunction):
 class BuiltinShorten(BuiltinFormatterFunction):
     name = 'shorten'
     arg_count = 4
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('shorten(val, left chars, middle text, right chars) -- Return a '
             'shortened version of val, consisting of `left chars` '
@@ -719,6 +743,7 @@ class BuiltinShorten(BuiltinFormatterFunction):
 class BuiltinCount(BuiltinFormatterFunction):
     name = 'count'
     arg_count = 2
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('count(val, separator) -- interprets the value as a list of items '
             'separated by `separator`, returning the number of items in the '
@@ -732,6 +757,7 @@ class BuiltinCount(BuiltinFormatterFunction):
 class BuiltinListitem(BuiltinFormatterFunction):
     name = 'list_item'
     arg_count = 3
+    is_pure = True
     category = 'List lookup'
     __doc__ = doc = _('list_item(val, index, separator) -- interpret the value as a list of '
             'items separated by `separator`, returning the `index`th item. '
@@ -754,6 +780,7 @@ class BuiltinListitem(BuiltinFormatterFunction):
 class BuiltinSelect(BuiltinFormatterFunction):
     name = 'select'
     arg_count = 2
+    is_pure = True
     category = 'List lookup'
     __doc__ = doc = _('select(val, key) -- interpret the value as a comma-separated list '
             'of items, with the items being "id:value". Find the pair with the '
@@ -864,6 +891,7 @@ class BuiltinFormatsPaths(BuiltinFormatterFunction):
 class BuiltinHumanReadable(BuiltinFormatterFunction):
     name = 'human_readable'
     arg_count = 1
+    is_pure = True
     category = 'Formatting values'
     __doc__ = doc = _('human_readable(v) -- return a string '
                       'representing the number v in KB, MB, GB, etc.'
@@ -879,6 +907,7 @@ class BuiltinHumanReadable(BuiltinFormatterFunction):
 class BuiltinFormatNumber(BuiltinFormatterFunction):
     name = 'format_number'
     arg_count = 2
+    is_pure = True
     category = 'Formatting values'
     __doc__ = doc = _('format_number(v, template) -- format the number v using '
                   'a Python formatting template such as "{0:5.2f}" or '
@@ -915,6 +944,7 @@ class BuiltinFormatNumber(BuiltinFormatterFunction):
 class BuiltinSublist(BuiltinFormatterFunction):
     name = 'sublist'
     arg_count = 4
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('sublist(val, start_index, end_index, separator) -- interpret the '
             'value as a list of items separated by `separator`, returning a '
@@ -951,6 +981,7 @@ class BuiltinSublist(BuiltinFormatterFunction):
 class BuiltinSubitems(BuiltinFormatterFunction):
     name = 'subitems'
     arg_count = 3
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('subitems(val, start_index, end_index) -- This function is used to '
             'break apart lists of items such as genres. It interprets the value '
@@ -1034,6 +1065,7 @@ class BuiltinFormatDate(BuiltinFormatterFunction):
 class BuiltinUppercase(BuiltinFormatterFunction):
     name = 'uppercase'
     arg_count = 1
+    is_pure = True
     category = 'String case changes'
     __doc__ = doc = _('uppercase(val) -- return val in upper case')
 
@@ -1044,6 +1076,7 @@ class BuiltinUppercase(BuiltinFormatterFunction):
 class BuiltinLowercase(BuiltinFormatterFunction):
     name = 'lowercase'
     arg_count = 1
+    is_pure = True
     category = 'String case changes'
     __doc__ = doc = _('lowercase(val) -- return val in lower case')
 
@@ -1054,6 +1087,7 @@ class BuiltinLowercase(BuiltinFormatterFunction):
 class BuiltinTitlecase(BuiltinFormatterFunction):
     name = 'titlecase'
     arg_count = 1
+    is_pure = True
     category = 'String case changes'
     __doc__ = doc = _('titlecase(val) -- return val in title case')
 
@@ -1064,6 +1098,7 @@ class BuiltinTitlecase(BuiltinFormatterFunction):
 class BuiltinCapitalize(BuiltinFormatterFunction):
     name = 'capitalize'
     arg_count = 1
+    is_pure = True
     category = 'String case changes'
     __doc__ = doc = _('capitalize(val) -- return val capitalized')
 
@@ -1142,6 +1177,7 @@ class BuiltinHasCover(BuiltinFormatterFunction):
 class BuiltinFirstNonEmpty(BuiltinFormatterFunction):
     name = 'first_non_empty'
     arg_count = -1
+    is_pure = True
     category = 'Iterating over values'
     __doc__ = doc = _('first_non_empty(value, value, ...) -- '
             'returns the first value that is not empty. If all values are '
@@ -1160,6 +1196,7 @@ class BuiltinFirstNonEmpty(BuiltinFormatterFunction):
 class BuiltinAnd(BuiltinFormatterFunction):
     name = 'and'
     arg_count = -1
+    is_pure = True
     category = 'Boolean'
     __doc__ = doc = _('and(value, value, ...) -- '
             'returns the string "1" if all values are not empty, otherwise '
@@ -1178,6 +1215,7 @@ class BuiltinAnd(BuiltinFormatterFunction):
 class BuiltinOr(BuiltinFormatterFunction):
     name = 'or'
     arg_count = -1
+    is_pure = True
     category = 'Boolean'
     __doc__ = doc = _('or(value, value, ...) -- '
             'returns the string "1" if any value is not empty, otherwise '
@@ -1196,6 +1234,7 @@ class BuiltinOr(BuiltinFormatterFunction):
 class BuiltinNot(BuiltinFormatterFunction):
     name = 'not'
     arg_count = 1
+    is_pure = True
     category = 'Boolean'
     __doc__ = doc = _('not(value) -- '
             'returns the string "1" if the value is empty, otherwise '
@@ -1209,6 +1248,7 @@ class BuiltinNot(BuiltinFormatterFunction):
 class BuiltinListUnion(BuiltinFormatterFunction):
     name = 'list_union'
     arg_count = 3
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('list_union(list1, list2, separator) -- '
             'return a list made by merging the items in list1 and list2, '
@@ -1234,6 +1274,7 @@ class BuiltinListUnion(BuiltinFormatterFunction):
 class BuiltinListDifference(BuiltinFormatterFunction):
     name = 'list_difference'
     arg_count = 3
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('list_difference(list1, list2, separator) -- '
             'return a list made by removing from list1 any item found in list2, '
@@ -1256,6 +1297,7 @@ class BuiltinListDifference(BuiltinFormatterFunction):
 class BuiltinListIntersection(BuiltinFormatterFunction):
     name = 'list_intersection'
     arg_count = 3
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('list_intersection(list1, list2, separator) -- '
             'return a list made by removing from list1 any item not found in list2, '
@@ -1278,6 +1320,7 @@ class BuiltinListIntersection(BuiltinFormatterFunction):
 class BuiltinListSort(BuiltinFormatterFunction):
     name = 'list_sort'
     arg_count = 3
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('list_sort(list, direction, separator) -- '
             'return list sorted using a case-insensitive sort. If direction is '
@@ -1294,6 +1337,7 @@ class BuiltinListSort(BuiltinFormatterFunction):
 class BuiltinListEquals(BuiltinFormatterFunction):
     name = 'list_equals'
     arg_count = 6
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('list_equals(list1, sep1, list2, sep2, yes_val, no_val) -- '
             'return yes_val if list1 and list2 contain the same items, '
@@ -1313,6 +1357,7 @@ class BuiltinListEquals(BuiltinFormatterFunction):
 class BuiltinListRe(BuiltinFormatterFunction):
     name = 'list_re'
     arg_count = 4
+    is_pure = True
     category = 'List manipulation'
     __doc__ = doc = _('list_re(src_list, separator, include_re, opt_replace) -- '
             'Construct a list by first separating src_list into items using '
@@ -1542,6 +1587,7 @@ class BuiltinUserCategories(BuiltinFormatterFunction):
 class BuiltinTransliterate(BuiltinFormatterFunction):
     name = 'transliterate'
     arg_count = 1
+    is_pure = True
     category = 'String manipulation'
     __doc__ = doc = _('transliterate(a) -- Returns a string in a latin alphabet '
                       'formed by approximating the sound of the words in the '
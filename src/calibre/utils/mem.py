@@ -24,6 +24,18 @@ def get_memory():
     return psutil.Process(os.getpid()).memory_info().rss
 
 
+def get_peak_memory():
+    'Return the peak memory usage of this process in bytes'
+    from calibre.constants import iswindows, isosx
+    if iswindows:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().peak_wset
+    import resource
+    ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    return ans if isosx else ans * 1024
+
+
 def memory(since=0.0):
     'Return memory used in MB. The value of since is subtracted from the used memory'
     ans = get_memory()
@@ -13,8 +13,8 @@ from itertools import chain
 
 from lxml import etree
 
-from css_selectors.errors import ExpressionError
-from css_selectors.parser import parse, ascii_lower, Element
+from css_selectors.errors import ExpressionError, SelectorError
+from css_selectors.parser import parse, ascii_lower, Element, CombinedSelector, Hash, Class, Pseudo
 from css_selectors.ordered_set import OrderedSet
 
 PARSE_CACHE_SIZE = 200
@@ -78,6 +78,10 @@ def normalize_language_tag(tag):
             taglist.add('-'.join(base_tag + tags))
     return taglist
 
+def key_priority(key, order={'id': 0, 'class': 1, 'tag': 2}):
+    ' Used to prefer more specific keys, see Select.tag_keys() '
+    return order[key[0]]
+
 INAPPROPRIATE_PSEUDO_CLASSES = frozenset([
     'active', 'after', 'disabled', 'visited', 'link', 'before', 'focus', 'first-letter', 'enabled', 'first-line', 'hover', 'checked', 'target'])
 
@@ -115,6 +119,10 @@ class Select(object):
     the same selector object for finding the matching nodes for multiple
     queries. Of course, remember not to change the tree in between queries.
 
+    When you need to match all the rules of one or more stylesheets, use
+    :meth:`match_rules` instead, which tests every tag only against the
+    rules that could possibly match it.
+
     '''
 
     combinator_mapping = {
@@ -134,11 +142,13 @@ class Select(object):
         '*=': 'substringmatch',
     }
 
-    def __init__(self, root, default_lang=None, ignore_inappropriate_pseudo_classes=False, dispatch_map=None, trace=False):
+    def __init__(self, root, default_lang=None, ignore_inappropriate_pseudo_classes=False, dispatch_map=None, trace=False, match_map=None):
         if hasattr(root, 'getroot'):
             root = root.getroot()
         self.root = root
         self.dispatch_map = dispatch_map or default_dispatch_map
+        self.match_map = match_map or default_match_map
+        self.match_funcs = {}
         self.invalidate_caches()
         self.default_lang = default_lang
         if trace:
@@ -157,11 +167,12 @@ class Select(object):
         self._attrib_map = None
         self._attrib_space_map = None
         self._lang_map = None
-        self.map_tag_name = ascii_lower
+        self._lang_sets = {}
+        self.map_tag_name = self.map_attrib_name = ascii_lower
         if '{' in self.root.tag:
             def map_tag_name(x):
                 return ascii_lower(x.rpartition('}')[2])
-            self.map_tag_name = map_tag_name
+            self.map_tag_name = self.map_attrib_name = map_tag_name
 
     def __call__(self, selector, root=None):
         ''' Return an iterator over all matching tags, in document order.
@@ -169,10 +180,16 @@ class Select(object):
         specify root, then only tags that are root or descendants of root are
         returned. Note that this can be very expensive if root has a lot of
         descendants. '''
+        for item in self.select_parsed(get_parsed_selector(selector), root=root):
+            yield item
+
+    def select_parsed(self, parsed_selectors, root=None):
+        ''' Same as calling this object, except that the selector has already
+        been parsed, with :func:`css_selectors.parse`. '''
         seen = set()
         if root is not None:
             root = frozenset(self.itertag(root))
-        for selector in get_parsed_selector(selector):
+        for selector in parsed_selectors:
             parsed_selector = selector.parsed_tree
             for item in self.iterparsedselector(parsed_selector):
                 if item not in seen and (root is None or item in root):
@@ -184,6 +201,196 @@ class Select(object):
         for elem in self(selector, root=root):
             return True
         return False
+
+    def match_rules(self, rules, on_error=None):
+        '''
+        Match many rules against the tree at once, which is much faster than
+        selecting the tags for each rule separately. rules must be a sequence
+        of (selector, data) pairs, where selector is either the text of a
+        selector or the result of :func:`css_selectors.parse`. The rules are
+        grouped by the id, class or tag name in the rightmost part of their
+        selectors and the tree is walked once, testing every tag only against
+        the rules that could match it. Rules that need ancestors with some
+        id, class or tag name are skipped for tags that have no such ancestors.
+
+        Returns a list of (tag, datas) in document order, for every tag matched
+        by at least one rule, where datas is the list of the data of the rules
+        that match the tag, in the order the rules were given. So pass in the
+        rules sorted by specificity, to get the matching rules of every tag in
+        specificity order.
+
+        Invalid selectors cause :class:`SelectorError` to be raised. If
+        on_error is specified, on_error(selector, data, error) is called
+        instead and the rule is ignored.
+        '''
+        # Maps rightmost keys to maps of the most specific ancestor key a
+        # selector requires to the selectors
+        buckets = defaultdict(lambda : defaultdict(list))
+        selectors, bad = [], set()
+        for i, (selector, data) in enumerate(rules):
+            try:
+                parsed_selectors = get_parsed_selector(selector) if isinstance(selector, basestring) else selector
+            except SelectorError as err:
+                if on_error is None:
+                    raise
+                on_error(selector, data, err)
+                bad.add(i)
+                continue
+            for parsed_selector in parsed_selectors:
+                tree = parsed_selector.parsed_tree
+                required = self.ancestor_keys(tree)
+                akey = min(required, key=key_priority) if required else None
+                buckets[self.rightmost_key(tree)][akey].append(len(selectors))
+                selectors.append((i, tree, required))
+        buckets = dict(buckets)
+
+        ans = []
+        ancestors = {}
+        for elem, keys in self.iterkeyedtags(ancestors):
+            candidates = []
+            for key in [None] + keys:
+                bucket = buckets.get(key)
+                if bucket is None:
+                    continue
+                candidates.extend(bucket.get(None, ()))
+                if len(bucket) > len(ancestors):
+                    for akey in ancestors:
+                        candidates.extend(bucket.get(akey, ()))
+                else:
+                    for akey, indices in bucket.iteritems():
+                        if akey in ancestors:
+                            candidates.extend(indices)
+            if not candidates:
+                continue
+            candidates.sort()
+            matched = []
+            for x in candidates:
+                i, tree, required = selectors[x]
+                if i in bad or (matched and matched[-1] == i):
+                    continue
+                if required:
+                    for key in required:
+                        if key not in ancestors:
+                            break
+                    else:
+                        required = None
+                    if required is not None:
+                        continue
+                try:
+                    if self.matches(tree, elem):
+                        matched.append(i)
+                except SelectorError as err:
+                    if on_error is None:
+                        raise
+                    bad.add(i)
+                    on_error(rules[i][0], rules[i][1], err)
+            if matched:
+                ans.append((elem, matched))
+
+        if bad:
+            ans = [(tag, [r for r in indices if r not in bad]) for tag, indices in ans]
+        return [(tag, [rules[r][1] for r in indices]) for tag, indices in ans if indices]
+
+    def matches(self, parsed_selector, elem):
+        'Return True iff the tag elem is matched by parsed_selector'
+        try:
+            func = self.match_funcs[type(parsed_selector)]
+        except KeyError:
+            type_name = type(parsed_selector).__name__
+            try:
+                func = self.match_funcs[type(parsed_selector)] = self.match_map[ascii_lower(type_name)]
+            except KeyError:
+                raise ExpressionError('%s is not supported' % type_name)
+        return func(self, parsed_selector, elem)
+
+    def tag_keys(self, elem):
+        ''' Return the tag name, id and classes of elem as (type, lowercased
+        value) tuples. '''
+        lower = ascii_lower
+        ans = [('tag', self.map_tag_name(elem.tag))]
+        eid = elem.get('id')
+        if eid is not None:
+            ans.append(('id', lower(eid)))
+        classes = elem.get('class')
+        if classes:
+            ans.extend(('class', cls) for cls in frozenset(lower(cls) for cls in classes.split()))
+        return ans
+
+    def iterkeyedtags(self, ancestors):
+        ''' Iterate over all tags in document order, yielding (tag, keys),
+        where keys is :meth:`tag_keys` for the tag. While a tag is being
+        yielded, ancestors maps the keys of its ancestors to the number of
+        ancestors having them. '''
+        iterators, keys_stack = [iter((self.root,))], []
+        while iterators:
+            for elem in iterators[-1]:
+                keys = self.tag_keys(elem)
+                yield elem, keys
+                for key in keys:
+                    ancestors[key] = ancestors.get(key, 0) + 1
+                keys_stack.append(keys)
+                iterators.append(self.iterchildren(elem))
+                break
+            else:
+                iterators.pop()
+                if keys_stack:
+                    for key in keys_stack.pop():
+                        ancestors[key] -= 1
+                        if not ancestors[key]:
+                            del ancestors[key]
+
+    def compound_keys(self, parsed_selector, first=False):
+        ''' Return the keys (see :meth:`tag_keys`) that a tag must have to be
+        matched by the simple selectors in parsed_selector, that are not part
+        of a combined selector. If first is True, return only the most
+        specific of these keys, preferring ids to classes to tag names. '''
+        ans = []
+        while parsed_selector is not None:
+            if isinstance(parsed_selector, Hash):
+                ans.append(('id', ascii_lower(parsed_selector.id)))
+            elif isinstance(parsed_selector, Class):
+                ans.append(('class', ascii_lower(parsed_selector.class_name)))
+            elif isinstance(parsed_selector, Element):
+                if parsed_selector.element and parsed_selector.element != '*':
+                    ans.append(('tag', ascii_lower(parsed_selector.element)))
+                break
+            elif isinstance(parsed_selector, Pseudo) and parsed_selector.ident == 'root' and 'root' not in self.dispatch_map:
+                # :root matches the root tag, whatever else the selector says
+                return None if first else []
+            elif isinstance(parsed_selector, CombinedSelector):
+                break
+            parsed_selector = getattr(parsed_selector, 'selector', None)
+        if first:
+            return min(ans, key=key_priority) if ans else None
+        return ans
+
+    def rightmost_key(self, parsed_selector):
+        ''' Return the most specific key (see :meth:`tag_keys`) that a tag must
+        have to be matched by parsed_selector, or None if there is none. '''
+        if isinstance(parsed_selector, CombinedSelector):
+            parsed_selector = parsed_selector.subselector
+        return self.compound_keys(parsed_selector, first=True)
+
+    def ancestor_keys(self, parsed_selector):
+        ''' Return the keys (see :meth:`tag_keys`) that ancestors of a tag
+        must have for it to be matched by parsed_selector. '''
+        ans = set()
+        while isinstance(parsed_selector, CombinedSelector):
+            left = parsed_selector.selector
+            if parsed_selector.combinator in ' >':
+                # Everything that is an ancestor of the left side is also an
+                # ancestor of the tag, whatever the combinators to the right
+                ans.update(self.compound_keys(left.subselector if isinstance(left, CombinedSelector) else left))
+            parsed_selector = left
+        return tuple(ans)
+
+    def lang_tags(self, function):
+        key = tuple(token.value for token in function.arguments)
+        try:
+            return self._lang_sets[key]
+        except KeyError:
+            ans = self._lang_sets[key] = frozenset(self.dispatch_map['lang'](self, function))
+            return ans
     # }}}
 
     def iterparsedselector(self, parsed_selector):
@@ -226,10 +433,7 @@ class Select(object):
     def attrib_map(self):
         if self._attrib_map is None:
             self._attrib_map = am = defaultdict(lambda : defaultdict(OrderedSet))
-            map_attrib_name = ascii_lower
-            if '{' in self.root.tag:
-                def map_attrib_name(x):
-                    return ascii_lower(x.rpartition('}')[2])
+            map_attrib_name = self.map_attrib_name
             for tag in self.itertag():
                 for attr, val in tag.attrib.iteritems():
                     am[map_attrib_name(attr)][val].add(tag)
@@ -239,10 +443,7 @@ class Select(object):
     def attrib_space_map(self):
         if self._attrib_space_map is None:
             self._attrib_space_map = am = defaultdict(lambda : defaultdict(OrderedSet))
-            map_attrib_name = ascii_lower
-            if '{' in self.root.tag:
-                def map_attrib_name(x):
-                    return ascii_lower(x.rpartition('}')[2])
+            map_attrib_name = self.map_attrib_name
             for tag in self.itertag():
                 for attr, val in tag.attrib.iteritems():
                     for v in val.split():
@@ -278,6 +479,12 @@ class Select(object):
     def iterchildren(self, tag=None):
         return (self.root if tag is None else tag).iterchildren('*')
 
+    def iterancestors(self, tag):
+        return tag.iterancestors('*')
+
+    def getparent(self, tag):
+        return tag.getparent()
+
     def itersiblings(self, tag=None, preceding=False):
         return (self.root if tag is None else tag).itersiblings('*', preceding=preceding)
 
@@ -613,6 +820,110 @@ select_empty.is_pseudo = True
 
 default_dispatch_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('select_') and callable(obj)}
 
+# Matching a single tag {{{
+# Used by Select.match_rules(). Rather than finding all the tags matched by a
+# selector, these test whether a given tag is matched by it, from right to left.
+
+def match_combinedselector(cache, combined, elem):
+    if not cache.matches(combined.subselector, elem):
+        return False
+    combinator = cache.combinator_mapping[combined.combinator]
+    return cache.match_map[combinator](cache, combined.selector, elem)
+
+def match_descendant(cache, left, elem):
+    for ancestor in cache.iterancestors(elem):
+        if cache.matches(left, ancestor):
+            return True
+    return False
+
+def match_child(cache, left, elem):
+    parent = cache.getparent(elem)
+    return parent is not None and cache.matches(left, parent)
+
+def match_direct_adjacent(cache, left, elem):
+    for sibling in cache.itersiblings(elem, preceding=True):
+        return cache.matches(left, sibling)
+    return False
+
+def match_indirect_adjacent(cache, left, elem):
+    for sibling in cache.itersiblings(elem, preceding=True):
+        if cache.matches(left, sibling):
+            return True
+    return False
+
+def match_element(cache, selector, elem):
+    element = selector.element
+    return not element or element == '*' or cache.map_tag_name(elem.tag) == ascii_lower(element)
+
+def match_hash(cache, selector, elem):
+    eid = elem.get('id')
+    return eid is not None and ascii_lower(eid) == ascii_lower(selector.id) and cache.matches(selector.selector, elem)
+
+def match_class(cache, selector, elem):
+    classes = elem.get('class')
+    if not classes:
+        return False
+    name = ascii_lower(selector.class_name)
+    for cls in classes.split():
+        if ascii_lower(cls) == name:
+            return cache.matches(selector.selector, elem)
+    return False
+
+def match_negation(cache, selector, elem):
+    return cache.matches(selector.selector, elem) and not cache.matches(selector.subselector, elem)
+
+attribute_value_tests = {
+    'exists': lambda val, value: True,
+    'equals': lambda val, value: val == value,
+    'includes': lambda val, value: is_non_whitespace(value) and value in val.split(),
+    'dashmatch': lambda val, value: value and (val == value or val.startswith(value + '-')),
+    'prefixmatch': lambda val, value: value and val.startswith(value),
+    'suffixmatch': lambda val, value: value and val.endswith(value),
+    'substringmatch': lambda val, value: value and value in val,
+}
+
+def match_attrib(cache, selector, elem):
+    name, value = ascii_lower(selector.attrib), selector.value
+    test = attribute_value_tests[cache.attribute_operator_mapping[selector.operator]]
+    map_attrib_name = cache.map_attrib_name
+    for attr, val in elem.attrib.iteritems():
+        if map_attrib_name(attr) == name and test(val, value):
+            return cache.matches(selector.selector, elem)
+    return False
+
+def match_function(cache, function, elem):
+    fname = function.name.replace('-', '_')
+    try:
+        func = cache.dispatch_map[fname]
+    except KeyError:
+        raise ExpressionError(
+            "The pseudo-class :%s() is unknown" % function.name)
+    if fname == 'lang':
+        return elem in cache.lang_tags(function) and cache.matches(function.selector, elem)
+    return cache.matches(function.selector, elem) and func(cache, function, elem)
+
+def match_pseudo(cache, pseudo, elem):
+    try:
+        func = cache.dispatch_map[pseudo.ident.replace('-', '_')]
+    except KeyError:
+        if pseudo.ident == 'root':
+            return elem is cache.root
+        if pseudo.ident in cache.ignore_inappropriate_pseudo_classes:
+            return cache.matches(pseudo.selector, elem)
+        raise ExpressionError(
+            "The pseudo-class :%s is not supported" % pseudo.ident)
+
+    try:
+        func.is_pseudo
+    except AttributeError:
+        raise ExpressionError(
+            "The pseudo-class :%s is invalid" % pseudo.ident)
+    return cache.matches(pseudo.selector, elem) and func(cache, elem)
+
+# }}}
+
+default_match_map = {name.partition('_')[2]:obj for name, obj in globals().items() if name.startswith('match_') and callable(obj)}
+
 if __name__ == '__main__':
     from pprint import pprint
     root = etree.fromstring('<body xmlns="xxx" xml:lang="en"><p id="p" class="one two" lang="fr"><a id="a"/><b/><c/><d/></p></body>')
@@ -648,8 +648,10 @@ by William Shakespeare
     def test_select(self):  # {{{
         document = etree.fromstring(self.HTML_IDS)
         select = Select(document)
+        selectors = []
 
         def select_ids(selector):
+            selectors.append(selector)
             for elem in select(selector):
                 yield elem.get('id')
 
@@ -738,14 +740,37 @@ by William Shakespeare
         self.ae(pcss(r'[h\a0 ref]', r'[h\]ref]'), [])
 
         self.assertRaises(ExpressionError, lambda : tuple(select('body:nth-child')))
+        self.check_match_rules(select, selectors + [
+            'div li + li', 'ol > li ~ li.c', 'div ol li div', '#outer-div li > div', 'ol.c li:nth-child(2) + li', 'div :root li'])
+        self.assertRaises(ExpressionError, lambda : select.match_rules([('body:nth-child', None)]))
+        errors = []
+        self.ae(select.match_rules([('body:nth-child', 1), ('body', 2)], on_error=lambda *a: errors.append(a[1])), [(document[1], [2])])
+        self.ae(errors, [1])
 
         select = Select(document, ignore_inappropriate_pseudo_classes=True)
         self.assertGreater(len(tuple(select('p:hover'))), 0)
+        self.check_match_rules(select, ['p:hover', 'a:hover:first-child'])
+
+    def check_match_rules(self, select, selectors):
+        # match_rules() must match the same tags as selecting each rule separately
+        order = {elem:i for i, elem in enumerate(select.itertag())}
+        expected = {i:sorted(select(s), key=order.__getitem__) for i, s in enumerate(selectors)}
+        actual = {i:[] for i in expected}
+        for elem, indices in select.match_rules([(s, i) for i, s in enumerate(selectors)]):
+            self.ae(indices, sorted(indices))
+            for i in indices:
+                actual[i].append(elem)
+        for i, s in enumerate(selectors):
+            self.ae(actual[i], expected[i], 'match_rules() failed for: %r' % s)
 
     def test_select_shakespeare(self):
         document = html.document_fromstring(self.HTML_SHAKESPEARE)
         select = Select(document)
-        count = lambda s: sum(1 for r in select(s))
+        selectors = []
+
+        def count(s):
+            selectors.append(s)
+            return sum(1 for r in select(s))
 
         # Data borrowed from http://mootools.net/slickspeed/
 
@@ -794,6 +819,7 @@ by William Shakespeare
         assert count('div[class*=sce]') == 1
         assert count('div[class|=dialog]') == 50  # ? Seems right
         assert count('div[class~=dialog]') == 51  # ? Seems right
+        self.check_match_rules(select, selectors)
 
     # }}}
 